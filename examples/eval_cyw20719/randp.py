@@ -146,25 +146,22 @@ if not internalblue.writeMem(address=ASM_LOCATION_RNG, data=code, progress_log=N
     internalblue.logger.critical("error!")
     exit(-1)
 
-# Disable original RNG
-patch = asm("bx lr; bx lr", vma=FUN_RNG)  # 2 times bx lr is 4 bytes and we can only patch 4 bytes
-if not internalblue.patchRom(FUN_RNG, patch):
-    internalblue.logger.critical("Could not disable original RNG!")
-    exit(-1)
-
-# CYW20719 Launch_RAM fix: overwrite an unused HCI handler
-# The Launch_RAM handler is broken so we can just overwrite it to call the function we need.
-# The handler table entry for it is at 0x1AB218, and it points to launch_RAM+1.
-# Located by looking for bthci_cmd_vs_HandleLaunch_RAM+1 in the dump.
-if not internalblue.patchRom(0x1AB218, p32(ASM_LOCATION_RNG + 1)):  # function table entries are sub+1
-    internalblue.logger.critical("Could not implement our launch RAM fix!")
-    exit(-1)
-
-# Disable functions that crash us when using the target memory region
-# here: bcs_taskDeactivate_blocking - similar behavior as in CYW20819
-patch = asm("bx lr; bx lr", vma=0xD2DEC)  # 2 times bx lr is 4 bytes and we can only patch 4 bytes
-if not internalblue.patchRom(0xD2DEC, patch):
-    internalblue.logger.critical("Could not disable original bcs_taskDeactivate_blocking!")
+patches = [
+    # Disable original RNG
+    (FUN_RNG, asm("bx lr; bx lr", vma=FUN_RNG)),  # 2 times bx lr is 4 bytes and we can only patch 4 bytes
+
+    # CYW20719 Launch_RAM fix: overwrite an unused HCI handler
+    # The Launch_RAM handler is broken so we can just overwrite it to call the function we need.
+    # The handler table entry for it is at 0x1AB218, and it points to launch_RAM+1.
+    # Located by looking for bthci_cmd_vs_HandleLaunch_RAM+1 in the dump.
+    (0x1AB218, p32(ASM_LOCATION_RNG + 1)),  # function table entries are sub+1
+
+    # Disable functions that crash us when using the target memory region
+    # here: bcs_taskDeactivate_blocking - similar behavior as in CYW20819
+    (0xD2DEC, asm("bx lr; bx lr", vma=0xD2DEC)),
+]
+if not internalblue.applyPatches(patches):
+    internalblue.logger.critical("Could not install RNG hooks!")
     exit(-1)
 
 internalblue.logger.info("Installed all RNG hooks.")
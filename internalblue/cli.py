@@ -49,9 +49,19 @@ from cmd2 import fg, style
 
 from . import Address
 from .hci import HCI_COMND
+from .hci_events import CommandComplete
+from .coverage import CoverageCollector
+from .diag_decoder import DiagDecoder, DiagFilter, pdu_name
+from .heap_monitor import HeapMonitor
+from .inquiry import InquirySweep
+from .le_scanner import LeScanner
+from .lmp_fuzzer import LmpCorpus, LmpFuzzer, LmpMutator
+from .objects.patch_manifest import PatchManifest
+from .objects.tracepoint import CaptureRange, TracepointCondition
 from .utils import bytes_to_hex, flat, yesno
 from .utils.packing import p8, p16, p32, u32
 from .utils.progress_logger import ProgressLogger
+from .utils.tracepoint_log import TracepointHit
 from .utils.internalblue_logger import getInternalBlueLogger
 from .hcicore import HCICore
 from .adbcore import ADBCore
@@ -129,6 +139,24 @@ class InternalBlueCLI(cmd2.Cmd):
         # create progress logger
         self.progress_log = None
 
+        # running CoverageCollector, see do_coverage()
+        self.coverage = None
+
+        # HeapMonitor with the snapshot history, see do_monitorheap()
+        self.heap_monitor = None
+
+        # LmpCorpus of the last fuzzing campaign, see do_lmpfuzz()
+        self.lmp_corpus = None
+
+        # DiagDecoder for the LMP/LCP diagnostic frames, see do_diagmonitor()
+        self.diag_decoder = None
+
+        # LeScanner with the device table of the last LE scan, see do_lescan()
+        self.le_scanner = None
+
+        # InquirySweep with the device table of the inquiries, see do_inquiry()
+        self.inquiry_sweep = None
+
         # set prompt
         self.prompt = '> '
 
@@ -164,6 +192,7 @@ class InternalBlueCLI(cmd2.Cmd):
             'execute': 'exec',
             'show': 'info',
             'tp': 'tracepoint',
+            'cp': 'countpoint',
             'bp': 'breakpoint',
             'heap': 'memorypool', 'pool': 'memorypool',
             'leconnect': 'connectle', 'cle': 'connectle', 'lec': 'connectle',
@@ -443,10 +472,10 @@ class InternalBlueCLI(cmd2.Cmd):
             address, length, progress_log, bytes_done, bytes_total
         )
 
-    def writeMem(self, address, data, progress_log=None, bytes_done=0, bytes_total=0):
-        # type: (Address, bytes, Optional[Any], int, int) -> bool
+    def writeMem(self, address, data, progress_log=None, bytes_done=0, bytes_total=0, persistent=False):
+        # type: (Address, bytes, Optional[Any], int, int, bool) -> bool
         return self.internalblue.writeMem(
-            address, data, progress_log, bytes_done, bytes_total
+            address, data, progress_log, bytes_done, bytes_total, persistent
         )
 
     def initMemoryImage(self):
@@ -1016,7 +1045,7 @@ class InternalBlueCLI(cmd2.Cmd):
 
         self.progress_log = self.progress("Writing Memory")
         if self.writeMem(
-                args.address, data, self.progress_log, bytes_done=0, bytes_total=len(data)
+                args.address, data, self.progress_log, bytes_done=0, bytes_total=len(data), persistent=True
         ):
             self.progress_log.success(
                 "Written %d bytes to 0x%08x." % (len(data), args.address)
@@ -1086,7 +1115,7 @@ class InternalBlueCLI(cmd2.Cmd):
 
         self.progress_log = self.progress("Writing Memory")
         if self.writeMem(
-                args.address, data, self.progress_log, bytes_done=0, bytes_total=len(data)
+                args.address, data, self.progress_log, bytes_done=0, bytes_total=len(data), persistent=True
         ):
             self.progress_log.success(
                 "Written %d bytes to 0x%08x." % (len(data), args.address)
@@ -1267,6 +1296,60 @@ class InternalBlueCLI(cmd2.Cmd):
 
         return self.internalblue.patchRom(args.address, data, args.slot)
 
+    manifest_parser = argparse.ArgumentParser()
+    manifest_parser.add_argument('command',
+                                 help='One of: save (writemem/writeasm data and patches of the session), apply/load, verify, show')
+    manifest_parser.add_argument('file', help='Filename of the patch set manifest')
+    manifest_parser.add_argument('-f', '--force', action='store_true',
+                                 help='Apply the manifest even if it is already applied.')
+
+    @cmd2.with_argparser(manifest_parser)
+    def do_manifest(self, args):
+        """Save, apply and verify patch set manifests (RAM blobs and patchram entries)."""
+        if args.command == "save":
+            manifest = self.internalblue.createPatchManifest()
+            if os.path.exists(args.file):
+                if not yesno("Update '%s'?" % args.file):
+                    return False
+            manifest.save(args.file)
+            self.logger.info(
+                "Saved %d RAM blobs and %d patches to %s (digest %s)"
+                % (len(manifest.coalesced_ram_blobs()), len(manifest.patches), args.file, manifest.digest()[:16])
+            )
+            return
+
+        if not os.path.exists(args.file):
+            self.logger.warning("File %s does not exist." % args.file)
+            return False
+        try:
+            manifest = PatchManifest.load(args.file)
+        except (ValueError, KeyError) as e:
+            self.logger.warning("Could not load manifest %s: %s" % (args.file, e))
+            return False
+
+        if args.command in ["apply", "load"]:
+            if not self.internalblue.applyPatchManifest(manifest, args.force):
+                return False
+
+        elif args.command == "verify":
+            if self.internalblue.isPatchManifestApplied(manifest):
+                self.logger.info("Manifest %s is applied." % manifest.digest()[:16])
+            else:
+                self.logger.info("Manifest %s is NOT applied." % manifest.digest()[:16])
+
+        elif args.command == "show":
+            lines = ["Manifest %s for %s (LMP subversion 0x%x):"
+                     % (manifest.digest()[:16], manifest.fw_name, manifest.lmp_subversion or 0)]
+            for address, data in manifest.coalesced_ram_blobs():
+                lines.append("  RAM   0x%08x: %d bytes" % (address, len(data)))
+            for address, value in manifest.patches:
+                lines.append("  PATCH 0x%08x: %s" % (address, bytes_to_hex(value)))
+            self.logger.info("\n".join(lines))
+
+        else:
+            self.logger.warning("Unknown command: %s" % args.command)
+            return False
+
     sendlmp_parser = argparse.ArgumentParser()
     sendlmp_parser.add_argument('-c', '--conn_handle', type=auto_int,
                                 help='Handle of the connection associated with the other device, default is '
@@ -1283,22 +1366,12 @@ class InternalBlueCLI(cmd2.Cmd):
         # initially assume we are master
         is_master = True
 
-        # automatically get the first valid connection handle if not set
-        if args.conn_handle is None:
-            if hasattr(self.internalblue.fw, "CONNECTION_MAX"):
-                for i in range(self.internalblue.fw.CONNECTION_MAX):
-                    connection = self.internalblue.readConnectionInformation(
-                        cast("ConnectionNumber", i + 1)
-                    )
-                    if connection is None:
-                        continue
-                    if (
-                            connection.connection_handle != 0
-                            and connection.remote_address != b"\x00\x00\x00\x00\x00\x00"
-                    ):
-                        args.conn_handle = connection.connection_handle
-                        is_master = connection.master_of_connection
-                        break
+        # automatically get the first valid connection handle if not set, and our role in the connection
+        connections = self.internalblue.connection_tracker.current("ACL", args.conn_handle)
+        if connections:
+            args.conn_handle = connections[0].handle
+            if connections[0].is_master is not None:
+                is_master = connections[0].is_master
 
         # if still not set, typical connection handles seem to be 0x0b...0x0d
         if args.conn_handle is None:
@@ -1330,6 +1403,61 @@ class InternalBlueCLI(cmd2.Cmd):
         firmware constraint is the buffer allocated by lm_allocLmpBlock (32 bytes)."""
         return None if self.internalblue.fuzzLmp() else False
 
+    lmpfuzz_parser = argparse.ArgumentParser()
+    lmpfuzz_parser.add_argument('-c', '--conn_handle', type=auto_int,
+                                help='Handle of the connection, default is the first ACL connection or 0x0C.')
+    lmpfuzz_parser.add_argument('--slave', action='store_true', help='Send as slave (default is auto detection)')
+    lmpfuzz_parser.add_argument('-n', '--count', type=int, help='Number of packets, default runs until a key is pressed')
+    lmpfuzz_parser.add_argument('-t', '--time', type=float, help='Duration of the campaign in seconds')
+    lmpfuzz_parser.add_argument('-w', '--window', type=int, default=4,
+                                help='Number of commands in flight (default: %(default)s)')
+    lmpfuzz_parser.add_argument('--timeout', type=float, default=2.0,
+                                help='Seconds without response until the chip is considered crashed (default: %(default)s)')
+    lmpfuzz_parser.add_argument('-d', '--directory', help='Directory for the corpus and the crashes')
+    lmpfuzz_parser.add_argument('-s', '--seed', type=int, help='Seed of the mutation engine')
+    lmpfuzz_parser.add_argument('--no-patch', action='store_true',
+                                help='Do not install the fuzzlmp patch (the firmware checks opcodes and lengths)')
+
+    @cmd2.with_argparser(lmpfuzz_parser)
+    def do_lmpfuzz(self, args):
+        """Fuzz a connection with mutated LMP packets, reports packets per second, stops at the first crash."""
+        is_master = not args.slave
+        connections = self.internalblue.connection_tracker.current("ACL", args.conn_handle)
+        if args.conn_handle is None:
+            args.conn_handle = connections[0].handle if connections else 0x0C
+        if connections and connections[0].is_master is not None and not args.slave:
+            is_master = connections[0].is_master
+
+        if not args.no_patch and not self.internalblue.fuzzLmp():
+            return False
+
+        if self.lmp_corpus is None or args.directory is not None:
+            self.lmp_corpus = LmpCorpus(args.directory)
+        fuzzer = LmpFuzzer(self.internalblue, args.conn_handle, is_master, self.lmp_corpus,
+                           LmpMutator(seed=args.seed), window=args.window, timeout=args.timeout)
+
+        def stop():
+            # Check for keypresses by user:
+            if select.select([sys.stdin], [], [], 0)[0]:
+                sys.stdin.readline()
+                self.logger.info("LMP fuzzing stopped by user!")
+                return True
+            return False
+
+        def status(f):
+            self.logger.info("%d packets sent, %.1f pkts/s, %d accepted, %d rejected, corpus: %d"
+                             % (f.sent, f.rate(), f.accepted, f.rejected, len(f.corpus.cases)))
+
+        self.logger.info("Fuzzing connection handle 0x%04x as %s (press Enter to stop)..."
+                         % (args.conn_handle, "master" if is_master else "slave"))
+        crash = fuzzer.run(args.count, args.time, stop if args.count is None and args.time is None else None, status)
+        status(fuzzer)
+        if crash is not None:
+            self.logger.warning("Chip crashed (%s, %s, %s), last packets:\n%s" % (
+                crash.kind, "pc 0x%08x" % crash.pc if crash.pc is not None else "no pc",
+                "new" if crash.new else "known", "\n".join("  " + repr(case) for case in crash.cases)))
+            return False
+
     sendlcp_parser = argparse.ArgumentParser()
     sendlcp_parser.add_argument('-c', '--conn_index', type=auto_int, help='Connection index, starts at 0 for first connection.')
     sendlcp_parser.add_argument('data', help='Payload as hexstring.')
@@ -1365,6 +1493,7 @@ class InternalBlueCLI(cmd2.Cmd):
                           Optional argument: BLOC index or address for more details.
                           Optional argument: verbose Show verbose information
             queue:        List of QUEU structures (Blocking Queues).
+                          Optional argument: verbose Dump the queued items
             '''
                              )
     info_parser.add_argument('args', nargs='*', help='Optional arguments for each type.')
@@ -1378,10 +1507,11 @@ class InternalBlueCLI(cmd2.Cmd):
                 self.logger.warning("CONNECTION_MAX not defined in fw.")
                 return False
 
-            for i in range(self.internalblue.fw.CONNECTION_MAX):
-                connection = self.internalblue.readConnectionInformation(
-                    cast("ConnectionNumber", i + 1)
-                )
+            connections = self.internalblue.readAllConnections()
+            if connections is None:
+                return False
+
+            for i, connection in enumerate(connections):
                 if connection is None:
                     continue
 
@@ -1486,7 +1616,10 @@ class InternalBlueCLI(cmd2.Cmd):
                     return False
 
             progress_log = self.progress("Traversing Heap")
-            heaplist = self.internalblue.readHeapInformation()  # List of BLOC structs
+            # List of BLOC structs, with the buffer contents if they are dumped below
+            heaplist = self.internalblue.readHeapInformation(
+                include_memory=bloc_address is not None or bloc_index is not None
+            )
 
             if not heaplist:
                 self.logger.debug("No heap returned!")
@@ -1555,7 +1688,8 @@ class InternalBlueCLI(cmd2.Cmd):
                 )
                 # Buffer in use!
                 if buffer_hdr == bloc_for_details["address"]:
-                    buf = self.internalblue.readMem(buffer_address, buffer_size)
+                    offset = buffer_address - bloc_for_details["memory"]
+                    buf = bloc_for_details["memory_dump"][offset:offset + buffer_size]
                     self.logger.info(
                         "dumping buffer 0x%06X from BLOC[%d]:"
                         % (buffer_address + 4, bloc_for_details["index"])
@@ -1565,9 +1699,11 @@ class InternalBlueCLI(cmd2.Cmd):
             progress_log.success("done")
             return None
 
-        def infoQueue(_):
+        def infoQueue(info_args):
+            verbose = "verbose" in info_args
             progress_log = self.progress("Traversing Queues")
-            queuelist = self.internalblue.readQueueInformation()  # List of QUEU structs
+            # List of QUEU structs, with the queued items in verbose mode
+            queuelist = self.internalblue.readQueueInformation(include_items=verbose)
 
             if queuelist is None:
                 self.logger.debug("No queues returned!")
@@ -1580,7 +1716,7 @@ class InternalBlueCLI(cmd2.Cmd):
             self.logger.info(
                 "--------------------------------------------------------------------------------"
             )
-            for queue in [vars(element) for element in queuelist]:
+            for queue in [element.to_dict() for element in queuelist]:
                 # TODO: waitlist
                 self.logger.info(
                     (
@@ -1589,15 +1725,16 @@ class InternalBlueCLI(cmd2.Cmd):
                     ).format(**queue)
                 )
 
-            # TODO: output all queued items
-            # if "-v" in args:
-            #    print
-            #    for queue in queuelist:
-            #        if len(queue["items"]) > 0:
-            #            self.logger.info("QUEUE[{index}] @ 0x{address:06X}:  {name:10s}  ({available_items:d} items)\n"
-            #                     "---------------------------------------------------------------------------")
-            #            for item in queue["items"]:
-            #                self.hexdump(item, begin=0x0)
+            if verbose:
+                for queue in queuelist:
+                    if len(queue.items) > 0:
+                        self.logger.info(
+                            ("\nQUEUE[{index}] @ 0x{address:06X}:  {name:10s}  ({available_items:d} items)\n"
+                             "---------------------------------------------------------------------------"
+                             ).format(**queue.to_dict())
+                        )
+                        for item in queue.items:
+                            self.hexdump(item, begin=0x0)
 
             progress_log.success("done")
             return None
@@ -1621,8 +1758,18 @@ class InternalBlueCLI(cmd2.Cmd):
             return False
 
     tracepoint_parser = argparse.ArgumentParser()
-    tracepoint_parser.add_argument('command', help='One of: add/set, remove/delete/del, list/show')
+    tracepoint_parser.add_argument('command', help='One of: add/set, remove/delete/del, list/show, hits')
     tracepoint_parser.add_argument('address', type=auto_int, nargs='?', help='Address of the tracepoint')
+    tracepoint_parser.add_argument('-c', '--capture', action='append', metavar='RANGE',
+                                   help='Only send this memory range instead of the whole RAM: '
+                                        '<address>:<length> or sp+<offset>:<length> (can be repeated)')
+    tracepoint_parser.add_argument('--registers-only', action='store_true',
+                                   help='Do not send any memory, only the registers')
+    tracepoint_parser.add_argument('-i', '--if', dest='conditions', action='append', metavar='CONDITION',
+                                   help='Only report hits for which the condition holds (checked on the chip), '
+                                        'e.g. r0==0x5, u8[r1+4]!=0, [0x200000]>=2 or hits==10 (can be repeated)')
+    tracepoint_parser.add_argument('-r', '--register',
+                                   help='hits: Show how often each value of this register was seen')
 
     @cmd2.with_argparser(tracepoint_parser)
     def do_tracepoint(self, args):
@@ -1631,8 +1778,16 @@ class InternalBlueCLI(cmd2.Cmd):
             if args.address is None:
                 self.logger.warning("Missing address. Use tracepoint add <address>")
                 return False
+            capture = None
+            try:
+                if args.capture or args.registers_only:
+                    capture = [CaptureRange.parse(spec) for spec in args.capture or []]
+                conditions = [TracepointCondition.parse(spec) for spec in args.conditions or []]
+            except ValueError as e:
+                self.logger.warning(str(e))
+                return False
             self.logger.info("Inserting tracepoint at 0x%x..." % args.address)
-            if self.internalblue.addTracepoint(args.address):
+            if self.internalblue.addTracepoint(args.address, capture, conditions):
                 self.logger.info("Tracing instruction at address 0x%x." % args.address)
             else:
                 return False
@@ -1651,10 +1806,198 @@ class InternalBlueCLI(cmd2.Cmd):
                 self.logger.info("No active tracepoints.")
             else:
                 tracepoints = "\n".join(
-                    ["  - 0x%x" % tp[0] for tp in self.internalblue.tracepoints]
+                    [
+                        "  - 0x%x (slot %d)" % (tp.address, tp.patchram_slot)
+                        + ("" if tp.capture is None else ", capture: %s" % tp.capture)
+                        + ("" if not tp.conditions else ", if: %s" % " && ".join(map(repr, tp.conditions)))
+                        for tp in self.internalblue.tracepoints
+                    ]
                 )
                 self.logger.info("Active Tracepoints:\n" + tracepoints)
 
+        elif args.command == "hits":
+            log = self.internalblue.getTracepointLog()
+            if len(log) == 0:
+                self.logger.info("No tracepoint hits logged.")
+                return
+            if args.register is not None:
+                if args.register not in TracepointHit.REGISTER_NAMES:
+                    self.logger.warning("Unknown register: %s" % args.register)
+                    return False
+                histogram = log.register_histogram(args.register, args.address)
+                self.logger.info("Values of %s:\n" % args.register + "\n".join(
+                    ["  0x%08x: %d" % (value, count)
+                     for value, count in sorted(histogram.items(), key=lambda item: -item[1])]
+                ))
+            else:
+                self.logger.info("Hits in %s:\n" % log.data_filename + "\n".join(
+                    ["  0x%x: %d" % (pc, count) for pc, count in sorted(log.hit_counts().items())]
+                ))
+
+    countpoint_parser = argparse.ArgumentParser()
+    countpoint_parser.add_argument('command', help='One of: add/set, remove/delete/del, list/show, sample')
+    countpoint_parser.add_argument('address', type=auto_int, nargs='*', help='Address(es) of the countpoint(s)')
+    countpoint_parser.add_argument('-i', '--interval', type=float, default=1.0,
+                                   help='sample: Seconds between two readouts (default: %(default)s)')
+    countpoint_parser.add_argument('-n', '--count', type=int, default=0,
+                                   help='sample: Number of readouts, 0 samples until a key is pressed (default: %(default)s)')
+
+    @cmd2.with_argparser(countpoint_parser)
+    def do_countpoint(self, args):
+        """Manage countpoints (hit counters without HCI events) and sample their rates."""
+        if args.command in ["add", "set"]:
+            if len(args.address) == 0:
+                self.logger.warning("Missing address. Use countpoint add <address> [<address> ...]")
+                return False
+            for address in args.address:
+                if not self.internalblue.addCountpoint(address):
+                    return False
+                self.logger.info("Counting hits at address 0x%x." % address)
+
+        elif args.command in ["remove", "delete", "del"]:
+            if len(args.address) == 0:
+                self.logger.warning("Missing address. Use countpoint del <address> [<address> ...]")
+                return False
+            for address in args.address:
+                if not self.internalblue.deleteCountpoint(address):
+                    return False
+                self.logger.info("Deleted countpoint at address 0x%x" % address)
+
+        elif args.command in ["list", "show"]:
+            if len(self.internalblue.countpoints) == 0:
+                self.logger.info("No active countpoints.")
+                return
+            counts = self.internalblue.readCountpoints()
+            if counts is None:
+                return False
+            self.logger.info("Active Countpoints:\n" + "\n".join(
+                ["  - 0x%x: %d hits (slot %d)" % (cp.address, counts[cp.address], cp.patchram_slot)
+                 for cp in self.internalblue.countpoints]
+            ))
+
+        elif args.command == "sample":
+            if len(self.internalblue.countpoints) == 0:
+                self.logger.info("No active countpoints.")
+                return
+            previous = self.internalblue.sampleCountpoints()
+            if previous is None:
+                return False
+            samples = 0
+            while args.count == 0 or samples < args.count:
+                # Check for keypresses by user:
+                if select.select([sys.stdin], [], [], args.interval)[0]:
+                    sys.stdin.readline()
+                    self.logger.info("Sampling aborted by user!")
+                    return
+                sample = self.internalblue.sampleCountpoints()
+                if sample is None:
+                    return False
+                rates = sample.rates(previous)
+                self.logger.info("Countpoint rates:\n" + "\n".join(
+                    ["  0x%08x: %10d hits %12.1f/s" % (address, sample.counts[address], rates.get(address, 0.0))
+                     for address in sorted(sample.counts)]
+                ))
+                previous = sample
+                samples += 1
+
+        else:
+            self.logger.warning("Unknown command: %s" % args.command)
+            return False
+
+    coverage_parser = argparse.ArgumentParser()
+    coverage_parser.add_argument('command', help='One of: start, rotate/step, run, status, export, stop')
+    coverage_parser.add_argument('file', nargs='?',
+                                 help='start: File with one block address (and optionally its size) per line. '
+                                      'export: Output file (drcov format)')
+    coverage_parser.add_argument('-s', '--slots', type=int, default=None,
+                                 help='start: Maximum number of patchram slots to use (default: all free slots)')
+    coverage_parser.add_argument('-i', '--interval', type=float, default=1.0,
+                                 help='run: Seconds between two rotations (default: %(default)s)')
+    coverage_parser.add_argument('-n', '--count', type=int, default=0,
+                                 help='run: Number of rotations, 0 runs until a key is pressed or all blocks are covered (default: %(default)s)')
+
+    @cmd2.with_argparser(coverage_parser)
+    def do_coverage(self, args):
+        """Collect basic block coverage of the ROM with rotating one-shot patchram hooks."""
+        if args.command == "start":
+            if self.coverage is not None and self.coverage.running:
+                self.logger.warning("Coverage collection is already running. Use coverage stop first.")
+                return False
+            if args.file is None:
+                self.logger.warning("Missing block file. Use coverage start <file>")
+                return False
+            blocks = []
+            try:
+                with open(args.file) as f:
+                    for line in f:
+                        fields = line.split("#")[0].split()
+                        if len(fields) == 1:
+                            blocks.append(int(fields[0], 16))
+                        elif len(fields) >= 2:
+                            blocks.append((int(fields[0], 16), int(fields[1], 0)))
+            except (IOError, ValueError) as e:
+                self.logger.warning("Cannot read block file: %s" % e)
+                return False
+            self.coverage = CoverageCollector(self.internalblue, blocks, max_slots=args.slots)
+            if self.coverage.invalid:
+                self.logger.warning("Ignoring %d odd block addresses" % len(self.coverage.invalid))
+            if not self.coverage.start():
+                return False
+            return
+
+        if self.coverage is None:
+            self.logger.warning("No coverage collection. Use coverage start <file> first.")
+            return False
+
+        if args.command in ["rotate", "step"]:
+            hits = self.coverage.rotate()
+            if hits is None:
+                return False
+            self.logger.info("%d new blocks, %d covered, %d pending" % (
+                len(hits), len(self.coverage.covered), self.coverage.pending()))
+
+        elif args.command == "run":
+            rounds = 0
+            while (args.count == 0 or rounds < args.count) and self.coverage.pending() > 0:
+                # Check for keypresses by user:
+                if select.select([sys.stdin], [], [], args.interval)[0]:
+                    sys.stdin.readline()
+                    self.logger.info("Coverage collection paused by user!")
+                    return
+                hits = self.coverage.rotate()
+                if hits is None:
+                    return False
+                rounds += 1
+                self.logger.info("Round %d: %d new blocks, %d covered, %d pending" % (
+                    self.coverage.rounds, len(hits), len(self.coverage.covered), self.coverage.pending()))
+
+        elif args.command in ["status", "info"]:
+            self.logger.info("Coverage: %d of %d blocks covered after %d rounds, %d armed, %d pending%s" % (
+                len(self.coverage.covered), len(self.coverage.block_sizes), self.coverage.rounds,
+                len(self.coverage.armed), self.coverage.pending(),
+                "" if self.coverage.running else " (stopped)"))
+
+        elif args.command == "export":
+            if args.file is None:
+                self.logger.warning("Missing output file. Use coverage export <file.drcov>")
+                return False
+            self.coverage.write_drcov(args.file)
+            self.logger.info("Wrote %d blocks to %s" % (len(self.coverage.covered), args.file))
+
+        elif args.command == "stop":
+            if not self.coverage.running:
+                self.logger.info("Coverage collection is not running.")
+                return
+            hits = self.coverage.stop()
+            if hits is None:
+                return False
+            self.logger.info("Stopped coverage collection: %d of %d blocks covered." % (
+                len(self.coverage.covered), len(self.coverage.block_sizes)))
+
+        else:
+            self.logger.warning("Unknown command: %s" % args.command)
+            return False
+
     breakpoint_parser = argparse.ArgumentParser()
     breakpoint_parser.add_argument('address', type=auto_int, help='Address of the breakpoint')
 
@@ -1664,10 +2007,129 @@ class InternalBlueCLI(cmd2.Cmd):
         self.logger.info("Inserting breakpoint at 0x%x..." % args.address)
         self.internalblue.patchRom(args.address, b'\x00\xbe\x00\x00')  # on ARM, hex code for a break point is 0xBE00
 
-    def do_memorypool(self, _):
-        """Enable memory pool statistics."""
-        self.logger.info("Memory statistics will now appear every second.")
-        self.internalblue.sendHciCommand(HCI_COMND.VSC_DBFW, b'\x50')
+    memorypool_parser = argparse.ArgumentParser()
+    memorypool_parser.add_argument('command', nargs='?', default='enable',
+                                   help='One of: enable (default), status, alert, alerts, export, clear')
+    memorypool_parser.add_argument('args', nargs='*',
+                                   help='alert: [<pool>] <allocated|free|low> <op> <threshold>, e.g. "RFCM free lt 2" (lt, le, gt, ge, eq). '
+                                        'export: <file.csv>')
+
+    @cmd2.with_argparser(memorypool_parser)
+    def do_memorypool(self, args):
+        """Enable memory pool statistics and inspect their time series."""
+        statistics = self.internalblue.memory_pool_statistics
+        if args.command == "enable":
+            self.logger.info("Memory statistics will now appear every second.")
+            self.internalblue.sendHciCommand(HCI_COMND.VSC_DBFW, b'\x50')
+
+        elif args.command in ["status", "show"]:
+            if len(statistics.pools) == 0:
+                self.logger.info("No memory pool statistics received yet. Use memorypool enable.")
+                return
+            self.logger.info("  Name  Samples  Alloc / Cnt   Free  Low   Min Free  Max Alloc")
+            self.logger.info("  ------------------------------------------------------------")
+            for name in sorted(statistics.pools):
+                series = statistics.pools[name]
+                latest = series.latest()
+                self.logger.info("  %-4s  %7d  %5d / %-5d %5d  %3d   %8d  %9d" % (
+                    name, len(series), latest["allocated"], series.block_count, latest["free"], latest["low"],
+                    min(series.column("free")), max(series.column("allocated"))))
+
+        elif args.command == "alert":
+            if len(args.args) not in (3, 4):
+                self.logger.warning("Use memorypool alert [<pool>] <allocated|free|low> <op> <threshold>")
+                return False
+            pool = args.args[0] if len(args.args) == 4 else None
+            field, op, threshold = args.args[-3:]
+            try:
+                alert = statistics.add_alert(pool, field, op, auto_int(threshold))
+            except ValueError as e:
+                self.logger.warning(str(e))
+                return False
+            self.logger.info("Added memory pool alert: %s" % alert)
+
+        elif args.command == "alerts":
+            self.logger.info("Memory pool alerts:\n" + "\n".join(["  - %s" % alert for alert in statistics.alerts]))
+            for timestamp, name, alert, sample in statistics.fired:
+                self.logger.info("  %s: %s %s=%d (%s)" % (
+                    time.strftime("%H:%M:%S", time.localtime(timestamp)), name, alert.field, sample[alert.field], alert))
+
+        elif args.command == "export":
+            if len(args.args) != 1:
+                self.logger.warning("Use memorypool export <file.csv>")
+                return False
+            statistics.write_csv(args.args[0])
+            self.logger.info("Wrote memory pool statistics to %s" % args.args[0])
+
+        elif args.command == "clear":
+            statistics.clear()
+            self.logger.info("Memory pool statistics cleared.")
+
+        else:
+            self.logger.warning("Unknown command: %s" % args.command)
+            return False
+
+    monitorheap_parser = argparse.ArgumentParser()
+    monitorheap_parser.add_argument('command', nargs='?', default='run', help='One of: run (default), report, reset')
+    monitorheap_parser.add_argument('-i', '--interval', type=float, default=1.0,
+                                    help='Seconds between two snapshots (default: %(default)s)')
+    monitorheap_parser.add_argument('-n', '--count', type=int, default=0,
+                                    help='Number of snapshots, 0 runs until a key is pressed (default: %(default)s)')
+    monitorheap_parser.add_argument('-l', '--leak', type=int, default=10,
+                                    help='Report buffers allocated in this many consecutive snapshots (default: %(default)s)')
+    monitorheap_parser.add_argument('-e', '--exhaustion', type=float, default=600.0,
+                                    help='Warn about pools which run out of buffers within this many seconds (default: %(default)s)')
+
+    @cmd2.with_argparser(monitorheap_parser)
+    def do_monitorheap(self, args):
+        """Snapshot the BLOC pools periodically and report allocation deltas, leak candidates and exhaustion trends."""
+        if self.heap_monitor is None or args.command == "reset":
+            self.heap_monitor = HeapMonitor(self.internalblue)
+            if args.command == "reset":
+                self.logger.info("Heap monitor history cleared.")
+                return
+
+        if args.command == "run":
+            if self.heap_monitor.snapshot() is None:
+                return False
+            snapshots = 0
+            while args.count == 0 or snapshots < args.count:
+                # Check for keypresses by user:
+                if select.select([sys.stdin], [], [], args.interval)[0]:
+                    sys.stdin.readline()
+                    self.logger.info("Heap monitor stopped by user!")
+                    break
+                if self.heap_monitor.snapshot() is None:
+                    return False
+                changes = ["BLOC @ 0x%06X: %+d" % (address, delta)
+                           for address, delta in sorted(self.heap_monitor.deltas().items()) if delta != 0]
+                if changes:
+                    self.logger.info("Heap changes: " + ", ".join(changes))
+                for address, exhaustion in self.heap_monitor.exhausting(args.exhaustion).items():
+                    self.logger.warning("BLOC @ 0x%06X will be exhausted in about %d seconds" % (address, exhaustion))
+                snapshots += 1
+
+        elif args.command != "report":
+            self.logger.warning("Unknown command: %s" % args.command)
+            return False
+
+        if len(self.heap_monitor.snapshots) == 0:
+            self.logger.info("No heap snapshots yet.")
+            return
+        latest = self.heap_monitor.snapshots[-1]
+        trends = self.heap_monitor.trends()
+        self.logger.info("Heap report over %d snapshots:" % len(self.heap_monitor.snapshots))
+        self.logger.info("  @Pool-Addr  Used/Capacity  Buffers/s  Exhausted in")
+        for address, pool in sorted(latest.pools.items()):
+            slope, exhaustion = trends.get(address, (0.0, None))
+            self.logger.info("  0x%06X    %4d / %4d    %+9.3f  %s" % (
+                address, pool.used, pool.capacity, slope, "-" if exhaustion is None else "%ds" % exhaustion))
+        leaks = self.heap_monitor.persistent_buffers(args.leak)
+        if leaks:
+            self.logger.info("Buffers allocated in the last %d snapshots:\n" % args.leak + "\n".join(
+                ["  0x%06X (BLOC @ 0x%06X)" % (buffer_address, pool_address)
+                 for pool_address, buffer_address in leaks]
+            ))
 
     connect_parser = argparse.ArgumentParser()
     connect_parser.add_argument('btaddr', help='Bluetooth address of the remote device (with or without \':\').')
@@ -1709,14 +2171,17 @@ class InternalBlueCLI(cmd2.Cmd):
                 HCI_COMND.Read_AFH_Channel_Map, p16(handle)
             )
 
-            if len(response) < 17 or response[8:] == b"\x00" * 9:
+            if response is None:
+                return False
+            result = CommandComplete(response).result
+            if len(result) < 13 or result[4:] == b"\x00" * 9:
                 self.logger.info("Connection 0x%04x is not established." % handle)
                 return False
 
             self.logger.info("Connection Handle: 0x%04x" % handle)
-            self.logger.info("AFH Enabled: %s" % bool(response[7] != 0))
+            self.logger.info("AFH Enabled: %s" % bool(result[3] != 0))
             channels = ""
-            for c in response[8:]:
+            for c in result[4:]:
                 bits = format(c, "08b")
                 for b in bits:
                     if b == "1":
@@ -1739,15 +2204,10 @@ class InternalBlueCLI(cmd2.Cmd):
 
         if args.conn_handle is None:
             # automatically get all connection handles if not set
-            if hasattr(self.internalblue.fw, "CONNECTION_MAX"):
-                for i in range(self.internalblue.fw.CONNECTION_MAX):
-                    connection = self.internalblue.readConnectionInformation(
-                        cast("ConnectionNumber", i + 1)
-                    )
-                    if connection is None:
-                        continue
-                    else:
-                        readafh(connection.connection_handle)
+            connections = self.internalblue.connection_tracker.current("ACL")
+            if connections or hasattr(self.internalblue.fw, "CONNECTION_MAX"):
+                for connection in connections:
+                    readafh(connection.handle)
                 return None
             # if not set but connection struct unknown, typical connection handles seem to be 0x0b...0x0d
             else:
@@ -1782,6 +2242,79 @@ class InternalBlueCLI(cmd2.Cmd):
                     return False
         self.internalblue.sendH4(args.type, data)
 
+    diagmonitor_parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    diagmonitor_parser.add_argument('command', help='''One of:
+            start [filter]: Enable diagnostic logging and decode LMP/LCP PDUs
+            stop:           Disable diagnostic logging
+            load <file>:    Decode the diagnostic frames of a btsnoop log
+            show:           Print the last decoded PDUs
+            stats:          Print the number of PDUs per opcode
+            clear:          Reset records and counters''')
+    diagmonitor_parser.add_argument('args', nargs='*',
+                                    help='Filter words (lmp, ll, sent, received, opcode=3,4, ext=0x0b, '
+                                         'name=LMP_accepted) or the btsnoop file for load')
+    diagmonitor_parser.add_argument('-n', '--count', type=int, default=20,
+                                    help='Number of PDUs for show (default: %(default)s)')
+    diagmonitor_parser.add_argument('-q', '--quiet', action='store_true',
+                                    help='Do not print every PDU while monitoring, only count them')
+
+    @cmd2.with_argparser(diagmonitor_parser)
+    def do_diagmonitor(self, args):
+        """Decode the LMP and LL control PDUs of the Broadcom diagnostic frames, with filters and counters."""
+        if self.diag_decoder is None:
+            self.diag_decoder = DiagDecoder()
+
+        if args.command in ["start", "load"]:
+            filter_words = args.args if args.command == "start" else args.args[1:]
+            try:
+                self.diag_decoder.filters = [DiagFilter.parse(" ".join(filter_words))] if filter_words else []
+            except ValueError as e:
+                self.logger.warning(str(e))
+                return False
+
+        if args.command == "start":
+            self.diag_decoder.subscribers = [] if args.quiet else [lambda pdu: self.logger.info(str(pdu))]
+            if self.diag_decoder.hciCallback not in self.internalblue.registeredHciCallbacks:
+                self.internalblue.registerHciCallback(self.diag_decoder.hciCallback)
+            self.internalblue.enableBroadcomDiagnosticLogging(True)
+            self.logger.info("Diagnostic monitor started.")
+
+        elif args.command == "stop":
+            self.internalblue.enableBroadcomDiagnosticLogging(False)
+            if self.diag_decoder.hciCallback in self.internalblue.registeredHciCallbacks:
+                self.internalblue.unregisterHciCallback(self.diag_decoder.hciCallback)
+            self.logger.info("Diagnostic monitor stopped after %d frames." % self.diag_decoder.frames)
+
+        elif args.command == "load":
+            if not args.args or not os.path.exists(args.args[0]):
+                self.logger.warning("Usage: diagmonitor load <btsnoop file> [filter]")
+                return False
+            self.diag_decoder.subscribers = []
+            try:
+                frames = self.diag_decoder.read_btsnoop(args.args[0])
+            except ValueError as e:
+                self.logger.warning(str(e))
+                return False
+            self.logger.info("Decoded %d diagnostic frames from %s." % (frames, args.args[0]))
+
+        elif args.command == "show":
+            records = list(self.diag_decoder.records)[-args.count:]
+            self.logger.info("\n".join(str(pdu) for pdu in records) if records else "No PDUs recorded.")
+
+        elif args.command == "stats":
+            lines = ["%-5s %-8s %-36s %d" % (protocol, direction, pdu_name(protocol, opcode, extended), count)
+                     for (protocol, direction, opcode, extended), count in sorted(
+                         self.diag_decoder.counters.items(), key=lambda item: -item[1])]
+            self.logger.info("PDUs per opcode (%d frames):\n" % self.diag_decoder.frames + "\n".join(lines))
+
+        elif args.command == "clear":
+            self.diag_decoder.clear()
+            self.logger.info("Diagnostic monitor records cleared.")
+
+        else:
+            self.logger.warning("Unknown command: %s" % args.command)
+            return False
+
     launch_parser = argparse.ArgumentParser()
     launch_parser.add_argument('address', type=auto_int, help='Execute this address.')
 
@@ -1795,6 +2328,137 @@ class InternalBlueCLI(cmd2.Cmd):
         """Enables enhanced advertisement reports in the first half of the `Event Type` field."""
         self.internalblue.enableEnhancedAdvReport()
 
+    inquiry_parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    inquiry_parser.add_argument('command', help='''One of:
+            start:          Run inquiries in the background and collect the responses
+            stop:           Stop the inquiries
+            show:           Print the device table
+            export <file>:  Write the device table as .json or .csv
+            clear:          Reset the device table''')
+    inquiry_parser.add_argument('args', nargs='*', help='The file for export')
+    inquiry_parser.add_argument('-n', '--sweeps', type=int, help='Number of inquiries (default: until stopped)')
+    inquiry_parser.add_argument('-l', '--length', type=auto_int, default=8,
+                                help='Inquiry length in 1.28 s units, 1..0x30 (default: %(default)s)')
+    inquiry_parser.add_argument('-i', '--interval', type=float, default=1.0,
+                                help='Pause between inquiries in seconds (default: %(default)s)')
+    inquiry_parser.add_argument('-c', '--major-class', type=auto_int,
+                                help='Only show devices of this major device class, e.g. 2 for phones')
+
+    @cmd2.with_argparser(inquiry_parser)
+    def do_inquiry(self, args):
+        """Run periodic inquiries and aggregate the responses (class, RSSI history, EIR) per device."""
+        if self.inquiry_sweep is None:
+            self.inquiry_sweep = InquirySweep(self.internalblue)
+        sweep = self.inquiry_sweep
+
+        if args.command == "start":
+            if sweep.running:
+                self.logger.warning("Inquiries are already running.")
+                return False
+            sweep.stop()  # Unregisters the callback of a previous, finished run
+            sweep.inquiry_length = args.length
+            sweep.interval = args.interval
+            sweep.subscribers = [lambda device: self.logger.info(
+                "[New device: %s %s %s]" % (device["address"], device["major_device_class"], device["name"] or ""))]
+            if not sweep.start(args.sweeps):
+                return False
+            self.logger.info("Inquiries started.")
+
+        elif args.command == "stop":
+            sweep.stop()
+            self.logger.info("Inquiries stopped after %d sweeps, %d devices." % (sweep.sweeps, len(sweep.table)))
+
+        elif args.command == "show":
+            devices = sweep.table.snapshot(args.major_class)
+            if not devices:
+                self.logger.info("No devices found.")
+                return
+            lines = ["Address            Class     Major class    Responses  RSSI  Name"]
+            for device in devices:
+                lines.append("%-17s  0x%06x  %-14s %9d  %4s  %s" % (
+                    device["address"], device["device_class"], device["major_device_class"], device["responses"],
+                    device["rssi"][-1] if device["rssi"] else "", device["name"] or ""))
+            self.logger.info("\n".join(lines))
+
+        elif args.command == "export":
+            if not args.args:
+                self.logger.warning("Usage: inquiry export <file.json|file.csv>")
+                return False
+            if args.args[0].endswith(".csv"):
+                sweep.table.write_csv(args.args[0])
+            else:
+                sweep.table.write_json(args.args[0])
+            self.logger.info("Wrote %d devices to %s." % (len(sweep.table), args.args[0]))
+
+        elif args.command == "clear":
+            sweep.clear()
+            self.logger.info("Inquiry table cleared.")
+
+        else:
+            self.logger.warning("Unknown command: %s" % args.command)
+            return False
+
+    lescan_parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    lescan_parser.add_argument('command', help='''One of:
+            start:  Start a continuous LE scan and aggregate the advertising reports
+            stop:   Stop the scan
+            show:   Print the device table
+            stats:  Print report, duplicate and drop counters
+            clear:  Reset the device table and counters''')
+    lescan_parser.add_argument('-a', '--active', action='store_true', help='Active scan (request scan responses)')
+    lescan_parser.add_argument('-e', '--enhanced', action='store_true',
+                               help='Enable enhanced advertisement reports (channel, antenna, scan mode) first')
+    lescan_parser.add_argument('-n', '--count', type=int, default=20,
+                               help='Number of devices for show, most recently seen first (default: %(default)s)')
+    lescan_parser.add_argument('-s', '--sort', default='last_seen', choices=['last_seen', 'reports', 'rssi_mean'],
+                               help='Sort the devices for show (default: %(default)s)')
+
+    @cmd2.with_argparser(lescan_parser)
+    def do_lescan(self, args):
+        """Scan for LE advertisements and aggregate the reports per device (RSSI, channels, duplicates)."""
+        if self.le_scanner is None:
+            self.le_scanner = LeScanner(self.internalblue)
+
+        if args.command == "start":
+            if args.enhanced:
+                self.internalblue.enableEnhancedAdvReport()
+            if not self.le_scanner.start(active=args.active):
+                return False
+            self.logger.info("LE scan started.")
+
+        elif args.command == "stop":
+            self.le_scanner.stop()
+            self.logger.info("LE scan stopped, %d reports from %d devices."
+                             % (self.le_scanner.reports, len(self.le_scanner.table)))
+
+        elif args.command == "show":
+            devices = self.le_scanner.table.devices(args.sort)[:args.count]
+            if not devices:
+                self.logger.info("No devices seen.")
+                return
+            lines = ["Address            Reports  Dups  RSSI last/mean/min/max   Ch 37/38/39     Last seen"]
+            for device in devices:
+                lines.append("%-17s %8d %5d  %4d %6.1f %4d %4d  %6d %6d %6d  %s" % (
+                    ":".join("%02x" % b for b in device["address"]), device["reports"], device["duplicates"],
+                    device["rssi_last"], device["rssi_mean"], device["rssi_min"], device["rssi_max"],
+                    device["channel_37"], device["channel_38"], device["channel_39"],
+                    time.strftime("%H:%M:%S", time.localtime(device["last_seen"]))))
+            self.logger.info("\n".join(lines))
+
+        elif args.command == "stats":
+            scanner = self.le_scanner
+            self.logger.info("Events: %d  Reports: %d (%.1f/s)  Duplicates: %d  Dropped: %d  Devices: %d  Queued: %d"
+                             % (scanner.events, scanner.reports, scanner.rate(), scanner.duplicates,
+                                scanner.dropped, len(scanner.table), len(scanner.pending)))
+
+        elif args.command == "clear":
+            self.le_scanner.clear()
+            self.logger.info("LE scan table cleared.")
+
+        else:
+            self.logger.warning("Unknown command: %s" % args.command)
+            return False
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -0,0 +1,232 @@
+import struct
+import time
+from builtins import object
+from threading import RLock
+
+from .hci_events import (ConnectionComplete, ConnectionRequest, DisconnectionComplete, EncryptionChange, HciEvent,
+                         LeConnectionComplete, RoleChange, SynchronousConnectionComplete, decode_packet)
+
+try:
+    from typing import Callable, Dict, List, Optional, TYPE_CHECKING
+    if TYPE_CHECKING:
+        from .core import InternalBlue
+        from .objects.connection_information import ConnectionInformation
+except ImportError:
+    pass
+
+
+class TrackedConnection(object):
+    """ A connection as seen in the HCI events. """
+
+    __slots__ = ("handle", "address", "link_type", "role", "encrypted", "connected_at", "information")
+
+    def __init__(self, handle, address, link_type, role=None, encrypted=False, connected_at=None):
+        # type: (int, bytes, str, Optional[str], bool, Optional[float]) -> None
+        self.handle = handle
+        self.address = address  # Big endian, as displayed
+        self.link_type = link_type  # 'ACL', 'SCO', 'eSCO' or 'LE'
+        self.role = role  # 'master', 'slave' or None if unknown
+        self.encrypted = encrypted
+        self.connected_at = connected_at
+        self.information = None  # type: Optional[ConnectionInformation]  # Firmware struct, see details()
+
+    @property
+    def is_master(self):
+        # type: () -> Optional[bool]
+        return None if self.role is None else self.role == "master"
+
+    def __repr__(self):
+        return "<%s 0x%x %s %s>" % (
+            self.link_type, self.handle, ":".join("%02x" % b for b in self.address), self.role or "unknown role")
+
+
+class ConnectionTracker(object):
+    """
+    Live table of the connections, maintained from the HCI events (Connection
+    Complete, LE (Enhanced) Connection Complete, Synchronous Connection
+    Complete, Role Change, Encryption Change and Disconnection Complete).
+
+    The firmware connection struct is only read if details() are requested
+    (or the role is unknown). sync() reads the table, e.g. to learn about
+    connections which existed before InternalBlue was started; current() does
+    so on its first call and whenever the requested connection is unknown.
+
+    Subscribers are called from the receive thread with (event, connection),
+    event is one of 'connected', 'changed' and 'disconnected'.
+    """
+
+    LINK_TYPES = {0x00: "SCO", 0x01: "ACL", 0x02: "eSCO"}
+
+    def __init__(self, internalblue):
+        # type: (InternalBlue) -> None
+        self.internalblue = internalblue
+        self.lock = RLock()
+        self.table = {}  # type: Dict[int, TrackedConnection]
+        self.incoming = set()  # type: set  # Addresses of Connection Requests, we become slave
+        self.subscribers = []  # type: List[Callable[[str, TrackedConnection], None]]
+        self.synced = False
+
+    def subscribe(self, callback):
+        # type: (Callable[[str, TrackedConnection], None]) -> None
+        if callback not in self.subscribers:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        # type: (Callable[[str, TrackedConnection], None]) -> None
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def _notify(self, event, connection):
+        # type: (str, TrackedConnection) -> None
+        for callback in list(self.subscribers):
+            try:
+                callback(event, connection)
+            except Exception as e:
+                self.internalblue.logger.warning("ConnectionTracker: subscriber failed: %s" % e)
+
+    def _add(self, connection):
+        # type: (TrackedConnection) -> None
+        with self.lock:
+            self.table[connection.handle] = connection
+        self._notify("connected", connection)
+
+    def _update(self, handle, **changes):
+        with self.lock:
+            connection = self.table.get(handle)
+            if connection is None:
+                return
+            for name, value in changes.items():
+                setattr(connection, name, value)
+        self._notify("changed", connection)
+
+    def hciCallback(self, record):
+        # type: (tuple) -> None
+        """ HCI callback, registered by InternalBlue. """
+        try:
+            self._handleEvent(decode_packet(record[0]))
+        except (IndexError, struct.error):
+            pass  # Truncated event
+
+    def _handleEvent(self, event):
+        # type: (Optional[HciEvent]) -> None
+        if isinstance(event, ConnectionRequest):
+            self.incoming.add(event.address)
+            return
+        if event is None or event.status != 0:
+            return
+
+        if isinstance(event, ConnectionComplete):
+            role = "slave" if event.address in self.incoming else "master"
+            self.incoming.discard(event.address)
+            self._add(TrackedConnection(event.handle, event.address, self.LINK_TYPES.get(event.link_type, "ACL"),
+                                        role, event.encryption_enabled, time.time()))
+
+        elif isinstance(event, SynchronousConnectionComplete):
+            self._add(TrackedConnection(event.handle, event.address, self.LINK_TYPES.get(event.link_type, "SCO"),
+                                        None, False, time.time()))
+
+        elif isinstance(event, LeConnectionComplete):  # Also LE Enhanced Connection Complete
+            self._add(TrackedConnection(event.handle, event.address, "LE", event.role, False, time.time()))
+
+        elif isinstance(event, RoleChange):
+            with self.lock:
+                handles = [c.handle for c in self.table.values()
+                           if c.address == event.address and c.link_type == "ACL"]
+            for handle in handles:
+                self._update(handle, role=event.role)
+
+        elif isinstance(event, EncryptionChange):
+            self._update(event.handle, encrypted=event.encryption_enabled)
+
+        elif isinstance(event, DisconnectionComplete):
+            with self.lock:
+                connection = self.table.pop(event.handle & 0x0FFF, None)
+            if connection is not None:
+                self._notify("disconnected", connection)
+
+    def connections(self, link_type=None):
+        # type: (Optional[str]) -> List[TrackedConnection]
+        """ The current connections, sorted by handle. """
+        with self.lock:
+            return [c for _, c in sorted(self.table.items()) if link_type is None or c.link_type == link_type]
+
+    def get(self, handle):
+        # type: (int) -> Optional[TrackedConnection]
+        with self.lock:
+            return self.table.get(handle)
+
+    def by_address(self, address):
+        # type: (bytes) -> List[TrackedConnection]
+        with self.lock:
+            return [c for c in self.table.values() if c.address == bytes(address)]
+
+    def sync(self):
+        # type: () -> bool
+        """
+        Reads the firmware connection table once (readAllConnections) and merges
+        it into the tracked connections: missing connections are added, e.g.
+        because they were established before the tracker was running, and known
+        ones get their firmware struct.
+        """
+        self.synced = True
+        structs = self.internalblue.readAllConnections()
+        if structs is None:
+            return False
+        for information in structs:
+            if information is None or information.connection_handle == 0:
+                continue
+            known = self.get(information.connection_handle)
+            if known is not None:
+                with self.lock:
+                    known.information = information
+                    if known.role is None:
+                        known.role = "master" if information.master_of_connection else "slave"
+                continue
+            connection = TrackedConnection(
+                information.connection_handle,
+                bytes(information.remote_address),
+                "ACL",
+                "master" if information.master_of_connection else "slave",
+            )
+            connection.information = information
+            self._add(connection)
+        return True
+
+    def details(self, handle, refresh=False):
+        # type: (int, bool) -> Optional[ConnectionInformation]
+        """
+        The firmware connection struct of a connection. It is read (together
+        with all others, in one bulk read) the first time it is needed.
+        """
+        connection = self.get(handle)
+        if connection is None:
+            return None
+        if connection.information is not None and not refresh:
+            return connection.information
+        structs = self.internalblue.readAllConnections()
+        for information in structs or []:
+            if information is not None and information.connection_handle == handle:
+                connection.information = information
+                if connection.role is None:
+                    connection.role = "master" if information.master_of_connection else "slave"
+                return information
+        return None
+
+    def current(self, link_type=None, handle=None):
+        # type: (Optional[str], Optional[int]) -> List[TrackedConnection]
+        """
+        Like connections(), optionally only the connection with <handle>. The
+        firmware table is merged in with sync() on the first call, and again
+        whenever the requested connection is unknown (no connection with
+        <handle>, or none of <link_type>). So connections from before the start
+        or with missed events are known as well.
+        """
+        if "CONNECTION_MAX" in dir(self.internalblue.fw):
+            if handle is not None:
+                unknown = self.get(handle) is None
+            else:
+                # The firmware table only contains ACL connections
+                unknown = link_type in (None, "ACL") and not self.connections(link_type)
+            if not self.synced or unknown:
+                self.sync()
+        return [c for c in self.connections(link_type) if handle is None or c.handle == handle]
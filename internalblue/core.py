@@ -45,15 +45,25 @@ from . import hci
 from .fw import FirmwareDefinition
 from .fw.fw import Firmware
 from .hci import HCI, HCI_COMND
+from .hci_events import CommandComplete, CommandStatus, ConnectionComplete, DisconnectionComplete, decode_packet
+from .connection_tracker import ConnectionTracker
 from .objects.connection_information import ConnectionInformation
+from .objects.countpoint import COUNTPOINT_HOOK_ASM, Countpoint, CountpointSample
+from .objects.patch_manifest import PatchManifest, RamBlobs
 from .objects.queue_element import QueueElement
+from .objects.tracepoint import (CaptureRange, Tracepoint, TracepointCaptures, TracepointCondition,
+                                  capture_table, condition_asm)
 from .utils import flat, bytes_to_hex
-from .utils.packing import p8, p16, u16, p32, u32, bits, unbits
+from .utils.packing import p8, p16, u16, p32, u32, unpack_u16_array, unpack_u32_array
+from .utils.memory_pool_statistics import MemoryPoolStatistics
+from .utils.ram_allocator import RamAllocator
+from .utils.thumb import relocatable
+from .utils.tracepoint_log import TracepointHit, TracepointLog
 from .utils.internalblue_logger import getInternalBlueLogger
 standard_library.install_aliases()
 
 try:
-    from typing import List, Optional, Any, TYPE_CHECKING, Tuple, Union, NewType, Callable, cast
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple, Union, NewType, Callable, Dict, cast
     from internalblue import (Address, Record, Task, HCI_CMD, FilterFunction, ConnectionNumber, ConnectionDict,
                               ConnectionIndex, BluetoothAddress, HeapInformation, QueueInformation, Opcode)
     from . import DeviceTuple
@@ -117,6 +127,7 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
 
         self.interface = None  # holds the self.device / hci interface which is used to connect, is set in cli
         self.fw: FirmwareDefinition = None  # holds the firmware file
+        self.lmp_subversion: Optional[int] = None  # LMP subversion reported by the chip, selects self.fw
 
         self.data_directory = data_directory
         self.s_inject = (
@@ -164,15 +175,41 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
             Thread
         ] = None  # The thread which is responsible for the HCI inject socket
 
-        self.tracepoints = []  # A list of currently active tracepoints
-        # The list contains tuples:
-        # [0] target address
-        # [1] address of the hook code
+        self.tracepoints = []  # type: List[Tracepoint]  # A list of currently active tracepoints
+        self.tracepoint_hook_pool: Optional[RamAllocator] = None  # Free RAM for the hook code, see _getTracepointHookPool()
         self.tracepoint_registers: Optional[
             List[int]
         ] = None  # Last captured register values from a tracepoint
         self.tracepoint_memdump_parts = {}  # Last captured RAM dump from a tracepoint
         self.tracepoint_memdump_address = None  # Start address of the RAM dump
+        self.tracepoint_captures = {}  # type: Dict[Address, TracepointCaptures]  # Captured memory per tracepoint
+        self.tracepoint_capture_pending = None  # Capture of the last hit while its packets arrive
+        self.tracepoint_log: Optional[TracepointLog] = None  # Registers and captures of all hits, see _logTracepointHit()
+
+        self.countpoints = []  # type: List[Countpoint]  # A list of currently active countpoints
+        self.countpoint_table_address = None  # type: Optional[Address]  # Counters of all countpoints
+        self.countpoint_table_size = 32  # Number of counters in the table, allocated with the first countpoint
+
+        # Assembled injection snippets (sendLmpPacketLegacy, sendLcpPacket) per base address,
+        # see _writeInjectionSnippet()
+        self.injection_snippets = {}  # type: Dict[Address, Dict[str, Any]]
+
+        # Live table of the connections, maintained from HCI events
+        self.connection_tracker = ConnectionTracker(self)
+
+        # Time series of the memory pool statistics events, see readMemoryPoolStatisticsCallback()
+        self.memory_pool_statistics = MemoryPoolStatistics()
+
+        # Patchram slots which are handed out by allocatePatchramSlot() but might not
+        # be enabled yet (or were disabled by the firmware, e.g. a tracepoint hook).
+        # patchRom() and applyPatches() never choose these slots on their own.
+        self.reserved_patchram_slots = set()
+
+        # The persistent RAM writes (see writeMem()) and the patchram entries of this
+        # session. This is what createPatchManifest() saves, so the setup can be
+        # re-applied after a reset.
+        self.session_ram_writes = RamBlobs()
+        self.session_patches = {}  # type: Dict[Address, bytes]
 
         # The registeredHciCallbacks list holds callback functions which are being called by the
         # recvThread once a HCI Event is being received. Use registerHciCallback() for registering
@@ -206,6 +243,7 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         self.registerHciCallback(self.connectionStatusCallback)
         self.registerHciCallback(self.coexStatusCallback)
         self.registerHciCallback(self.readMemoryPoolStatisticsCallback)
+        self.registerHciCallback(self.connection_tracker.hciCallback)
 
         # If the --replay flag was used and a chip is spoofed.
         self.replay = replay
@@ -408,7 +446,7 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         if hcipkt.event_code != 0xFF:  # must be custom event (0xff)
             return
 
-        if hcipkt.data[0:6] == "TRACE_":  # My custom header (see hook code)
+        if hcipkt.data[0:6] == b"TRACE_":  # My custom header (see hook code)
             data = hcipkt.data[6:]
             tracepoint_registers = [u32(data[i: i + 4]) for i in range(0, 68, 4)]
             pc = tracepoint_registers[0]
@@ -430,29 +468,42 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 tracepoint_registers[13:16]
             )
             self.logger.info("Tracepoint 0x%x was hit and deactivated:\n" % pc + registers)
-
-            filename = (
-                    self.data_directory
-                    + "/"
-                    + "internalblue_tracepoint_registers_%s.bin"
-                    % datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            )
-            self.logger.info("Captured Registers for Tracepoint to %s" % filename)
-            f = open(filename, "w")
-            f.write(registers)
-            f.close()
             self.tracepoint_registers = tracepoint_registers
-            # remove tracepoint from self.tracepoints
+            if isinstance(timestamp, datetime.datetime):
+                hit = TracepointHit(timestamp.timestamp(), tracepoint_registers)
+            else:
+                hit = TracepointHit(time.time(), tracepoint_registers)
+
+            # reset all RAM dump and capture related variables:
+            self.tracepoint_memdump_address = None
+            self.tracepoint_memdump_parts = {}
+            if self.tracepoint_capture_pending is not None:
+                self._freeTracepointRam(self.tracepoint_capture_pending["tracepoint"])
+                self.tracepoint_capture_pending = None
+
+            # remove tracepoint from self.tracepoints, the hook already disabled its slot
             for tp in self.tracepoints:
-                if tp[0] == pc:
+                if tp.address == pc:
                     self.tracepoints.remove(tp)
+                    self.releasePatchramSlot(tp.patchram_slot)
+                    self.session_patches.pop(tp.address, None)
+                    if tp.capture is not None:
+                        # the body still reads the capture table while it sends the ranges,
+                        # the hit is logged and the RAM freed once the captured memory arrived
+                        self._startTracepointCapture(tp, hit)
+                        return
+                    self._freeTracepointRam(tp)
                     break
+            self._logTracepointHit(hit)
 
-            # reset all RAM dump related variables:
-            self.tracepoint_memdump_address = None
-            self.tracepoint_memdump_parts = {}
+        elif hcipkt.data[0:6] == b"CAPT__":  # Selected memory ranges (see capture_ranges in the body)
+            if self.tracepoint_capture_pending is None:
+                return
+            self._addTracepointCaptureChunk(
+                u32(hcipkt.data[6:10]), hcipkt.data[12: 12 + u16(hcipkt.data[10:12])]
+            )
 
-        elif hcipkt.data[0:6] == "RAM___":  # My custom header (see hook code)
+        elif hcipkt.data[0:6] == b"RAM___":  # My custom header (see hook code)
             dump_address = u32(hcipkt.data[6:10])
             data = hcipkt.data[10:]
 
@@ -466,7 +517,7 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                     len(self.tracepoint_memdump_parts)
                     == self.fw.TRACEPOINT_RAM_DUMP_PKT_COUNT
             ):
-                dump = flat(self.tracepoint_memdump_parts)
+                dump = flat(self.tracepoint_memdump_parts, filler=0x00)
                 # TODO: use this to start qemu
                 filename = (
                         self.data_directory
@@ -485,9 +536,121 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 f.write(dump)
                 f.close()
 
+    def getTracepointLog(self):
+        # type: () -> TracepointLog
+        """
+        The log of all tracepoint hits in the data directory. It is kept across
+        sessions, new hits are appended.
+        """
+        if self.tracepoint_log is None:
+            self.tracepoint_log = TracepointLog(self.data_directory + "/" + "internalblue_tracepoints")
+        return self.tracepoint_log
+
+    def _logTracepointHit(self, hit):
+        # type: (TracepointHit) -> None
+        self.getTracepointLog().append(hit)
+        self.logger.debug(
+            "Logged hit %d to %s" % (len(self.tracepoint_log), self.tracepoint_log.data_filename)
+        )
+
+    def _startTracepointCapture(self, tp, hit):
+        # type: (Tracepoint, TracepointHit) -> None
+        """ Prepares for the 'CAPT__' packets which follow the 'TRACE_' packet of a hit. """
+        sp = hit.register("sp")
+        self.tracepoint_capture_pending = {
+            "tracepoint": tp,
+            "hit": hit,
+            "ranges": [(capture_range.resolve(sp), capture_range.length) for capture_range in tp.capture],
+            "data": bytearray(),
+        }
+        self._addTracepointCaptureChunk(None, b"")
+
+    def _addTracepointCaptureChunk(self, address, data):
+        # type: (Optional[Address], bytes) -> None
+        """
+        The chip sends the ranges of a capture spec in order and splits them
+        into chunks. Once all chunks arrived, only the changes since the
+        previous hit are stored in self.tracepoint_captures.
+        """
+        pending = self.tracepoint_capture_pending
+        tp = pending["tracepoint"]
+        received = pending["data"]
+
+        if len(data) > 0:
+            # address where the next chunk is expected
+            offset = len(received)
+            for start, length in pending["ranges"]:
+                if offset < length:
+                    break
+                offset -= length
+            if address != start + offset:
+                self.logger.warning(
+                    "Tracepoint 0x%x: lost capture packets (expected 0x%x, got 0x%x), dropping the capture"
+                    % (tp.address, start + offset, address)
+                )
+                self.tracepoint_capture_pending = None
+                self._freeTracepointRam(tp)
+                self._logTracepointHit(pending["hit"])
+                return
+            received += data
+
+        if len(received) < tp.capture_length():
+            return
+
+        ranges = []
+        offset = 0
+        for start, length in pending["ranges"]:
+            ranges.append((start, bytes(received[offset: offset + length])))
+            offset += length
+
+        if tp.address not in self.tracepoint_captures:
+            self.tracepoint_captures[tp.address] = TracepointCaptures()
+        captures = self.tracepoint_captures[tp.address]
+        changed = captures.add_hit(ranges)
+        self.logger.info(
+            "Captured %d bytes in %d ranges for Tracepoint 0x%x (hit %d, %d bytes changed)"
+            % (len(received), len(ranges), tp.address, len(captures), changed)
+        )
+        self.tracepoint_capture_pending = None
+        self._freeTracepointRam(tp)
+        pending["hit"].captures = ranges
+        self._logTracepointHit(pending["hit"])
+
+    def _releaseTracepoint(self, tp):
+        # type: (Tracepoint) -> None
+        """
+        Returns the patchram slot and pool RAM of a tracepoint. Only call this
+        once the chip can no longer branch to the hook, i.e. the slot is
+        disabled (or was never enabled).
+        """
+        self.releasePatchramSlot(tp.patchram_slot)
+        self._freeTracepointRam(tp)
+
+    def _freeTracepointRam(self, tp):
+        # type: (Tracepoint) -> None
+        self.tracepoint_hook_pool.free(tp.hook_address)
+        if tp.capture_address is not None:
+            self.tracepoint_hook_pool.free(tp.capture_address)
+        if tp.counter_address is not None:
+            self.tracepoint_hook_pool.free(tp.counter_address)
+
     @needs_pwnlib
-    def addTracepoint(self, address):
-        # type: (Address) -> bool
+    def addTracepoint(self, address, capture=None, conditions=None):
+        # type: (Address, Optional[List[CaptureRange]], Optional[List[TracepointCondition]]) -> bool
+        """
+        Places a tracepoint at <address>. When it is hit, the registers are sent
+        to the host and the tracepoint is removed.
+
+        Without a capture spec, firmwares with TRACEPOINT_RAM_DUMP_PKT_COUNT
+        also dump the whole RAM. A list of CaptureRange objects only sends
+        these ranges (an empty list only the registers); the data ends up in
+        self.tracepoint_captures[address].
+
+        With conditions, the hook checks them on the chip and only hits for
+        which all of them hold are reported (and remove the tracepoint). The
+        hook executes the 4 bytes at <address> for the skipped hits, so like
+        for countpoints, they must not depend on the PC.
+        """
         # Check if constants are defined in fw.py
         for const in [
             "TRACEPOINT_BODY_ASM_LOCATION",
@@ -502,6 +665,14 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 )
                 return False
 
+        if capture is not None and not self.fw.TRACEPOINT_CAPTURE_SUPPORTED:
+            self.logger.warning("addTracepoint: Memory captures are not supported by this firmware!")
+            return False
+
+        if conditions and not self.fw.TRACEPOINT_CONDITIONS_SUPPORTED:
+            self.logger.warning("addTracepoint: Conditions are not supported by this firmware!")
+            return False
+
         if not self.check_running():
             return False
 
@@ -511,25 +682,80 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
             return False
 
         # Check if tracepoint exists
-        existing_hook_addresses = []
-        for tp_address, tp_hook_address in self.tracepoints:
-            existing_hook_addresses.append(tp_hook_address)
-            if tp_address == address:
+        for tp in self.tracepoints:
+            if tp.address == address:
                 self.logger.warning("Tracepoint at 0x%x does already exist!" % address)
                 return False
+        for cp in self.countpoints:
+            if cp.address == address:
+                self.logger.warning("There is a countpoint at 0x%x!" % address)
+                return False
 
-        # we only have room for 0x90/28 = 5 tracepoints
-        if len(self.tracepoints) >= 5:
-            self.logger.warning("Already using the maximum of 5 tracepoints")
-            return False
+        # A skipped hit executes the original instructions in the hook (the
+        # branch to the hook stays installed), like a countpoint does
+        original = b""
+        if conditions:
+            original = self.readMem(address, 4)
+            if original is None or len(original) != 4:
+                self.logger.warning("addTracepoint: Could not read the instructions at 0x%x" % address)
+                return False
+            if not relocatable(original):
+                self.logger.warning(
+                    "addTracepoint: The instructions at 0x%x (%s) depend on the PC, conditions are not supported here!"
+                    % (address, bytes_to_hex(original))
+                )
+                return False
 
-        # Find a free address for the hook code
-        for i in range(5):
-            hook_address = (
-                    self.fw.TRACEPOINT_HOOKS_LOCATION + self.fw.TRACEPOINT_HOOK_SIZE * i
+        # The hook code lives in a pool of free RAM, the number of tracepoints is
+        # only limited by the size of this pool and the free patchram slots
+        self._getTracepointHookPool()
+
+        def hook_asm(slot, capture_address, counter_address):
+            # type: (int, Optional[Address], Optional[Address]) -> str
+            condition, condition_skip = condition_asm(conditions or [], address, original, counter_address)
+            return self.fw.TRACEPOINT_HOOK_ASM % {
+                "address": address,
+                "slot": slot,
+                "body": self.fw.TRACEPOINT_BODY_ASM_LOCATION,
+                "capture": capture_address or 0,
+                "condition": condition,
+                "condition_skip": condition_skip,
+            }
+
+        # Conditions make the hook larger, assemble it once to get its size
+        # (plus some room for the alignment of the literal pool)
+        hook_size = self.fw.TRACEPOINT_HOOK_SIZE
+        if conditions:
+            hook_size = max(hook_size, len(asm(hook_asm(0, 0, 0), vma=self.tracepoint_hook_pool.start, arch="thumb")) + 4)
+
+        hook_address = self.tracepoint_hook_pool.allocate(hook_size)
+        if hook_address is None:
+            self.logger.warning(
+                "addTracepoint: No free RAM for the hook (%d tracepoints in a pool of 0x%x bytes)"
+                % (len(self.tracepoints), self.tracepoint_hook_pool.size)
             )
-            if hook_address not in existing_hook_addresses:
-                break
+            return False
+
+        # The capture table is read by the body code, it shares the pool with the hooks
+        capture_address = None
+        if capture is not None:
+            capture_spec = capture_table(capture)
+            capture_address = self.tracepoint_hook_pool.allocate(len(capture_spec))
+            if capture_address is None:
+                self.logger.warning("addTracepoint: No free RAM for the capture table!")
+                self.tracepoint_hook_pool.free(hook_address)
+                return False
+
+        # A hit count condition needs a counter in RAM
+        counter_address = None
+        if any(condition.kind == "hits" for condition in conditions or []):
+            counter_address = self.tracepoint_hook_pool.allocate(4)
+            if counter_address is None:
+                self.logger.warning("addTracepoint: No free RAM for the hit counter!")
+                self.tracepoint_hook_pool.free(hook_address)
+                if capture_address is not None:
+                    self.tracepoint_hook_pool.free(capture_address)
+                return False
 
         # Check if this is the first tracepoint
         if self._tracepointHciCallbackFunction not in self.registeredHciCallbacks:
@@ -541,15 +767,15 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 vma=self.fw.TRACEPOINT_BODY_ASM_LOCATION,
                 arch="thumb",
             )
-            if len(hooks_code) > 0x100:
+            if len(hooks_code) > self.fw.TRACEPOINT_BODY_ASM_SIZE:
                 self.logger.error(
-                    "Assertion failed: len(hooks_code)=%d  is larger than 0x100!"
-                    % len(hooks_code)
+                    "Assertion failed: len(hooks_code)=%d  is larger than 0x%x!"
+                    % (len(hooks_code), self.fw.TRACEPOINT_BODY_ASM_SIZE)
                 )
 
             # save memory content at the addresses where we place the snippet and the stage-1 hooks
             self.tracepoint_saved_data = self.readMem(
-                self.fw.TRACEPOINT_BODY_ASM_LOCATION, 0x100
+                self.fw.TRACEPOINT_BODY_ASM_LOCATION, self.fw.TRACEPOINT_BODY_ASM_SIZE
             )
 
             # write code for hook to memory
@@ -558,51 +784,55 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
             # Register tracepoint hci callback function
             self.registerHciCallback(self._tracepointHciCallbackFunction)
 
-        # Add tracepoint to list
-        self.tracepoints.append((address, hook_address))
-
         ### Injecting stage-1 hooks ###
-        # save the 4 bytes at which the hook branch (e.g. b <hook address>) will be placed
-        saved_instructions = self.readMem(address, 4)
-
-        # we need to know the patchram slot in advance..
-        # little trick/hack: we just insert a patch now with the original data to
-        # receive the slot value. later we insert the actual patch which will reuse
-        # the same slot.
-        # FIXME: To increase performance, try to not do it like that ^^
-        self.patchRom(address, saved_instructions)
-        table_addresses, _, _ = self.getPatchramState()
-        patchram_slot = table_addresses.index(address)
+        # The hook code needs to know its patchram slot in advance (it disables
+        # the slot once it is hit), so we reserve one before assembling the hook.
+        patchram_slot = self.allocatePatchramSlot(address)
+        if patchram_slot is None:
+            self.logger.warning("addTracepoint: No free patchram slot for the tracepoint!")
+            self.tracepoint_hook_pool.free(hook_address)
+            if capture_address is not None:
+                self.tracepoint_hook_pool.free(capture_address)
+            if counter_address is not None:
+                self.tracepoint_hook_pool.free(counter_address)
+            return False
         self.logger.info("Using patchram slot %d for tracepoint." % patchram_slot)
-        self.disableRomPatch(
-            address
-        )  # Eval board requires to delete patch before installing it again
+        tp = Tracepoint(address, hook_address, patchram_slot, capture, capture_address,
+                        conditions, counter_address)
 
         # compile assembler snippet containing the stage-1 hook code:
         stage1_hook_code = asm(
-            self.fw.TRACEPOINT_HOOK_ASM
-            % (address, patchram_slot, self.fw.TRACEPOINT_BODY_ASM_LOCATION, address),
+            hook_asm(patchram_slot, capture_address, counter_address),
             vma=hook_address,
             arch="thumb",
         )
 
-        if len(stage1_hook_code) > self.fw.TRACEPOINT_HOOK_SIZE:
+        if len(stage1_hook_code) > hook_size:
             self.logger.error(
-                "Assertion failed: len(stage1_hook_code)=%d  is larger than TRACEPOINT_HOOK_SIZE!"
-                % len(stage1_hook_code)
+                "Assertion failed: len(stage1_hook_code)=%d  is larger than %d bytes!"
+                % (len(stage1_hook_code), hook_size)
             )
+            self._releaseTracepoint(tp)
             return False
 
-        # write code for hook to memory
+        # write code for hook and the capture table to memory
         self.logger.debug("addTracepoint: injecting hook function...")
         self.writeMem(hook_address, stage1_hook_code)
+        if capture_address is not None:
+            self.writeMem(capture_address, capture_spec)
+        if counter_address is not None:
+            self.writeMem(counter_address, p32(0))
 
         # patch in the hook branch instruction
         patch = asm("b 0x%x" % hook_address, vma=address, arch="thumb")
-        if not self.patchRom(address, patch):
+        if not self.patchRom(address, patch, patchram_slot, record=False):
             self.logger.warning("addTracepoint: couldn't insert tracepoint hook!")
+            self._releaseTracepoint(tp)
             return False
 
+        # Add tracepoint to list
+        self.tracepoints.append(tp)
+
         self.logger.debug(
             "addTracepoint: Placed Tracepoint at 0x%08x (hook at 0x%x)."
             % (address, hook_address)
@@ -616,9 +846,16 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
 
         # find tracepoint in the list
         for tp in self.tracepoints:
-            if tp[0] == address:
-                # disable patchram slot for the tracepoint
-                self.disableRomPatch(tp[0])
+            if tp.address == address:
+                # disable patchram slot for the tracepoint, the hook and its
+                # capture table are only freed once the chip cannot reach them
+                if not self.disableRomPatch(tp.address, tp.patchram_slot):
+                    self.logger.warning(
+                        "deleteTracepoint: Could not disable patchram slot %d, keeping the tracepoint at 0x%x"
+                        % (tp.patchram_slot, address)
+                    )
+                    return False
+                self._releaseTracepoint(tp)
 
                 # remove tracepoint from self.tracepoints
                 self.tracepoints.remove(tp)
@@ -629,6 +866,192 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
 
         return True
 
+    def _getTracepointHookPool(self):
+        # type: () -> RamAllocator
+        """
+        The RAM for hook code (tracepoints and countpoints), capture tables and
+        counters. Without TRACEPOINT_HOOK_POOL_ADDRESS in fw.py, there is room
+        for 5 tracepoint hooks at TRACEPOINT_HOOKS_LOCATION.
+        """
+        if self.tracepoint_hook_pool is None:
+            if self.fw.TRACEPOINT_HOOK_POOL_ADDRESS is not None:
+                self.tracepoint_hook_pool = RamAllocator(
+                    self.fw.TRACEPOINT_HOOK_POOL_ADDRESS, self.fw.TRACEPOINT_HOOK_POOL_SIZE
+                )
+            else:
+                self.tracepoint_hook_pool = RamAllocator(
+                    self.fw.TRACEPOINT_HOOKS_LOCATION, self.fw.TRACEPOINT_HOOK_SIZE * 5
+                )
+        return self.tracepoint_hook_pool
+
+    @needs_pwnlib
+    def addCountpoint(self, address):
+        # type: (Address) -> bool
+        """
+        Places a countpoint at <address>: a hook which increments a counter in
+        RAM and continues with the original code, no HCI event is sent. The
+        counters of all countpoints are read with readCountpoints().
+
+        The 4 bytes at <address> are replaced by a branch and moved into the
+        hook, so they must not depend on the PC (branches, literal loads, ...)
+        and nothing may branch to <address> + 2.
+        """
+        # Check if constants are defined in fw.py
+        for const in ["TRACEPOINT_HOOKS_LOCATION", "TRACEPOINT_HOOK_SIZE"]:
+            if const not in dir(self.fw):
+                self.logger.warning(
+                    "addCountpoint: '%s' not in fw.py. FEATURE NOT SUPPORTED!" % const
+                )
+                return False
+
+        if not self.check_running():
+            return False
+
+        if address % 4 != 0:
+            self.logger.warning("Only countpoints at aligned addresses are allowed!")
+            return False
+
+        for cp in self.countpoints:
+            if cp.address == address:
+                self.logger.warning("Countpoint at 0x%x does already exist!" % address)
+                return False
+
+        state = self.getPatchramState()
+        if not state:
+            return False
+        if address in state[0]:
+            self.logger.warning("addCountpoint: 0x%x is already patched!" % address)
+            return False
+
+        # The original instructions are executed by the hook
+        original = self.readMem(address, 4)
+        if original is None or len(original) != 4:
+            self.logger.warning("addCountpoint: Could not read the instructions at 0x%x" % address)
+            return False
+        if not relocatable(original):
+            self.logger.warning(
+                "addCountpoint: The instructions at 0x%x (%s) depend on the PC and cannot be moved to the hook!"
+                % (address, bytes_to_hex(original))
+            )
+            return False
+
+        pool = self._getTracepointHookPool()
+
+        # All counters are in one table, so that they can be read at once
+        used_indices = set(cp.counter_index for cp in self.countpoints)
+        free_indices = [i for i in range(self.countpoint_table_size) if i not in used_indices]
+        if len(free_indices) == 0:
+            self.logger.warning("addCountpoint: All %d counters are in use!" % self.countpoint_table_size)
+            return False
+        if self.countpoint_table_address is None:
+            self.countpoint_table_address = pool.allocate(self.countpoint_table_size * 4)
+            if self.countpoint_table_address is None:
+                self.logger.warning("addCountpoint: No free RAM for the counter table!")
+                return False
+        counter_index = free_indices[0]
+        counter_address = self.countpoint_table_address + counter_index * 4
+
+        hook_code = COUNTPOINT_HOOK_ASM % {
+            "counter": counter_address,
+            "original": "\n".join(".hword 0x%04x" % hw for hw in unpack_u16_array(original)),
+            "resume": address + 4,
+        }
+        hook_size = len(asm(hook_code, vma=pool.start, arch="thumb")) + 4
+        hook_address = pool.allocate(hook_size)
+        if hook_address is None:
+            self.logger.warning("addCountpoint: No free RAM for the hook!")
+            self._freeCountpointTable()
+            return False
+
+        patchram_slot = self.allocatePatchramSlot(address)
+        if patchram_slot is None:
+            self.logger.warning("addCountpoint: No free patchram slot for the countpoint!")
+            pool.free(hook_address)
+            self._freeCountpointTable()
+            return False
+
+        cp = Countpoint(address, hook_address, patchram_slot, counter_index, original)
+        stage1_hook_code = asm(hook_code, vma=hook_address, arch="thumb")
+        if len(stage1_hook_code) > hook_size:
+            self.logger.error(
+                "Assertion failed: len(stage1_hook_code)=%d  is larger than %d bytes!"
+                % (len(stage1_hook_code), hook_size)
+            )
+            self._releaseCountpoint(cp)
+            return False
+
+        # reset the counter, write the hook and branch to it
+        self.writeMem(counter_address, p32(0))
+        self.writeMem(hook_address, stage1_hook_code)
+        patch = asm("b 0x%x" % hook_address, vma=address, arch="thumb")
+        if not self.patchRom(address, patch, patchram_slot, record=False):
+            self.logger.warning("addCountpoint: couldn't insert countpoint hook!")
+            self._releaseCountpoint(cp)
+            return False
+
+        self.countpoints.append(cp)
+        self.logger.debug(
+            "addCountpoint: Placed Countpoint at 0x%08x (hook at 0x%x, counter at 0x%x)."
+            % (address, hook_address, counter_address)
+        )
+        return True
+
+    def _freeCountpointTable(self):
+        # type: () -> None
+        if len(self.countpoints) == 0 and self.countpoint_table_address is not None:
+            self.tracepoint_hook_pool.free(self.countpoint_table_address)
+            self.countpoint_table_address = None
+
+    def _releaseCountpoint(self, cp):
+        # type: (Countpoint) -> None
+        self.releasePatchramSlot(cp.patchram_slot)
+        self.tracepoint_hook_pool.free(cp.hook_address)
+        self._freeCountpointTable()
+
+    def deleteCountpoint(self, address):
+        # type: (Address) -> bool
+        if not self.check_running():
+            return False
+
+        for cp in self.countpoints:
+            if cp.address == address:
+                if not self.disableRomPatch(cp.address, cp.patchram_slot):
+                    self.logger.warning(
+                        "deleteCountpoint: Could not disable patchram slot %d, keeping the countpoint at 0x%x"
+                        % (cp.patchram_slot, address)
+                    )
+                    return False
+                self.countpoints.remove(cp)
+                self._releaseCountpoint(cp)
+                return True
+
+        self.logger.warning("deleteCountpoint: No countpoint at address: 0x%x" % address)
+        return False
+
+    def readCountpoints(self):
+        # type: () -> Optional[Dict[Address, int]]
+        """
+        Reads the counters of all countpoints with a single readMem().
+        Returns a dict of countpoint address -> number of hits.
+        """
+        if len(self.countpoints) == 0:
+            return {}
+        count = max(cp.counter_index for cp in self.countpoints) + 1
+        table = self.readMem(self.countpoint_table_address, count * 4)
+        if table is None or len(table) != count * 4:
+            self.logger.warning("readCountpoints: Could not read the counter table")
+            return None
+        counters = unpack_u32_array(table)
+        return {cp.address: counters[cp.counter_index] for cp in self.countpoints}
+
+    def sampleCountpoints(self):
+        # type: () -> Optional[CountpointSample]
+        """ The counters with the time they were read, see CountpointSample.rates(). """
+        counts = self.readCountpoints()
+        if counts is None:
+            return None
+        return CountpointSample(time.time(), counts)
+
     def check_running(self):
         # type: () -> bool
         """
@@ -729,6 +1152,7 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 iOS = True
 
             self.fw = Firmware(subversion, iOS).firmware
+            self.lmp_subversion = subversion
 
         # Safe to turn diagnostic logging on, it just gets a timeout if the Android
         # driver was recompiled with other flags but without applying a proper patch.
@@ -766,6 +1190,13 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         if self.write_btsnooplog:
             self.btsnooplog_file.close()
 
+        if self.tracepoint_log is not None:
+            self.tracepoint_log.close()
+            self.tracepoint_log = None
+
+        # The chip might be reset until the next connect()
+        self.injection_snippets = {}
+
         self.running = False
         self.exit_requested = False
         self.logger.info("Shutdown complete.")
@@ -882,12 +1313,10 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
             # Interpret HCI event
             if isinstance(hcipkt, hci.HCI_Event):
                 if hcipkt.event_code == 0x0E:  # Cmd Complete event
-                    if u16(hcipkt.data[1:3]) == opcode:
-                        return True
+                    return CommandComplete(hcipkt.data).opcode == opcode
 
                 if hcipkt.event_code == 0x0F:  # Cmd Status event
-                    if u16(hcipkt.data[2:4]) == opcode:
-                        return True
+                    return CommandStatus(hcipkt.data).opcode == opcode
 
             return False
 
@@ -1004,7 +1433,8 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                     self.logger.warning("readMem: failed!")
                     return None
 
-            data = response[4:]  # start of the actual data is at offset 4
+            complete = CommandComplete(response)
+            data = complete.result
 
             if len(data) == 0:  # this happens i.e. if not called on a brcm chip
                 self.logger.warning("readMem: empty response, quitting...")
@@ -1014,7 +1444,7 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 self.logger.debug("readMem: insufficient bytes returned, retrying...")
                 continue
 
-            status = response[3]
+            status = complete.status
             if status != 0:
                 # It is not yet reverse engineered what this byte means. For almost
                 # all memory addresses it will be 0. But for some it will be different,
@@ -1168,12 +1598,16 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         self.unregisterHciRecvQueue(recvQueue)
         return outbuffer
 
-    def writeMem(self, address, data, progress_log=None, bytes_done=0, bytes_total=0):
-        # type: (int, bytes, Optional[Any], int, int) -> Optional[bool]
+    def writeMem(self, address, data, progress_log=None, bytes_done=0, bytes_total=0, persistent=False):
+        # type: (int, bytes, Optional[Any], int, int, bool) -> Optional[bool]
         """
         Writes the <data> to the memory space of the firmware at the given
         address.
 
+        Writes with persistent=True (hooks and data that make up the setup of
+        the session) are recorded for createPatchManifest(). Scratch writes
+        like the buffers of tracepoints and injected packets are not.
+
         Optional arguments for progress logs:
         - progress_log: An instance of log.progress() which will be updated during the write.
         - bytes_done:   Number of bytes that have already been written with earlier calls to
@@ -1186,6 +1620,10 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         if not self.check_running():
             return None
 
+        # Other code written over an injection snippet (e.g. by fuzzLmp()) has to
+        # be replaced by the whole snippet on the next send
+        self._invalidateInjectionSnippets(address, len(data))
+
         write_addr = address
         byte_counter = 0
         if bytes_total == 0:
@@ -1206,10 +1644,10 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                     "writeMem: Timeout while reading response, probably need to wait longer."
                 )
                 return False
-            elif response[3] != 0:
+            elif CommandComplete(response).status != 0:
                 self.logger.warning(
-                    "writeMem: Got error code %d in command complete event."
-                    % response[3]
+                    "writeMem: Got error code %s in command complete event."
+                    % CommandComplete(response).status
                 )
                 return False
             write_addr += blocksize
@@ -1220,6 +1658,9 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                     bytes_total,
                 )
                 progress_log.status(msg)
+
+        if persistent and not self._isPatchramTableAddress(address):
+            self.session_ram_writes.add(address, data)
         return True
 
     def launchRam(self, address):
@@ -1238,7 +1679,7 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
             )
             return False
 
-        error_code = response[3]
+        error_code = CommandComplete(response).status
         if error_code != 0:
             self.logger.warning("Got error code %x in command complete event." % error_code)
             return False
@@ -1298,13 +1739,9 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
 
         table_addresses = []
         table_values = []
-        slot_dwords = []
-        slot_bits = []
-        for dword in range(old_div(slot_count, 32)):
-            slot_dwords.append(slot_dump[dword * 32: (dword + 1) * 32])
-
-        for dword in slot_dwords:
-            slot_bits.extend(bits(bytes(dword[::-1]))[::-1])
+        # The bitmap is an array of little endian dwords, slot 0 is the LSB of the first dword
+        bitmap = int.from_bytes(slot_dump, "little")
+        slot_bits = [(bitmap >> i) & 1 for i in range(len(slot_dump) * 8)]
         for i in range(slot_count):
             if slot_bits[i]:
                 table_addresses.append(u32(table_addr_dump[i * 4: i * 4 + 4]) << 2)
@@ -1314,8 +1751,8 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 table_values.append(None)
         return (table_addresses, table_values, slot_bits)
 
-    def patchRom(self, address, patch, slot=None):
-        # type: (Address, Any, Optional[Any]) -> bool
+    def patchRom(self, address, patch, slot=None, record=True):
+        # type: (Address, Any, Optional[Any], bool) -> bool
         """
         Patch a 4-byte value (DWORD) inside the ROM section of the firmware
         (0x0 - 0x8FFFF) using the patchram mechanism. There are 128 available
@@ -1326,6 +1763,9 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         address: The address at which the patch should be applied
                  (if the address is not 4-byte aligned, the patch will be splitted into two slots)
         patch:   The new value which should be placed at the address (byte string of length 4)
+        record:  Whether the patch is part of the session setup saved by createPatchManifest().
+                 Branches into RAM which is not restored by the manifest (e.g. tracepoint
+                 and countpoint hooks) must not be recorded.
 
         Returns True on success and False on failure.
         """
@@ -1362,12 +1802,13 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
             orig = self.readMem(address - alignment, 8)
             # patch the difference of the 4 bytes we want to patch within the original 8 bytes
             self.patchRom(
-                address - alignment, orig[:alignment] + patch[: 4 - alignment], slot
+                address - alignment, orig[:alignment] + patch[: 4 - alignment], slot, record
             )
             self.patchRom(
                 address - alignment + 4,
                 patch[4 - alignment:] + orig[alignment + 4:],
                 slot,
+                record,
             )
             return True
 
@@ -1382,12 +1823,14 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 )
                 # Write new value to patchram value table at 0xd0000
                 self.writeMem(self.fw.PATCHRAM_VALUE_TABLE_ADDRESS + slot * 4, patch)
+                if record:
+                    self.session_patches[address] = bytes(patch)
                 return True
 
         if slot is None:
             # Find free slot:
             for i in range(self.fw.PATCHRAM_NUMBER_OF_SLOTS):
-                if table_addresses[i] is None:
+                if table_addresses[i] is None and i not in self.reserved_patchram_slots:
                     slot = i
                     self.logger.info("patchRom: Choosing next free slot: %d" % slot)
                     break
@@ -1410,14 +1853,233 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         # (We need to enable the slot by setting a bit in a multi-dword bitfield)
         target_dword = int(old_div(slot, 32))
         table_slots[slot] = 1
-        slot_dword = unbits(
-            table_slots[target_dword * 32: (target_dword + 1) * 32][::-1]
-        )[::-1]
+        slot_dword = self._patchramBitmapDword(table_slots, target_dword)
         self.writeMem(
             self.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS + target_dword * 4, slot_dword
         )
+        if record:
+            self.session_patches[address] = bytes(patch)
+        return True
+
+    def allocatePatchramSlot(self, address=None):
+        # type: (Optional[Address]) -> Optional[int]
+        """
+        Reserves a patchram slot, e.g. for hook code which has to know its own
+        slot before the patch is installed with patchRom(address, patch, slot).
+        If the address is already patched, its slot is reserved and returned.
+        Otherwise the lowest inactive slot, which is not reserved yet, is chosen.
+
+        Returns the slot number or None if no slot is available.
+        """
+        state = self.getPatchramState()
+        if not state:
+            return None
+        table_addresses, _, _ = state
+
+        if address is not None and address in table_addresses:
+            slot = table_addresses.index(address)
+        else:
+            for slot in range(self.fw.PATCHRAM_NUMBER_OF_SLOTS):
+                if table_addresses[slot] is None and slot not in self.reserved_patchram_slots:
+                    break
+            else:
+                return None
+
+        self.reserved_patchram_slots.add(slot)
+        return slot
+
+    def releasePatchramSlot(self, slot):
+        # type: (int) -> None
+        """
+        Returns a slot reserved with allocatePatchramSlot(). The patch itself
+        is not touched, use disableRomPatch() for that.
+        """
+        self.reserved_patchram_slots.discard(slot)
+
+    @staticmethod
+    def _patchramBitmapDword(table_slots, dword):
+        # type: (List[int], int) -> bytes
+        """
+        Encodes the 32 slot bits of the patchram enable bitmap which belong to
+        the given dword index (as returned in the third list of getPatchramState()).
+        """
+        value = 0
+        for i, bit in enumerate(table_slots[dword * 32: (dword + 1) * 32]):
+            if bit:
+                value |= 1 << i
+        return p32(value)
+
+    @staticmethod
+    def _contiguousRuns(indices):
+        # type: (List[int]) -> List[List[int]]
+        """
+        Splits a list of slot (or dword) indices into runs of consecutive
+        indices, so that each run can be written with a single writeMem().
+        """
+        runs = []  # type: List[List[int]]
+        for index in sorted(indices):
+            if runs and runs[-1][-1] + 1 == index:
+                runs[-1].append(index)
+            else:
+                runs.append([index])
+        return runs
+
+    def _writePatchramTable(self, table_address, entries):
+        # type: (Address, Dict[int, bytes]) -> bool
+        """
+        Writes the given {slot: dword} entries to a patchram table (value table,
+        target table or enable bitmap) with one writeMem() per run of consecutive slots.
+        """
+        for run in self._contiguousRuns(list(entries.keys())):
+            data = b"".join(entries[slot] for slot in run)
+            if not self.writeMem(table_address + run[0] * 4, data):
+                return False
         return True
 
+    def applyPatches(self, patches):
+        # type: (List[Tuple[Address, bytes]]) -> bool
+        """
+        Patch a whole set of 4-byte values (DWORDs) inside the ROM section of the
+        firmware within one transaction (see also patchRom()). In contrast to calling
+        patchRom() for each patch, the patchram state is only read once, all slots
+        are allocated up front, the value and target tables are written in
+        contiguous chunks and each dword of the enable bitmap is written only once.
+
+        patches: A list of (address, patch) tuples. Each patch must be a byte string
+                 of length 4. Unaligned patches are merged with the original content
+                 of the surrounding dwords (or with other patches of the same set).
+                 Addresses which are already patched reuse their slot.
+
+        Returns True on success and False on failure. If writing to the patchram
+        fails, the tables and the enable bitmap are restored to their previous state.
+        """
+
+        # Check if constants are defined in fw.py
+        for const in [
+            "PATCHRAM_TARGET_TABLE_ADDRESS",
+            "PATCHRAM_ENABLED_BITMAP_ADDRESS",
+            "PATCHRAM_VALUE_TABLE_ADDRESS",
+            "PATCHRAM_NUMBER_OF_SLOTS",
+        ]:
+            if const not in dir(self.fw):
+                self.logger.warning("applyPatches: '%s' not in fw.py. FEATURE NOT SUPPORTED!" % const)
+                return False
+
+        # Merge all patches into aligned dwords. The mask tracks which bytes
+        # of a dword are covered by the patch set.
+        dwords = {}  # type: Dict[int, bytearray]
+        masks = {}  # type: Dict[int, List[bool]]
+        for address, patch in patches:
+            if len(patch) != 4:
+                self.logger.warning("applyPatches: patch (%s) must be a 32-bit dword!" % patch)
+                return False
+            for i in range(4):
+                aligned = (address + i) & ~3
+                if aligned not in dwords:
+                    dwords[aligned] = bytearray(4)
+                    masks[aligned] = [False] * 4
+                dwords[aligned][(address + i) % 4] = patch[i]
+                masks[aligned][(address + i) % 4] = True
+
+        if not dwords:
+            return True
+
+        # Partially covered dwords (unaligned patches) keep the original bytes.
+        # Neighbouring dwords are fetched with a single readMem().
+        partial = [old_div(aligned, 4) for aligned in dwords if not all(masks[aligned])]
+        for run in self._contiguousRuns(partial):
+            orig = self.readMem(run[0] * 4, len(run) * 4)
+            if orig is None or len(orig) != len(run) * 4:
+                self.logger.warning("applyPatches: Could not read original content at 0x%x" % (run[0] * 4))
+                return False
+            for n, index in enumerate(run):
+                for i in range(4):
+                    if not masks[index * 4][i]:
+                        dwords[index * 4][i] = orig[n * 4 + i]
+
+        state = self.getPatchramState()
+        if not state:
+            self.logger.warning("applyPatches: Could not read patchram state!")
+            return False
+        table_addresses, table_values, table_slots = state
+        slot_count = self.fw.PATCHRAM_NUMBER_OF_SLOTS
+
+        # Reuse slots of addresses which are already patched
+        slots = {}  # type: Dict[int, int]
+        for i in range(slot_count):
+            if table_addresses[i] in dwords:
+                slots[table_addresses[i]] = i
+        reused_slots = list(slots.values())
+
+        # Allocate all remaining slots up front. Prefer a run of consecutive
+        # free slots so that the tables can be written in one chunk.
+        new_addresses = sorted(aligned for aligned in dwords if aligned not in slots)
+        free_slots = [
+            i for i in range(slot_count)
+            if table_addresses[i] is None and i not in self.reserved_patchram_slots
+        ]
+        if len(free_slots) < len(new_addresses):
+            self.logger.warning(
+                "applyPatches: %d slots needed but only %d are free!"
+                % (len(new_addresses), len(free_slots))
+            )
+            return False
+        count = len(new_addresses)
+        new_slots = free_slots[:count]
+        if count > 0:
+            for start in range(len(free_slots) - count + 1):
+                if free_slots[start + count - 1] - free_slots[start] == count - 1:
+                    new_slots = free_slots[start: start + count]
+                    break
+        for aligned, slot in zip(new_addresses, new_slots):
+            slots[aligned] = slot
+
+        values = {slot: bytes(dwords[aligned]) for aligned, slot in slots.items()}
+        targets = {slot: p32(aligned >> 2) for aligned, slot in zip(new_addresses, new_slots)}
+
+        # Enable all new slots, each affected bitmap dword is written exactly once
+        new_table_slots = list(table_slots)
+        for slot in new_slots:
+            new_table_slots[slot] = 1
+        bitmap_dwords = set(old_div(slot, 32) for slot in new_slots)
+        bitmap = {dword: self._patchramBitmapDword(new_table_slots, dword) for dword in bitmap_dwords}
+
+        self.logger.debug(
+            "applyPatches: applying %d dwords (%d new slots, %d reused slots)"
+            % (len(dwords), len(new_slots), len(reused_slots))
+        )
+
+        # New slots are still disabled while their value and target are written,
+        # they only become active with the bitmap write at the very end.
+        if (
+                self._writePatchramTable(self.fw.PATCHRAM_VALUE_TABLE_ADDRESS, values)
+                and self._writePatchramTable(self.fw.PATCHRAM_TARGET_TABLE_ADDRESS, targets)
+                and self._writePatchramTable(self.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS, bitmap)
+        ):
+            self.logger.info(
+                "applyPatches: Applied %d patches using %d slots" % (len(patches), len(slots))
+            )
+            for aligned in dwords:
+                self.session_patches[aligned] = bytes(dwords[aligned])
+            return True
+
+        # Roll back: restore the bitmap, the values of reused slots and clear the
+        # targets of new slots (0xFFFFC seems to be the default value if the slot is inactive)
+        self.logger.warning("applyPatches: Writing to patchram failed, rolling back...")
+        self._writePatchramTable(
+            self.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS,
+            {dword: self._patchramBitmapDword(table_slots, dword) for dword in bitmap_dwords},
+        )
+        self._writePatchramTable(
+            self.fw.PATCHRAM_VALUE_TABLE_ADDRESS,
+            {slot: table_values[slot] for slot in reused_slots},
+        )
+        self._writePatchramTable(
+            self.fw.PATCHRAM_TARGET_TABLE_ADDRESS,
+            {slot: p32(0xFFFFC >> 2) for slot in new_slots},
+        )
+        return False
+
     def disableRomPatch(self, address, slot=None):
         # type: (int, Optional[int]) -> bool
         """
@@ -1439,7 +2101,10 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 )
                 return False
 
-        table_addresses, table_values, table_slots = self.getPatchramState()
+        state = self.getPatchramState()
+        if not state:
+            return False
+        table_addresses, table_values, table_slots = state
 
         if slot is None:
             if address is None:
@@ -1458,17 +2123,118 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         # (We need to disable the slot by clearing a bit in a multi-dword bitfield)
         target_dword = int(old_div(slot, 32))
         table_slots[slot] = 0
-        slot_dword = unbits(
-            table_slots[target_dword * 32: (target_dword + 1) * 32][::-1]
-        )[::-1]
-        self.writeMem(
+        slot_dword = self._patchramBitmapDword(table_slots, target_dword)
+        if not self.writeMem(
             self.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS + target_dword * 4, slot_dword
-        )
+        ):
+            self.logger.warning("disableRomPatch: Could not disable slot %d!" % slot)
+            return False
 
         # Write 0xFFFFC to patchram target table at 0x310000
         # (0xFFFFC seems to be the default value if the slot is inactive)
-        self.writeMem(
+        if not self.writeMem(
             self.fw.PATCHRAM_TARGET_TABLE_ADDRESS + slot * 4, p32(0xFFFFC >> 2)
+        ):
+            self.logger.warning("disableRomPatch: Could not reset the target of slot %d!" % slot)
+            return False
+        self.session_patches.pop(table_addresses[slot], None)
+        return True
+
+    def _isPatchramTableAddress(self, address):
+        # type: (Address) -> bool
+        """
+        Returns True if the address belongs to one of the patchram tables. Writes
+        to these tables are covered by session_patches instead of session_ram_writes.
+        """
+        if self.fw is None or "PATCHRAM_NUMBER_OF_SLOTS" not in dir(self.fw):
+            return False
+        slot_count = self.fw.PATCHRAM_NUMBER_OF_SLOTS
+        for table_address, table_size in [
+            (self.fw.PATCHRAM_VALUE_TABLE_ADDRESS, slot_count * 4),
+            (self.fw.PATCHRAM_TARGET_TABLE_ADDRESS, slot_count * 4),
+            (self.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS, old_div(slot_count, 8)),
+        ]:
+            if table_address <= address < table_address + table_size:
+                return True
+        return False
+
+    def createPatchManifest(self):
+        # type: () -> PatchManifest
+        """
+        Creates a PatchManifest of the persistent RAM writes (writeMem() with
+        persistent=True) and the patchram entries (patchRom(), applyPatches())
+        of this session.
+        """
+        return PatchManifest(
+            self.fw.FW_NAME if self.fw else None,
+            self.lmp_subversion,
+            self.session_ram_writes,
+            sorted(self.session_patches.items()),
+        )
+
+    def isPatchManifestApplied(self, manifest):
+        # type: (PatchManifest) -> bool
+        """
+        Checks whether a PatchManifest is already applied by reading back the
+        patchram state and the RAM blobs and comparing the digest. The patchram
+        is checked first, as it is cleared by a controller reset anyway.
+        """
+        state = self.getPatchramState()
+        if not state:
+            return False
+        table_addresses, table_values, table_slots = state
+
+        enabled = {}
+        for i in range(self.fw.PATCHRAM_NUMBER_OF_SLOTS):
+            if table_addresses[i] is not None:
+                enabled[table_addresses[i]] = bytes(table_values[i])
+
+        current = PatchManifest(manifest.fw_name, manifest.lmp_subversion)
+        for address, value in manifest.patches:
+            if enabled.get(address) != value:
+                return False
+            current.add_patch(address, value)
+
+        for address, data in manifest.coalesced_ram_blobs():
+            dump = self.readMem(address, len(data))
+            if dump is None or len(dump) != len(data):
+                return False
+            current.add_ram(address, dump)
+
+        return current.digest() == manifest.digest()
+
+    def applyPatchManifest(self, manifest, force=False):
+        # type: (PatchManifest, bool) -> bool
+        """
+        Applies a PatchManifest: RAM blobs are written first (coalesced into as
+        few writeMem() calls as possible), then all patchram entries are installed
+        with a single applyPatches() transaction.
+
+        If the manifest is already applied, nothing is written unless force is set.
+        Returns True on success and False on failure.
+        """
+        if manifest.lmp_subversion is not None and manifest.lmp_subversion != self.lmp_subversion:
+            self.logger.warning(
+                "applyPatchManifest: Manifest was created for LMP subversion 0x%x (%s), but this is 0x%x!"
+                % (manifest.lmp_subversion, manifest.fw_name, self.lmp_subversion or 0)
+            )
+            return False
+
+        if not force and self.isPatchManifestApplied(manifest):
+            self.logger.info("applyPatchManifest: Manifest %s is already applied." % manifest.digest()[:16])
+            return True
+
+        for address, data in manifest.coalesced_ram_blobs():
+            if not self.writeMem(address, data, persistent=True):
+                self.logger.warning("applyPatchManifest: Writing RAM blob to 0x%x failed!" % address)
+                return False
+
+        if len(manifest.patches) > 0 and not self.applyPatches(manifest.patches):
+            return False
+
+        self.logger.info(
+            "applyPatchManifest: Applied %d RAM blobs and %d patches."
+            % (len(manifest.coalesced_ram_blobs()), len(manifest.patches))
         )
         return True
 
@@ -1543,40 +2309,68 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         if connection == b"\x00" * self.fw.CONNECTION_STRUCT_LENGTH:
             return None
 
-        conn_dict = ConnectionInformation.from_connection_buffer(connection)
+        conn_dict = ConnectionInformation.from_connection_buffer(connection, self.fw.CONNECTION_STRUCT_LAYOUT)
 
         return conn_dict
 
-    def sendLmpPacket(
-            self, opcode, payload="", is_master=True, conn_handle=0x0C, extended_op=False
-    ):
-        # type: (Opcode, bytes, bool, ConnectionNumber, bool) -> bool
+    def readAllConnections(self):
+        # type: () -> Optional[List[Optional[ConnectionInformation]]]
         """
-        Inject a LMP packet into a Bluetooth connection (i.e. send a LMP packet
-        to a remote device which is paired and connected with our local device).
-        This code is using the vendor specific HCI command 0xfc58, which sends
-        an LMP PDU. Note that Broadcom firmware internally checks opcodes and 
-        lengths, meaning that despite returning success long payloads will be
-        cut and invalid opcodes might be discarded.
+        Reads and parses all connection structs at once. The result has one
+        entry per connection index (connection number - 1), empty structs are
+        None, see readConnectionInformation().
 
-        is_master:   Determines if we are master or slave within the connection.
-        conn_handle: The connection handle specifying the connection into which the
-                     packet will be injected. By default, the first connection handle
-                     used by Broadcom is 0x0c.
-        opcode:      The LMP opcode of the LMP packet that will be injected.
-        payload:     The LMP payload of the LMP packet that will be injected.
-                     Can be empty.
-        extended_op: Set to True if the opcode should be interpreted as extended / escaped
-                     LMP opcode.
+        With CONNECTION_ARRAY_ADDRESS, the whole table is read with a single
+        readMem(). With CONNECTION_LIST_ADDRESS, all pointers are read at once
+        and then the structs, adjacent structs together.
+        """
+        for const in ["CONNECTION_MAX", "CONNECTION_STRUCT_LENGTH"]:
+            if const not in dir(self.fw):
+                self.logger.warning(
+                    "readAllConnections: '%s' not in fw.py. FEATURE NOT SUPPORTED!" % const
+                )
+                return None
 
-        Returns True on success and False on failure.
+        length = self.fw.CONNECTION_STRUCT_LENGTH
+        if "CONNECTION_ARRAY_ADDRESS" in dir(self.fw):
+            table = self.readMem(self.fw.CONNECTION_ARRAY_ADDRESS, length * self.fw.CONNECTION_MAX)
+            if table is None or len(table) != length * self.fw.CONNECTION_MAX:
+                return None
+            table = memoryview(table)
+            buffers = [table[i * length:(i + 1) * length] for i in range(self.fw.CONNECTION_MAX)]
+        elif "CONNECTION_LIST_ADDRESS" in dir(self.fw):
+            pointers = self.readMem(self.fw.CONNECTION_LIST_ADDRESS, 4 * self.fw.CONNECTION_MAX)
+            if pointers is None or len(pointers) != 4 * self.fw.CONNECTION_MAX:
+                return None
+            addresses = unpack_u32_array(pointers)
+            structs = self._readMemRanges([(address, length) for address in addresses if address != 0], max_gap=0)
+            if structs is None:
+                return None
+            buffers = [structs[address] if address != 0 else None for address in addresses]
+        else:
+            self.logger.warning(
+                "readAllConnections: neither CONNECTION_LIST nor CONNECTION_ARRAY in fw.py. FEATURE NOT SUPPORTED!"
+            )
+            return None
+
+        return [
+            None if connection is None or connection == b"\x00" * length
+            else ConnectionInformation.from_connection_buffer(connection, self.fw.CONNECTION_STRUCT_LAYOUT)
+            for connection in buffers
+        ]
+
+    def _lmpPduParameters(self, opcode, payload, is_master, conn_handle, extended_op):
+        # type: (Opcode, bytes, bool, ConnectionNumber, bool) -> Optional[bytes]
+        """
+        Builds the parameters of the VSC_SendLmpPdu command, see sendLmpPacket().
+        Returns None if the arguments are out of range.
         """
 
         # Check the connection handle
         # Range: 0x0000-0x0EFF (all other values reserved for future use)
         if conn_handle < 0 or conn_handle > 0x0EFF:
             self.logger.warning("sendLmpPacket: connection handle out of bounds: %d" % conn_handle)
-            return False
+            return None
 
         # must be string...
         if payload is None:
@@ -1586,7 +2380,7 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 extended_op and opcode > 0xFF
         ):
             self.logger.warning("sendLmpPacket: opcode out of range!")
-            return False
+            return None
 
         # Build the LMP packet
         opcode_data = (
@@ -1607,11 +2401,38 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 "sendLmpPacket: Vendor specific HCI command only allows for 17 bytes LMP content."
             )
 
-        # self.logger.info("packet: " + p16(conn_handle) + p8(len(data)) + data)
-        result = self.sendHciCommand(
-            HCI_COMND.VSC_SendLmpPdu,
-            p16(conn_handle) + p8(len(payload + opcode_data)) + data,
-        )
+        return p16(conn_handle) + p8(len(payload + opcode_data)) + data
+
+    def sendLmpPacket(
+            self, opcode, payload="", is_master=True, conn_handle=0x0C, extended_op=False
+    ):
+        # type: (Opcode, bytes, bool, ConnectionNumber, bool) -> bool
+        """
+        Inject a LMP packet into a Bluetooth connection (i.e. send a LMP packet
+        to a remote device which is paired and connected with our local device).
+        This code is using the vendor specific HCI command 0xfc58, which sends
+        an LMP PDU. Note that Broadcom firmware internally checks opcodes and 
+        lengths, meaning that despite returning success long payloads will be
+        cut and invalid opcodes might be discarded.
+
+        is_master:   Determines if we are master or slave within the connection.
+        conn_handle: The connection handle specifying the connection into which the
+                     packet will be injected. By default, the first connection handle
+                     used by Broadcom is 0x0c.
+        opcode:      The LMP opcode of the LMP packet that will be injected.
+        payload:     The LMP payload of the LMP packet that will be injected.
+                     Can be empty.
+        extended_op: Set to True if the opcode should be interpreted as extended / escaped
+                     LMP opcode.
+
+        Returns True on success and False on failure.
+        """
+
+        parameters = self._lmpPduParameters(opcode, payload, is_master, conn_handle, extended_op)
+        if parameters is None:
+            return False
+
+        result = self.sendHciCommand(HCI_COMND.VSC_SendLmpPdu, parameters)
 
         if result is None:
             self.logger.warning(
@@ -1663,12 +2484,71 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
             "b 0x%x" % self.fw.FUZZLMP_CODE_BASE_ADDRESS,
             vma=self.fw.FUZZLMP_HOOK_ADDRESS,
         )
-        if not self.patchRom(self.fw.FUZZLMP_HOOK_ADDRESS, patch):
+        if not self.patchRom(self.fw.FUZZLMP_HOOK_ADDRESS, patch, record=False):
             self.logger.warning("Error writing to patchram when installing fuzzLmp patch!")
             return False
 
         return True
 
+    def _invalidateInjectionSnippets(self, address, length):
+        # type: (Address, int) -> None
+        """ Forgets the resident injection snippets which overlap the given range. """
+        for snippet_address, state in self.injection_snippets.items():
+            resident = state["resident"]
+            if resident is None:
+                continue
+            if address < snippet_address + len(resident) and snippet_address < address + length:
+                state["resident"] = None
+
+    def _writeInjectionSnippet(self, address, asm_code, data):
+        # type: (Address, str, bytes) -> bool
+        """
+        Writes an injection snippet (e.g. SENDLMP_ASM_CODE) followed by <data>
+        to <address>. The snippet ends with the 'mailbox' label, the data is
+        placed there. The snippet does not contain any per-packet values, these
+        are passed in the mailbox together with the packet. Its literal pool
+        must be placed in front of the mailbox (.ltorg), so that the mailbox is
+        the end of the snippet and may have any size.
+
+        Each snippet is only assembled once per session, and only the bytes
+        which differ from the snippet that is already on the chip are written.
+        Sending packets therefore costs one small writeMem() for the mailbox
+        instead of running the assembler.
+        Any other writeMem() to the snippet's range invalidates this state.
+        """
+        state = self.injection_snippets.setdefault(address, {"code": {}, "resident": None})
+        if asm_code not in state["code"]:
+            # The mailbox offset is found by assembling the snippet with two different fillings
+            zeros = asm(asm_code + ".fill 4, 1, 0x00\n", vma=address, arch="thumb")
+            ones = asm(asm_code + ".fill 4, 1, 0xff\n", vma=address, arch="thumb")
+            offset = next(i for i in range(len(zeros)) if zeros[i] != ones[i])
+            if offset + 4 != len(zeros):
+                self.logger.warning(
+                    "_writeInjectionSnippet: the snippet continues behind its mailbox (missing .ltorg?)"
+                )
+                return False
+            state["code"][asm_code] = zeros[:offset]
+        image = state["code"][asm_code] + data
+
+        resident = state["resident"]
+        if resident is not None:
+            # A shorter mailbox leaves the end of the previous one on the chip
+            common = min(len(image), len(resident))
+            changed = [i for i in range(common) if image[i] != resident[i]] + list(range(common, len(image)))
+            if not changed:
+                return True
+            start, end = changed[0], changed[-1] + 1
+            image = image + resident[len(image):]
+        else:
+            start, end = 0, len(image)
+
+        # Forget the content on failure, the next call writes the whole snippet
+        state["resident"] = None
+        if not self.writeMem(address + start, image[start:end]):
+            return False
+        state["resident"] = image
+        return True
+
     @needs_pwnlib
     def sendLmpPacketLegacy(self, conn_nr, opcode, payload, extended_op=False):
         # type: (int, Opcode, bytes, bool) -> bool
@@ -1712,18 +2592,12 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         opcode_data = p8(opcode << 1) if not extended_op else p8(0x7F << 1) + p8(opcode)
         data = opcode_data + payload
 
-        # Prepare the assembler snippet by injecting the connection number
-        # and appending the LMP packet data.
-        asm_code = self.fw.SENDLMP_ASM_CODE % (conn_nr)  # type: str
-        asm_code_with_data = asm_code + "".join(
-            [".byte 0x%02x\n" % x for x in data.ljust(20, b"\x00")]
-        )
-
-        # Assemble the snippet and write it to SENDLMP_CODE_BASE_ADDRESS
-        code = asm(
-            asm_code_with_data, vma=self.fw.SENDLMP_CODE_BASE_ADDRESS, arch="thumb"
-        )
-        self.writeMem(self.fw.SENDLMP_CODE_BASE_ADDRESS, code)
+        # The connection number and the LMP packet go into the mailbox at the end of the snippet.
+        # The snippet always copies 20 bytes (the max. size of an LMP packet).
+        mailbox = p32(conn_nr) + data.ljust(20, b"\x00")
+        if not self._writeInjectionSnippet(self.fw.SENDLMP_CODE_BASE_ADDRESS, self.fw.SENDLMP_ASM_CODE, mailbox):
+            self.logger.warning("sendLmpPacket: writing the snippet failed!")
+            return False
 
         # Invoke the snippet
         if self.launchRam(self.fw.SENDLMP_CODE_BASE_ADDRESS):
@@ -1755,18 +2629,11 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 )
                 return False
 
-        # Prepare the assembler snippet by injecting the connection number
-        # and appending the LMP packet data.
-        asm_code = self.fw.SENDLCP_ASM_CODE % (conn_idx, len(payload))
-        asm_code_with_data = asm_code + "".join(
-            [".byte 0x%02x\n" % x for x in payload.ljust(20, b"\x00")]
-        )
-
-        # Assemble the snippet and write it to SENDLCP_CODE_BASE_ADDRESS
-        code = asm(
-            asm_code_with_data, vma=self.fw.SENDLCP_CODE_BASE_ADDRESS, arch="thumb"
-        )
-        self.writeMem(self.fw.SENDLCP_CODE_BASE_ADDRESS, code)
+        # The connection index, the length and the LCP packet go into the mailbox at the end of the snippet
+        mailbox = p32(conn_idx) + p32(len(payload)) + payload
+        if not self._writeInjectionSnippet(self.fw.SENDLCP_CODE_BASE_ADDRESS, self.fw.SENDLCP_ASM_CODE, mailbox):
+            self.logger.warning("sendLcpPacket: writing the snippet failed!")
+            return False
 
         # Invoke the snippet
         if self.launchRam(self.fw.SENDLCP_CODE_BASE_ADDRESS):
@@ -1835,38 +2702,24 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         Create Connection
         """
 
-        _hcipkt = record[0]
-        if not issubclass(_hcipkt.__class__, hci.HCI_Event):
-            return
-        hcipkt: hci.HCI_Event = cast(hci.HCI_Event, _hcipkt)  # get HCI Event packet
+        event = decode_packet(record[0])
 
         # Check if event is Connection Create Status Event
-        if hcipkt.event_code == 0x0F:
-            if u16(hcipkt.data[2:4]) == 0x0405:  # Create Connection HCI Cmd
+        if isinstance(event, CommandStatus):
+            if event.opcode == HCI_COMND.Create_Connection.value:
                 self.logger.info("[Connection Create initiated]")
                 return
 
         # Check if event is Connection Create Complete Event
-        if hcipkt.event_code == 0x03:
-            status = hcipkt.data[0]
-            status_str = (
-                hex(status)
-                if status not in hcipkt.HCI_COMMAND_ERROR_STR
-                else hcipkt.HCI_COMMAND_ERROR_STR[status]
-            )
-            conn_handle = u16(hcipkt.data[1:3])
-            btaddr = hcipkt.data[3:9][::-1]
-            # btaddr_str = ":".join([b.encode("hex") for b in btaddr])
-            btaddr_str = bytes_to_hex(btaddr)
+        if isinstance(event, ConnectionComplete):
             self.logger.info(
                 "[Connect Complete: Handle=0x%x  Address=%s  status=%s]"
-                % (conn_handle, btaddr_str, status_str)
+                % (event.handle, bytes_to_hex(event.address), event.status_str)
             )
 
         # Also show Disconnect Complete
-        if hcipkt.event_code == 0x05:
-            conn_handle = u16(hcipkt.data[1:3])
-            self.logger.info("[Disconnect Complete: Handle=0x%x]" % (conn_handle))
+        if isinstance(event, DisconnectionComplete):
+            self.logger.info("[Disconnect Complete: Handle=0x%x]" % event.handle)
 
     def coexStatusCallback(self, record):
         # type: (Record) -> None
@@ -1876,17 +2729,13 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         Call with "sendhcicmd 0xfc90"
         """
 
-        hcipkt = record[0]  # get HCI Event packet
-        timestamp = record[5]  # get timestamp
-
-        if not issubclass(hcipkt.__class__, hci.HCI_Event):
-            return
+        event = decode_packet(record[0])
 
         # Command complete event with stats
-        if hcipkt.event_code == 0x0E:
-            if u16(hcipkt.data[1:3]) == 0xFC90:  # Coex Statistics Cmd
-                coex_grant = u32(hcipkt.data[4:8])
-                coex_reject = u32(hcipkt.data[8:12])
+        if isinstance(event, CommandComplete):
+            if event.opcode == 0xFC90:  # Coex Statistics Cmd
+                coex_grant = u32(event.result[0:4])
+                coex_reject = u32(event.result[4:8])
                 ratio = 0
                 if coex_grant > 0:
                     ratio = coex_reject / float(coex_grant)
@@ -1896,8 +2745,8 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 )
                 return
 
-    def readHeapInformation(self):
-        # type: () -> Optional[Union[List[HeapInformation], bool]]
+    def readHeapInformation(self, include_memory=False):
+        # type: (bool) -> Optional[Union[List[HeapInformation], bool]]
         """
         Traverses the double-linked list of BLOC structs and returns them as a
         list of dictionaries. The dicts have the following fields:
@@ -1914,6 +2763,11 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         - prev:             Previous BLOC struct (double-linked list)
         - next:             Next BLOC struct (double-linked list)
         - buffer_headers:   Dictionoary containing buffer headers (e.g. free linked list)
+        - memory_dump:      Content of the backing buffer (only if include_memory is set)
+
+        Only the buffer headers are read, neighbouring headers of small buffers
+        share one readMem() call. With include_memory the backing buffer of each
+        BLOC struct is read with a single readMem() call instead.
         """
 
         # Check if constants are defined in fw.py
@@ -1983,12 +2837,37 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 current_element["prev"] = bloc_fields[11]
                 current_element["buffer_headers"] = {}
 
-            # Parsing buffer headers
+            # Parsing buffer headers: each buffer is preceded by a 4 byte header
             buffer_size = current_element["buffer_size"] + 4
-            for buf_index in range(current_element["capacity"]):
-                buffer_address = current_element["memory"] + buf_index * buffer_size
-                hdr = u32(self.readMem(buffer_address, 4))
-                current_element["buffer_headers"][buffer_address] = hdr
+            if include_memory:
+                # Read the whole backing buffer, the headers are decoded from it
+                headers_per_read = current_element["capacity"]
+            elif buffer_size <= 0x40:
+                # Neighbouring headers of small buffers share one Read_RAM command (max. 251 bytes)
+                headers_per_read = (251 - 4) // buffer_size + 1
+            else:
+                headers_per_read = 1
+            memory_dump = bytearray()
+            for buf_index in range(0, current_element["capacity"], headers_per_read):
+                count = min(headers_per_read, current_element["capacity"] - buf_index)
+                read_address = current_element["memory"] + buf_index * buffer_size
+                if include_memory:
+                    data = self.readMem(read_address, count * buffer_size)
+                else:
+                    data = self.readMem(read_address, (count - 1) * buffer_size + 4)
+                if data is None:
+                    self.logger.warning(
+                        "readHeapInformation: Cannot read memory of BLOC[%d] at 0x%x. abort."
+                        % (index, read_address)
+                    )
+                    return None
+                if include_memory:
+                    memory_dump += data
+                for hdr_index, hdr in enumerate(unpack_u32_array(data, count=count, stride=buffer_size)):
+                    buffer_address = read_address + hdr_index * buffer_size
+                    current_element["buffer_headers"][buffer_address] = hdr
+            if include_memory:
+                current_element["memory_dump"] = bytes(memory_dump)
 
             # Append and iterate
             bloclist.append(current_element)
@@ -2015,7 +2894,8 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         In contrast to the readHeapInformation command, this does
         not manually traverse and check the heap. This means that
         this variant is faster but cannot perform checks for
-        heap corruptions.
+        heap corruptions. The statistics of each event are added
+        to self.memory_pool_statistics (see MemoryPoolStatistics).
 
         TODO: There might be more subcommands, maybe also check out
         0x51 (Logging over PCIe) and 0x02 (Write Trace Config).
@@ -2059,6 +2939,10 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
                 self.logger.debug(current_element)
                 pool_list.append(current_element)
 
+            # Keep the time series, the return value is discarded by the receive thread
+            for pool_name, alert in self.memory_pool_statistics.add(meta_info, pool_list):
+                self.logger.warning("Memory pool alert: %s (%s)" % (pool_name, alert))
+
             # We're called asynchronous so we can return but printing in the
             # command line does not really make sense.
             self.logger.info((
@@ -2080,11 +2964,48 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
 
         return
 
-    def readQueueInformation(self):
-        # type: () -> Optional[List[QueueElement]]
+    def _readAheadLength(self, address, length):
+        # type: (int, int) -> int
+        """
+        Number of bytes that can be read at <address> with a single Read_RAM
+        command without leaving the RAM section. Reading from unmapped memory
+        crashes the chip, so nothing is read ahead outside of known RAM.
+        """
+        for section in getattr(self.fw, "SECTIONS", []):
+            if section.is_ram and section.start_addr <= address < section.end_addr:
+                return max(length, min(address + 248, section.end_addr) - address)
+        return length
+
+    def _readMemRanges(self, ranges, max_gap=0x40):
+        # type: (List[Tuple[int, int]], int) -> Optional[Dict[int, bytes]]
+        """
+        Reads several (address, length) ranges. Ranges that overlap or are at
+        most <max_gap> bytes apart are read with one readMem() call.
+        Returns the content of each range by its address.
+        """
+        result = {}
+        ordered = sorted(set((address, length) for address, length in ranges if length > 0))
+        i = 0
+        while i < len(ordered):
+            start = ordered[i][0]
+            end = start + ordered[i][1]
+            j = i + 1
+            while j < len(ordered) and ordered[j][0] <= end + max_gap:
+                end = max(end, ordered[j][0] + ordered[j][1])
+                j += 1
+            data = self.readMem(start, end - start)
+            if data is None or len(data) != end - start:
+                return None
+            for address, length in ordered[i:j]:
+                result[address] = bytes(data[address - start:address - start + length])
+            i = j
+        return result
+
+    def readQueueInformation(self, include_items=False):
+        # type: (bool) -> Optional[List[QueueElement]]
         """
         Traverses the double-linked list of QUEUE structs and returns them as a
-        list of dictionaries. The dicts have the following fields:
+        list of QueueElement objects. They have the following fields:
         - index:            Index of the BLOC struct inside the double-linked list
         - address:          Address of the BLOC struct
         - item_size:        Size of a single queue item (in Byte)
@@ -2099,8 +3020,13 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         - waitlist_length:  Length of the waiting list
         - prev:             Previous BLOC struct (double-linked list)
         - next:             Next BLOC struct (double-linked list)
-        - items:            List of queue items (raw bytes)
+        - items:            List of queue items (raw bytes), only if include_items is set
         - name:             Name of the queue (from reverse engineering its usage)
+
+        A QUEUE struct is usually followed by its buffer and the next struct, so
+        each read fetches a whole Read_RAM payload which is used for all structs
+        (and buffers) inside it. The remaining buffers of non-empty queues are
+        read together afterwards.
         """
 
         # Check if constants are defined in fw.py
@@ -2115,13 +3041,33 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
         # Read address of first queue struct:
         first_queue_struct_address = u32(self.readMem(self.fw.QUEUE_HEAD, 4))
 
+        def fetched_range(address, length):
+            # type: (int, int) -> Optional[bytes]
+            for fetched_address, data in fetched:
+                offset = address - fetched_address
+                if 0 <= offset and offset + length <= len(data):
+                    return data[offset:offset + length]
+            return None
+
         # Traverse the double-linked list
+        fetched = []  # type: List[Tuple[int, bytes]]
         queuelist = []
         current_queue_struct_address = first_queue_struct_address
         for index in range(
                 100
         ):  # Traverse at most 100 (don't loop forever if linked-list is corrupted)
-            queue_struct = self.readMem(current_queue_struct_address, 0x38)
+            queue_struct = fetched_range(current_queue_struct_address, 0x38)
+            if queue_struct is None:
+                data = self.readMem(
+                    current_queue_struct_address, self._readAheadLength(current_queue_struct_address, 0x38)
+                )
+                if data is None or len(data) < 0x38:
+                    self.logger.warning(
+                        "readQueueInformation: Cannot read QUEUE struct at 0x%x. abort." % current_queue_struct_address
+                    )
+                    return None
+                fetched.append((current_queue_struct_address, data))
+                queue_struct = data[:0x38]
             queue_fields = struct.unpack("I" * 14, queue_struct)
             if queue_fields[0] != u32(b"UEUQ"):
                 self.logger.warning(
@@ -2152,6 +3098,31 @@ class InternalBlue(with_metaclass(ABCMeta, object)):
             current_queue_struct_address = current_element["next"]
             if current_queue_struct_address == first_queue_struct_address:
                 break
+
+        if include_items:
+            # Only non-empty queues need their buffer
+            buffers = {}  # type: Dict[int, bytes]
+            missing = []  # type: List[Tuple[int, int]]
+            for queue in queuelist:
+                length = queue.queue_buf_end - queue.queue_buf_start
+                if queue.available_items == 0 or length <= 0:
+                    queue.items = []
+                    continue
+                data = fetched_range(queue.queue_buf_start, length)
+                if data is None:
+                    missing.append((queue.queue_buf_start, length))
+                else:
+                    buffers[queue.queue_buf_start] = data
+            if missing:
+                data = self._readMemRanges(missing)
+                if data is None:
+                    self.logger.warning("readQueueInformation: Cannot read the queue buffers.")
+                    return None
+                buffers.update(data)
+            for queue in queuelist:
+                if queue.items is None:
+                    queue.items = queue.decode_items(buffers[queue.queue_buf_start])
+
         return queuelist
 
     def enableBroadcomDiagnosticLogging(self, enable):
@@ -0,0 +1,430 @@
+from __future__ import division
+
+import struct
+from builtins import object
+
+from .core import asm, needs_pwnlib
+from .utils.packing import p32, u32
+from .utils.thumb import encode_branch
+
+try:
+    from typing import Dict, Iterable, List, Optional, Set, Tuple, Union, TYPE_CHECKING
+    if TYPE_CHECKING:
+        from .core import InternalBlue
+except ImportError:
+    pass
+
+
+# Shared by all coverage hooks. Each hook (see CoverageCollector._stub) saves
+# r0-r5 and lr, reserves a word for the return address and passes its
+# patchram slot in r0 and the block address (with the Thumb bit) in r1.
+# The hit is stored in the hit map and the slot(s) of the hook are disabled,
+# so the original code runs from now on (one-shot).
+COVERAGE_COMMON_ASM = """
+    coverage_common:
+        str  r1, [sp, 28]       // return address for the final pop
+        mrs  r4, cpsr           // the flags must survive the hook
+
+        ldr  r1, =0x%(hitmap)x
+        mov  r2, 1
+        strb r2, [r1, r0]       // hitmap[slot] = 1
+
+        ldr  r1, =0x%(partners)x
+        ldrb r1, [r1, r0]       // second slot of blocks which are not 4-byte aligned (0xff: none)
+        bl   disable_slot
+        cmp  r1, 0xff
+        beq  coverage_return
+        mov  r0, r1
+        bl   disable_slot
+
+    coverage_return:
+        msr  cpsr_f, r4
+        pop  {r0-r5, lr}
+        pop  {pc}               // continue at the block, the patch is gone now
+
+    // Clears bit <r0> in the patchram enable bitmap, keeps r1 and r4
+    disable_slot:
+        lsr  r2, r0, #5
+        ldr  r3, =0x%(bitmap)x
+        add  r2, r3, r2, lsl #2
+        and  r0, r0, #31
+        mov  r3, 1
+        lsl  r3, r3, r0
+        mrs  r5, primask
+        cpsid i                 // the hooks of other blocks modify the same dword
+        ldr  r0, [r2]
+        bic  r0, r0, r3
+        str  r0, [r2]
+        msr  primask, r5
+        bx   lr
+"""
+
+
+class CoverageCollector(object):
+    """
+    Collects basic block coverage of the ROM with one-shot patchram hooks.
+
+    As many blocks as there are free patchram slots are armed at once. A
+    hit is recorded in a hit map in RAM (one byte per slot) and disables
+    the hook. rotate() reads the hit map with a single readMem(), and arms
+    the next batch of blocks which were not hit yet. Blocks which were not
+    hit in their batch are queued again.
+
+    Blocks which are not 4-byte aligned need two patchram slots. Blocks
+    whose patchram dwords are already patched by someone else are skipped
+    until that patch is gone.
+    """
+
+    STUB_SIZE = 20
+    UNUSED = 0xFF
+
+    def __init__(self, internalblue, blocks, max_slots=None):
+        # type: (InternalBlue, Iterable[Union[int, Tuple[int, int]]], Optional[int]) -> None
+        """
+        blocks: Start addresses of the basic blocks, or (address, size) tuples.
+                The size is only used for the drcov export.
+        """
+        self.internalblue = internalblue
+        self.fw = internalblue.fw
+        self.max_slots = max_slots
+
+        self.block_sizes = {}  # type: Dict[int, int]
+        for block in blocks:
+            if isinstance(block, tuple):
+                self.block_sizes[block[0]] = block[1]
+            else:
+                self.block_sizes[block] = 4
+        self.queue = sorted(address for address in self.block_sizes if address % 2 == 0)
+        self.invalid = sorted(address for address in self.block_sizes if address % 2 != 0)
+
+        self.covered = set()  # type: Set[int]
+        self.rounds = 0
+        self.slots = []  # type: List[int]  # Patchram slots reserved for the hooks
+        self.armed = {}  # type: Dict[int, int]  # Primary slot -> block address
+        self.armed_partners = {}  # type: Dict[int, int]  # Primary slot -> second slot
+        self.original = {}  # type: Dict[int, bytes]  # dword address -> ROM content
+        self.common_address = None  # type: Optional[int]
+        self.stubs_address = None  # type: Optional[int]
+        self.tables_address = None  # type: Optional[int]  # hit map and partner table
+
+    @property
+    def running(self):
+        # type: () -> bool
+        return len(self.slots) > 0
+
+    def hitmap_address(self):
+        # type: () -> int
+        return self.tables_address
+
+    def partners_address(self):
+        # type: () -> int
+        return self.tables_address + self.fw.PATCHRAM_NUMBER_OF_SLOTS
+
+    @needs_pwnlib
+    def _install_common_code(self, address):
+        # type: (int) -> Optional[bytes]
+        return asm(
+            COVERAGE_COMMON_ASM % {
+                "hitmap": self.hitmap_address(),
+                "partners": self.partners_address(),
+                "bitmap": self.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS,
+            },
+            vma=address,
+            arch="thumb",
+        )
+
+    def start(self):
+        # type: () -> bool
+        """ Reserves patchram slots and RAM for the hooks and arms the first batch. """
+        ib = self.internalblue
+        for const in [
+            "PATCHRAM_TARGET_TABLE_ADDRESS",
+            "PATCHRAM_ENABLED_BITMAP_ADDRESS",
+            "PATCHRAM_VALUE_TABLE_ADDRESS",
+            "PATCHRAM_NUMBER_OF_SLOTS",
+            "TRACEPOINT_HOOKS_LOCATION",
+            "TRACEPOINT_HOOK_SIZE",
+        ]:
+            if const not in dir(self.fw):
+                ib.logger.warning("CoverageCollector: '%s' not in fw.py. FEATURE NOT SUPPORTED!" % const)
+                return False
+        if self.running:
+            ib.logger.warning("CoverageCollector: already running")
+            return False
+        if not ib.check_running():
+            return False
+
+        # Take every free slot (or up to max_slots), at least two so that unaligned blocks fit
+        while self.max_slots is None or len(self.slots) < self.max_slots:
+            slot = ib.allocatePatchramSlot()
+            if slot is None:
+                break
+            self.slots.append(slot)
+        if len(self.slots) < 2:
+            ib.logger.warning("CoverageCollector: Not enough free patchram slots")
+            self._release()
+            return False
+
+        # One stub per slot, as many as fit into the hook RAM
+        pool = ib._getTracepointHookPool()
+        self.tables_address = pool.allocate(2 * self.fw.PATCHRAM_NUMBER_OF_SLOTS)
+        self.common_address = pool.allocate(0x60)
+        if self.tables_address is not None and self.common_address is not None:
+            for slot in self.slots[pool.largest_free() // self.STUB_SIZE:]:
+                ib.releasePatchramSlot(slot)
+                self.slots.remove(slot)
+            if len(self.slots) >= 2:
+                self.stubs_address = pool.allocate(self.STUB_SIZE * len(self.slots))
+        if None in (self.tables_address, self.stubs_address, self.common_address):
+            ib.logger.warning("CoverageCollector: No free RAM for the hooks")
+            self._release()
+            return False
+
+        common_code = self._install_common_code(self.common_address)
+        if common_code is None or len(common_code) > 0x60:
+            ib.logger.warning("CoverageCollector: common hook code does not fit")
+            self._release()
+            return False
+        ib.writeMem(self.common_address, common_code)
+
+        ib.logger.info(
+            "CoverageCollector: %d blocks, %d patchram slots" % (len(self.queue), len(self.slots))
+        )
+        return self._arm()
+
+    def _release(self):
+        # type: () -> None
+        ib = self.internalblue
+        for slot in self.slots:
+            ib.releasePatchramSlot(slot)
+        self.slots = []
+        for address in (self.tables_address, self.stubs_address, self.common_address):
+            if address is not None:
+                ib.tracepoint_hook_pool.free(address)
+        self.tables_address = self.stubs_address = self.common_address = None
+
+    def _stub(self, index, slot, block):
+        # type: (int, int, int) -> bytes
+        """ Hook for one block, see COVERAGE_COMMON_ASM. """
+        address = self.stubs_address + index * self.STUB_SIZE
+        return (
+            b"\x81\xb0"  # sub  sp, 4
+            + b"\x3f\xb5"  # push {r0-r5, lr}
+            + b"\x4f\xf0" + bytes([slot, 0x00])  # mov.w r0, <slot>
+            + b"\x01\x49"  # ldr  r1, [pc, 4]
+            + encode_branch(address + 10, self.common_address)  # b.w coverage_common
+            + b"\x00\xbf"  # nop
+            + p32(block | 1, "little")
+        )
+
+    def _bitmap_dwords(self):
+        # type: () -> List[int]
+        return sorted(set(slot // 32 for slot in self.slots))
+
+    def _set_enabled(self, enable):
+        # type: (bool) -> bool
+        """ Sets or clears the enable bits of all hook slots (one read and write per bitmap dword). """
+        ib = self.internalblue
+        active = set(self.armed) | set(self.armed_partners.values()) if enable else set()
+        for dword in self._bitmap_dwords():
+            address = self.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS + dword * 4
+            value = ib.readMem(address, 4)
+            if value is None or len(value) != 4:
+                return False
+            value = u32(value)
+            for slot in self.slots:
+                if slot // 32 == dword:
+                    if slot in active:
+                        value |= 1 << (slot % 32)
+                    else:
+                        value &= ~(1 << (slot % 32))
+            if not ib.writeMem(address, p32(value)):
+                return False
+        return True
+
+    def _read_original(self, dwords):
+        # type: (List[int]) -> bool
+        """ Reads the ROM dwords which are not cached yet, close dwords with one readMem(). """
+        missing = sorted(dword for dword in dwords if dword not in self.original)
+        start = 0
+        while start < len(missing):
+            end = start
+            while end + 1 < len(missing) and missing[end + 1] - missing[end] <= 32 \
+                    and missing[end + 1] + 4 - missing[start] <= 248:
+                end += 1
+            data = self.internalblue.readMem(missing[start], missing[end] + 4 - missing[start])
+            if data is None:
+                return False
+            for dword in missing[start:end + 1]:
+                offset = dword - missing[start]
+                self.original[dword] = bytes(data[offset:offset + 4])
+            start = end + 1
+        return True
+
+    def _select(self, patched):
+        # type: (Set[int]) -> List[Tuple[int, List[int]]]
+        """ The next blocks that fit into the slots, as (block, [dwords]) tuples. """
+        batch = []
+        used = set(patched)
+        slots_left = len(self.slots)
+        deferred = []
+        while self.queue and slots_left > 0:
+            block = self.queue.pop(0)
+            if block in self.covered:
+                continue
+            dwords = [block] if block % 4 == 0 else [block - 2, block + 2]
+            if len(dwords) > slots_left or any(dword in used for dword in dwords):
+                deferred.append(block)
+                continue
+            used.update(dwords)
+            slots_left -= len(dwords)
+            batch.append((block, dwords))
+        self.queue = deferred + self.queue
+        return batch
+
+    def _arm(self):
+        # type: () -> bool
+        """ Installs the hooks for the next batch of blocks. """
+        ib = self.internalblue
+        state = ib.getPatchramState()
+        if not state:
+            return False
+        patched = set(
+            address for slot, address in enumerate(state[0])
+            if address is not None and slot not in self.slots
+        )
+
+        batch = self._select(patched)
+        if not self._read_original([dword for _, dwords in batch for dword in dwords]):
+            return False
+
+        self.armed = {}
+        self.armed_partners = {}
+        free_slots = list(self.slots)
+        stubs = bytearray(self.STUB_SIZE * len(self.slots))
+        values = {}  # type: Dict[int, bytes]
+        targets = {}  # type: Dict[int, bytes]
+        partners = bytearray([self.UNUSED] * self.fw.PATCHRAM_NUMBER_OF_SLOTS)
+        for block, dwords in batch:
+            index = len(self.slots) - len(free_slots)
+            slot = free_slots.pop(0)
+            stub_address = self.stubs_address + index * self.STUB_SIZE
+            stubs[index * self.STUB_SIZE: (index + 1) * self.STUB_SIZE] = self._stub(index, slot, block)
+            branch = encode_branch(block, stub_address)
+            if len(dwords) == 1:
+                values[slot] = branch
+            else:
+                partner = free_slots.pop(0)
+                values[slot] = self.original[dwords[0]][:2] + branch[:2]
+                values[partner] = branch[2:] + self.original[dwords[1]][2:]
+                targets[partner] = p32(dwords[1] >> 2)
+                partners[slot] = partner
+                self.armed_partners[slot] = partner
+            targets[slot] = p32(dwords[0] >> 2)
+            self.armed[slot] = block
+
+        if len(batch) == 0:
+            return True
+
+        # Hooks first, then the patchram tables, then enable the slots
+        if not ib.writeMem(self.stubs_address, bytes(stubs[: self.STUB_SIZE * (len(self.slots) - len(free_slots))])):
+            return False
+        if not ib.writeMem(self.tables_address, bytes(self.fw.PATCHRAM_NUMBER_OF_SLOTS) + bytes(partners)):
+            return False
+        if not ib._writePatchramTable(self.fw.PATCHRAM_VALUE_TABLE_ADDRESS, values):
+            return False
+        if not ib._writePatchramTable(self.fw.PATCHRAM_TARGET_TABLE_ADDRESS, targets):
+            return False
+        return self._set_enabled(True)
+
+    def collect(self):
+        # type: () -> Optional[List[int]]
+        """
+        Disables the hooks and reads the hit map. Returns the newly covered
+        blocks, blocks which were not hit are queued again.
+        """
+        ib = self.internalblue
+        if not self._set_enabled(False):
+            return None
+        if len(self.armed) == 0:
+            return []
+        hitmap = ib.readMem(self.hitmap_address(), max(self.armed) + 1)
+        if hitmap is None:
+            return None
+        hits = []
+        for slot, block in sorted(self.armed.items(), key=lambda item: item[1]):
+            if hitmap[slot]:
+                self.covered.add(block)
+                hits.append(block)
+            else:
+                self.queue.append(block)
+        self.armed = {}
+        self.armed_partners = {}
+        return hits
+
+    def rotate(self):
+        # type: () -> Optional[List[int]]
+        """ collect() and arm the next batch. Returns the newly covered blocks. """
+        hits = self.collect()
+        if hits is None:
+            return None
+        self.rounds += 1
+        if not self._arm():
+            return None
+        return hits
+
+    def stop(self):
+        # type: () -> Optional[List[int]]
+        """ collect() and release all slots and RAM. Returns the newly covered blocks. """
+        hits = self.collect()
+        # The value and target tables of our slots are left as they are, the slots are disabled
+        self._release()
+        return hits
+
+    def pending(self):
+        # type: () -> int
+        """ Number of blocks that were not hit yet. """
+        return len(self.block_sizes) - len(self.covered) - len(self.invalid)
+
+    def write_drcov(self, filename, module_name=None):
+        # type: (str, Optional[str]) -> None
+        """
+        Writes the covered blocks in the drcov format (version 2), which is
+        understood by Lighthouse, bncov, and most coverage-guided fuzzers.
+        The ROM is a single module starting at 0.
+        """
+        rom_end = max([section.end_addr for section in getattr(self.fw, "SECTIONS", []) if section.is_rom] or [0])
+        if module_name is None:
+            module_name = self.fw.FW_NAME if hasattr(self.fw, "FW_NAME") else "rom"
+        blocks = sorted(self.covered)
+        with open(filename, "wb") as f:
+            f.write(b"DRCOV VERSION: 2\n")
+            f.write(b"DRCOV FLAVOR: internalblue\n")
+            f.write(b"Module Table: version 2, count 1\n")
+            f.write(b"Columns: id, base, end, entry, checksum, timestamp, path\n")
+            f.write((" 0, 0x0, 0x%x, 0x0, 0x0, 0x0, %s\n" % (rom_end, module_name)).encode())
+            f.write(("BB Table: %d bbs\n" % len(blocks)).encode())
+            # struct _bb_entry_t { uint32 start; uint16 size; uint16 mod_id; }
+            f.write(b"".join(struct.pack("<IHH", block, min(self.block_sizes[block], 0xFFFF), 0) for block in blocks))
+
+
+def read_drcov(filename):
+    # type: (str) -> List[Tuple[int, int]]
+    """ (address, size) tuples of the blocks in a drcov file (module offsets are added). """
+    with open(filename, "rb") as f:
+        data = f.read()
+    header, _, table = data.partition(b"BB Table: ")
+    count_line, _, entries = table.partition(b"\n")
+    count = int(count_line.split()[0])
+
+    bases = {}
+    lines = header.decode(errors="replace").splitlines()
+    for line in lines:
+        fields = [field.strip() for field in line.split(",")]
+        if len(fields) >= 3 and fields[0].isdigit():
+            bases[int(fields[0])] = int(fields[1], 16)
+    blocks = []
+    for i in range(count):
+        start, size, module = struct.unpack_from("<IHH", entries, i * 8)
+        blocks.append((bases.get(module, 0) + start, size))
+    return blocks
@@ -0,0 +1,277 @@
+import datetime
+import struct
+from builtins import object
+from collections import deque
+
+from . import hci
+
+try:
+    from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+except ImportError:
+    pass
+
+
+LMP_OPCODES = {
+    1: "LMP_name_req", 2: "LMP_name_res", 3: "LMP_accepted", 4: "LMP_not_accepted",
+    5: "LMP_clkoffset_req", 6: "LMP_clkoffset_res", 7: "LMP_detach", 8: "LMP_in_rand",
+    9: "LMP_comb_key", 10: "LMP_unit_key", 11: "LMP_au_rand", 12: "LMP_sres",
+    13: "LMP_temp_rand", 14: "LMP_temp_key", 15: "LMP_encryption_mode_req",
+    16: "LMP_encryption_key_size_req", 17: "LMP_start_encryption_req", 18: "LMP_stop_encryption_req",
+    19: "LMP_switch_req", 20: "LMP_hold", 21: "LMP_hold_req", 23: "LMP_sniff_req",
+    24: "LMP_unsniff_req", 25: "LMP_park_req", 27: "LMP_set_broadcast_scan_window",
+    28: "LMP_modify_beacon", 29: "LMP_unpark_BD_ADDR_req", 30: "LMP_unpark_PM_ADDR_req",
+    31: "LMP_incr_power_req", 32: "LMP_decr_power_req", 33: "LMP_max_power", 34: "LMP_min_power",
+    35: "LMP_auto_rate", 36: "LMP_preferred_rate", 37: "LMP_version_req", 38: "LMP_version_res",
+    39: "LMP_features_req", 40: "LMP_features_res", 41: "LMP_quality_of_service",
+    42: "LMP_quality_of_service_req", 43: "LMP_SCO_link_req", 44: "LMP_remove_SCO_link_req",
+    45: "LMP_max_slot", 46: "LMP_max_slot_req", 47: "LMP_timing_accuracy_req",
+    48: "LMP_timing_accuracy_res", 49: "LMP_setup_complete", 50: "LMP_use_semi_permanent_key",
+    51: "LMP_host_connection_req", 52: "LMP_slot_offset", 53: "LMP_page_mode_req",
+    54: "LMP_page_scan_mode_req", 55: "LMP_supervision_timeout", 56: "LMP_test_activate",
+    57: "LMP_test_control", 58: "LMP_encryption_key_size_mask_req", 59: "LMP_encryption_key_size_mask_res",
+    60: "LMP_set_AFH", 61: "LMP_encapsulated_header", 62: "LMP_encapsulated_payload",
+    63: "LMP_simple_pairing_confirm", 64: "LMP_simple_pairing_number", 65: "LMP_DHkey_check",
+}
+
+LMP_EXTENDED_OPCODES = {
+    1: "LMP_accepted_ext", 2: "LMP_not_accepted_ext", 3: "LMP_features_req_ext", 4: "LMP_features_res_ext",
+    5: "LMP_clk_adj", 6: "LMP_clk_adj_ack", 7: "LMP_clk_adj_req", 11: "LMP_packet_type_table_req",
+    12: "LMP_eSCO_link_req", 13: "LMP_remove_eSCO_link_req", 16: "LMP_channel_classification_req",
+    17: "LMP_channel_classification", 21: "LMP_sniff_subrating_req", 22: "LMP_sniff_subrating_res",
+    23: "LMP_pause_encryption_req", 24: "LMP_resume_encryption_req", 25: "LMP_IO_capability_req",
+    26: "LMP_IO_capability_res", 27: "LMP_numeric_comparison_failed", 28: "LMP_passkey_failed",
+    29: "LMP_oob_failed", 30: "LMP_keypress_notification", 31: "LMP_power_control_req",
+    32: "LMP_power_control_res", 33: "LMP_ping_req", 34: "LMP_ping_res",
+}
+
+LL_CONTROL_OPCODES = {
+    0x00: "LL_CONNECTION_UPDATE_IND", 0x01: "LL_CHANNEL_MAP_IND", 0x02: "LL_TERMINATE_IND",
+    0x03: "LL_ENC_REQ", 0x04: "LL_ENC_RSP", 0x05: "LL_START_ENC_REQ", 0x06: "LL_START_ENC_RSP",
+    0x07: "LL_UNKNOWN_RSP", 0x08: "LL_FEATURE_REQ", 0x09: "LL_FEATURE_RSP", 0x0A: "LL_PAUSE_ENC_REQ",
+    0x0B: "LL_PAUSE_ENC_RSP", 0x0C: "LL_VERSION_IND", 0x0D: "LL_REJECT_IND", 0x0E: "LL_SLAVE_FEATURE_REQ",
+    0x0F: "LL_CONNECTION_PARAM_REQ", 0x10: "LL_CONNECTION_PARAM_RSP", 0x11: "LL_REJECT_EXT_IND",
+    0x12: "LL_PING_REQ", 0x13: "LL_PING_RSP", 0x14: "LL_LENGTH_REQ", 0x15: "LL_LENGTH_RSP",
+    0x16: "LL_PHY_REQ", 0x17: "LL_PHY_RSP", 0x18: "LL_PHY_UPDATE_IND", 0x19: "LL_MIN_USED_CHANNELS_IND",
+}
+
+# Offset of the PDU in the diagnostic frames (after the type byte), see decode_diag()
+DIAG_PDU_OFFSETS = {0x00: 9, 0x01: 12, 0x80: 11, 0x81: 11}
+
+_CLOCK = struct.Struct(">I")
+
+
+def pdu_name(protocol, opcode, extended_opcode=None):
+    # type: (str, int, Optional[int]) -> str
+    if protocol == "LL":
+        return LL_CONTROL_OPCODES.get(opcode, "LL_0x%02x" % opcode)
+    if extended_opcode is not None:
+        return LMP_EXTENDED_OPCODES.get(extended_opcode, "LMP_ext_0x%02x" % extended_opcode)
+    return LMP_OPCODES.get(opcode, "LMP_0x%02x" % opcode)
+
+
+class DiagPdu(object):
+    """
+    A LMP or LL control PDU from a Broadcom diagnostic frame. The frames have
+    a fixed size, so parameters includes the padding after the PDU.
+    """
+
+    __slots__ = ("protocol", "direction", "clock", "opcode", "extended_opcode", "tid", "parameters", "timestamp")
+
+    def __init__(self, protocol, direction, clock, opcode, extended_opcode, tid, parameters, timestamp=None):
+        # type: (str, str, int, int, Optional[int], Optional[int], bytes, Any) -> None
+        self.protocol = protocol  # 'LMP' or 'LL'
+        self.direction = direction  # 'sent' or 'received'
+        self.clock = clock  # Bluetooth clock of the chip
+        self.opcode = opcode
+        self.extended_opcode = extended_opcode  # Only for escaped LMP opcodes (127)
+        self.tid = tid  # LMP transaction ID, None for LL
+        self.parameters = parameters
+        self.timestamp = timestamp
+
+    @property
+    def name(self):
+        # type: () -> str
+        return pdu_name(self.protocol, self.opcode, self.extended_opcode)
+
+    def __str__(self):
+        return "%s %-8s %s%s: %s" % (
+            self.protocol, self.direction, self.name,
+            "" if self.tid is None else " (TID %d)" % self.tid,
+            "".join(format(x, "02x") for x in self.parameters[0:16]))
+
+
+def decode_diag(opcode, data, timestamp=None):
+    # type: (int, bytes, Any) -> Optional[DiagPdu]
+    """
+    Decodes the payload of a diagnostic frame (HCI_Diag opcode and data).
+    Returns None for other diagnostic messages. The frame starts with the
+    big endian clock, the PDU follows at a fixed offset (the same layout as
+    decoded by BlueZ' btmon):
+
+        0x00 LMP sent:     clock, 4 bytes address, 1 byte,  LMP PDU at 9
+        0x01 LMP received: clock, 4 bytes address, 4 bytes, LMP PDU at 12
+        0x80 LL sent,
+        0x81 LL received:  clock, 7 bytes,                  LL control PDU at 11
+    """
+    offset = DIAG_PDU_OFFSETS.get(opcode)
+    if offset is None or len(data) <= offset:
+        return None
+    clock = _CLOCK.unpack_from(data)[0]
+    direction = "received" if opcode & 0x01 else "sent"
+    first = data[offset]
+    if opcode & 0x80:
+        return DiagPdu("LL", direction, clock, first, None, None, bytes(data[offset + 1:]), timestamp)
+    if first >> 1 == 127 and len(data) > offset + 1:
+        return DiagPdu("LMP", direction, clock, 127, data[offset + 1], first & 0x01,
+                       bytes(data[offset + 2:]), timestamp)
+    return DiagPdu("LMP", direction, clock, first >> 1, None, first & 0x01, bytes(data[offset + 1:]), timestamp)
+
+
+class DiagFilter(object):
+    """
+    Declarative filter for DiagPdus. All given criteria must match, e.g.
+    DiagFilter.parse("lmp received opcode=3,4") or
+    DiagFilter(protocol="LL", names=["LL_ENC_REQ"]).
+    """
+
+    __slots__ = ("protocol", "direction", "opcodes", "extended_opcodes", "names", "predicate")
+
+    def __init__(self, protocol=None, direction=None, opcodes=None, extended_opcodes=None, names=None,
+                 predicate=None):
+        # type: (Optional[str], Optional[str], Optional[Iterable[int]], Optional[Iterable[int]], Optional[Iterable[str]], Optional[Callable[[DiagPdu], bool]]) -> None
+        self.protocol = protocol
+        self.direction = direction
+        self.opcodes = frozenset(opcodes) if opcodes is not None else None
+        self.extended_opcodes = frozenset(extended_opcodes) if extended_opcodes is not None else None
+        self.names = frozenset(names) if names is not None else None
+        self.predicate = predicate
+
+    @classmethod
+    def parse(cls, expression):
+        # type: (str) -> DiagFilter
+        """
+        Words of the expression: lmp, ll, sent, received, opcode=<n>[,<n>...],
+        ext=<n>[,<n>...] and name=<name>[,<name>...]. Numbers can be hex (0x..).
+        """
+        kwargs = {}  # type: Dict[str, Any]
+        for word in expression.split():
+            key, _, value = word.partition("=")
+            key = key.lower()
+            if not value and key in ("lmp", "ll"):
+                kwargs["protocol"] = key.upper()
+            elif not value and key in ("sent", "received"):
+                kwargs["direction"] = key
+            elif key == "opcode" and value:
+                kwargs["opcodes"] = [int(x, 0) for x in value.split(",")]
+            elif key == "ext" and value:
+                kwargs["extended_opcodes"] = [int(x, 0) for x in value.split(",")]
+            elif key == "name" and value:
+                kwargs["names"] = value.split(",")
+            else:
+                raise ValueError("invalid filter '%s'" % word)
+        return cls(**kwargs)
+
+    def matches(self, pdu):
+        # type: (DiagPdu) -> bool
+        if self.protocol is not None and pdu.protocol != self.protocol:
+            return False
+        if self.direction is not None and pdu.direction != self.direction:
+            return False
+        if self.opcodes is not None and pdu.opcode not in self.opcodes:
+            return False
+        if self.extended_opcodes is not None and pdu.extended_opcode not in self.extended_opcodes:
+            return False
+        if self.names is not None and pdu.name not in self.names:
+            return False
+        if self.predicate is not None and not self.predicate(pdu):
+            return False
+        return True
+
+
+class DiagDecoder(object):
+    """
+    Streaming decoder for the diagnostic frames (H4 type 0x07) which the chip
+    sends after enableBroadcomDiagnosticLogging(True). Register hciCallback()
+    or feed btsnoop logs with read_btsnoop().
+
+    Every decoded PDU is counted per (protocol, direction, opcode, extended
+    opcode). PDUs which match any of the filters (all PDUs if there are no
+    filters) are kept in the last <history> records and passed to the
+    subscribers.
+    """
+
+    def __init__(self, filters=None, history=10000):
+        # type: (Optional[List[DiagFilter]], int) -> None
+        self.filters = filters or []  # type: List[DiagFilter]
+        self.records = deque(maxlen=history)  # type: Deque[DiagPdu]
+        self.counters = {}  # type: Dict[Tuple[str, str, int, Optional[int]], int]
+        self.subscribers = []  # type: List[Callable[[DiagPdu], None]]
+        self.frames = 0  # Diagnostic frames seen, including other messages
+
+    def feed(self, opcode, data, timestamp=None):
+        # type: (int, bytes, Any) -> Optional[DiagPdu]
+        """ Decodes one diagnostic frame, returns the PDU if it matches the filters. """
+        self.frames += 1
+        pdu = decode_diag(opcode, data, timestamp)
+        if pdu is None:
+            return None
+        key = (pdu.protocol, pdu.direction, pdu.opcode, pdu.extended_opcode)
+        self.counters[key] = self.counters.get(key, 0) + 1
+        if self.filters and not any(f.matches(pdu) for f in self.filters):
+            return None
+        self.records.append(pdu)
+        for callback in self.subscribers:
+            callback(pdu)
+        return pdu
+
+    def hciCallback(self, record):
+        # type: (tuple) -> None
+        hcipkt = record[0]
+        if hcipkt.uart_type == hci.HCI.BCM_DIAG:
+            self.feed(hcipkt.opcode, hcipkt.data, record[5] if len(record) > 5 else None)
+
+    def read_btsnoop(self, filename):
+        # type: (str) -> int
+        """
+        Decodes the diagnostic frames of a btsnoop log (H4 data link type
+        1002, as written by InternalBlue). Returns the number of frames.
+        """
+        frames = self.frames
+        for timestamp, data in iter_btsnoop(filename):
+            if len(data) > 1 and data[0] == hci.HCI.BCM_DIAG:
+                self.feed(data[1], data[2:], timestamp)
+        return self.frames - frames
+
+    def counter(self, name):
+        # type: (str) -> int
+        """ Number of PDUs with this name, e.g. 'LMP_accepted' (both directions). """
+        return sum(count for (protocol, _, opcode, extended), count in self.counters.items()
+                   if pdu_name(protocol, opcode, extended) == name)
+
+    def clear(self):
+        # type: () -> None
+        self.records.clear()
+        self.counters = {}
+        self.frames = 0
+
+
+_BTSNOOP_HEADER = struct.Struct(">8sII")
+_BTSNOOP_RECORD = struct.Struct(">IIIIq")
+_BTSNOOP_EPOCH = datetime.datetime(2000, 1, 1)
+_BTSNOOP_EPOCH_OFFSET = 0x00E03AB44A676000  # Microseconds from 0 AD to 2000 AD
+
+
+def iter_btsnoop(filename):
+    # type: (str) -> Iterator[Tuple[datetime.datetime, bytes]]
+    """ (timestamp, data) of each record of a btsnoop file (see RFC 1761). """
+    with open(filename, "rb") as f:
+        magic, _, _ = _BTSNOOP_HEADER.unpack(f.read(_BTSNOOP_HEADER.size))
+        if magic != b"btsnoop\x00":
+            raise ValueError("%s is not a btsnoop file" % filename)
+        while True:
+            header = f.read(_BTSNOOP_RECORD.size)
+            if len(header) < _BTSNOOP_RECORD.size:
+                return
+            _, included_length, _, _, time = _BTSNOOP_RECORD.unpack(header)
+            data = f.read(included_length)
+            yield _BTSNOOP_EPOCH + datetime.timedelta(microseconds=time - _BTSNOOP_EPOCH_OFFSET), data
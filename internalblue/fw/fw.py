@@ -61,6 +61,8 @@ class FirmwareDefinition:
     TRACEPOINT_RAM_DUMP_PKT_COUNT = None
 
     CONNECTION_STRUCT_LENGTH: int
+    # StructLayout of the connection struct, None uses ConnectionInformation.LAYOUT
+    CONNECTION_STRUCT_LAYOUT = None
 
     FW_NAME: str
 
@@ -97,7 +99,16 @@ class FirmwareDefinition:
 
     TRACEPOINT_HOOK_SIZE = None
     TRACEPOINT_BODY_ASM_LOCATION: Address
+    TRACEPOINT_BODY_ASM_SIZE = 0x100
     TRACEPOINT_HOOK_ASM = None
+    # The body sends the ranges of a capture table (hook loads it into r9) as 'CAPT__' events
+    TRACEPOINT_CAPTURE_SUPPORTED = False
+    # TRACEPOINT_HOOK_ASM has the condition and condition_skip placeholders
+    TRACEPOINT_CONDITIONS_SUPPORTED = False
+    # Free RAM for tracepoint hooks. Without these, there is room
+    # for 5 hooks at TRACEPOINT_HOOKS_LOCATION.
+    TRACEPOINT_HOOK_POOL_ADDRESS = None
+    TRACEPOINT_HOOK_POOL_SIZE = None
 
     ENHANCED_ADV_REPORT_ADDRESS: Address
 
@@ -66,15 +66,18 @@ class BCM4375B1(FirmwareDefinition):
     # TRACEPOINT_BODY_ASM_LOCATION = 0x00218300
     # TRACEPOINT_HOOKS_LOCATION = 0x00218500
     # TRACEPOINT_HOOK_SIZE = 40
+    # No TRACEPOINT_HOOK_POOL_ADDRESS either, as long as tracepoints are not supported
     TRACEPOINT_HOOK_ASM = """
             push {r0-r12, lr}       // save all registers on the stack (except sp and pc)
-            ldr  r6, =0x%x          // addTracepoint() injects pc of original tracepoint here
-            mov  r9, %d             // addTracepoint() injects the patchram slot of the hook patch
-            bl   0x%x               // addTracepoint() injects TRACEPOINT_BODY_ASM_LOCATION here
+            %(condition)s           // addTracepoint() injects the conditions, they branch to tracepoint_skip
+            ldr  r6, =0x%(address)x // addTracepoint() injects pc of original tracepoint here
+            mov  r9, %(slot)d       // addTracepoint() injects the patchram slot of the hook patch
+            bl   0x%(body)x         // addTracepoint() injects TRACEPOINT_BODY_ASM_LOCATION here
             pop  {r0-r12, lr}       // restore registers
     
             // branch back to the original instruction
-            b 0x%x                  // addTracepoint() injects the address of the tracepoint
+            b 0x%(address)x         // addTracepoint() injects the address of the tracepoint
+            %(condition_skip)s
     """
 
     TRACEPOINT_BODY_ASM_SNIPPET = """
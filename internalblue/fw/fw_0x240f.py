@@ -100,14 +100,16 @@ class BCM4358A3(FirmwareDefinition):
             // fill buffer
             add r0, 0xC         // The actual LMP packet must start at offset 0xC in the buffer.
                                 // The first 12 bytes are (supposely?) unused and remain zero.
-            ldr r1, =payload    // LMP packet is stored at the end of the snippet
+            ldr r1, =mailbox    // LMP packet is stored in the mailbox at the end of the snippet,
+            add r1, 4           // behind the connection number
             mov r2, 20          // Max. size of an LMP packet is 19 (I guess). The send_LMP_packet
                                 // function will use the LMP opcode to lookup the actual size and
                                 // use it for actually transmitting the correct number of bytes.
             bl  0x63900+1       // memcpy
 
             // load conn struct pointer (needed for determine if we are master or slave)
-            mov r0, %d      // connection number is injected by sendLmpPacket()
+            ldr r0, =mailbox    // connection number is written into the mailbox by sendLmpPacket()
+            ldr r0, [r0]
             bl 0x473CC      // find connection struct from conn nr (r0 will hold pointer to conn struct)    //FIXME
             //FIXME: mac address is always 1f:8d:00:00:00:00
 
@@ -129,8 +131,9 @@ class BCM4358A3(FirmwareDefinition):
             pop {r4,lr}     // restore r4 and the lr
             b 0xAF4C        // branch to send_LMP_packet. send_LMP_packet will do the return for us.
 
-            .align          // The payload (LMP packet) must be 4-byte aligend (memcpy needs aligned addresses)
-            payload:        // Note: the payload will be appended here by the sendLmpPacket() function
+            .ltorg          // The literal pool goes in front of the mailbox, the mailbox ends the snippet
+            .align          // The mailbox must be 4-byte aligned (memcpy needs aligned addresses)
+            mailbox:        // Note: sendLmpPacket() places the connection number and the LMP packet here
             """
 
     # Assembler snippet for the readMemAligned() function
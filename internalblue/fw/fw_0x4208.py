@@ -23,6 +23,7 @@
 from __future__ import absolute_import
 from .fw import MemorySection, FirmwareDefinition
 from .. import Address
+from ..objects.connection_information import ConnectionInformation
 
 
 class CYW20735B1(FirmwareDefinition):
@@ -101,6 +102,8 @@ class CYW20735B1(FirmwareDefinition):
     CONNECTION_LIST_ADDRESS = 0x216F98  # pRm_whole_conn = 0x280C9C points to this
     CONNECTION_MAX = 11  # g_bt_max_connections = 0 in firmware
     CONNECTION_STRUCT_LENGTH = 0x168  # ??
+    # Offsets were taken over from the BCM4335C0 struct and are not verified for this chip
+    CONNECTION_STRUCT_LAYOUT = ConnectionInformation.LAYOUT
 
     # Enable enhanced advertisement reports (bEnhancedAdvReport)
     ENHANCED_ADV_REPORT_ADDRESS = Address(0x2829AC)
@@ -175,16 +178,22 @@ class CYW20735B1(FirmwareDefinition):
     TRACEPOINT_BODY_ASM_LOCATION = 0x00218500
     TRACEPOINT_HOOKS_LOCATION = 0x00218700
     TRACEPOINT_HOOK_SIZE = 40
+    # Hooks and capture tables may use the RAM up to 0x2189F0, examples/eval_cyw20735/rand.py uses it as well
+    TRACEPOINT_HOOK_POOL_ADDRESS = 0x00218700
+    TRACEPOINT_HOOK_POOL_SIZE = 0x2F0
+    TRACEPOINT_CONDITIONS_SUPPORTED = True
     TRACEPOINT_HOOK_ASM = """
             push {r0-r12, lr}       // save all registers on the stack (except sp and pc)
-            ldr  r6, =0x%x          // addTracepoint() injects pc of original tracepoint here
-            mov  r0, %d             // addTracepoint() injects the patchram slot of the hook patch
+            %(condition)s           // addTracepoint() injects the conditions, they branch to tracepoint_skip
+            ldr  r6, =0x%(address)x // addTracepoint() injects pc of original tracepoint here
+            mov  r0, %(slot)d       // addTracepoint() injects the patchram slot of the hook patch
             bl   0x28794            // patch_uninstallPatchEntry(slot)
-            bl   0x%x               // addTracepoint() injects TRACEPOINT_BODY_ASM_LOCATION here
+            bl   0x%(body)x         // addTracepoint() injects TRACEPOINT_BODY_ASM_LOCATION here
             pop  {r0-r12, lr}       // restore registers
     
             // branch back to the original instruction
-            b 0x%x                  // addTracepoint() injects the address of the tracepoint
+            b 0x%(address)x         // addTracepoint() injects the address of the tracepoint
+            %(condition_skip)s
     """
 
     TRACEPOINT_BODY_ASM_SNIPPET = """
@@ -88,16 +88,22 @@ class CYW20739B1(FirmwareDefinition):
     TRACEPOINT_BODY_ASM_LOCATION = 0x00223100
     TRACEPOINT_HOOKS_LOCATION = 0x00223200
     TRACEPOINT_HOOK_SIZE = 40
+    # Hooks and capture tables may use the free RAM up to 0x225800 (see examples/eval_cyw20719/rand.py)
+    TRACEPOINT_HOOK_POOL_ADDRESS = 0x00223200
+    TRACEPOINT_HOOK_POOL_SIZE = 0x2600
+    TRACEPOINT_CONDITIONS_SUPPORTED = True
     TRACEPOINT_HOOK_ASM = """
             push {r0-r12, lr}       // save all registers on the stack (except sp and pc)
-            ldr  r6, =0x%x          // addTracepoint() injects pc of original tracepoint here
-            mov  r0, %d             // addTracepoint() injects the patchram slot of the hook patch
+            %(condition)s           // addTracepoint() injects the conditions, they branch to tracepoint_skip
+            ldr  r6, =0x%(address)x // addTracepoint() injects pc of original tracepoint here
+            mov  r0, %(slot)d       // addTracepoint() injects the patchram slot of the hook patch
             bl   0x34964            // patch_uninstallPatchEntry(slot)
-            bl   0x%x               // addTracepoint() injects TRACEPOINT_BODY_ASM_LOCATION here
+            bl   0x%(body)x         // addTracepoint() injects TRACEPOINT_BODY_ASM_LOCATION here
             pop  {r0-r12, lr}       // restore registers
     
             // branch back to the original instruction
-            b 0x%x                  // addTracepoint() injects the address of the tracepoint
+            b 0x%(address)x         // addTracepoint() injects the address of the tracepoint
+            %(condition_skip)s
     """
 
     TRACEPOINT_BODY_ASM_SNIPPET = """
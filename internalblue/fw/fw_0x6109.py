@@ -27,6 +27,7 @@
 
 from __future__ import absolute_import
 from .fw import MemorySection, FirmwareDefinition
+from ..objects.connection_information import ConnectionInformation
 
 
 class BCM4335C0(FirmwareDefinition):
@@ -85,6 +86,8 @@ class BCM4335C0(FirmwareDefinition):
     CONNECTION_ARRAY_ADDRESS = 0x002038E8
     CONNECTION_MAX = 11
     CONNECTION_STRUCT_LENGTH = 0x14C
+    # remote BD_ADDR at 0x28 (reversed), connection handle at 0x64
+    CONNECTION_STRUCT_LAYOUT = ConnectionInformation.LAYOUT
 
     # Patchram
     PATCHRAM_ENABLED_BITMAP_ADDRESS = 0x310204
@@ -102,15 +105,17 @@ class BCM4335C0(FirmwareDefinition):
             
             // we want to call lmulp_sendLcp(conn_index, input, length)
             
-            mov r0,  %d     // connection index, starts at 0
-            ldr r1, =payload
-            mov r2, %d      // length
+            ldr r1, =mailbox    // sendLcpPacket() writes the parameters into the mailbox
+            ldr r0, [r1]        // connection index, starts at 0
+            ldr r2, [r1, 4]     // length
+            add r1, 8           // the LCP packet follows the parameters
             bl  0x66760     // lmulp_sendLcp
             
             pop {r4,pc}     // go back
     
-            .align          // The payload (LMP packet) must be 4-byte aligend (memcpy needs aligned addresses)
-            payload:        // Note: the payload will be appended here by the sendLmpPacket() function
+            .ltorg          // The literal pool goes in front of the mailbox, the mailbox ends the snippet
+            .align          // The mailbox must be 4-byte aligned (memcpy needs aligned addresses)
+            mailbox:        // Note: sendLcpPacket() places the connection index, the length and the LCP packet here
             """
 
     # Snippet for sendLmpPacketLegacy()
@@ -125,14 +130,16 @@ class BCM4335C0(FirmwareDefinition):
             // fill buffer
             add r0, 0xC         // The actual LMP packet must start at offset 0xC in the buffer.
                                 // The first 12 bytes are (supposely?) unused and remain zero.
-            ldr r1, =payload    // LMP packet is stored at the end of the snippet
+            ldr r1, =mailbox    // LMP packet is stored in the mailbox at the end of the snippet,
+            add r1, 4           // behind the connection number
             mov r2, 20          // Max. size of an LMP packet is 19 (I guess). The send_LMP_packet
                                 // function will use the LMP opcode to lookup the actual size and
                                 // use it for actually transmitting the correct number of bytes.
             bl  0x2e03c         // memcpy
     
             // load conn struct pointer (needed for determine if we are master or slave)
-            mov r0, %d      // connection number is injected by sendLmpPacket()
+            ldr r0, =mailbox    // connection number is written into the mailbox by sendLmpPacket()
+            ldr r0, [r0]
             bl 0x42c04      // find connection struct from conn nr (r0 will hold pointer to conn struct)
     
             // set tid bit if we are the slave
@@ -152,8 +159,9 @@ class BCM4335C0(FirmwareDefinition):
             pop {r4,lr}     // restore r4 and the lr
             b 0xf81a        // branch to send_LMP_packet. send_LMP_packet will do the return for us.
     
-            .align          // The payload (LMP packet) must be 4-byte aligend (memcpy needs aligned addresses)
-            payload:        // Note: the payload will be appended here by the sendLmpPacket() function
+            .ltorg          // The literal pool goes in front of the mailbox, the mailbox ends the snippet
+            .align          // The mailbox must be 4-byte aligned (memcpy needs aligned addresses)
+            mailbox:        // Note: sendLmpPacket() places the connection number and the LMP packet here
             """
 
     # Snippet for fuzzLmp()
@@ -265,17 +273,26 @@ class BCM4335C0(FirmwareDefinition):
 
     # Assembler snippet for tracepoints
     TRACEPOINT_BODY_ASM_LOCATION = 0xD7A00
-    TRACEPOINT_HOOKS_LOCATION = 0xD7B00
-    TRACEPOINT_HOOK_SIZE = 28
+    TRACEPOINT_BODY_ASM_SIZE = 0x200
+    TRACEPOINT_HOOKS_LOCATION = 0xD7C00
+    TRACEPOINT_HOOK_SIZE = 40
+    # Hooks and capture tables may use the remaining RAM up to the end of the 0xD0000 section
+    TRACEPOINT_HOOK_POOL_ADDRESS = 0xD7C00
+    TRACEPOINT_HOOK_POOL_SIZE = 0x400
+    TRACEPOINT_CAPTURE_SUPPORTED = True
+    TRACEPOINT_CONDITIONS_SUPPORTED = True
     TRACEPOINT_HOOK_ASM = """
             push {r0-r12, lr}       // save all registers on the stack (except sp and pc)
-            ldr  r6, =0x%x          // addTracepoint() injects pc of original tracepoint here
-            mov  r7, %d             // addTracepoint() injects the patchram slot of the hook patch
-            bl   0x%x               // addTracepoint() injects TRACEPOINT_BODY_ASM_LOCATION here
+            %(condition)s           // addTracepoint() injects the conditions, they branch to tracepoint_skip
+            ldr  r6, =0x%(address)x // addTracepoint() injects pc of original tracepoint here
+            mov  r7, %(slot)d       // addTracepoint() injects the patchram slot of the hook patch
+            ldr  r9, =0x%(capture)x // addTracepoint() injects the capture table (0: dump the whole RAM)
+            bl   0x%(body)x         // addTracepoint() injects TRACEPOINT_BODY_ASM_LOCATION here
             pop  {r0-r12, lr}       // restore registers
     
             // branch back to the original instruction
-            b 0x%x                  // addTracepoint() injects the address of the tracepoint
+            b 0x%(address)x         // addTracepoint() injects the address of the tracepoint
+            %(condition_skip)s
     """
     TRACEPOINT_RAM_DUMP_PKT_COUNT = (
         670  # <ramsize> / <packetsize>   where packetsize is 244
@@ -332,16 +349,111 @@ class BCM4335C0(FirmwareDefinition):
             mov  r0, r7      // r7 still contains the patchram slot number
             bl   0x311AA     // disable_patchram_slot(slot)
     
+            // send the ranges from the capture table, or dump the whole RAM without one
+            cmp  r9, 0
+            beq  body_dump_ram
+            mov  r0, r9      // r9 still contains the capture table
+            mov  r1, 56      // sp of the tracepoint (14 saved registers * 4)
+            add  r1, sp
+            bl   capture_ranges
+            b    body_return
+        body_dump_ram:
+            bl   dump_ram
+    
+        body_return:
             // restore status register
             msr  cpsr_f, r5
     
-            // dump ram
-            bl   dump_ram
-    
             mov  lr, r8      // restore lr from r8
             bx   lr          // return
     
     
+    // function to send the ranges of a capture table as 'CAPT__' HCI packets:
+    // capture_ranges(table, sp)
+    // table: uint32 count, then per range: uint32 address, uint16 length, uint16 flags (bit 0: address is relative to sp)
+    // packet: 'CAPT__', uint32 address, uint16 length, data
+    capture_ranges:
+            push {r4-r11,lr}
+            mov  r9, r0           // r9: current entry of the capture table
+            mov  r10, r1          // r10: sp of the tracepoint
+            ldr  r11, [r9]        // r11: number of remaining ranges
+            add  r9, 4
+    
+            // malloc HCI event buffer
+            mov  r0, 0xff    // event code is 0xff (vendor specific HCI Event)
+            mov  r1, 252     // buffer size
+            bl   0x7AFC      // malloc_hci_event_buffer (will automatically copy event code and length into the buffer)
+            mov  r4, r0      // save pointer to the buffer in r4
+    
+            // append our custom header (the word 'CAPT__') after the event code and event length field
+            add  r0, 2            // write after the length field
+            ldr  r1, =0x54504143  // 'CAPT'
+            str  r1, [r0]
+            add  r0, 4            // advance the pointer.
+            ldr  r1, =0x5f5f      // '__'
+            strh r1, [r0]
+    
+            cmp  r11, 0
+            beq  capture_done
+    
+            capture_range_loop:
+                ldr  r5, [r9]         // r5: address of the range
+                ldrh r6, [r9, 4]      // r6: remaining length of the range
+                ldrh r7, [r9, 6]      // r7: flags
+                add  r9, 8
+                tst  r7, 1
+                beq  capture_chunk_loop
+                add  r5, r10          // stack-relative range
+    
+                capture_chunk_loop:
+                    cmp  r6, 0
+                    beq  capture_next_range
+    
+                    // r7: length of this packet, at most 236 bytes
+                    mov  r7, r6
+                    cmp  r7, 236
+                    ble  capture_send
+                    mov  r7, 236
+    
+                capture_send:
+                    // Set r0 to point to the beginning of the payload in the hci buffer
+                    mov  r0, r4
+                    add  r0, 8
+                    str  r5, [r0]    // address of this chunk
+                    strh r7, [r0, 4] // length of this chunk
+                    add  r0, 6
+    
+                    // copy ram to hci buffer
+                    mov  r1, r5
+                    mov  r2, r7
+                    bl   0x2e03c     // memcpy
+    
+                    // send HCI buffer to the host
+                    mov  r0, r4      // r4 still points to the beginning of the HCI buffer
+                    bl   0x398c1     // send_hci_event_without_free()
+    
+                    // same delay as in dump_ram, otherwise packets get lost
+                    mov  r0, 0x1000
+                    capture_delay_loop:
+                        subs r0, 1
+                        bne capture_delay_loop
+    
+                    add  r5, r7
+                    sub  r6, r7
+                    b    capture_chunk_loop
+    
+            capture_next_range:
+                subs r11, 1
+                bne  capture_range_loop
+    
+        capture_done:
+            // free HCI buffer
+            mov  r0, r4
+            bl   0x3FA36     // free_bloc_buffer_aligned
+    
+            pop  {r4-r11,pc}
+    
+    
     // function to dump the RAM as multiple HCI packets:
     dump_ram:
             push {r4-r6,lr}
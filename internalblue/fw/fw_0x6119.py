@@ -85,13 +85,15 @@ class BCM4345C0(FirmwareDefinition):
     
             // we want to call lmulp_sendLcp(conn_index, input, length)
     
-            mov r0,  %d     // connection index, starts at 0
-            ldr r1, =payload
-            mov r2, %d      // length
+            ldr r1, =mailbox    // sendLcpPacket() writes the parameters into the mailbox
+            ldr r0, [r1]        // connection index, starts at 0
+            ldr r2, [r1, 4]     // length
+            add r1, 8           // the LCP packet follows the parameters
             bl  0x92062     // lmulp_sendLcp
     
             pop {r4,pc}     // go back
     
-            .align          // The payload (LMP packet) must be 4-byte aligend (memcpy needs aligned addresses)
-            payload:        // Note: the payload will be appended here by the sendLmpPacket() function
+            .ltorg          // The literal pool goes in front of the mailbox, the mailbox ends the snippet
+            .align          // The mailbox must be 4-byte aligned (memcpy needs aligned addresses)
+            mailbox:        // Note: sendLcpPacket() places the connection index, the length and the LCP packet here
             """
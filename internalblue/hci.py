@@ -27,6 +27,7 @@
 
 from __future__ import absolute_import
 
+import struct
 from builtins import hex
 from builtins import object
 from builtins import range
@@ -35,7 +36,7 @@ from enum import Enum
 
 from internalblue.utils import flat
 from internalblue.utils.internalblue_logger import getInternalBlueLogger
-from internalblue.utils.packing import p8, u8, p16, u16, p32, u32, bits, unbits, bits_str
+from internalblue.utils.packing import p8, u8, p16, u16, p32, u32
 
 
 class HCI_COMND(Enum):
@@ -544,12 +545,22 @@ class HCI_COMND(Enum):
 
 
 class HCI(object):
-    data: bytes
     """
     HCI Packet types for UART Transport layer
     Core specification 4.1 [vol 4] Part A (Section 2) - Protocol
     Type 0x07 is Broadcom specific for diagnostics
+
+    Parsing ACL, SCO and diagnostic packets only determines the class and
+    keeps the received bytes. Their fields are unpacked with precompiled
+    structs on first access, so packets that are only routed by their class
+    or uart_type are never decoded. Commands and events are decoded right
+    away, nearly every callback reads them and the deferred decoding costs
+    more than it saves for these short packets. payload is a memoryview of
+    data.
     """
+
+    __slots__ = ("uart_type", "event_code", "data", "_raw")
+
     HCI_CMD = 0x01
     ACL_DATA = 0x02
     SCO_DATA = 0x03
@@ -566,12 +577,44 @@ class HCI(object):
 
     @staticmethod
     def from_data(data):
-        uart_type = data[0]
-        return HCI_UART_TYPE_CLASS[uart_type].from_data(data[1:])
+        return HCI_UART_TYPE_CLASS[data[0]]._parse(data)
+
+    @classmethod
+    def _parse(cls, raw):
+        packet = cls.__new__(cls)
+        packet.uart_type = raw[0]
+        packet.event_code = None
+        packet._raw = raw
+        return packet
 
     def __init__(self, uart_type):
         self.event_code = None
         self.uart_type = uart_type
+        self._raw = None
+
+    def __getattr__(self, name):
+        # Only called for slots that are not set yet, i.e. fields of a packet
+        # that was not decoded so far
+        if name == "_raw":
+            raise AttributeError(name)
+        raw = self._raw
+        if raw is None:
+            raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+        # _raw is cleared only after all fields are set: another thread which
+        # accesses a field meanwhile decodes the packet again instead of
+        # finding neither the field nor _raw
+        self._decode(raw)
+        self._raw = None
+        return getattr(self, name)
+
+    def _decode(self, raw):
+        self.data = raw[1:]
+
+    @property
+    def payload(self):
+        # type: () -> memoryview
+        """ The payload (data) without copying it. """
+        return memoryview(self.data)
 
     def getRaw(self):
         return p8(self.uart_type)
@@ -580,10 +623,29 @@ class HCI(object):
         return self.HCI_UART_TYPE_STR[self.uart_type]
 
 
+# Packet headers, including the H4 type
+_CMD_HEADER = struct.Struct("<BHB")
+_ACL_HEADER = struct.Struct("<BHH")
+_SCO_HEADER = struct.Struct("<BHB")
+_DIAG_HEADER = struct.Struct("<BB")
+_EVENT_HEADER = struct.Struct("<BBB")
+
+
 class HCI_Cmd(HCI):
+    __slots__ = ("opcode", "length")
+
     @staticmethod
     def from_data(data):
-        return HCI_Cmd(u16(data[0:2]), data[2], data[3:])
+        return HCI_Cmd._parse(p8(HCI.HCI_CMD) + bytes(data))
+
+    @staticmethod
+    def _parse(raw):
+        packet = HCI_Cmd.__new__(HCI_Cmd)
+        packet.event_code = None
+        packet._raw = None
+        packet.data = raw[4:]
+        packet.uart_type, packet.opcode, packet.length = _CMD_HEADER.unpack_from(raw)
+        return packet
 
     def __init__(self, opcode, length, data):
         HCI.__init__(self, HCI.HCI_CMD)
@@ -592,12 +654,7 @@ class HCI_Cmd(HCI):
         self.data = data
 
     def getRaw(self):
-        return (
-            super(HCI_Cmd, self).getRaw()
-            + p16(self.opcode)
-            + p8(self.length)
-            + self.data
-        )
+        return _CMD_HEADER.pack(self.uart_type, self.opcode, self.length) + self.data
 
     def __str__(self):
         parent = HCI.__str__(self)
@@ -607,24 +664,27 @@ class HCI_Cmd(HCI):
         except ValueError:
             cmdname = "unknown"
 
-        return f"{HCI.__str__(self)}{'0x%04x'.format(self.opcode)} COMND {cmdname} (len={self.length}):  {''.join(format(x, '02x') for x in self.data[0:16])}"
+        return f"{HCI.__str__(self)}{'0x%04x'.format(self.opcode)} COMND {cmdname} (len={self.length}):  {''.join(format(x, '02x') for x in self.payload[0:16])}"
 
 
 class HCI_Acl(HCI):
+    __slots__ = ("handle", "bp", "bc", "length")
+
     @staticmethod
     def from_data(data):
-        data = bytes(data)  # bytearray to bytes
-        handle = u16(unbits(bits_str(data[0:2])[0:12].rjust(16, "0")))
-        bp = u8(unbits(bits_str(data[1:2])[4:6].rjust(8, "0")))
-        bc = u8(unbits(bits_str(data[1:2])[6:8].rjust(8, "0")))
-        return HCI_Acl(handle, bp, bc, u16(data[2:4]), data[4:])
+        return HCI_Acl._parse(p8(HCI.ACL_DATA) + bytes(data))
+
+    def _decode(self, raw):
+        # 12 bit handle, 2 bit packet boundary flag, 2 bit broadcast flag, 16 bit length
+        self.data = raw[5:]
+        _, header, self.length = _ACL_HEADER.unpack_from(raw)
+        self.handle = header & 0x0FFF
+        self.bp = (header >> 12) & 0x3
+        self.bc = header >> 14
 
     def getRaw(self):
-        raw = bits(p16(self.handle))[4:]
-        raw.extend(bits(p8(self.bp))[6:])
-        raw.extend(bits(p8(self.bc))[6:])
-        raw.extend(bits(p16(self.length)))
-        return super(HCI_Acl, self).getRaw() + unbits(raw) + self.data
+        header = (self.handle & 0x0FFF) | (self.bp & 0x3) << 12 | (self.bc & 0x3) << 14
+        return _ACL_HEADER.pack(self.uart_type, header, self.length) + self.data
 
     def __init__(self, handle, bp, bc, length, data):
         HCI.__init__(self, HCI.ACL_DATA)
@@ -636,19 +696,22 @@ class HCI_Acl(HCI):
 
 
 class HCI_Sco(HCI):
+    __slots__ = ("handle", "ps", "length")
+
     @staticmethod
     def from_data(data):
-        data = bytes(data)  # bytearray to bytes
-        handle = u16(unbits(bits_str(data[0:2])[0:12].rjust(16, "0")))
-        ps = u8(unbits(bits_str(data[1:2])[4:6].rjust(8, "0")))
-        return HCI_Sco(handle, ps, u8(data[2]), data[3:])
+        return HCI_Sco._parse(p8(HCI.SCO_DATA) + bytes(data))
+
+    def _decode(self, raw):
+        # 12 bit handle, 2 bit packet status flag, 2 bit RFU, 8 bit length
+        self.data = raw[4:]
+        _, header, self.length = _SCO_HEADER.unpack_from(raw)
+        self.handle = header & 0x0FFF
+        self.ps = (header >> 12) & 0x3
 
     def getRaw(self):
-        raw = bits(p16(self.handle))[4:]
-        raw.extend(bits(p8(self.ps))[6:])
-        raw.extend(bits(p8(0))[6:])
-        raw.extend(bits(p8(self.length)))
-        return super(HCI_Sco, self).getRaw() + unbits(raw) + self.data
+        header = (self.handle & 0x0FFF) | (self.ps & 0x3) << 12
+        return _SCO_HEADER.pack(self.uart_type, header, self.length) + self.data
 
     def __init__(self, handle, ps, length, data):
         HCI.__init__(self, HCI.SCO_DATA)
@@ -659,6 +722,8 @@ class HCI_Sco(HCI):
 
 
 class HCI_Diag(HCI):
+    __slots__ = ("opcode", "length")
+
     BCM_DIAG_STR = {
         0x00: "LMP Sent",
         0x01: "LMP Received",
@@ -668,10 +733,15 @@ class HCI_Diag(HCI):
 
     @staticmethod
     def from_data(data):
-        return HCI_Diag(u8(data[0:1]), data[1:])
+        return HCI_Diag._parse(p8(HCI.BCM_DIAG) + bytes(data))
+
+    def _decode(self, raw):
+        self.data = raw[2:]
+        self.opcode = raw[1]
+        self.length = 63  # fixed length
 
     def getRaw(self):
-        return super(HCI_Diag, self).getRaw() + p8(self.opcode) + self.data
+        return _DIAG_HEADER.pack(self.uart_type, self.opcode) + self.data
 
     def __init__(self, opcode, data):
         HCI.__init__(self, HCI.BCM_DIAG)
@@ -687,11 +757,13 @@ class HCI_Diag(HCI):
         return parent + "<0x%02x %s: %s>" % (
             self.opcode,
             cmdname,
-            "".join(format(x, "02x") for x in self.data[0:16]),
+            "".join(format(x, "02x") for x in self.payload[0:16]),
         )
 
 
 class HCI_Event(HCI):
+    __slots__ = ("length",)
+
     HCI_EVENT_STR = {
         0x01: "EVENT Inquiry_Complete",
         0x02: "EVENT Inquiry_Result",
@@ -876,7 +948,17 @@ class HCI_Event(HCI):
 
     @staticmethod
     def from_data(data):
-        return HCI_Event(data[0], data[1], data[2:])
+        return HCI_Event._parse(p8(HCI.HCI_EVT) + bytes(data))
+
+    @staticmethod
+    def _parse(raw):
+        # Events are decoded right away, nearly every callback reads them
+        packet = HCI_Event.__new__(HCI_Event)
+        packet.uart_type = HCI.HCI_EVT
+        packet._raw = None
+        packet.data = raw[3:]
+        _, packet.event_code, packet.length = _EVENT_HEADER.unpack_from(raw)
+        return packet
 
     def __init__(self, event_code, length, data):
         HCI.__init__(self, HCI.HCI_EVT)
@@ -885,12 +967,7 @@ class HCI_Event(HCI):
         self.data = data
 
     def getRaw(self):
-        return (
-            super(HCI_Event, self).getRaw()
-            + p8(self.event_code)
-            + p8(self.length)
-            + self.data
-        )
+        return _EVENT_HEADER.pack(self.uart_type, self.event_code, self.length) + self.data
 
     def __str__(self):
         parent = HCI.__str__(self)
@@ -901,7 +978,7 @@ class HCI_Event(HCI):
             self.event_code,
             eventname,
             self.length,
-            "".join(format(x, "02x") for x in self.data[0:]),
+            "".join(format(x, "02x") for x in self.payload),
         )
 
 
@@ -922,6 +999,7 @@ class StackDumpReceiver(object):
     memdump_addr = None
     memdumps = {}
     stack_dump_has_happened = False
+    registers = None  # pc, lr and sp of the last stack dump, set as soon as the register event arrives
 
     def __init__(self, data_directory="."):
         self.data_directory = data_directory
@@ -998,6 +1076,7 @@ class StackDumpReceiver(object):
                 self.logger.warn(
                     "Received Stack-Dump Event (contains %d registers):" % (data[1])
                 )
+                self.registers = {"pc": values[2], "lr": values[3], "sp": values[1]}
                 registers = (
                     "pc: 0x%08x   lr: 0x%08x   sp: 0x%08x   r0: 0x%08x   r1: 0x%08x\n"
                     % (values[2], values[3], values[1], values[4], values[5])
@@ -1041,6 +1120,7 @@ class StackDumpReceiver(object):
                 self.logger.warn(
                     "Received Stack-Dump Event (contains %d registers):" % (data[1])
                 )
+                self.registers = {"pc": values[2], "lr": values[3], "sp": values[1]}
                 registers = (
                     "pc: 0x%08x   lr: 0x%08x   sp: 0x%08x   r0: 0x%08x   r1: 0x%08x\n"
                     % (values[2], values[3], values[1], values[4], values[5])
@@ -1108,6 +1188,7 @@ class StackDumpReceiver(object):
                     "Received Evaluation Stack-Dump Event (contains %d registers):"
                     % (data[1])
                 )
+                self.registers = {"pc": values[2], "lr": values[3], "sp": values[1]}
                 registers = (
                     "pc: 0x%08x   lr: 0x%08x   sp: 0x%08x   r0: 0x%08x   r1: 0x%08x\n"
                     % (values[2], values[3], values[1], values[4], values[5])
@@ -1174,6 +1255,7 @@ class StackDumpReceiver(object):
             self.logger.warn(
                 "Received S10 Stack-Dump Event (contains %d registers):" % (data[1])
             )
+            self.registers = {"pc": values[16], "lr": values[17], "sp": values[23]}
             registers = (
                 "pc: 0x%08x   lr: 0x%08x   sp: 0x%08x   r0: 0x%08x   r1: 0x%08x\n"
                 % (values[16], values[17], values[23], values[19], values[20])
@@ -0,0 +1,495 @@
+import struct
+from builtins import object
+
+from . import hci
+
+try:
+    from typing import Dict, Iterator, List, Optional, Tuple, Type
+except ImportError:
+    pass
+
+
+LE_META_EVENT = 0x3E
+
+# (event code, LE sub-event or None) -> decoder class, see register_event()
+EVENT_DECODERS = {}  # type: Dict[Tuple[int, Optional[int]], Type[HciEvent]]
+
+_U16 = struct.Struct("<H")
+_HANDLE_COUNT = struct.Struct("<HH")
+
+
+def register_event(event_code, subevent=None):
+    """ Class decorator which registers a decoder for decode_event(). """
+
+    def register(cls):
+        cls.event_code = event_code
+        cls.subevent = subevent
+        EVENT_DECODERS[(event_code, subevent)] = cls
+        return cls
+
+    return register
+
+
+def decode_event(event_code, data):
+    # type: (int, bytes) -> Optional[HciEvent]
+    """
+    Returns the typed event for the parameters of an HCI event, or None if
+    there is no decoder for it. LE Meta events are looked up by sub-event.
+    """
+    if event_code == LE_META_EVENT and data:
+        cls = EVENT_DECODERS.get((event_code, data[0]))
+    else:
+        cls = EVENT_DECODERS.get((event_code, None))
+    return cls(data) if cls is not None else None
+
+
+def decode_packet(hcipkt):
+    # type: (hci.HCI) -> Optional[HciEvent]
+    """ decode_event() for a received packet, None if it is not a known event. """
+    if not isinstance(hcipkt, hci.HCI_Event):
+        return None
+    return decode_event(hcipkt.event_code, hcipkt.data)
+
+
+class HciEvent(object):
+    """
+    Base class of the typed events. Only the event parameters are stored,
+    the fields are properties which are decoded when they are accessed.
+    """
+
+    __slots__ = ("data",)
+
+    event_code = None  # type: Optional[int]
+    subevent = None  # type: Optional[int]
+
+    def __init__(self, data):
+        # type: (bytes) -> None
+        self.data = data
+
+    @property
+    def status(self):
+        # type: () -> Optional[int]
+        return self.data[0] if self.data else None
+
+    @property
+    def status_str(self):
+        # type: () -> str
+        status = self.status
+        return hci.HCI_Event.HCI_COMMAND_ERROR_STR.get(status, hex(status) if status is not None else "None")
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, bytes(self.data).hex())
+
+
+@register_event(0x0E)
+class CommandComplete(HciEvent):
+    """
+    Command Complete. sendHciCommand() returns these parameters, so call
+    sites wrap its response: CommandComplete(response).status
+    """
+
+    __slots__ = ()
+
+    @property
+    def num_packets(self):
+        # type: () -> int
+        return self.data[0]
+
+    @property
+    def opcode(self):
+        # type: () -> Optional[int]
+        return _U16.unpack_from(self.data, 1)[0] if len(self.data) >= 3 else None
+
+    @property
+    def status(self):
+        # type: () -> Optional[int]
+        return self.data[3] if len(self.data) >= 4 else None
+
+    @property
+    def return_parameters(self):
+        # type: () -> bytes
+        """ All return parameters, starting with the status. """
+        return self.data[3:]
+
+    @property
+    def result(self):
+        # type: () -> bytes
+        """ The return parameters after the status, e.g. the memory of VSC_Read_RAM. """
+        return self.data[4:]
+
+
+@register_event(0x0F)
+class CommandStatus(HciEvent):
+    __slots__ = ()
+
+    @property
+    def num_packets(self):
+        # type: () -> int
+        return self.data[1]
+
+    @property
+    def opcode(self):
+        # type: () -> Optional[int]
+        return _U16.unpack_from(self.data, 2)[0] if len(self.data) >= 4 else None
+
+
+@register_event(0x03)
+class ConnectionComplete(HciEvent):
+    __slots__ = ()
+
+    @property
+    def handle(self):
+        # type: () -> int
+        return _U16.unpack_from(self.data, 1)[0]
+
+    @property
+    def address(self):
+        # type: () -> bytes
+        """ Big endian, as displayed. """
+        return bytes(self.data[3:9][::-1])
+
+    @property
+    def link_type(self):
+        # type: () -> int
+        return self.data[9]
+
+    @property
+    def encryption_enabled(self):
+        # type: () -> bool
+        return self.data[10] != 0
+
+
+@register_event(0x04)
+class ConnectionRequest(HciEvent):
+    __slots__ = ()
+
+    @property
+    def status(self):
+        return None  # This event has no status
+
+    @property
+    def address(self):
+        # type: () -> bytes
+        """ Big endian, as displayed. """
+        return bytes(self.data[0:6][::-1])
+
+    @property
+    def device_class(self):
+        # type: () -> int
+        return int.from_bytes(bytes(self.data[6:9]), "little")
+
+    @property
+    def link_type(self):
+        # type: () -> int
+        return self.data[9]
+
+
+@register_event(0x05)
+class DisconnectionComplete(HciEvent):
+    __slots__ = ()
+
+    @property
+    def handle(self):
+        # type: () -> int
+        return _U16.unpack_from(self.data, 1)[0]
+
+    @property
+    def reason(self):
+        # type: () -> int
+        return self.data[3]
+
+
+@register_event(0x08)
+class EncryptionChange(HciEvent):
+    __slots__ = ()
+
+    @property
+    def handle(self):
+        # type: () -> int
+        return _U16.unpack_from(self.data, 1)[0]
+
+    @property
+    def encryption_enabled(self):
+        # type: () -> bool
+        return self.data[3] != 0
+
+
+@register_event(0x12)
+class RoleChange(HciEvent):
+    __slots__ = ()
+
+    @property
+    def address(self):
+        # type: () -> bytes
+        """ Big endian, as displayed. """
+        return bytes(self.data[1:7][::-1])
+
+    @property
+    def role(self):
+        # type: () -> str
+        return "master" if self.data[7] == 0 else "slave"
+
+
+@register_event(0x13)
+class NumberOfCompletedPackets(HciEvent):
+    __slots__ = ()
+
+    @property
+    def status(self):
+        return None  # This event has no status
+
+    @property
+    def completed(self):
+        # type: () -> List[Tuple[int, int]]
+        """ (connection handle, number of completed packets) per handle. """
+        count = self.data[0] if self.data else 0
+        return list(_HANDLE_COUNT.iter_unpack(bytes(self.data[1:1 + 4 * count])))
+
+
+@register_event(0x2C)
+class SynchronousConnectionComplete(HciEvent):
+    __slots__ = ()
+
+    @property
+    def handle(self):
+        # type: () -> int
+        return _U16.unpack_from(self.data, 1)[0]
+
+    @property
+    def address(self):
+        # type: () -> bytes
+        """ Big endian, as displayed. """
+        return bytes(self.data[3:9][::-1])
+
+    @property
+    def link_type(self):
+        # type: () -> int
+        """ 0x00: SCO, 0x02: eSCO """
+        return self.data[9]
+
+
+class LeMetaEvent(HciEvent):
+    """ LE Meta event, the first parameter is the sub-event code. """
+
+    __slots__ = ()
+
+    @property
+    def status(self):
+        # type: () -> Optional[int]
+        return self.data[1] if len(self.data) >= 2 else None
+
+
+@register_event(LE_META_EVENT, 0x01)
+class LeConnectionComplete(LeMetaEvent):
+    __slots__ = ()
+
+    @property
+    def handle(self):
+        # type: () -> int
+        return _U16.unpack_from(self.data, 2)[0]
+
+    @property
+    def role(self):
+        # type: () -> str
+        return "master" if self.data[4] == 0 else "slave"
+
+    @property
+    def address_type(self):
+        # type: () -> int
+        return self.data[5]
+
+    @property
+    def address(self):
+        # type: () -> bytes
+        return bytes(self.data[6:12][::-1])
+
+
+@register_event(LE_META_EVENT, 0x0A)
+class LeEnhancedConnectionComplete(LeConnectionComplete):
+    """ Same fields as LE Connection Complete, followed by the resolvable private addresses. """
+
+    __slots__ = ()
+
+
+def enhanced_event_type(event_type):
+    # type: (int) -> Tuple[int, int, int, int]
+    """
+    Splits the Event Type of an advertising report with the Broadcom/Cypress
+    enhanced bits (see InternalBlue.enableEnhancedAdvReport) into
+    (event type, channel 37-39, antenna, scan mode). Without the enhanced
+    bits, the channel is 37.
+    """
+    return event_type & 0x07, 37 + ((event_type >> 4) & 7), (event_type >> 7) & 1, (event_type >> 3) & 3
+
+
+def iter_advertising_reports(data):
+    # type: (bytes) -> Iterator[Tuple[int, int, bytes, bytes, int]]
+    """
+    Parses the parameters of an LE Advertising Report event (starting with
+    the sub-event code) without creating report objects. Yields
+    (event type, address type, address, data, rssi) per report, the address
+    is big endian. The reports are stored one after another, like the
+    controllers (and BlueZ) do it. Truncated reports are dropped.
+    """
+    end_of_data = len(data)
+    offset = 2
+    for _ in range(data[1] if end_of_data >= 2 else 0):
+        if offset + 9 > end_of_data:
+            return
+        end = offset + 9 + data[offset + 8]
+        if end >= end_of_data:
+            return
+        rssi = data[end]
+        yield (data[offset], data[offset + 1], bytes(data[offset + 2:offset + 8][::-1]),
+               bytes(data[offset + 9:end]), rssi - 0x100 if rssi > 0x7F else rssi)
+        offset = end + 1
+
+
+class AdvertisingReport(object):
+    """ One report of an LE Advertising Report event. """
+
+    __slots__ = ("event_type", "address_type", "address", "data", "rssi")
+
+    def __init__(self, event_type, address_type, address, data, rssi):
+        # type: (int, int, bytes, bytes, int) -> None
+        self.event_type = event_type  # Including the enhanced bits, see enhanced_event_type()
+        self.address_type = address_type
+        self.address = address  # Big endian, as displayed
+        self.data = data
+        self.rssi = rssi
+
+    @property
+    def pdu_type(self):
+        # type: () -> int
+        """ ADV_IND (0) .. SCAN_RSP (4) """
+        return self.event_type & 0x07
+
+    @property
+    def channel(self):
+        # type: () -> int
+        return enhanced_event_type(self.event_type)[1]
+
+    @property
+    def antenna(self):
+        # type: () -> int
+        """ 0 for Bluetooth, 1 for WLAN """
+        return enhanced_event_type(self.event_type)[2]
+
+    @property
+    def scan_mode(self):
+        # type: () -> int
+        return enhanced_event_type(self.event_type)[3]
+
+    def __repr__(self):
+        return "<AdvertisingReport %s rssi=%d>" % (":".join("%02x" % b for b in self.address), self.rssi)
+
+
+@register_event(LE_META_EVENT, 0x02)
+class LeAdvertisingReport(LeMetaEvent):
+    __slots__ = ("_reports",)
+
+    def __init__(self, data):
+        # type: (bytes) -> None
+        super(LeAdvertisingReport, self).__init__(data)
+        self._reports = None  # type: Optional[List[AdvertisingReport]]
+
+    @property
+    def status(self):
+        return None  # This event has no status
+
+    @property
+    def reports(self):
+        # type: () -> List[AdvertisingReport]
+        if self._reports is None:
+            self._reports = [AdvertisingReport(*report) for report in iter_advertising_reports(self.data)]
+        return self._reports
+
+
+@register_event(0x01)
+class InquiryComplete(HciEvent):
+    __slots__ = ()
+
+
+def iter_inquiry_results(event_code, data):
+    # type: (int, bytes) -> Iterator[Tuple[bytes, int, int, int, Optional[int], Optional[bytes]]]
+    """
+    Parses the parameters of an Inquiry Result (0x02), Inquiry Result with
+    RSSI (0x22) or Extended Inquiry Result (0x2F) event without creating
+    objects. Yields (address, page scan repetition mode, class of device,
+    clock offset, rssi, extended inquiry response) per response, the
+    address is big endian. rssi and the EIR data are None if the event does
+    not contain them. Like BlueZ, the responses are read one after another.
+    """
+    # 14 bytes per response: Inquiry Result has two reserved bytes after the
+    # page scan repetition mode, the others one reserved byte and the RSSI at the end
+    with_rssi = event_code != 0x02
+    class_offset = 8 if with_rssi else 9
+    end_of_data = len(data)
+    offset = 1
+    for _ in range(data[0] if data else 0):
+        end = offset + 14
+        if end > end_of_data:
+            return
+        position = offset + class_offset
+        device_class = data[position] | data[position + 1] << 8 | data[position + 2] << 16
+        clock_offset = _U16.unpack_from(data, position + 3)[0]
+        rssi = None
+        if with_rssi:
+            rssi = data[offset + 13] - 0x100 if data[offset + 13] > 0x7F else data[offset + 13]
+        yield (bytes(data[offset:offset + 6][::-1]), data[offset + 6], device_class, clock_offset, rssi,
+               bytes(data[end:]) if event_code == 0x2F else None)
+        offset = end
+
+
+class InquiryResponse(object):
+    """ One response of an inquiry result event. """
+
+    __slots__ = ("address", "page_scan_repetition_mode", "device_class", "clock_offset", "rssi", "eir")
+
+    def __init__(self, address, page_scan_repetition_mode, device_class, clock_offset, rssi=None, eir=None):
+        # type: (bytes, int, int, int, Optional[int], Optional[bytes]) -> None
+        self.address = address  # Big endian, as displayed
+        self.page_scan_repetition_mode = page_scan_repetition_mode
+        self.device_class = device_class
+        self.clock_offset = clock_offset
+        self.rssi = rssi
+        self.eir = eir
+
+    def __repr__(self):
+        return "<InquiryResponse %s class=0x%06x>" % (":".join("%02x" % b for b in self.address), self.device_class)
+
+
+class InquiryResultEvent(HciEvent):
+    __slots__ = ("_responses",)
+
+    def __init__(self, data):
+        # type: (bytes) -> None
+        super(InquiryResultEvent, self).__init__(data)
+        self._responses = None  # type: Optional[List[InquiryResponse]]
+
+    @property
+    def status(self):
+        return None  # This event has no status
+
+    @property
+    def responses(self):
+        # type: () -> List[InquiryResponse]
+        if self._responses is None:
+            self._responses = [InquiryResponse(*response)
+                               for response in iter_inquiry_results(self.event_code, self.data)]
+        return self._responses
+
+
+@register_event(0x02)
+class InquiryResult(InquiryResultEvent):
+    __slots__ = ()
+
+
+@register_event(0x22)
+class InquiryResultWithRssi(InquiryResultEvent):
+    __slots__ = ()
+
+
+@register_event(0x2F)
+class ExtendedInquiryResult(InquiryResultEvent):
+    __slots__ = ()
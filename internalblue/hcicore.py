@@ -280,9 +280,8 @@ class HCICore(InternalBlue):
                 btsnoop_time,
             )
 
-            self.logger.debug(
-                "_recvThreadFunc Recv: [" + str(btsnoop_time) + "] " + str(record[0])
-            )
+            # Lazy formatting, str() would decode the packet
+            self.logger.debug("_recvThreadFunc Recv: [%s] %s", btsnoop_time, record[0])
 
             # Write to btsnoop file:
             if self.write_btsnooplog:
@@ -0,0 +1,170 @@
+from __future__ import division
+
+import time
+from builtins import object
+from collections import deque
+
+try:
+    from typing import Deque, Dict, List, Optional, Tuple, TYPE_CHECKING
+    if TYPE_CHECKING:
+        from .core import InternalBlue
+except ImportError:
+    pass
+
+
+class PoolSnapshot(object):
+    """
+    State of one BLOC pool at one point in time. The buffer headers are
+    reduced to one state byte per buffer (FREE, USED or CORRUPTED).
+    """
+
+    __slots__ = ("address", "capacity", "list_length", "memory", "buffer_size", "states")
+
+    FREE = 0
+    USED = 1
+    CORRUPTED = 2
+
+    def __init__(self, address, capacity, list_length, memory, buffer_size, states):
+        # type: (int, int, int, int, int, bytes) -> None
+        self.address = address
+        self.capacity = capacity
+        self.list_length = list_length  # Number of free buffers
+        self.memory = memory
+        self.buffer_size = buffer_size  # Including the 4 byte header
+        self.states = states
+
+    @classmethod
+    def from_heap_information(cls, pool):
+        # type: (dict) -> PoolSnapshot
+        """ Converts a dict returned by InternalBlue.readHeapInformation(). """
+        headers = pool["buffer_headers"]
+        states = bytearray(len(headers))
+        for i, buffer_address in enumerate(sorted(headers)):
+            hdr = headers[buffer_address]
+            # Same classification as 'info heap verbose'
+            if hdr in headers or hdr == 0:
+                states[i] = cls.FREE
+            elif hdr == pool["address"]:
+                states[i] = cls.USED
+            else:
+                states[i] = cls.CORRUPTED
+        return cls(pool["address"], pool["capacity"], pool["list_length"], pool["memory"],
+                   pool["buffer_size"] + 4, bytes(states))
+
+    @property
+    def used(self):
+        # type: () -> int
+        return self.capacity - self.list_length
+
+    def buffer_address(self, index):
+        # type: (int) -> int
+        return self.memory + index * self.buffer_size
+
+
+class HeapSnapshot(object):
+    """ All BLOC pools at one point in time. """
+
+    __slots__ = ("timestamp", "pools")
+
+    def __init__(self, timestamp, pools):
+        # type: (float, Dict[int, PoolSnapshot]) -> None
+        self.timestamp = timestamp
+        self.pools = pools  # Pool address -> PoolSnapshot
+
+
+class HeapMonitor(object):
+    """
+    Takes periodic snapshots of the BLOC pools (see readHeapInformation) and
+    compares them: allocation deltas, buffers which stay allocated over many
+    snapshots (leak candidates) and pools which approach exhaustion.
+
+    Only the last <history> snapshots are kept. Each snapshot reads the BLOC
+    structs and the buffer headers, the buffer contents are not read.
+    """
+
+    def __init__(self, internalblue, history=100):
+        # type: (InternalBlue, int) -> None
+        self.internalblue = internalblue
+        self.snapshots = deque(maxlen=history)  # type: Deque[HeapSnapshot]
+
+    def snapshot(self):
+        # type: () -> Optional[HeapSnapshot]
+        """ Reads the heap and stores a new snapshot. """
+        heap = self.internalblue.readHeapInformation()
+        if not heap:
+            return None
+        snapshot = HeapSnapshot(
+            time.time(),
+            {pool["address"]: PoolSnapshot.from_heap_information(pool) for pool in heap},
+        )
+        self.snapshots.append(snapshot)
+        return snapshot
+
+    def deltas(self, previous=None, current=None):
+        # type: (Optional[HeapSnapshot], Optional[HeapSnapshot]) -> Dict[int, int]
+        """
+        Change of the number of used buffers per pool, by default between the
+        last two snapshots. Positive values are allocations.
+        """
+        if current is None or previous is None:
+            if len(self.snapshots) < 2:
+                return {}
+            previous, current = self.snapshots[-2], self.snapshots[-1]
+        return {
+            address: pool.used - previous.pools[address].used
+            for address, pool in current.pools.items()
+            if address in previous.pools
+        }
+
+    def persistent_buffers(self, count):
+        # type: (int) -> List[Tuple[int, int]]
+        """
+        (pool address, buffer address) of the buffers which were allocated in
+        each of the last <count> snapshots. Empty if there are fewer snapshots.
+        """
+        if count < 1 or len(self.snapshots) < count:
+            return []
+        recent = list(self.snapshots)[-count:]
+        result = []
+        for address, pool in sorted(recent[-1].pools.items()):
+            history = [snapshot.pools.get(address) for snapshot in recent]
+            if any(p is None or p.capacity != pool.capacity or p.memory != pool.memory for p in history):
+                continue
+            for index in range(pool.capacity):
+                if all(p.states[index] != PoolSnapshot.FREE for p in history):
+                    result.append((address, pool.buffer_address(index)))
+        return result
+
+    def trends(self, window=None):
+        # type: (Optional[int]) -> Dict[int, Tuple[float, Optional[float]]]
+        """
+        Least-squares slope of the used buffers per pool (buffers per second)
+        over the last <window> snapshots (default: all), and the estimated
+        seconds until the pool is exhausted (None if it does not grow).
+        """
+        recent = list(self.snapshots)[-window:] if window else list(self.snapshots)
+        if len(recent) < 2:
+            return {}
+        result = {}
+        for address, pool in recent[-1].pools.items():
+            points = [(s.timestamp, s.pools[address].used) for s in recent if address in s.pools]
+            if len(points) < 2:
+                continue
+            mean_t = sum(t for t, _ in points) / len(points)
+            mean_u = sum(u for _, u in points) / len(points)
+            variance = sum((t - mean_t) ** 2 for t, _ in points)
+            if variance == 0:
+                continue
+            slope = sum((t - mean_t) * (u - mean_u) for t, u in points) / variance
+            exhaustion = pool.list_length / slope if slope > 0 else None
+            result[address] = (slope, exhaustion)
+        return result
+
+    def exhausting(self, horizon, window=None):
+        # type: (float, Optional[int]) -> Dict[int, float]
+        """ Pools which are expected to run out of buffers within <horizon> seconds. """
+        return {
+            address: exhaustion
+            for address, (_, exhaustion) in self.trends(window).items()
+            if exhaustion is not None and exhaustion <= horizon
+        }
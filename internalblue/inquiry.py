@@ -0,0 +1,336 @@
+from __future__ import division
+
+import json
+import time
+from builtins import object
+from collections import deque
+from threading import Event, RLock, Thread
+
+from .hci import HCI_COMND
+from .hci_events import CommandStatus, iter_inquiry_results
+from .utils.packing import p8
+
+try:
+    from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, TYPE_CHECKING
+    if TYPE_CHECKING:
+        from .core import InternalBlue
+except ImportError:
+    pass
+
+
+INQUIRY_COMPLETE = 0x01
+INQUIRY_RESULT_EVENTS = (0x02, 0x22, 0x2F)
+
+GIAC_LAP = b"\x33\x8b\x9e"  # General Inquiry Access Code 0x9E8B33
+
+EIR_TYPES = {
+    0x01: "flags", 0x02: "uuid16_incomplete", 0x03: "uuid16", 0x04: "uuid32_incomplete", 0x05: "uuid32",
+    0x06: "uuid128_incomplete", 0x07: "uuid128", 0x08: "short_name", 0x09: "name", 0x0A: "tx_power",
+    0x0D: "device_class", 0x10: "device_id", 0xFF: "manufacturer_data",
+}
+
+MAJOR_DEVICE_CLASSES = {
+    0x00: "Miscellaneous", 0x01: "Computer", 0x02: "Phone", 0x03: "Network", 0x04: "Audio/Video",
+    0x05: "Peripheral", 0x06: "Imaging", 0x07: "Wearable", 0x08: "Toy", 0x09: "Health", 0x1F: "Uncategorized",
+}
+
+
+def parse_eir(data):
+    # type: (bytes) -> Dict[int, bytes]
+    """
+    Splits extended inquiry response data into its structures (length,
+    type, data), type -> data. The zero padding after the last structure
+    and truncated structures are ignored.
+    """
+    fields = {}
+    offset = 0
+    while offset < len(data):
+        length = data[offset]
+        if length == 0 or offset + 1 + length > len(data):
+            break
+        fields[data[offset + 1]] = bytes(data[offset + 2:offset + 1 + length])
+        offset += 1 + length
+    return fields
+
+
+def major_device_class(device_class):
+    # type: (int) -> str
+    major = (device_class >> 8) & 0x1F
+    return MAJOR_DEVICE_CLASSES.get(major, "0x%02x" % major)
+
+
+class InquiryDevice(object):
+    """ Everything learned about one device from the inquiry responses. """
+
+    __slots__ = ("address", "device_class", "page_scan_repetition_mode", "clock_offset", "responses",
+                 "first_seen", "last_seen", "rssi", "eir")
+
+    def __init__(self, address, history):
+        # type: (bytes, int) -> None
+        self.address = address  # Big endian, as displayed
+        self.device_class = 0
+        self.page_scan_repetition_mode = 0
+        self.clock_offset = 0
+        self.responses = 0
+        self.first_seen = None  # type: Optional[float]
+        self.last_seen = None  # type: Optional[float]
+        self.rssi = deque(maxlen=history)  # type: Deque[Tuple[float, int]]  # (timestamp, rssi)
+        self.eir = {}  # type: Dict[int, bytes]  # EIR type -> data, merged over all responses
+
+    @property
+    def name(self):
+        # type: () -> Optional[str]
+        name = self.eir.get(0x09, self.eir.get(0x08))
+        return name.decode("utf-8", "replace") if name is not None else None
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        return {
+            "address": ":".join("%02x" % b for b in self.address),
+            "device_class": self.device_class,
+            "major_device_class": major_device_class(self.device_class),
+            "page_scan_repetition_mode": self.page_scan_repetition_mode,
+            "clock_offset": self.clock_offset,
+            "responses": self.responses,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "rssi": [rssi for _, rssi in self.rssi],
+            "name": self.name,
+            "eir": {EIR_TYPES.get(eir_type, "0x%02x" % eir_type): data.hex()
+                    for eir_type, data in sorted(self.eir.items())},
+        }
+
+
+class InquiryTable(object):
+    """
+    Devices found by inquiries, indexed by address and by major device
+    class. Updated by the sweep worker thread, so all access is locked;
+    snapshot() returns copies which can be used without the lock.
+    """
+
+    def __init__(self, history=100):
+        # type: (int) -> None
+        self.history = history  # RSSI values per device
+        self.lock = RLock()
+        self.devices = {}  # type: Dict[bytes, InquiryDevice]
+        self.by_class = {}  # type: Dict[int, set]  # Major device class -> addresses
+
+    def __len__(self):
+        with self.lock:
+            return len(self.devices)
+
+    def update(self, address, page_scan_repetition_mode, device_class, clock_offset, rssi, eir, timestamp):
+        # type: (bytes, int, int, int, Optional[int], Optional[bytes], float) -> bool
+        """ Adds one inquiry response, returns True if the device is new. """
+        with self.lock:
+            device = self.devices.get(address)
+            new = device is None
+            if new:
+                device = self.devices[address] = InquiryDevice(address, self.history)
+                device.first_seen = timestamp
+            elif device.device_class != device_class:
+                self.by_class[(device.device_class >> 8) & 0x1F].discard(address)
+            self.by_class.setdefault((device_class >> 8) & 0x1F, set()).add(address)
+            device.device_class = device_class
+            device.page_scan_repetition_mode = page_scan_repetition_mode
+            device.clock_offset = clock_offset
+            device.responses += 1
+            device.last_seen = timestamp
+            if rssi is not None:
+                device.rssi.append((timestamp, rssi))
+            if eir:
+                device.eir.update(parse_eir(eir))
+            return new
+
+    def get(self, address):
+        # type: (bytes) -> Optional[Dict[str, Any]]
+        with self.lock:
+            device = self.devices.get(bytes(address))
+            return device.to_dict() if device is not None else None
+
+    def snapshot(self, major_class=None):
+        # type: (Optional[int]) -> List[Dict[str, Any]]
+        """ All devices (or those of one major device class) as dicts, sorted by address. """
+        with self.lock:
+            if major_class is None:
+                addresses = self.devices.keys()
+            else:
+                addresses = self.by_class.get(major_class, ())
+            return [self.devices[address].to_dict() for address in sorted(addresses)]
+
+    def write_json(self, filename):
+        # type: (str) -> None
+        with open(filename, "w") as f:
+            json.dump({"timestamp": time.time(), "devices": self.snapshot()}, f, indent=2)
+
+    def write_csv(self, filename):
+        # type: (str) -> None
+        """ One row per device, with the last RSSI. """
+        with open(filename, "w") as f:
+            f.write("address,device_class,major_device_class,responses,first_seen,last_seen,rssi,name\n")
+            for device in self.snapshot():
+                f.write("%s,0x%06x,%s,%d,%.3f,%.3f,%s,%s\n" % (
+                    device["address"], device["device_class"], device["major_device_class"], device["responses"],
+                    device["first_seen"], device["last_seen"], device["rssi"][-1] if device["rssi"] else "",
+                    (device["name"] or "").replace(",", " ")))
+
+    def clear(self):
+        # type: () -> None
+        with self.lock:
+            self.devices = {}
+            self.by_class = {}
+
+
+class InquirySweep(object):
+    """
+    Runs inquiries one after another (<sweeps> times, or until stop()) and
+    aggregates the responses into an InquiryTable.
+
+    The HCI callback only peeks at the event code and queues the inquiry
+    events. The sweep thread parses them, updates the table and starts the
+    next inquiry <interval> seconds after the Inquiry Complete event, so the
+    receive thread is never busy with long sweeps. The inquiry mode is set to
+    extended inquiry results, which contain RSSI and EIR data.
+
+    Subscribers are called from the sweep thread with the dict of every new
+    device.
+    """
+
+    def __init__(self, internalblue=None, table=None, inquiry_length=8, interval=1.0, backlog=10000):
+        # type: (Optional[InternalBlue], Optional[InquiryTable], int, float, int) -> None
+        self.internalblue = internalblue
+        self.table = table if table is not None else InquiryTable()
+        self.inquiry_length = inquiry_length  # In 1.28 s units, 1..0x30
+        self.interval = interval
+        self.backlog = backlog
+        self.pending = deque()  # type: Deque[Tuple[int, bytes, float]]
+        self.subscribers = []  # type: List[Callable[[Dict[str, Any]], None]]
+        self.sweeps = 0  # Completed inquiries
+        self.responses = 0
+        self.dropped = 0
+        self.inquiry_active = False
+        self.wakeup = Event()
+        self.thread = None  # type: Optional[Thread]
+        self.running = False
+
+    def hciCallback(self, record):
+        # type: (tuple) -> None
+        """ HCI callback, registered by start(). """
+        hcipkt = record[0]
+        if hcipkt.event_code not in INQUIRY_RESULT_EVENTS and hcipkt.event_code != INQUIRY_COMPLETE:
+            return
+        if len(self.pending) >= self.backlog:
+            self.dropped += 1
+            return
+        self.pending.append((hcipkt.event_code, hcipkt.data, time.time()))
+        self.wakeup.set()
+
+    def feed(self, event_code, data, timestamp=None):
+        # type: (int, bytes, Optional[float]) -> int
+        """ Processes one inquiry event, returns the number of responses. """
+        if timestamp is None:
+            timestamp = time.time()
+        if event_code == INQUIRY_COMPLETE:
+            self.inquiry_active = False
+            self.sweeps += 1
+            return 0
+        count = 0
+        for response in iter_inquiry_results(event_code, data):
+            count += 1
+            if self.table.update(*(response + (timestamp,))) and self.subscribers:
+                device = self.table.get(response[0])
+                for callback in self.subscribers:
+                    callback(device)
+        self.responses += count
+        return count
+
+    def process(self):
+        # type: () -> int
+        """ Processes all queued events, returns the number of responses. """
+        count = 0
+        while self.pending:
+            count += self.feed(*self.pending.popleft())
+        return count
+
+    def inquiry(self):
+        # type: () -> bool
+        """ Starts one inquiry, the responses arrive as events. """
+        response = self.internalblue.sendHciCommand(
+            HCI_COMND.Inquiry, GIAC_LAP + p8(self.inquiry_length) + p8(0))
+        if response is None or CommandStatus(response).status != 0:
+            self.internalblue.logger.warning("InquirySweep: Inquiry command failed.")
+            return False
+        self.inquiry_active = True
+        return True
+
+    def _sweepFunc(self, sweeps):
+        # type: (Optional[int]) -> None
+        next_inquiry = time.time()
+        # An inquiry which does not complete (e.g. lost event) is given up after twice its length
+        timeout = self.inquiry_length * 1.28 * 2 + 5
+        started = 0.0
+        while self.running:
+            if not self.inquiry_active:
+                if sweeps is not None and self.sweeps >= sweeps:
+                    break
+                if time.time() >= next_inquiry:
+                    if not self.inquiry():
+                        break
+                    started = time.time()
+            elif time.time() - started > timeout:
+                self.internalblue.logger.warning("InquirySweep: Inquiry did not complete, starting the next one.")
+                self.inquiry_active = False
+            self.wakeup.wait(0.2)
+            self.wakeup.clear()
+            was_active = self.inquiry_active
+            self.process()
+            if was_active and not self.inquiry_active:
+                next_inquiry = time.time() + self.interval
+        self.running = False
+        self.process()
+
+    def start(self, sweeps=None):
+        # type: (Optional[int]) -> bool
+        """ Starts <sweeps> inquiries (endless if None) in the sweep thread. """
+        if self.running:
+            return True
+        response = self.internalblue.sendHciCommand(HCI_COMND.Write_Inquiry_Mode, p8(2))  # Extended results
+        if response is None:
+            self.internalblue.logger.warning("InquirySweep: Write Inquiry Mode failed.")
+            return False
+        self.running = True
+        self.sweeps = 0
+        self.internalblue.registerHciCallback(self.hciCallback)
+        self.thread = Thread(target=self._sweepFunc, args=(sweeps,))
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def wait(self, timeout=None):
+        # type: (Optional[float]) -> bool
+        """ Waits for the sweeps to finish, returns False on timeout. """
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                return False
+        self.stop()
+        return True
+
+    def stop(self):
+        # type: () -> None
+        if self.thread is None:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+        if self.inquiry_active:
+            self.internalblue.sendHciCommand(HCI_COMND.Inquiry_Cancel, b"")
+            self.inquiry_active = False
+        self.internalblue.unregisterHciCallback(self.hciCallback)
+        self.process()
+
+    def clear(self):
+        # type: () -> None
+        self.table.clear()
+        self.sweeps = self.responses = self.dropped = 0
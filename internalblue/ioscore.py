@@ -212,7 +212,7 @@ class iOSCore(InternalBlue):
                 # Put all relevant infos into a tuple. The HCI packet is parsed with the help of hci.py.
                 record = (hci.parse_hci_packet(record_data), 0, 0, 0, 0, 0)
 
-                self.logger.debug("Recv: " + str(record[0]))
+                self.logger.debug("Recv: %s", record[0])
 
                 # Put the record into all queues of registeredHciRecvQueues if their
                 # filter function matches.
@@ -0,0 +1,290 @@
+from __future__ import division
+
+import math
+import time
+from array import array
+from builtins import object
+from collections import deque
+from threading import Event, RLock, Thread
+
+from .hci import HCI_COMND
+from .hci_events import CommandComplete, LE_META_EVENT, enhanced_event_type, iter_advertising_reports
+from .utils.packing import p8, p16
+
+try:
+    from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, TYPE_CHECKING
+    if TYPE_CHECKING:
+        from .core import InternalBlue
+except ImportError:
+    pass
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class DeviceTable(object):
+    """
+    Aggregated advertising reports, one row per address. The values are kept
+    in typed arrays, one per column, so that large scans stay compact and can
+    be exported with to_numpy(). The last advertising data is kept per PDU
+    type (e.g. ADV_IND and SCAN_RSP).
+
+    A report is a duplicate if the device sent the same data with the same
+    PDU type before. Duplicates are counted but do not change the data.
+
+    The table is updated by the scanner's worker thread, so all access is
+    locked. device() and devices() return copies.
+    """
+
+    COLUMNS = ("address_type", "event_type", "reports", "duplicates", "rssi_last", "rssi_min", "rssi_max",
+               "rssi_sum", "rssi_squares", "first_seen", "last_seen", "channel_37", "channel_38", "channel_39")
+    TYPECODES = {"address_type": "B", "event_type": "B", "reports": "L", "duplicates": "L", "rssi_last": "b",
+                 "rssi_min": "b", "rssi_max": "b", "rssi_sum": "d", "rssi_squares": "d", "first_seen": "d",
+                 "last_seen": "d", "channel_37": "L", "channel_38": "L", "channel_39": "L"}
+
+    def __init__(self):
+        self.lock = RLock()
+        self._reset()
+
+    def _reset(self):
+        self.rows = {}  # type: Dict[bytes, int]  # Address -> row
+        self.addresses = []  # type: List[bytes]
+        self.data = []  # type: List[Dict[int, bytes]]  # Per row: PDU type -> last data
+        self.columns = {column: array(self.TYPECODES[column]) for column in self.COLUMNS}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.addresses)
+
+    def update(self, address, address_type, event_type, data, rssi, timestamp):
+        # type: (bytes, int, int, bytes, int, float) -> bool
+        """ Adds one report, returns False if it was a duplicate. """
+        pdu_type, channel, _, _ = enhanced_event_type(event_type)
+        with self.lock:
+            columns = self.columns
+            row = self.rows.get(address)
+            if row is None:
+                row = self.rows[address] = len(self.addresses)
+                self.addresses.append(address)
+                self.data.append({pdu_type: data})
+                for column, value in (("address_type", address_type), ("event_type", event_type), ("reports", 1),
+                                      ("duplicates", 0), ("rssi_last", rssi), ("rssi_min", rssi), ("rssi_max", rssi),
+                                      ("rssi_sum", rssi), ("rssi_squares", rssi * rssi), ("first_seen", timestamp),
+                                      ("last_seen", timestamp), ("channel_37", 0), ("channel_38", 0),
+                                      ("channel_39", 0)):
+                    columns[column].append(value)
+                if channel <= 39:
+                    columns["channel_%d" % channel][row] = 1
+                return True
+
+            columns["event_type"][row] = event_type
+            columns["reports"][row] += 1
+            columns["rssi_last"][row] = rssi
+            if rssi < columns["rssi_min"][row]:
+                columns["rssi_min"][row] = rssi
+            if rssi > columns["rssi_max"][row]:
+                columns["rssi_max"][row] = rssi
+            columns["rssi_sum"][row] += rssi
+            columns["rssi_squares"][row] += rssi * rssi
+            columns["last_seen"][row] = timestamp
+            if channel <= 39:
+                columns["channel_%d" % channel][row] += 1
+
+            known = self.data[row]
+            if known.get(pdu_type) == data:
+                columns["duplicates"][row] += 1
+                return False
+            known[pdu_type] = data
+            return True
+
+    def device(self, address):
+        # type: (bytes) -> Optional[Dict[str, Any]]
+        """ The columns of one device as dict, with RSSI mean and standard deviation. """
+        with self.lock:
+            row = self.rows.get(bytes(address))
+            if row is None:
+                return None
+            device = {column: self.columns[column][row] for column in self.COLUMNS}
+            device["address"] = self.addresses[row]
+            device["data"] = dict(self.data[row])
+        count = device["reports"]
+        mean = device["rssi_sum"] / count
+        device["rssi_mean"] = mean
+        device["rssi_std"] = math.sqrt(max(device["rssi_squares"] / count - mean * mean, 0.0))
+        return device
+
+    def devices(self, sort="last_seen"):
+        # type: (str) -> List[Dict[str, Any]]
+        """ All devices, sorted by <sort> (descending). """
+        with self.lock:
+            devices = [self.device(address) for address in self.addresses]
+        return sorted(devices, key=lambda device: -device[sort])
+
+    def to_numpy(self):
+        # type: () -> Dict[str, numpy.ndarray]
+        """ The columns as numpy arrays (row order), e.g. for plotting. """
+        if numpy is None:
+            raise ImportError("numpy is required for this function.")
+        # Copies: a view would keep the arrays from growing while a scan is running
+        with self.lock:
+            columns = {column: numpy.array(self.columns[column]) for column in self.COLUMNS}
+            columns["address"] = numpy.array([address.hex() for address in self.addresses])
+        return columns
+
+    def clear(self):
+        # type: () -> None
+        with self.lock:
+            self._reset()
+
+
+class LeScanner(object):
+    """
+    Collects the LE Advertising Reports of an LE scan into a DeviceTable.
+
+    The HCI callback only peeks at the event header and queues the event
+    parameters, the reports are parsed and aggregated by a worker thread
+    (start()) or by process(), so the receive thread keeps up with dense
+    environments. Events are dropped (and counted) if more than <backlog>
+    events are waiting.
+
+    The Event Type contains channel, antenna and scan mode if enhanced
+    reports are enabled, see InternalBlue.enableEnhancedAdvReport.
+    Subscribers are called from the worker thread with (address, event
+    type, data, rssi) for every report which is not a duplicate.
+    """
+
+    RATE_WINDOW = 5.0  # Seconds, for rate()
+
+    def __init__(self, internalblue=None, table=None, backlog=100000):
+        # type: (Optional[InternalBlue], Optional[DeviceTable], int) -> None
+        self.internalblue = internalblue
+        self.table = table if table is not None else DeviceTable()
+        self.backlog = backlog
+        self.pending = deque()  # type: Deque[Tuple[bytes, float]]
+        self.subscribers = []  # type: List[Callable[[bytes, int, bytes, int], None]]
+        self.events = 0
+        self.reports = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.buckets = deque()  # type: Deque[List[int]]  # [second, reports]
+        self.wakeup = Event()
+        self.worker = None  # type: Optional[Thread]
+        self.running = False
+
+    def hciCallback(self, record):
+        # type: (tuple) -> None
+        """ HCI callback, registered by start(). """
+        hcipkt = record[0]
+        if hcipkt.event_code != LE_META_EVENT:
+            return
+        data = hcipkt.data
+        if not data or data[0] != 0x02:  # LE Advertising Report
+            return
+        if len(self.pending) >= self.backlog:
+            self.dropped += 1
+            return
+        self.pending.append((data, time.time()))
+        self.wakeup.set()
+
+    def feed(self, data, timestamp=None):
+        # type: (bytes, Optional[float]) -> int
+        """ Aggregates the reports of one LE Advertising Report event, returns their number. """
+        if timestamp is None:
+            timestamp = time.time()
+        update = self.table.update
+        count = 0
+        for event_type, address_type, address, report_data, rssi in iter_advertising_reports(data):
+            count += 1
+            if update(address, address_type, event_type, report_data, rssi, timestamp):
+                for callback in self.subscribers:
+                    callback(address, event_type, report_data, rssi)
+            else:
+                self.duplicates += 1
+        self.events += 1
+        self.reports += count
+
+        second = int(timestamp)
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += count
+        else:
+            self.buckets.append([second, count])
+            while self.buckets[0][0] < second - self.RATE_WINDOW:
+                self.buckets.popleft()
+        return count
+
+    def process(self):
+        # type: () -> int
+        """ Aggregates all queued events, returns the number of reports. """
+        count = 0
+        while self.pending:
+            count += self.feed(*self.pending.popleft())
+        return count
+
+    def rate(self):
+        # type: () -> float
+        """ Reports per second, averaged over the last RATE_WINDOW seconds. """
+        since = time.time() - self.RATE_WINDOW
+        return sum(count for second, count in self.buckets if second >= since) / self.RATE_WINDOW
+
+    def _workerFunc(self):
+        while self.running:
+            self.wakeup.wait(0.5)
+            self.wakeup.clear()
+            self.process()
+        self.process()
+
+    def start(self, enable_scan=True, active=False):
+        # type: (bool, bool) -> bool
+        """
+        Registers the HCI callback and starts the worker thread. With
+        <enable_scan>, the controller is also set to scan continuously
+        (without duplicate filtering, so that every report is counted).
+        """
+        if self.running:
+            return True
+        self.running = True
+        self.internalblue.registerHciCallback(self.hciCallback)
+        self.worker = Thread(target=self._workerFunc)
+        self.worker.daemon = True
+        self.worker.start()
+        if enable_scan and not self.enable_scan(True, active):
+            self.stop(disable_scan=False)
+            return False
+        return True
+
+    def stop(self, disable_scan=True):
+        # type: (bool) -> None
+        if not self.running:
+            return
+        if disable_scan:
+            self.enable_scan(False)
+        self.internalblue.unregisterHciCallback(self.hciCallback)
+        self.running = False
+        self.wakeup.set()
+        self.worker.join()
+        self.worker = None
+
+    def enable_scan(self, enable, active=False, interval=0x10, window=0x10):
+        # type: (bool, bool, int, int) -> bool
+        """ Sends LE Set Scan Parameters and LE Set Scan Enable, interval and window in 0.625 ms. """
+        if enable:
+            response = self.internalblue.sendHciCommand(
+                HCI_COMND.LE_Set_Set_Scan_Parameters,
+                p8(1 if active else 0) + p16(interval) + p16(window) + p8(0) + p8(0))
+            if response is None or CommandComplete(response).status != 0:
+                self.internalblue.logger.warning("LeScanner: LE Set Scan Parameters failed.")
+                return False
+        response = self.internalblue.sendHciCommand(HCI_COMND.LE_Set_Scan_Enable,
+                                                    p8(1 if enable else 0) + p8(0))
+        if response is None or CommandComplete(response).status != 0:
+            self.internalblue.logger.warning("LeScanner: LE Set Scan Enable failed.")
+            return False
+        return True
+
+    def clear(self):
+        # type: () -> None
+        self.table.clear()
+        self.events = self.reports = self.duplicates = self.dropped = 0
+        self.buckets.clear()
@@ -0,0 +1,386 @@
+from __future__ import division
+
+import hashlib
+import os
+import random
+import time
+from builtins import object
+from collections import deque
+from threading import Lock, Semaphore
+
+from . import hci
+from .hci import HCI_COMND
+from .hci_events import CommandComplete, CommandStatus, decode_packet
+from .utils.packing import p8, p16
+
+try:
+    from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+    if TYPE_CHECKING:
+        from .core import InternalBlue
+except ImportError:
+    pass
+
+
+class LmpTestCase(object):
+    """ One LMP packet: opcode (escaped with 0x7F if extended) and payload. """
+
+    __slots__ = ("opcode", "extended_op", "payload")
+
+    def __init__(self, opcode, extended_op=False, payload=b""):
+        # type: (int, bool, bytes) -> None
+        self.opcode = opcode
+        self.extended_op = extended_op
+        self.payload = payload
+
+    def pdu(self):
+        # type: () -> bytes
+        """ The packet as on air, with the TID bit cleared. """
+        opcode_data = p8(0x7F << 1) + p8(self.opcode) if self.extended_op else p8(self.opcode << 1)
+        return opcode_data + self.payload
+
+    @classmethod
+    def from_pdu(cls, data):
+        # type: (bytes) -> LmpTestCase
+        if data[0] >> 1 == 0x7F and len(data) > 1:
+            return cls(data[1], True, bytes(data[2:]))
+        return cls(data[0] >> 1, False, bytes(data[1:]))
+
+    def digest(self):
+        # type: () -> str
+        return hashlib.sha1(self.pdu()).hexdigest()[:16]
+
+    def __eq__(self, other):
+        return isinstance(other, LmpTestCase) and self.pdu() == other.pdu()
+
+    def __hash__(self):
+        return hash(self.pdu())
+
+    def __repr__(self):
+        return "<LMP %sop=0x%02x %s>" % ("ext " if self.extended_op else "", self.opcode, self.payload.hex())
+
+
+class LmpMutator(object):
+    """
+    Generates LMP test cases, either from scratch or by mutating entries of
+    the corpus: bit flips, interesting and random bytes, insertions,
+    deletions, splicing and replacing the (extended) opcode.
+
+    max_length is the length of opcode and payload, VSC_SendLmpPdu transports
+    at most 17 bytes.
+    """
+
+    INTERESTING = (0x00, 0x01, 0x7F, 0x80, 0xFE, 0xFF)
+
+    def __init__(self, seed=None, max_length=17, opcodes=None, extended_opcodes=None, fresh_ratio=0.2):
+        # type: (Optional[int], int, Optional[List[int]], Optional[List[int]], float) -> None
+        self.random = random.Random(seed)
+        self.max_length = max_length
+        self.opcodes = opcodes or list(range(1, 0x7F))  # 0x7F is the escape opcode
+        self.extended_opcodes = extended_opcodes or list(range(0x100))
+        self.fresh_ratio = fresh_ratio
+
+    def max_payload(self, extended_op):
+        # type: (bool) -> int
+        return self.max_length - (2 if extended_op else 1)
+
+    def _opcode(self, extended_op):
+        # type: (bool) -> int
+        return self.random.choice(self.extended_opcodes if extended_op else self.opcodes)
+
+    def fresh(self):
+        # type: () -> LmpTestCase
+        extended_op = self.random.random() < 0.3
+        length = self.random.randint(0, self.max_payload(extended_op))
+        payload = bytes(self.random.getrandbits(8) for _ in range(length))
+        return LmpTestCase(self._opcode(extended_op), extended_op, payload)
+
+    def mutate(self, case, corpus=None):
+        # type: (LmpTestCase, Optional[List[LmpTestCase]]) -> LmpTestCase
+        opcode, extended_op, payload = case.opcode, case.extended_op, bytearray(case.payload)
+        rand = self.random
+        for _ in range(rand.randint(1, 4)):
+            strategy = rand.randrange(8)
+            position = rand.randrange(len(payload)) if payload else None
+            if strategy == 0 and position is not None:
+                payload[position] ^= 1 << rand.randrange(8)
+            elif strategy == 1 and position is not None:
+                payload[position] = rand.choice(self.INTERESTING)
+            elif strategy == 2 and position is not None:
+                payload[position] = rand.getrandbits(8)
+            elif strategy == 3:
+                payload.insert(rand.randint(0, len(payload)), rand.getrandbits(8))
+            elif strategy == 4 and position is not None:
+                del payload[position]
+            elif strategy == 5:
+                opcode = self._opcode(extended_op)
+            elif strategy == 6:
+                extended_op = not extended_op
+                opcode = self._opcode(extended_op)
+            elif strategy == 7 and corpus:
+                other = rand.choice(corpus).payload
+                cut = rand.randint(0, len(payload))
+                payload = payload[:cut] + other[rand.randint(0, len(other)):]
+        return LmpTestCase(opcode, extended_op, bytes(payload[:self.max_payload(extended_op)]))
+
+    def generate(self, corpus=None):
+        # type: (Optional[List[LmpTestCase]]) -> LmpTestCase
+        if not corpus or self.random.random() < self.fresh_ratio:
+            return self.fresh()
+        return self.mutate(self.random.choice(corpus), corpus)
+
+
+class LmpCrash(object):
+    """
+    A crash of the chip: a stack dump ('stackdump', with the registers) or
+    no response to the injected packets ('timeout'). cases are the packets
+    sent last, oldest first; with pipelining any of them might be the cause.
+    """
+
+    __slots__ = ("kind", "pc", "registers", "cases", "new")
+
+    def __init__(self, kind, cases, registers=None, new=True):
+        # type: (str, List[LmpTestCase], Optional[Dict[str, int]], bool) -> None
+        self.kind = kind
+        self.registers = registers
+        self.pc = registers["pc"] if registers else None
+        self.cases = cases
+        self.new = new  # False if a crash with the same pc (or last packet for timeouts) was seen before
+
+    def key(self):
+        # type: () -> str
+        if self.pc is not None:
+            return "pc_%08x" % self.pc
+        return "timeout_%s" % (self.cases[-1].digest() if self.cases else "none")
+
+
+class LmpCorpus(object):
+    """
+    The test cases worth mutating and the crashes, optionally persisted in
+    <directory>: corpus/<digest>.bin holds one packet, crashes/<key>/ the
+    packets sent before a crash (NN_<digest>.bin, oldest first) and the
+    registers. Crashes are deduplicated by pc, timeouts by the last packet.
+    """
+
+    def __init__(self, directory=None):
+        # type: (Optional[str]) -> None
+        self.directory = directory
+        self.cases = []  # type: List[LmpTestCase]
+        self.digests = set()  # type: Set[str]
+        self.crashes = {}  # type: Dict[str, int]  # Crash key -> number of occurrences
+        if directory is not None:
+            self.load()
+
+    def load(self):
+        # type: () -> None
+        corpus_directory = os.path.join(self.directory, "corpus")
+        if os.path.isdir(corpus_directory):
+            for filename in sorted(os.listdir(corpus_directory)):
+                with open(os.path.join(corpus_directory, filename), "rb") as f:
+                    data = f.read()
+                if data:
+                    self.add(LmpTestCase.from_pdu(data), save=False)
+        crash_directory = os.path.join(self.directory, "crashes")
+        if os.path.isdir(crash_directory):
+            for key in os.listdir(crash_directory):
+                self.crashes.setdefault(key, 1)
+
+    def add(self, case, save=True):
+        # type: (LmpTestCase, bool) -> bool
+        """ Adds a test case, returns False if it is already in the corpus. """
+        digest = case.digest()
+        if digest in self.digests:
+            return False
+        self.digests.add(digest)
+        self.cases.append(case)
+        if save and self.directory is not None:
+            self._write(os.path.join(self.directory, "corpus"), digest + ".bin", case.pdu())
+        return True
+
+    def add_crash(self, crash):
+        # type: (LmpCrash) -> bool
+        """ Stores a crash unless one with the same key exists. Returns True for new crashes. """
+        key = crash.key()
+        crash.new = key not in self.crashes
+        self.crashes[key] = self.crashes.get(key, 0) + 1
+        if crash.new and self.directory is not None:
+            directory = os.path.join(self.directory, "crashes", key)
+            for index, case in enumerate(crash.cases):
+                self._write(directory, "%02d_%s.bin" % (index, case.digest()), case.pdu())
+            if crash.registers:
+                self._write(directory, "registers.txt", "".join(
+                    "%s: 0x%08x\n" % (name, value) for name, value in sorted(crash.registers.items())
+                ).encode())
+        return crash.new
+
+    @staticmethod
+    def _write(directory, filename, data):
+        # type: (str, str, bytes) -> None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, filename), "wb") as f:
+            f.write(data)
+
+
+class LmpFuzzer(object):
+    """
+    Injects mutated LMP packets into a connection with VSC_SendLmpPdu. Up to
+    <window> commands are in flight (sent with sendH4, completed by their
+    Command Complete events), so the rate is not limited by the HCI round
+    trip. Install the fuzzLmp() patch first, otherwise the firmware drops
+    most of the packets.
+
+    The chip crashed if the StackDumpReceiver decoded new registers, or if
+    the in-flight commands are not completed within <timeout> seconds.
+    Packets accepted by the firmware with a new opcode and length are added
+    to the corpus.
+    """
+
+    RATE_WINDOW = 2.0  # Seconds over which rate() is averaged
+
+    def __init__(self, internalblue, conn_handle=0x0C, is_master=True, corpus=None, mutator=None,
+                 window=4, timeout=2.0, history=16):
+        # type: (InternalBlue, int, bool, Optional[LmpCorpus], Optional[LmpMutator], int, float, int) -> None
+        self.internalblue = internalblue
+        self.conn_handle = conn_handle
+        self.is_master = is_master
+        self.corpus = corpus if corpus is not None else LmpCorpus()
+        self.mutator = mutator if mutator is not None else LmpMutator()
+        self.window = window
+        self.timeout = timeout
+        self.lock = Lock()
+        self.slots = Semaphore(window)
+        self.in_flight = deque()  # type: Deque[LmpTestCase]
+        self.history = deque(maxlen=history)  # type: Deque[LmpTestCase]
+        self.completions = deque()  # type: Deque[float]
+        self.signatures = set(self._signature(case) for case in self.corpus.cases)
+        self.sent = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.started = None  # type: Optional[float]
+        self._known_registers = None  # type: Optional[Dict[str, int]]
+
+    @staticmethod
+    def _signature(case):
+        # type: (LmpTestCase) -> Tuple[bool, int, int]
+        return case.extended_op, case.opcode, len(case.payload)
+
+    def hciCallback(self, record):
+        # type: (tuple) -> None
+        """ Completes in-flight commands, registered while run() is active. """
+        event = decode_packet(record[0])
+        if not isinstance(event, (CommandComplete, CommandStatus)):
+            return
+        if event.opcode != HCI_COMND.VSC_SendLmpPdu.value or len(event.data) < 4:
+            return
+        status = event.status
+
+        with self.lock:
+            if not self.in_flight:
+                return  # e.g. sendLmpPacket() called in between
+            case = self.in_flight.popleft()
+            self.completions.append(time.time())
+            if status == 0:
+                self.accepted += 1
+                signature = self._signature(case)
+                if signature not in self.signatures:
+                    self.signatures.add(signature)
+                    self.corpus.add(case)
+            else:
+                self.rejected += 1
+        self.slots.release()
+
+    def rate(self):
+        # type: () -> float
+        """ Completed packets per second, averaged over the last RATE_WINDOW seconds. """
+        now = time.time()
+        with self.lock:
+            while self.completions and self.completions[0] < now - self.RATE_WINDOW:
+                self.completions.popleft()
+            count = len(self.completions)
+        if self.started is None:
+            return 0.0
+        return count / min(self.RATE_WINDOW, max(now - self.started, 1e-3))
+
+    def _crashed(self):
+        # type: () -> Optional[LmpCrash]
+        receiver = self.internalblue.stackDumpReceiver
+        if receiver is not None and receiver.registers is not None \
+                and receiver.registers is not self._known_registers:
+            return LmpCrash("stackdump", list(self.history), receiver.registers)
+        return None
+
+    def _send(self, case):
+        # type: (LmpTestCase) -> bool
+        parameters = self.internalblue._lmpPduParameters(
+            case.opcode, case.payload, self.is_master, self.conn_handle, case.extended_op)
+        if parameters is None:
+            return False
+        opcode = HCI_COMND.VSC_SendLmpPdu.value
+        with self.lock:
+            self.in_flight.append(case)
+            self.history.append(case)
+        if not self.internalblue.sendH4(hci.HCI.HCI_CMD, p16(opcode) + p8(len(parameters)) + parameters):
+            with self.lock:
+                self.in_flight.pop()
+            return False
+        self.sent += 1
+        return True
+
+    def run(self, count=None, duration=None, stop=None, status_callback=None, status_interval=1.0):
+        # type: (Optional[int], Optional[float], Optional[Callable[[], bool]], Optional[Callable[[LmpFuzzer], None]], float) -> Optional[LmpCrash]
+        """
+        Sends <count> packets or fuzzes for <duration> seconds (or until stop()
+        returns True). status_callback is called every <status_interval>
+        seconds, e.g. to print the rate. Returns the crash, if any; it is
+        stored in the corpus as well.
+        """
+        receiver = self.internalblue.stackDumpReceiver
+        self._known_registers = receiver.registers if receiver is not None else None
+        self.started = time.time()
+        deadline = None if duration is None else self.started + duration
+        next_status = self.started + status_interval
+        crash = None
+
+        self.internalblue.registerHciCallback(self.hciCallback)
+        try:
+            sent = 0
+            while count is None or sent < count:
+                if (deadline is not None and time.time() >= deadline) or (stop is not None and stop()):
+                    break
+                crash = self._crashed()
+                if crash is not None:
+                    break
+                if not self.slots.acquire(timeout=self.timeout):
+                    crash = self._crashed() or LmpCrash("timeout", list(self.history))
+                    break
+                case = self.mutator.generate(self.corpus.cases)
+                if not self._send(case):
+                    self.slots.release()
+                    break
+                sent += 1
+                if status_callback is not None and time.time() >= next_status:
+                    status_callback(self)
+                    next_status = time.time() + status_interval
+
+            # Wait for the commands in flight
+            if crash is None:
+                acquired = 0
+                while acquired < self.window:
+                    if not self.slots.acquire(timeout=self.timeout):
+                        crash = self._crashed() or LmpCrash("timeout", list(self.history))
+                        break
+                    acquired += 1
+                for _ in range(acquired):
+                    self.slots.release()
+                crash = crash or self._crashed()
+        finally:
+            self.internalblue.unregisterHciCallback(self.hciCallback)
+
+        if crash is not None:
+            self.corpus.add_crash(crash)
+            # Commands which were lost with the crash
+            with self.lock:
+                for _ in self.in_flight:
+                    self.slots.release()
+                self.in_flight.clear()
+        return crash
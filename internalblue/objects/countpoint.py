@@ -0,0 +1,54 @@
+from builtins import object
+
+
+# Counts a hit and continues with the original instructions, which are
+# moved into the hook. Only registers saved on the stack and the flags
+# (restored from r2) are touched, so the firmware does not notice the hook.
+COUNTPOINT_HOOK_ASM = """
+        push {r0-r2}
+        mrs  r2, cpsr
+        ldr  r0, =0x%(counter)x   // addCountpoint() injects the address of the counter
+        ldr  r1, [r0]
+        add  r1, 1
+        str  r1, [r0]
+        msr  cpsr_f, r2
+        pop  {r0-r2}
+
+        // original instructions
+        %(original)s
+
+        // continue after the patched instructions
+        b 0x%(resume)x
+"""
+
+
+class Countpoint(object):
+    """ An installed countpoint, see InternalBlue.addCountpoint(). """
+
+    def __init__(self, address, hook_address, patchram_slot, counter_index, original):
+        # type: (int, int, int, int, bytes) -> None
+        self.address = address
+        self.hook_address = hook_address
+        self.patchram_slot = patchram_slot
+        self.counter_index = counter_index  # Index into the counter table
+        self.original = original  # The 4 bytes replaced by the branch to the hook
+
+
+class CountpointSample(object):
+    """ Counter values read at one point in time. """
+
+    def __init__(self, timestamp, counts):
+        self.timestamp = timestamp
+        self.counts = counts  # Dict[address, count]
+
+    def rates(self, previous):
+        # type: (CountpointSample) -> dict
+        """ Hits per second since <previous> for each countpoint in both samples. """
+        elapsed = self.timestamp - previous.timestamp
+        if elapsed <= 0:
+            return {address: 0.0 for address in self.counts}
+        return {
+            address: ((count - previous.counts[address]) & 0xFFFFFFFF) / elapsed
+            for address, count in self.counts.items()
+            if address in previous.counts
+        }
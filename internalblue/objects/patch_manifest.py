@@ -0,0 +1,166 @@
+from bisect import bisect_left
+from builtins import object
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import hashlib
+import json
+
+
+class RamBlobs(object):
+    """
+    RAM contents as sorted, disjoint blobs. Overlapping and adjacent blobs
+    are merged when they are added (later bytes win), so a long session of
+    small writes stays a handful of blobs and can be written back with as
+    few writeMem() calls as possible.
+    """
+
+    def __init__(self):
+        self.starts = []  # type: List[int]
+        self.blobs = []  # type: List[bytearray]
+
+    def add(self, address, data):
+        # type: (int, bytes) -> None
+        end = address + len(data)
+        starts, blobs = self.starts, self.blobs
+        # First blob which ends at or after <address> (blobs are disjoint, so the ends are sorted, too)
+        first = bisect_left(starts, address)
+        if first > 0 and starts[first - 1] + len(blobs[first - 1]) >= address:
+            first -= 1
+        last = first
+        while last < len(starts) and starts[last] <= end:
+            last += 1
+
+        if first == last:
+            starts.insert(first, address)
+            blobs.insert(first, bytearray(data))
+            return
+        if last == first + 1 and starts[first] <= address:
+            # Common case: inside or appended to one blob, changed in place
+            offset = address - starts[first]
+            blobs[first][offset:offset + len(data)] = data
+            return
+
+        union_start = min(starts[first], address)
+        union_end = max(starts[last - 1] + len(blobs[last - 1]), end)
+        merged = bytearray(union_end - union_start)
+        for start, blob in zip(starts[first:last], blobs[first:last]):
+            merged[start - union_start:start - union_start + len(blob)] = blob
+        merged[address - union_start:end - union_start] = data
+        starts[first:last] = [union_start]
+        blobs[first:last] = [merged]
+
+    def __iter__(self):
+        # type: () -> Iterator[Tuple[int, bytes]]
+        return ((start, bytes(blob)) for start, blob in zip(self.starts, self.blobs))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def clear(self):
+        # type: () -> None
+        self.starts = []
+        self.blobs = []
+
+
+class PatchManifest(object):
+    """
+    A patch set which can be saved to a file and re-applied later on without
+    re-assembling anything. It consists of:
+    - ram_blobs: (address, data) tuples of already assembled code or data in
+                 RAM, coalesced (see RamBlobs)
+    - patches:   (address, value) tuples of 4-byte patchram entries
+    - the firmware (name and LMP subversion) the patch set was created for
+
+    The digest covers the RAM blobs and patchram entries, so it can be compared
+    against the state read back from a chip.
+    """
+
+    version = 1
+
+    def __init__(self, fw_name=None, lmp_subversion=None, ram_blobs=None, patches=None):
+        # type: (Optional[str], Optional[int], Optional[List[Tuple[int, bytes]]], Optional[List[Tuple[int, bytes]]]) -> None
+        self.fw_name = fw_name
+        self.lmp_subversion = lmp_subversion
+        self.ram = RamBlobs()
+        self.patches = []  # type: List[Tuple[int, bytes]]
+        for address, data in ram_blobs or []:
+            self.add_ram(address, data)
+        for address, value in patches or []:
+            self.add_patch(address, value)
+
+    def add_ram(self, address, data):
+        # type: (int, bytes) -> None
+        """ Add a RAM blob. Later blobs overwrite earlier ones where they overlap. """
+        self.ram.add(address, data)
+
+    @property
+    def ram_blobs(self):
+        # type: () -> List[Tuple[int, bytes]]
+        return list(self.ram)
+
+    def add_patch(self, address, value):
+        # type: (int, bytes) -> None
+        """ Add a patchram entry. An entry for the same address is replaced. """
+        if len(value) != 4:
+            raise ValueError("patch value must be a 32-bit dword")
+        self.patches = [(a, v) for a, v in self.patches if a != address]
+        self.patches.append((address, bytes(value)))
+
+    def coalesced_ram_blobs(self):
+        # type: () -> List[Tuple[int, bytes]]
+        """
+        The RAM blobs with overlapping and adjacent ones merged, so that the
+        manifest can be written with as few writeMem() calls as possible. They
+        are merged when they are added, see RamBlobs.
+        """
+        return list(self.ram)
+
+    def digest(self):
+        # type: () -> str
+        """ SHA-256 over the coalesced RAM blobs and the sorted patchram entries. """
+        h = hashlib.sha256()
+        for address, data in self.coalesced_ram_blobs():
+            h.update(b"RAM" + address.to_bytes(4, "little") + len(data).to_bytes(4, "little") + data)
+        for address, value in sorted(self.patches):
+            h.update(b"PATCH" + address.to_bytes(4, "little") + value)
+        return h.hexdigest()
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        return {
+            "version": self.version,
+            "fw_name": self.fw_name,
+            "lmp_subversion": self.lmp_subversion,
+            "digest": self.digest(),
+            "ram_blobs": [{"address": address, "data": data.hex()} for address, data in self.coalesced_ram_blobs()],
+            "patches": [{"address": address, "value": value.hex()} for address, value in self.patches],
+        }
+
+    @classmethod
+    def from_dict(cls, manifest):
+        # type: (Dict[str, Any]) -> PatchManifest
+        if manifest.get("version") != cls.version:
+            raise ValueError("unsupported manifest version: %s" % manifest.get("version"))
+        result = cls(
+            manifest.get("fw_name"),
+            manifest.get("lmp_subversion"),
+            [(blob["address"], bytes.fromhex(blob["data"])) for blob in manifest["ram_blobs"]],
+            [(patch["address"], bytes.fromhex(patch["value"])) for patch in manifest["patches"]],
+        )
+        if "digest" in manifest and manifest["digest"] != result.digest():
+            raise ValueError("manifest digest does not match its content")
+        return result
+
+    def save(self, filename):
+        # type: (str) -> None
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, filename):
+        # type: (str) -> PatchManifest
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+    def __len__(self):
+        return len(self.ram) + len(self.patches)
@@ -1,23 +1,26 @@
 from builtins import object
-from typing import Any
+from typing import Any, Dict, List, Optional
 
 
 class QueueElement(object):
-    index = 0
-    next_item = 0
-    prev = 0
-    capacity = 0
-    name = ""
-    queue_buf_start = 0
-    available_items = 0
-    item_size = 0
-    next_free_slot = 0
-    free_slots = 0
-    address = 0
-    waitlist_length = 0
-    next = 0
-    queue_buf_end = 0
-    thread_waitlist = 0
+    __slots__ = (
+        "index",
+        "address",
+        "item_size",
+        "capacity",
+        "available_items",
+        "free_slots",
+        "queue_buf_start",
+        "queue_buf_end",
+        "next_item",
+        "next_free_slot",
+        "thread_waitlist",
+        "waitlist_length",
+        "next",
+        "prev",
+        "name",
+        "items",
+    )
 
     def __init__(
         self,
@@ -36,6 +39,7 @@ class QueueElement(object):
         next,
         prev,
         name,
+        items=None,
     ):
         self.index = index
         self.next_item = next_item
@@ -52,7 +56,32 @@ class QueueElement(object):
         self.next = next
         self.queue_buf_end = queue_buf_end
         self.thread_waitlist = thread_waitlist
+        self.items = items  # type: Optional[List[bytes]]
+
+    def decode_items(self, buffer):
+        # type: (bytes) -> List[bytes]
+        """
+        Extracts the valid items from the content of the queue buffer
+        (queue_buf_start to queue_buf_end). The queue is a ring buffer, the
+        items start at next_item and may wrap around at the end of the buffer.
+        """
+        items = []  # type: List[bytes]
+        offset = self.next_item - self.queue_buf_start
+        if offset < 0:
+            # next_item points in front of the buffer, the struct is not a valid queue
+            return items
+        for _ in range(min(self.available_items, self.capacity)):
+            if offset + self.item_size > len(buffer):
+                offset = 0
+            items.append(bytes(buffer[offset:offset + self.item_size]))
+            offset += self.item_size
+        return items
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        """ Returns the fields of the queue, e.g. for str.format(). """
+        return {field: getattr(self, field) for field in self.__slots__}
 
     def __getitem__(self, item):
         # type: (str) -> Any
-        return vars(self)[item]
+        return getattr(self, item)
@@ -0,0 +1,293 @@
+from builtins import object
+import re
+from typing import Dict, List, Optional, Tuple
+
+from internalblue.utils.packing import p32, pack_u32_array, unpack_u16_array
+
+
+class CaptureRange(object):
+    """
+    A memory range that is sent to the host when a tracepoint is hit.
+    Stack-relative ranges start at <address> bytes (may be negative) from the
+    stack pointer at the tracepoint.
+    """
+
+    MAX_LENGTH = 0xFFFF
+
+    def __init__(self, address, length, stack_relative=False):
+        # type: (int, int, bool) -> None
+        if not 0 < length <= self.MAX_LENGTH:
+            raise ValueError("capture length must be between 1 and 0x%x" % self.MAX_LENGTH)
+        self.address = address
+        self.length = length
+        self.stack_relative = stack_relative
+
+    def resolve(self, sp):
+        # type: (int) -> int
+        """ Absolute start address for a hit with the given stack pointer. """
+        if self.stack_relative:
+            return (sp + self.address) & 0xFFFFFFFF
+        return self.address
+
+    @classmethod
+    def parse(cls, spec):
+        # type: (str) -> CaptureRange
+        """
+        Parses '<address>:<length>' or 'sp[+-]<offset>:<length>',
+        e.g. '0x200000:0x40' or 'sp-8:32'.
+        """
+        try:
+            start, length = spec.split(":")
+            start = start.strip().lower()
+            if start.startswith("sp"):
+                offset = start[2:]
+                return cls(int(offset, 0) if offset else 0, int(length, 0), stack_relative=True)
+            return cls(int(start, 0), int(length, 0))
+        except ValueError:
+            raise ValueError("invalid capture range '%s', use <address>:<length> or sp+<offset>:<length>" % spec)
+
+    def __repr__(self):
+        if self.stack_relative:
+            return "sp%+d:%d" % (self.address, self.length)
+        return "0x%x:%d" % (self.address, self.length)
+
+
+def capture_table(ranges):
+    # type: (List[CaptureRange]) -> bytes
+    """
+    Capture spec in the layout the tracepoint body reads from RAM:
+    uint32 count, then per range: uint32 address, uint16 length, uint16 flags
+    (bit 0: stack-relative).
+    """
+    table = p32(len(ranges), "little")
+    for capture_range in ranges:
+        flags = 1 if capture_range.stack_relative else 0
+        table += pack_u32_array([capture_range.address & 0xFFFFFFFF, capture_range.length | (flags << 16)])
+    return table
+
+
+class Tracepoint(object):
+    """ An installed tracepoint, see InternalBlue.addTracepoint(). """
+
+    def __init__(self, address, hook_address, patchram_slot, capture=None, capture_address=None,
+                 conditions=None, counter_address=None):
+        # type: (int, int, int, Optional[List[CaptureRange]], Optional[int], Optional[List[TracepointCondition]], Optional[int]) -> None
+        self.address = address
+        self.hook_address = hook_address
+        self.patchram_slot = patchram_slot
+        self.capture = capture  # None dumps the whole RAM (if supported by the firmware)
+        self.capture_address = capture_address  # Capture table in RAM
+        self.conditions = conditions or []  # Checked by the hook, see TracepointCondition
+        self.counter_address = counter_address  # Hit counter in RAM for a hit count condition
+
+    def capture_length(self):
+        # type: () -> int
+        return sum(capture_range.length for capture_range in self.capture or [])
+
+
+class TracepointCaptures(object):
+    """
+    Memory captured at the hits of a tracepoint. Each hit only stores the
+    bytes that changed since the previous hit of the same range, the full
+    content of a hit is reconstructed on demand.
+    """
+
+    def __init__(self):
+        self.last = {}  # type: Dict[Tuple[int, int], bytes]
+        self.hits = []  # type: List[List[Tuple[int, int, List[Tuple[int, bytes]]]]]
+
+    @staticmethod
+    def _delta(old, new):
+        # type: (bytes, bytes) -> List[Tuple[int, bytes]]
+        """ Runs of changed bytes as (offset, data) tuples. """
+        runs = []
+        start = None
+        for i in range(len(new)):
+            if old[i] != new[i]:
+                if start is None:
+                    start = i
+            elif start is not None:
+                runs.append((start, new[start:i]))
+                start = None
+        if start is not None:
+            runs.append((start, new[start:]))
+        return runs
+
+    def add_hit(self, ranges):
+        # type: (List[Tuple[int, bytes]]) -> int
+        """ Stores the captured (address, data) ranges of a hit, returns the number of changed bytes. """
+        hit = []
+        changed = 0
+        for address, data in ranges:
+            key = (address, len(data))
+            if key in self.last:
+                delta = self._delta(self.last[key], data)
+            else:
+                delta = [(0, bytes(data))]
+            self.last[key] = bytes(data)
+            changed += sum(len(run) for _, run in delta)
+            hit.append((address, len(data), delta))
+        self.hits.append(hit)
+        return changed
+
+    def hit(self, index):
+        # type: (int) -> List[Tuple[int, bytes]]
+        """ Reconstructs the (address, data) ranges captured at hit <index>. """
+        if index < 0:
+            index += len(self.hits)
+        image = {}  # type: Dict[Tuple[int, int], bytearray]
+        for hit in self.hits[: index + 1]:
+            for address, length, delta in hit:
+                data = image.setdefault((address, length), bytearray(length))
+                for offset, run in delta:
+                    data[offset: offset + len(run)] = run
+        return [(address, bytes(image[(address, length)])) for address, length, _ in self.hits[index]]
+
+    def __len__(self):
+        return len(self.hits)
+
+
+class TracepointCondition(object):
+    """
+    A condition which is checked by the hook on the chip before the body
+    runs. If it does not hold, the hook returns to the original code without
+    sending anything to the host and the tracepoint stays active.
+    Comparisons are unsigned. All conditions of a tracepoint must hold, the
+    hit counter only counts hits for which the other conditions hold.
+    """
+
+    # Branch to the skip label if the comparison does NOT hold
+    BRANCH_IF_FALSE = {"==": "bne", "!=": "beq", "<": "bhs", "<=": "bhi", ">": "bls", ">=": "blo"}
+    REGISTERS = ["r%d" % i for i in range(13)] + ["lr", "sp"]
+    LOAD = {1: "ldrb", 2: "ldrh", 4: "ldr"}
+
+    def __init__(self, kind, op="==", value=0, register=None, address=None, size=4):
+        # type: (str, str, int, Optional[str], Optional[int], int) -> None
+        if op not in self.BRANCH_IF_FALSE:
+            raise ValueError("unknown comparison '%s'" % op)
+        if register is not None and register not in self.REGISTERS:
+            raise ValueError("unknown register '%s'" % register)
+        if size not in self.LOAD:
+            raise ValueError("memory conditions compare 1, 2 or 4 bytes")
+        self.kind = kind
+        self.op = op
+        self.value = value & 0xFFFFFFFF
+        self.register = register
+        self.address = address
+        self.size = size
+
+    @classmethod
+    def register_value(cls, register, op, value):
+        # type: (str, str, int) -> TracepointCondition
+        """ Compares a register at the tracepoint. """
+        return cls("register", op, value, register=register)
+
+    @classmethod
+    def memory_value(cls, address, op, value, size=4, register=None):
+        # type: (int, str, int, int, Optional[str]) -> TracepointCondition
+        """ Compares memory at <address>, or at <register> + <address>. """
+        return cls("memory", op, value, register=register, address=address, size=size)
+
+    @classmethod
+    def hit_count(cls, count):
+        # type: (int) -> TracepointCondition
+        """ Only the <count>th hit is reported. """
+        if count < 1:
+            raise ValueError("hit count must be at least 1")
+        return cls("hits", "==", count)
+
+    @classmethod
+    def parse(cls, spec):
+        # type: (str) -> TracepointCondition
+        """
+        Parses 'r0==0x5', 'lr!=0x1234', 'hits==10',
+        '[0x200000]>=2', 'u8[r0+8]==1' or 'u16[sp-4]!=0'.
+        """
+        match = re.match(r"^\s*(.+?)\s*(==|!=|<=|>=|<|>)\s*(\S+)\s*$", spec)
+        if match is None:
+            raise ValueError("invalid condition '%s', use e.g. r0==0x5, [0x200000]!=0 or hits==10" % spec)
+        left, op, value = match.group(1).lower(), match.group(2), int(match.group(3), 0)
+
+        if left in ("hit", "hits"):
+            if op != "==":
+                raise ValueError("hit count conditions only support ==")
+            return cls.hit_count(value)
+        if left in cls.REGISTERS:
+            return cls.register_value(left, op, value)
+
+        memory = re.match(r"^(u8|u16|u32)?\[\s*(r\d+|lr|sp)?\s*([+-]?\s*(?:0x[0-9a-f]+|\d+))?\s*\]$", left)
+        if memory is None or (memory.group(2) is None and memory.group(3) is None):
+            raise ValueError("invalid condition '%s'" % spec)
+        size = {None: 4, "u8": 1, "u16": 2, "u32": 4}[memory.group(1)]
+        offset = int(memory.group(3).replace(" ", ""), 0) if memory.group(3) else 0
+        return cls.memory_value(offset, op, value, size=size, register=memory.group(2))
+
+    def _load_register(self, target):
+        # type: (str) -> str
+        # The hook pushed r0-r12 and lr, the sp of the tracepoint is above them
+        if self.register == "sp":
+            return "add  %s, sp, 56\n" % target
+        index = 13 if self.register == "lr" else int(self.register[1:])
+        return "ldr  %s, [sp, %d]\n" % (target, index * 4)
+
+    def asm(self, counter_address=None):
+        # type: (Optional[int]) -> str
+        """ Assembler snippet which branches to tracepoint_skip if the condition does not hold. """
+        if self.kind == "hits":
+            code = "ldr  r0, =0x%x\n" % counter_address
+            code += "ldr  r1, [r0]\n"
+            code += "add  r1, 1\n"
+            code += "str  r1, [r0]\n"
+            code += "ldr  r2, =0x%x\n" % self.value
+            code += "cmp  r1, r2\n"
+        else:
+            if self.kind == "register":
+                code = self._load_register("r0")
+            elif self.register is not None:
+                code = self._load_register("r0")
+                code += "ldr  r1, =0x%x\n" % (self.address & 0xFFFFFFFF)
+                code += "add  r0, r1\n"
+                code += "%s  r0, [r0]\n" % self.LOAD[self.size]
+            else:
+                code = "ldr  r0, =0x%x\n" % self.address
+                code += "%s  r0, [r0]\n" % self.LOAD[self.size]
+            code += "ldr  r1, =0x%x\n" % self.value
+            code += "cmp  r0, r1\n"
+        code += "%s  tracepoint_skip\n" % self.BRANCH_IF_FALSE[self.op]
+        return code
+
+    def __repr__(self):
+        if self.kind == "hits":
+            return "hits==%d" % self.value
+        if self.kind == "register":
+            return "%s%s0x%x" % (self.register, self.op, self.value)
+        location = "0x%x" % self.address if self.register is None else "%s%+d" % (self.register, self.address)
+        return "u%d[%s]%s0x%x" % (self.size * 8, location, self.op, self.value)
+
+
+def condition_asm(conditions, address, original=b"", counter_address=None):
+    # type: (List[TracepointCondition], int, bytes, Optional[int]) -> Tuple[str, str]
+    """
+    Assembler snippets for the 'condition' and 'condition_skip' placeholders
+    of TRACEPOINT_HOOK_ASM. The flags are saved in r4 (already pushed by the
+    hook), so a skipped hit leaves the original code undisturbed.
+
+    The branch to the hook is still installed at <address> when a hit is
+    skipped, so like a countpoint hook, the skip path executes the <original>
+    4 bytes (which must be relocatable) and continues at <address> + 4.
+    """
+    if not conditions:
+        return "", ""
+    if len(original) != 4:
+        raise ValueError("conditions need the 4 original bytes at 0x%x" % address)
+    # The counter only counts hits for which the other conditions hold
+    ordered = [c for c in conditions if c.kind != "hits"] + [c for c in conditions if c.kind == "hits"]
+    condition = "mrs  r4, cpsr\n"
+    condition += "".join(c.asm(counter_address) for c in ordered)
+    condition += "msr  cpsr_f, r4\n"
+    skip = "tracepoint_skip:\n"
+    skip += "msr  cpsr_f, r4\n"
+    skip += "pop  {r0-r12, lr}\n"
+    skip += "".join(".hword 0x%04x\n" % hw for hw in unpack_u16_array(original))
+    skip += "b 0x%x\n" % (address + 4)
+    return condition, skip
@@ -0,0 +1,195 @@
+from __future__ import division
+
+import operator
+import time
+from array import array
+from builtins import object
+
+try:
+    from typing import Callable, Dict, List, Optional, Tuple
+except ImportError:
+    pass
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class PoolSeries(object):
+    """
+    Ring buffer with the last <capacity> statistics of one memory pool. The
+    values are kept in typed arrays, one per field, in the order they were
+    added; the oldest sample is overwritten when the buffer is full.
+    """
+
+    FIELDS = ("timestamp", "chip_time", "allocated", "free", "low")
+    TYPECODES = {"timestamp": "d", "chip_time": "L", "allocated": "H", "free": "H", "low": "H"}
+
+    def __init__(self, name, capacity):
+        # type: (str, int) -> None
+        self.name = name
+        self.capacity = capacity
+        self.block_size = 0
+        self.block_count = 0
+        self.columns = {field: array(self.TYPECODES[field]) for field in self.FIELDS}
+        self.start = 0  # Index of the oldest sample once the buffer is full
+
+    def append(self, timestamp, chip_time, allocated, free, low):
+        # type: (float, int, int, int, int) -> None
+        values = (timestamp, chip_time & 0xFFFFFFFF, allocated, free, low)
+        if len(self) < self.capacity:
+            for field, value in zip(self.FIELDS, values):
+                self.columns[field].append(value)
+        else:
+            for field, value in zip(self.FIELDS, values):
+                self.columns[field][self.start] = value
+            self.start = (self.start + 1) % self.capacity
+
+    def __len__(self):
+        return len(self.columns["timestamp"])
+
+    def column(self, field):
+        # type: (str) -> List
+        """ All values of <field>, oldest first. """
+        values = self.columns[field]
+        return values[self.start:].tolist() + values[:self.start].tolist()
+
+    def samples(self, since=None, until=None):
+        # type: (Optional[float], Optional[float]) -> List[Dict[str, float]]
+        """ The samples with since <= timestamp <= until as dicts, oldest first. """
+        columns = [self.column(field) for field in self.FIELDS]
+        return [
+            dict(zip(self.FIELDS, values))
+            for values in zip(*columns)
+            if (since is None or values[0] >= since) and (until is None or values[0] <= until)
+        ]
+
+    def latest(self):
+        # type: () -> Optional[Dict[str, float]]
+        if len(self) == 0:
+            return None
+        index = (self.start - 1) % len(self)
+        return {field: self.columns[field][index] for field in self.FIELDS}
+
+    def to_numpy(self):
+        # type: () -> Dict[str, numpy.ndarray]
+        """ The columns as numpy arrays (oldest first), e.g. for plotting. """
+        if numpy is None:
+            raise ImportError("numpy is required for this function.")
+        return {field: numpy.array(self.column(field)) for field in self.FIELDS}
+
+
+class PoolAlert(object):
+    """
+    Threshold on a field of a pool ('allocated', 'free' or 'low'). The alert
+    fires when the condition starts to hold and re-arms when it stops to hold,
+    so a pool which stays below the threshold is reported once.
+    """
+
+    OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge, "==": operator.eq}
+    # Alternative names, '<' and '>' are redirections on the command line
+    NAMES = {"lt": "<", "le": "<=", "gt": ">", "ge": ">=", "eq": "=="}
+
+    def __init__(self, pool, field, op, threshold):
+        # type: (Optional[str], str, str, int) -> None
+        if field not in ("allocated", "free", "low"):
+            raise ValueError("alerts can be set on allocated, free or low")
+        op = self.NAMES.get(op, op)
+        if op not in self.OPERATORS:
+            raise ValueError("unknown comparison '%s'" % op)
+        self.pool = pool  # None applies to all pools
+        self.field = field
+        self.op = op
+        self.threshold = threshold
+        self.active = set()  # Pools for which the condition currently holds
+
+    def check(self, name, sample):
+        # type: (str, Dict[str, float]) -> bool
+        """ True if the alert fires for this sample. """
+        if self.pool is not None and self.pool != name:
+            return False
+        if self.OPERATORS[self.op](sample[self.field], self.threshold):
+            if name in self.active:
+                return False
+            self.active.add(name)
+            return True
+        self.active.discard(name)
+        return False
+
+    def __repr__(self):
+        return "%s %s %s %d" % (self.pool or "*", self.field, self.op, self.threshold)
+
+
+class MemoryPoolStatistics(object):
+    """
+    Time series of the memory pool statistics events (VSC_DBFW 0x50), one
+    ring buffer per pool name. Unlike readHeapInformation(), this does not
+    cost any HCI round trips once the statistics are enabled.
+    """
+
+    def __init__(self, history=3600):
+        # type: (int) -> None
+        self.history = history
+        self.pools = {}  # type: Dict[str, PoolSeries]
+        self.alerts = []  # type: List[PoolAlert]
+        self.fired = []  # type: List[Tuple[float, str, PoolAlert, Dict[str, float]]]
+        self.alert_callback = None  # type: Optional[Callable[[str, PoolAlert, Dict[str, float]], None]]
+
+    def add(self, meta_info, pool_list, timestamp=None):
+        # type: (dict, List[dict], Optional[float]) -> List[Tuple[str, PoolAlert]]
+        """
+        Stores one statistics event as parsed by readMemoryPoolStatisticsCallback.
+        Returns the alerts that fired.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        fired = []
+        for pool in pool_list:
+            series = self.pools.get(pool["name"])
+            if series is None:
+                series = self.pools[pool["name"]] = PoolSeries(pool["name"], self.history)
+            series.block_size = pool["size"]
+            series.block_count = pool["count"]
+            series.append(timestamp, meta_info["time"], pool["allocated"], pool["free"], pool["low"])
+            sample = series.latest()
+            for alert in self.alerts:
+                if alert.check(pool["name"], sample):
+                    fired.append((pool["name"], alert))
+                    self.fired.append((timestamp, pool["name"], alert, sample))
+                    if self.alert_callback is not None:
+                        self.alert_callback(pool["name"], alert, sample)
+        return fired
+
+    def add_alert(self, pool, field, op, threshold):
+        # type: (Optional[str], str, str, int) -> PoolAlert
+        alert = PoolAlert(pool, field, op, threshold)
+        self.alerts.append(alert)
+        return alert
+
+    def query(self, name, field=None, since=None, until=None):
+        # type: (str, Optional[str], Optional[float], Optional[float]) -> List
+        """ Samples of pool <name> in a time range, only the values of <field> if given. """
+        if name not in self.pools:
+            return []
+        samples = self.pools[name].samples(since, until)
+        if field is None:
+            return samples
+        return [(sample["timestamp"], sample[field]) for sample in samples]
+
+    def write_csv(self, filename):
+        # type: (str) -> None
+        """ All samples of all pools in one CSV file (one row per pool and sample). """
+        with open(filename, "w") as f:
+            f.write("pool,timestamp,chip_time,allocated,free,low,block_size,block_count\n")
+            for name in sorted(self.pools):
+                series = self.pools[name]
+                for sample in series.samples():
+                    f.write("%s,%.3f,%d,%d,%d,%d,%d,%d\n" % (
+                        name, sample["timestamp"], sample["chip_time"], sample["allocated"],
+                        sample["free"], sample["low"], series.block_size, series.block_count))
+
+    def clear(self):
+        # type: () -> None
+        self.pools = {}
+        self.fired = []
@@ -1,52 +1,102 @@
 import struct
 
 
+def _structs(fmt):
+    """ Precompiled structs for native (''), 'big' and 'little' endian. """
+    return {
+        '': struct.Struct(fmt),
+        'big': struct.Struct('>' + fmt),
+        'little': struct.Struct('<' + fmt),
+    }
+
+
+_B = _structs('B')
+_H = _structs('H')
+_I = _structs('I')
+
+
+def _struct(structs, endian):
+    try:
+        return structs[endian]
+    except KeyError:
+        return structs.get(endian.lower(), structs[''])
+
+
 def p8(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.pack('>B', num)
-    elif endian.lower() == 'little':
-        return struct.pack('<B', num)
-    return struct.pack('B', num)
+    return _struct(_B, endian).pack(num)
 
 
 def u8(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.unpack('>B', num)[0]
-    elif endian.lower() == 'little':
-        return struct.unpack('<B', num)[0]
-    return struct.unpack('B', num)[0]
+    return _struct(_B, endian).unpack(num)[0]
 
 
 def p16(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.pack('>H', num)
-    elif endian.lower() == 'little':
-        return struct.pack('<H', num)
-    return struct.pack('H', num)
+    return _struct(_H, endian).pack(num)
 
 
 def u16(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.unpack('>H', num)[0]
-    elif endian.lower() == 'little':
-        return struct.unpack('<H', num)[0]
-    return struct.unpack('H', num)[0]
+    return _struct(_H, endian).unpack(num)[0]
 
 
 def p32(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.pack('>I', num)
-    elif endian.lower() == 'little':
-        return struct.pack('<I', num)
-    return struct.pack('I', num)
+    return _struct(_I, endian).pack(num)
 
 
 def u32(num, endian: str = ''):
-    if endian.lower() == 'big':
-        return struct.unpack('>I', num)[0]
-    elif endian.lower() == 'little':
-        return struct.unpack('<I', num)[0]
-    return struct.unpack('I', num)[0]
+    return _struct(_I, endian).unpack(num)[0]
+
+
+# Bulk variants, the chip is little endian
+_array_structs = {}
+
+
+def _array_struct(fmt, count):
+    key = (fmt, count)
+    if key not in _array_structs:
+        _array_structs[key] = struct.Struct('<%d%s' % (count, fmt))
+    return _array_structs[key]
+
+
+def unpack_u32_array(data, offset: int = 0, count: int = None, stride: int = 4) -> [int]:
+    """
+    Decodes <count> little endian uint32 values from data, starting at offset.
+    Values are <stride> bytes apart, which allows picking one field out of an
+    array of structs (e.g. the header of each buffer in a memory pool).
+    Without count, all values until the end of data are decoded.
+    """
+    if count is None:
+        count = max(0, (len(data) - offset - 4) // stride + 1)
+    if stride == 4:
+        return list(_array_struct('I', count).unpack_from(data, offset))
+    unpack_from = _I['little'].unpack_from
+    return [unpack_from(data, offset + i * stride)[0] for i in range(count)]
+
+
+def pack_u32_array(values) -> bytes:
+    """ Encodes a sequence of integers as little endian uint32 values. """
+    return _array_struct('I', len(values)).pack(*values)
+
+
+def unpack_u16_array(data, offset: int = 0, count: int = None) -> [int]:
+    """ Decodes <count> little endian uint16 values from data, starting at offset. """
+    if count is None:
+        count = (len(data) - offset) // 2
+    return list(_array_struct('H', count).unpack_from(data, offset))
+
+
+# Lookup tables for the bit helpers
+_REVERSED_BITS = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+_BITS = [tuple((i >> (7 - n)) & 1 for n in range(8)) for i in range(256)]
+_BIT_CHARS = {'1': '1', 1: '1', '0': '0', 0: '0'}  # True and False hash like 1 and 0
+
+
+def _bit_order(s, endian, caller='bits'):
+    """ Returns s so that reading each byte MSB first yields the bits in the requested order. """
+    if endian == 'big':
+        return s
+    elif endian == 'little':
+        return bytes(s).translate(_REVERSED_BITS)
+    raise ValueError("%s(): 'endian' must be either 'little' or 'big'" % caller)
 
 
 def bits(s, endian='big') -> [int]:
@@ -61,28 +111,15 @@ def bits(s, endian='big') -> [int]:
     Returns:
         A list consisting of the values specified in `zero` and `one`.
 
-    [!!!] Copied from PWN, only available for bytes.
+    [!!!] Copied from PWN, only available for bytes (and other bytes-like objects).
     """
-
-    if endian not in ['little', 'big']:
-        raise ValueError("bits(): 'endian' must be either 'little' or 'big'")
-    else:
-        little = endian == 'little'
-
-    out = []
-    if isinstance(s, bytes):
-        for b in bytearray(s):
-            byte = []
-            for _ in range(8):
-                byte.append(1 if b & 1 else 0)
-                b >>= 1
-            if little:
-                out += byte
-            else:
-                out += byte[::-1]
-    else:
+    if not isinstance(s, (bytes, bytearray, memoryview)):
         raise ValueError("bits(): 's' must be either a string or a number")
+    s = _bit_order(s, endian)
 
+    out = []
+    for b in s:
+        out.extend(_BITS[b])
     return out
 
 
@@ -100,30 +137,25 @@ def unbits(s, endian='big'):
 
     [!!!] Coped from  PWN.
     """
-    if endian == 'little':
-        u = lambda s: p8(int(s[::-1], 2))
-    elif endian == 'big':
-        u = lambda s: p8(int(s, 2))
-    else:
+    if endian not in ['little', 'big']:
         raise ValueError("unbits(): 'endian' must be either 'little' or 'big'")
 
-    out = b''
-    cur = b''
-
-    for c in s:
-        if c in ['1', 1, True]:
-            cur += b'1'
-        elif c in ['0', 0, False]:
-            cur += b'0'
-        else:
-            raise ValueError("unbits(): cannot decode the value %r into a bit" % c)
-
-        if len(cur) == 8:
-            out += u(cur)
-            cur = b''
-    if cur:
-        out += u(cur.ljust(8, b'0'))
-
+    if isinstance(s, str) and not s.strip('01'):
+        bit_string = s
+    else:
+        try:
+            bit_string = ''.join([_BIT_CHARS[c] for c in s])
+        except KeyError as e:
+            raise ValueError("unbits(): cannot decode the value %r into a bit" % e.args[0])
+        except TypeError as e:
+            raise ValueError("unbits(): cannot decode the value into a bit (%s)" % e)
+
+    if not bit_string:
+        return b''
+    length = (len(bit_string) + 7) // 8
+    out = int(bit_string.ljust(length * 8, '0'), 2).to_bytes(length, 'big')
+    if endian == 'little':
+        out = out.translate(_REVERSED_BITS)
     return out
 
 
@@ -131,9 +163,14 @@ def bits_str(s, endian='big') -> str:
     """bits_str(s, endian = 'big') -> str
     A wrapper around :func:`bits`, which converts the output into a string.
     Examples:
-       >>> bits_str(511)
+       >>> bits_str(b"\\x01\\xff")
        '0000000111111111'
        >>> bits_str(b"bits_str", endian = "little")
        '0100011010010110001011101100111011111010110011100010111001001110'
     """
-    return ''.join(map(lambda x: str(x), bits(s, endian)))
+    if not isinstance(s, (bytes, bytearray, memoryview)):
+        raise ValueError("bits_str(): 's' must be either a string or a number")
+    s = _bit_order(s, endian, 'bits_str')
+    if len(s) == 0:
+        return ''
+    return format(int.from_bytes(s, 'big'), '0%db' % (len(s) * 8))
@@ -0,0 +1,86 @@
+from builtins import object
+
+try:
+    from typing import List, Optional, Tuple, Dict
+    from internalblue import Address
+except ImportError:
+    pass
+
+
+class RamAllocator(object):
+    """
+    First-fit allocator for a region of free RAM on the chip, e.g. the memory
+    used for tracepoint hooks. Only the bookkeeping happens on the host, the
+    chip memory is not touched. Freed blocks are merged with their neighbours.
+    """
+
+    def __init__(self, start, size, alignment=4):
+        # type: (Address, int, int) -> None
+        self.start = start
+        self.size = size
+        self.alignment = alignment
+        self.free_blocks = [(start, size)]  # type: List[Tuple[Address, int]]
+        self.allocations = {}  # type: Dict[Address, int]
+
+    def _align(self, value):
+        # type: (int) -> int
+        return (value + self.alignment - 1) // self.alignment * self.alignment
+
+    def allocate(self, size):
+        # type: (int) -> Optional[Address]
+        """
+        Reserves <size> bytes (rounded up to the alignment) and returns the
+        start address, or None if no free block is large enough.
+        """
+        size = self._align(size)
+        for i, (block_start, block_size) in enumerate(self.free_blocks):
+            address = self._align(block_start)
+            padding = address - block_start
+            if block_size - padding < size:
+                continue
+
+            remaining = []
+            if padding > 0:
+                remaining.append((block_start, padding))
+            if block_size - padding > size:
+                remaining.append((address + size, block_size - padding - size))
+            self.free_blocks[i:i + 1] = remaining
+            self.allocations[address] = size
+            return address
+        return None
+
+    def free(self, address):
+        # type: (Address) -> bool
+        """ Returns a block to the pool. Returns False if it was not allocated. """
+        size = self.allocations.pop(address, None)
+        if size is None:
+            return False
+
+        self.free_blocks.append((address, size))
+        self.free_blocks.sort()
+        merged = []  # type: List[Tuple[Address, int]]
+        for block_start, block_size in self.free_blocks:
+            if merged and merged[-1][0] + merged[-1][1] == block_start:
+                merged[-1] = (merged[-1][0], merged[-1][1] + block_size)
+            else:
+                merged.append((block_start, block_size))
+        self.free_blocks = merged
+        return True
+
+    @property
+    def used(self):
+        # type: () -> int
+        return sum(self.allocations.values())
+
+    @property
+    def available(self):
+        # type: () -> int
+        return sum(block_size for _, block_size in self.free_blocks)
+
+    def largest_free(self):
+        # type: () -> int
+        """ Size of the largest block that can be allocated at once. """
+        return max([block_size for _, block_size in self.free_blocks] or [0])
+
+    def __contains__(self, address):
+        return address in self.allocations
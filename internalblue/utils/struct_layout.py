@@ -0,0 +1,126 @@
+import struct
+from builtins import object
+
+try:
+    from typing import Any, Callable, Dict, Optional, Union
+except ImportError:
+    pass
+
+
+class Field(object):
+    """
+    A field of a firmware struct at a fixed offset. Integer kinds are 'u8',
+    'u16' and 'u32' (little endian), 'bytes' fields have a fixed length or
+    take their length from another field (given by its name).
+    """
+
+    __slots__ = ("offset", "kind", "length", "reverse", "transform")
+
+    INTEGERS = {"u8": struct.Struct("<B"), "u16": struct.Struct("<H"), "u32": struct.Struct("<I")}
+
+    def __init__(self, offset, kind="u32", length=None, reverse=False, transform=None):
+        # type: (int, str, Optional[Union[int, str]], bool, Optional[Callable[[Any], Any]]) -> None
+        if kind not in self.INTEGERS and kind != "bytes":
+            raise ValueError("unknown field kind '%s'" % kind)
+        if kind == "bytes" and length is None:
+            raise ValueError("bytes fields need a length")
+        self.offset = offset
+        self.kind = kind
+        self.length = length
+        self.reverse = reverse  # Byte order of 'bytes' fields, e.g. for BT addresses
+        self.transform = transform  # Applied to the decoded value
+
+    def decode(self, buffer, view):
+        # type: (memoryview, Any) -> Any
+        if self.kind == "bytes":
+            length = self.length if isinstance(self.length, int) else getattr(view, self.length)
+            value = bytes(buffer[self.offset:self.offset + length])
+            if self.reverse:
+                value = value[::-1]
+        else:
+            value = self.INTEGERS[self.kind].unpack_from(buffer, self.offset)[0]
+        if self.transform is not None:
+            value = self.transform(value)
+        return value
+
+
+class StructLayout(object):
+    """
+    Offsets and types of the fields of a firmware struct. Firmware definitions
+    can provide their own layout (e.g. CONNECTION_STRUCT_LAYOUT), usually by
+    moving single fields of the default layout with replace().
+    """
+
+    def __init__(self, **fields):
+        # type: (**Field) -> None
+        self.fields = fields  # type: Dict[str, Field]
+
+    def replace(self, **fields):
+        # type: (**Field) -> StructLayout
+        """ A copy of this layout with some fields replaced. """
+        merged = dict(self.fields)
+        merged.update(fields)
+        return StructLayout(**merged)
+
+    def unpack(self, buffer):
+        # type: (bytes) -> Dict[str, Any]
+        """ Decodes all fields at once. """
+        view = StructView.view(buffer, self)
+        return {name: getattr(view, name) for name in self.fields}
+
+
+class StructView(object):
+    """
+    Read-only view of a struct in a buffer (no copy). Fields are decoded from
+    the buffer when they are accessed. Subclasses define the default LAYOUT and
+    the FIELDS which vars() returns; values can also be set explicitly, which
+    overrides the buffer.
+    """
+
+    __slots__ = ("_buffer", "_layout", "_values")
+
+    LAYOUT = StructLayout()
+    FIELDS = ()  # type: tuple
+
+    def __init__(self, **values):
+        object.__setattr__(self, "_buffer", None)
+        object.__setattr__(self, "_layout", self.LAYOUT)
+        object.__setattr__(self, "_values", values)
+
+    @classmethod
+    def view(cls, buffer, layout=None):
+        # type: (Union[bytes, bytearray, memoryview], Optional[StructLayout]) -> Any
+        view = cls.__new__(cls)
+        object.__setattr__(view, "_buffer", memoryview(buffer))
+        object.__setattr__(view, "_layout", layout or cls.LAYOUT)
+        object.__setattr__(view, "_values", None)
+        return view
+
+    def __getattr__(self, name):
+        # Only called for names that are not slots, i.e. for the struct fields
+        if name.startswith("_"):
+            raise AttributeError(name)
+        values = self._values
+        if values is not None and name in values:
+            return values[name]
+        field = self._layout.fields.get(name)
+        if field is None or self._buffer is None:
+            raise AttributeError("%s has no field '%s'" % (type(self).__name__, name))
+        return field.decode(self._buffer, self)
+
+    def __setattr__(self, name, value):
+        if name not in self.FIELDS and name not in self._layout.fields:
+            raise AttributeError("%s has no field '%s'" % (type(self).__name__, name))
+        if self._values is None:
+            object.__setattr__(self, "_values", {})
+        self._values[name] = value
+
+    @property
+    def __dict__(self):
+        # type: () -> Dict[str, Any]
+        # Keeps vars() working, this decodes all fields
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def __getitem__(self, item):
+        # type: (str) -> Any
+        return getattr(self, item)
@@ -0,0 +1,95 @@
+from internalblue.utils.packing import unpack_u16_array
+
+try:
+    from typing import List
+except ImportError:
+    pass
+
+
+def is_32bit(halfword):
+    # type: (int) -> bool
+    """ True if <halfword> is the first half of a 32-bit Thumb-2 instruction. """
+    return (halfword >> 11) in (0b11101, 0b11110, 0b11111)
+
+
+def split_instructions(code):
+    # type: (bytes) -> List[bytes]
+    """
+    Splits Thumb code into its instructions. Raises a ValueError if the last
+    instruction continues after the end of <code>.
+    """
+    instructions = []
+    halfwords = unpack_u16_array(code, count=len(code) // 2)
+    i = 0
+    while i < len(halfwords):
+        if is_32bit(halfwords[i]):
+            if i + 1 >= len(halfwords):
+                raise ValueError("32-bit instruction at offset %d is cut off" % (i * 2))
+            instructions.append(code[i * 2: i * 2 + 4])
+            i += 2
+        else:
+            instructions.append(code[i * 2: i * 2 + 2])
+            i += 1
+    return instructions
+
+
+def uses_pc(instruction):
+    # type: (bytes) -> bool
+    """
+    True if a Thumb instruction depends on its own address, i.e. it cannot
+    be moved to other memory and executed there. This covers branches,
+    PC-relative loads and ADR, IT blocks (they affect the next instructions)
+    and register operations on the PC.
+    """
+    hw1 = instruction[0] | (instruction[1] << 8)
+    if len(instruction) == 2:
+        return (
+            (hw1 & 0xF800) == 0x4800  # LDR (literal)
+            or (hw1 & 0xF800) == 0xA000  # ADR
+            or (hw1 & 0xF000) == 0xD000  # B<cond>, UDF, SVC
+            or (hw1 & 0xF800) == 0xE000  # B
+            or (hw1 & 0xF500) == 0xB100  # CBZ, CBNZ
+            or ((hw1 & 0xFF00) == 0xBF00 and (hw1 & 0x000F) != 0)  # IT
+            or ((hw1 & 0xFC00) == 0x4400 and (hw1 & 0x0078) == 0x0078)  # ADD/CMP/MOV/BX/BLX with Rm = PC
+            or ((hw1 & 0xFC00) == 0x4400 and (hw1 & 0x0300) != 0x0300
+                and (hw1 & 0x0087) == 0x0087)  # ADD/CMP/MOV with Rdn = PC
+        )
+
+    hw2 = instruction[2] | (instruction[3] << 8)
+    return (
+        ((hw1 & 0xF800) == 0xF000 and (hw2 & 0x8000) == 0x8000 and (hw2 & 0x5000) != 0)  # B.W, BL, BLX
+        or ((hw1 & 0xF800) == 0xF000 and (hw2 & 0xD000) == 0x8000 and (hw1 & 0x0380) != 0x0380)  # B<cond>.W
+        or ((hw1 & 0xFE00) == 0xF800 and (hw1 & 0x000F) == 0x000F)  # LDR*/PLD (literal)
+        or (hw1 & 0xFB5F) == 0xF20F  # ADR.W (ADDW/SUBW from PC)
+        or (hw1 & 0xFFF0) == 0xE8D0  # TBB, TBH
+        or (hw1 & 0xFE5F) == 0xE85F  # LDRD (literal)
+    )
+
+
+def relocatable(code):
+    # type: (bytes) -> bool
+    """ True if all instructions in <code> can be executed at another address. """
+    try:
+        return not any(uses_pc(instruction) for instruction in split_instructions(code))
+    except ValueError:
+        return False
+
+
+def encode_branch(source, target):
+    # type: (int, int) -> bytes
+    """
+    Encodes a 'b.w <target>' (Thumb-2 encoding T4) placed at <source>, so
+    that hooks can be generated without an assembler.
+    """
+    offset = target - (source + 4)
+    if offset % 2 != 0 or not -(1 << 24) <= offset < (1 << 24):
+        raise ValueError("cannot branch from 0x%x to 0x%x" % (source, target))
+    imm = offset & 0x1FFFFFF
+    s = (imm >> 24) & 1
+    i1 = (imm >> 23) & 1
+    i2 = (imm >> 22) & 1
+    j1 = (~(i1 ^ s)) & 1
+    j2 = (~(i2 ^ s)) & 1
+    hw1 = 0xF000 | (s << 10) | ((imm >> 12) & 0x3FF)
+    hw2 = 0x9000 | (j1 << 13) | (j2 << 11) | ((imm >> 1) & 0x7FF)
+    return hw1.to_bytes(2, "little") + hw2.to_bytes(2, "little")
@@ -0,0 +1,209 @@
+from builtins import object
+from collections import Counter
+import os
+import struct
+
+try:
+    from typing import Dict, Iterator, List, Optional, Tuple
+except ImportError:
+    pass
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TracepointHit(object):
+    """ A tracepoint hit as stored in a TracepointLog. """
+
+    __slots__ = ("timestamp", "registers", "captures")
+
+    # Order of the registers as sent by the tracepoint body
+    REGISTER_NAMES = ["pc", "sp", "cpsr"] + ["r%d" % i for i in range(13)] + ["lr"]
+
+    def __init__(self, timestamp, registers, captures=None):
+        # type: (float, List[int], Optional[List[Tuple[int, bytes]]]) -> None
+        self.timestamp = timestamp
+        self.registers = registers
+        self.captures = captures or []
+
+    @property
+    def pc(self):
+        # type: () -> int
+        return self.registers[0]
+
+    def register(self, name):
+        # type: (str) -> int
+        return self.registers[self.REGISTER_NAMES.index(name)]
+
+
+class TracepointLog(object):
+    """
+    Append-only binary log of tracepoint hits.
+
+    <path>.hits holds the records: a header with the timestamp (double), the 17
+    registers and the number of memory captures, followed by the captures
+    (uint32 address, uint32 length, data). <path>.idx holds one fixed-size
+    entry per record (offset, pc, timestamp), so counting and filtering hits
+    does not touch the records. The index is rebuilt from the records if it
+    is missing or incomplete, e.g. after a crash. A partly written record at
+    the end is cut off, so that new records follow the last complete one.
+    """
+
+    MAGIC = b"IBTPLOG1"
+    _RECORD = struct.Struct("<d17IH")
+    _CAPTURE = struct.Struct("<II")
+    _INDEX = struct.Struct("<QId")
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.data_filename = path + ".hits"
+        self.index_filename = path + ".idx"
+
+        new = not os.path.exists(self.data_filename) or os.path.getsize(self.data_filename) == 0
+        self.data_file = open(self.data_filename, "ab+")
+        if new:
+            self.data_file.write(self.MAGIC)
+            self.data_file.flush()
+        else:
+            self.data_file.seek(0)
+            if self.data_file.read(len(self.MAGIC)) != self.MAGIC:
+                self.data_file.close()
+                raise ValueError("%s is not a tracepoint log" % self.data_filename)
+
+        self.index = []  # type: List[Tuple[int, int, float]]
+        self._load_index()
+        self.index_file = open(self.index_filename, "ab")
+
+    def _load_index(self):
+        # type: () -> None
+        rewrite = not os.path.exists(self.index_filename)
+        if not rewrite:
+            with open(self.index_filename, "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % self._INDEX.size
+            self.index = list(self._INDEX.iter_unpack(data[:usable]))
+            rewrite = usable != len(data)
+
+        # Records after the last indexed one (or a missing index) are recovered from the data file
+        offset = self.index[-1][0] if self.index else len(self.MAGIC)
+        entries, end = self._scan(offset)
+        for entry in entries:
+            if self.index and entry[0] <= self.index[-1][0]:
+                continue
+            self.index.append(entry)
+            rewrite = True
+
+        # Cut off a partly written record (and index entries of records which are gone)
+        self.data_file.seek(0, os.SEEK_END)
+        if self.data_file.tell() > end:
+            self.data_file.truncate(end)
+        while self.index and self.index[-1][0] >= end:
+            self.index.pop()
+            rewrite = True
+
+        if rewrite:
+            with open(self.index_filename, "wb") as f:
+                f.write(b"".join(self._INDEX.pack(*entry) for entry in self.index))
+
+    def _scan(self, offset):
+        # type: (int) -> Tuple[List[Tuple[int, int, float]], int]
+        """ Index entries of the complete records starting at offset, and the end of the last one. """
+        self.data_file.seek(0, os.SEEK_END)
+        end = self.data_file.tell()
+        entries = []
+        while offset + self._RECORD.size <= end:
+            self.data_file.seek(offset)
+            header = self._RECORD.unpack(self.data_file.read(self._RECORD.size))
+            position = offset + self._RECORD.size
+            for _ in range(header[-1]):
+                if position + self._CAPTURE.size > end:
+                    return entries, offset
+                self.data_file.seek(position)
+                _, length = self._CAPTURE.unpack(self.data_file.read(self._CAPTURE.size))
+                position += self._CAPTURE.size + length
+            if position > end:
+                return entries, offset
+            entries.append((offset, header[1], header[0]))
+            offset = position
+        return entries, offset
+
+    def append(self, hit):
+        # type: (TracepointHit) -> None
+        record = self._RECORD.pack(hit.timestamp, *(list(hit.registers) + [len(hit.captures)]))
+        for address, data in hit.captures:
+            record += self._CAPTURE.pack(address, len(data)) + bytes(data)
+
+        self.data_file.seek(0, os.SEEK_END)
+        offset = self.data_file.tell()
+        self.data_file.write(record)
+        self.data_file.flush()
+
+        entry = (offset, hit.pc, hit.timestamp)
+        self.index.append(entry)
+        self.index_file.write(self._INDEX.pack(*entry))
+        self.index_file.flush()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _read(self, offset):
+        # type: (int) -> TracepointHit
+        self.data_file.seek(offset)
+        header = self._RECORD.unpack(self.data_file.read(self._RECORD.size))
+        captures = []
+        for _ in range(header[-1]):
+            address, length = self._CAPTURE.unpack(self.data_file.read(self._CAPTURE.size))
+            captures.append((address, self.data_file.read(length)))
+        return TracepointHit(header[0], list(header[1:18]), captures)
+
+    def __getitem__(self, index):
+        # type: (int) -> TracepointHit
+        return self._read(self.index[index][0])
+
+    def hits(self, pc=None):
+        # type: (Optional[int]) -> Iterator[TracepointHit]
+        """ All hits in the order they were logged, optionally only those of one tracepoint. """
+        for offset, hit_pc, _ in self.index:
+            if pc is None or hit_pc == pc:
+                yield self._read(offset)
+
+    def hit_counts(self):
+        # type: () -> Dict[int, int]
+        """ Number of hits per tracepoint address, from the index only. """
+        return dict(Counter(pc for _, pc, _ in self.index))
+
+    def register_histogram(self, register, pc=None):
+        # type: (str, Optional[int]) -> Dict[int, int]
+        """ How often each value of <register> ('r0', 'lr', 'sp', ...) was seen. """
+        position = TracepointHit.REGISTER_NAMES.index(register)
+        # Only the fixed-size record headers are read
+        counter = Counter()  # type: Counter
+        for offset, hit_pc, _ in self.index:
+            if pc is None or hit_pc == pc:
+                self.data_file.seek(offset)
+                counter[self._RECORD.unpack(self.data_file.read(self._RECORD.size))[1 + position]] += 1
+        return dict(counter)
+
+    def to_numpy(self, pc=None):
+        # type: (Optional[int]) -> Dict[str, numpy.ndarray]
+        """
+        Returns the timestamps (float64) and registers (uint32, one column per
+        register in TracepointHit.REGISTER_NAMES order) as numpy arrays.
+        """
+        if numpy is None:
+            raise ImportError("numpy is required for this function.")
+        headers = []
+        for offset, hit_pc, _ in self.index:
+            if pc is None or hit_pc == pc:
+                self.data_file.seek(offset)
+                headers.append(self.data_file.read(self._RECORD.size))
+        dtype = numpy.dtype([("timestamp", "<f8"), ("registers", "<u4", (17,)), ("captures", "<u2")])
+        records = numpy.frombuffer(b"".join(headers), dtype=dtype)
+        return {"timestamp": records["timestamp"].copy(), "registers": records["registers"].copy()}
+
+    def close(self):
+        # type: () -> None
+        self.data_file.close()
+        self.index_file.close()
@@ -18,7 +18,7 @@ setup(
     ],
     python_requires='>=3.6',
     install_requires=["future", "cmd2", "pure-python-adb"],
-    extras_require={"macoscore": ["pyobjc"], "binutils": ["pwntools>=4.0.1", "pyelftools"]},
+    extras_require={"macoscore": ["pyobjc"], "binutils": ["pwntools>=4.0.1", "pyelftools"], "numpy": ["numpy"]},
     tests_require=["nose", "pytest", "pwntools>=4.2.0.dev0"],
     entry_points={
         "console_scripts": ["internalblue=internalblue.cli:internalblue_entry_point"]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# bench_hci.py
+#
+# Parse benchmark for the HCI packet model in internalblue.hci. The packets
+# are taken from the replay traces in tests/traces. The previous packet
+# classes (plain objects, payload slices copied) are kept here as reference,
+# the script checks that both produce the same raw packets and prints the
+# speedup.
+#
+# Usage: PYTHONPATH=. python3 tests/bench_hci.py
+
+from __future__ import print_function
+
+import glob
+import os
+import struct
+import timeit
+
+from internalblue import hci
+
+
+class RefHCI(object):
+    def __init__(self, uart_type):
+        self.event_code = None
+        self.uart_type = uart_type
+
+    def getRaw(self):
+        return struct.pack("B", self.uart_type)
+
+
+class RefCmd(RefHCI):
+    @staticmethod
+    def from_data(data):
+        return RefCmd(struct.unpack("<H", data[0:2])[0], data[2], data[3:])
+
+    def __init__(self, opcode, length, data):
+        RefHCI.__init__(self, 0x01)
+        self.opcode = opcode
+        self.length = length
+        self.data = data
+
+    def getRaw(self):
+        return RefHCI.getRaw(self) + struct.pack("<HB", self.opcode, self.length) + self.data
+
+
+class RefAcl(RefHCI):
+    @staticmethod
+    def from_data(data):
+        data = bytes(data)
+        header, length = struct.unpack_from("<HH", data)
+        return RefAcl(header & 0x0FFF, (header >> 12) & 0x3, header >> 14, length, data[4:])
+
+    def __init__(self, handle, bp, bc, length, data):
+        RefHCI.__init__(self, 0x02)
+        self.handle = handle
+        self.bp = bp
+        self.bc = bc
+        self.length = length
+        self.data = data
+
+    def getRaw(self):
+        header = (self.handle & 0x0FFF) | (self.bp & 0x3) << 12 | (self.bc & 0x3) << 14
+        return RefHCI.getRaw(self) + struct.pack("<HH", header, self.length) + self.data
+
+
+class RefSco(RefHCI):
+    @staticmethod
+    def from_data(data):
+        data = bytes(data)
+        header, length = struct.unpack_from("<HB", data)
+        return RefSco(header & 0x0FFF, (header >> 12) & 0x3, length, data[3:])
+
+    def __init__(self, handle, ps, length, data):
+        RefHCI.__init__(self, 0x03)
+        self.handle = handle
+        self.ps = ps
+        self.length = length
+        self.data = data
+
+    def getRaw(self):
+        header = (self.handle & 0x0FFF) | (self.ps & 0x3) << 12
+        return RefHCI.getRaw(self) + struct.pack("<HB", header, self.length) + self.data
+
+
+class RefEvent(RefHCI):
+    @staticmethod
+    def from_data(data):
+        return RefEvent(data[0], data[1], data[2:])
+
+    def __init__(self, event_code, length, data):
+        RefHCI.__init__(self, 0x04)
+        self.event_code = event_code
+        self.length = length
+        self.data = data
+
+    def getRaw(self):
+        return RefHCI.getRaw(self) + struct.pack("BB", self.event_code, self.length) + self.data
+
+
+class RefDiag(RefHCI):
+    @staticmethod
+    def from_data(data):
+        return RefDiag(data[0], data[1:])
+
+    def __init__(self, opcode, data):
+        RefHCI.__init__(self, 0x07)
+        self.opcode = opcode
+        self.length = 63
+        self.data = data
+
+    def getRaw(self):
+        return RefHCI.getRaw(self) + struct.pack("B", self.opcode) + self.data
+
+
+REF_CLASSES = {0x01: RefCmd, 0x02: RefAcl, 0x03: RefSco, 0x04: RefEvent, 0x07: RefDiag}
+
+
+def ref_parse(data):
+    return REF_CLASSES[data[0]].from_data(data[1:])
+
+
+def adb_packets(rx):
+    """ The adbcore traces contain the btsnoop stream (record header, data) in chunks. """
+    stream = bytes.fromhex("".join(rx))
+    if stream.startswith(b"btsnoop\x00"):
+        stream = stream[16:]
+    offset = 0
+    while offset + 24 <= len(stream):
+        inc_len = struct.unpack_from(">I", stream, offset + 4)[0]
+        yield stream[offset + 24:offset + 24 + inc_len]
+        offset += 24 + inc_len
+
+
+def trace_packets():
+    tracedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces")
+    packets = []
+    for filename in sorted(glob.glob(os.path.join(tracedir, "*", "**", "*.trace*"), recursive=True)):
+        with open(filename) as f:
+            lines = [line.split() for line in f if line.startswith(("TX ", "RX "))]
+        if os.sep + "adbcore" + os.sep in filename:
+            candidates = adb_packets([line[1] for line in lines if line[0] == "RX" and len(line) > 1])
+        else:
+            candidates = [bytes.fromhex(line[1]) for line in lines if len(line) > 1 and len(line[1]) % 2 == 0]
+        for packet in candidates:
+            if len(packet) >= 3 and packet[0] in REF_CLASSES:
+                packets.append(bytearray(packet))  # The receive threads pass bytearrays
+    return packets
+
+
+def bench(name, reference, optimized, number, count):
+    ref = timeit.timeit(reference, number=number)
+    opt = timeit.timeit(optimized, number=number)
+    print("%-32s %10.2f us %10.2f us %8.1fx" % (
+        name, ref / number / count * 1e6, opt / number / count * 1e6, ref / opt))
+
+
+def main():
+    packets = trace_packets()
+    for packet in packets:
+        assert hci.parse_hci_packet(packet).getRaw() == bytes(packet) == bytes(ref_parse(packet).getRaw())
+    print("%d packets from the replay traces" % len(packets))
+
+    print("%-32s %13s %13s %9s" % ("per packet", "reference", "optimized", "speedup"))
+    bench("parse", lambda: [ref_parse(p) for p in packets],
+          lambda: [hci.parse_hci_packet(p) for p in packets], 200, len(packets))
+    bench("parse + routing", lambda: [ref_parse(p).event_code for p in packets],
+          lambda: [hci.parse_hci_packet(p).event_code for p in packets], 200, len(packets))
+    bench("parse + header fields", lambda: [ref_parse(p).length for p in packets],
+          lambda: [hci.parse_hci_packet(p).length for p in packets], 200, len(packets))
+    bench("parse + getRaw", lambda: [ref_parse(p).getRaw() for p in packets],
+          lambda: [hci.parse_hci_packet(p).getRaw() for p in packets], 200, len(packets))
+    bench("parse + data", lambda: [ref_parse(p).data for p in packets],
+          lambda: [hci.parse_hci_packet(p).data for p in packets], 200, len(packets))
+
+
+if __name__ == "__main__":
+    main()
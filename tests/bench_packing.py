@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# bench_packing.py
+#
+# Micro-benchmark for the helpers in internalblue.utils.packing. The previous
+# (pwntools based) implementations are kept here as reference, the script
+# checks that both produce the same results and prints the speedup.
+#
+# Usage: PYTHONPATH=. python3 tests/bench_packing.py
+
+from __future__ import print_function
+
+import os
+import struct
+import timeit
+
+from internalblue.utils import packing
+
+
+def ref_p32(num, endian=''):
+    if endian.lower() == 'big':
+        return struct.pack('>I', num)
+    elif endian.lower() == 'little':
+        return struct.pack('<I', num)
+    return struct.pack('I', num)
+
+
+def ref_u32(num, endian=''):
+    if endian.lower() == 'big':
+        return struct.unpack('>I', num)[0]
+    elif endian.lower() == 'little':
+        return struct.unpack('<I', num)[0]
+    return struct.unpack('I', num)[0]
+
+
+def ref_bits(s, endian='big'):
+    little = endian == 'little'
+    out = []
+    for b in bytearray(s):
+        byte = []
+        for _ in range(8):
+            byte.append(1 if b & 1 else 0)
+            b >>= 1
+        if little:
+            out += byte
+        else:
+            out += byte[::-1]
+    return out
+
+
+def ref_unbits(s, endian='big'):
+    if endian == 'little':
+        u = lambda s: struct.pack('B', int(s[::-1], 2))
+    else:
+        u = lambda s: struct.pack('B', int(s, 2))
+    out = b''
+    cur = b''
+    for c in s:
+        if c in ['1', 1, True]:
+            cur += b'1'
+        elif c in ['0', 0, False]:
+            cur += b'0'
+        else:
+            raise ValueError("unbits(): cannot decode the value %r into a bit" % c)
+        if len(cur) == 8:
+            out += u(cur)
+            cur = b''
+    if cur:
+        out += u(cur.ljust(8, b'0'))
+    return out
+
+
+def ref_bits_str(s, endian='big'):
+    return ''.join(map(lambda x: str(x), ref_bits(s, endian)))
+
+
+def ref_acl_header(data):
+    handle = ref_u32(ref_unbits(ref_bits_str(data[0:2])[0:12].rjust(16, "0")).ljust(4, b'\x00'), 'little')
+    bp = ref_unbits(ref_bits_str(data[1:2])[4:6].rjust(8, "0"))[0]
+    bc = ref_unbits(ref_bits_str(data[1:2])[6:8].rjust(8, "0"))[0]
+    return handle, bp, bc
+
+
+def bench(name, reference, optimized, number):
+    ref = timeit.timeit(reference, number=number)
+    opt = timeit.timeit(optimized, number=number)
+    print("%-32s %10.2f us %10.2f us %8.1fx" % (name, ref / number * 1e6, opt / number * 1e6, ref / opt))
+
+
+def main():
+    bitmap = os.urandom(32)  # enable bitmap of 256 patchram slots
+    slot_bits = ref_bits(bitmap)
+    dwords = os.urandom(4 * 256)  # patchram target table
+    acl = os.urandom(4)
+
+    assert packing.bits(bitmap) == ref_bits(bitmap)
+    assert packing.bits(bitmap, 'little') == ref_bits(bitmap, 'little')
+    assert packing.unbits(slot_bits) == ref_unbits(slot_bits)
+    assert packing.bits_str(bitmap) == ref_bits_str(bitmap)
+    assert packing.unpack_u32_array(dwords) == [ref_u32(dwords[i:i + 4], 'little') for i in range(0, len(dwords), 4)]
+
+    print("%-32s %13s %13s %9s" % ("", "reference", "optimized", "speedup"))
+    bench("p32", lambda: ref_p32(0x12345678), lambda: packing.p32(0x12345678), 200000)
+    bench("u32 (little)", lambda: ref_u32(dwords[:4], 'little'), lambda: packing.u32(dwords[:4], 'little'), 200000)
+    bench("bits (32 bytes)", lambda: ref_bits(bitmap), lambda: packing.bits(bitmap), 20000)
+    bench("bits little (32 bytes)", lambda: ref_bits(bitmap, 'little'), lambda: packing.bits(bitmap, 'little'), 20000)
+    bench("unbits (256 bits)", lambda: ref_unbits(slot_bits), lambda: packing.unbits(slot_bits), 20000)
+    bench("bits_str (32 bytes)", lambda: ref_bits_str(bitmap), lambda: packing.bits_str(bitmap), 20000)
+    bench("256x u32 vs unpack_u32_array",
+          lambda: [ref_u32(dwords[i:i + 4]) for i in range(0, len(dwords), 4)],
+          lambda: packing.unpack_u32_array(dwords), 5000)
+    bench("ACL header bits_str vs struct",
+          lambda: ref_acl_header(acl),
+          lambda: struct.unpack_from("<HH", acl), 50000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+from __future__ import print_function
+
+from internalblue.core import InternalBlue
+from internalblue.fw import FirmwareDefinition
+from internalblue.hci import HCI_COMND
+from internalblue.utils.packing import p8, p16, u32
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+class MemoryFirmware(FirmwareDefinition):
+    """
+    Firmware definition for MemoryCore. The patchram tables live in plain RAM.
+    """
+    FW_NAME = "MemoryCore"
+
+    PATCHRAM_VALUE_TABLE_ADDRESS = 0x1000
+    PATCHRAM_TARGET_TABLE_ADDRESS = 0x2000
+    PATCHRAM_ENABLED_BITMAP_ADDRESS = 0x3000
+    PATCHRAM_NUMBER_OF_SLOTS = 128
+    PATCHRAM_ALIGNED = False
+
+
+class MemoryCore(InternalBlue):
+    """
+    A core without a chip. The Read_RAM, Write_RAM and Launch_RAM commands
+    operate on a local bytearray so that the memory layout produced by the
+    core can be checked. Each of these HCI commands is recorded.
+    """
+
+    def __init__(self, size=0x10000, fw=MemoryFirmware, **kwargs):
+        super(MemoryCore, self).__init__(btsnooplog_filename=None, **kwargs)
+        self.memory = bytearray(size)
+        self.fw = fw
+        self.running = True
+        self.doublecheck = False
+        self.reads = []  # type: List[Tuple[int, int]]
+        self.writes = []  # type: List[Tuple[int, int]]
+        self.failing_writes = []  # type: List[Tuple[int, int]]
+        self.launches = []  # type: List[int]
+
+        # Inactive patchram slots point to 0xFFFFC
+        for slot in range(fw.PATCHRAM_NUMBER_OF_SLOTS):
+            self.memory[fw.PATCHRAM_TARGET_TABLE_ADDRESS + slot * 4:
+                        fw.PATCHRAM_TARGET_TABLE_ADDRESS + slot * 4 + 4] = (0xFFFFC >> 2).to_bytes(4, "little")
+
+    def device_list(self):
+        return []
+
+    def local_connect(self):
+        return True
+
+    def _recvThreadFunc(self):
+        pass
+
+    def sendHciCommand(self, hci_opcode, data, timeout=3):
+        """
+        Emulates the Read_RAM, Write_RAM and Launch_RAM vendor specific commands
+        and returns the payload of the corresponding Command Complete event.
+        """
+        opcode = hci_opcode.value if isinstance(hci_opcode, HCI_COMND) else hci_opcode
+        address = u32(data[0:4])
+        header = p8(1) + p16(opcode)
+        if opcode == HCI_COMND.VSC_Read_RAM.value:
+            length = data[4]
+            self.reads.append((address, length))
+            return header + p8(0) + bytes(self.memory[address:address + length])
+        if opcode == HCI_COMND.VSC_Write_RAM.value:
+            for start, end in self.failing_writes:
+                if start <= address < end:
+                    return header + p8(0x12)
+            self.writes.append((address, len(data) - 4))
+            self.memory[address:address + len(data) - 4] = data[4:]
+            return header + p8(0)
+        if opcode == HCI_COMND.VSC_Launch_RAM.value:
+            self.launches.append(address)
+            return header + p8(0)
+        return None
+
+    def dword(self, address):
+        return int.from_bytes(self.memory[address:address + 4], "little")
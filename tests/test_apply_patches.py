@@ -0,0 +1,99 @@
+from __future__ import print_function
+from internalblue.utils.packing import p32
+
+import nose
+
+from memory_core import MemoryCore, MemoryFirmware
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+def enabled_slots(core):
+    table_addresses, table_values, table_slots = core.getPatchramState()
+    return {table_addresses[i]: bytes(table_values[i])
+            for i in range(MemoryFirmware.PATCHRAM_NUMBER_OF_SLOTS) if table_slots[i]}
+
+
+def test_apply_patches():
+    core = MemoryCore()
+    core.memory[0x8000:0x8010] = bytes(range(0x10))
+
+    patches = [(0x8000, b'\xaa\xbb\xcc\xdd'), (0x8006, b'\x11\x22\x33\x44'), (0x800c, b'\x55\x66\x77\x88')]
+    nose.tools.assert_true(core.applyPatches(patches))
+
+    nose.tools.assert_equal(enabled_slots(core), {
+        0x8000: b'\xaa\xbb\xcc\xdd',
+        0x8004: b'\x04\x05\x11\x22',
+        0x8008: b'\x33\x44\x0a\x0b',
+        0x800c: b'\x55\x66\x77\x88',
+    })
+
+    # One bulk write per table, the bitmap dword is written exactly once
+    writes = [address for address, length in core.writes]
+    nose.tools.assert_equal(writes, [MemoryFirmware.PATCHRAM_VALUE_TABLE_ADDRESS,
+                                     MemoryFirmware.PATCHRAM_TARGET_TABLE_ADDRESS,
+                                     MemoryFirmware.PATCHRAM_ENABLED_BITMAP_ADDRESS])
+
+
+def test_apply_patches_reuses_slots():
+    core = MemoryCore()
+    nose.tools.assert_true(core.patchRom(0x8000, b'\x00\x00\x00\x00'))
+    nose.tools.assert_true(core.patchRom(0x9000, b'\x01\x00\x00\x00'))
+
+    nose.tools.assert_true(core.applyPatches([(0x8000, b'\xaa\xaa\xaa\xaa'), (0x8004, b'\xbb\xbb\xbb\xbb')]))
+    nose.tools.assert_equal(enabled_slots(core), {
+        0x8000: b'\xaa\xaa\xaa\xaa',
+        0x8004: b'\xbb\xbb\xbb\xbb',
+        0x9000: b'\x01\x00\x00\x00',
+    })
+
+
+def test_apply_patches_rollback():
+    core = MemoryCore()
+    nose.tools.assert_true(core.patchRom(0x8000, b'\x00\x00\x00\x00'))
+    targets = MemoryFirmware.PATCHRAM_TARGET_TABLE_ADDRESS
+    before = bytes(core.memory[targets:targets + 0x1010])
+
+    # Fail on the bitmap write, which is the last step of the transaction
+    core.failing_writes = [(MemoryFirmware.PATCHRAM_ENABLED_BITMAP_ADDRESS,
+                            MemoryFirmware.PATCHRAM_ENABLED_BITMAP_ADDRESS + 0x10)]
+    nose.tools.assert_false(core.applyPatches([(0x8000, b'\xaa\xaa\xaa\xaa'), (0x9000, b'\xbb\xbb\xbb\xbb')]))
+    core.failing_writes = []
+
+    nose.tools.assert_equal(enabled_slots(core), {0x8000: b'\x00\x00\x00\x00'})
+    # Target table and bitmap are unchanged, values of inactive slots do not matter
+    nose.tools.assert_equal(bytes(core.memory[targets:targets + 0x1010]), before)
+
+
+def test_apply_patches_no_free_slots():
+    core = MemoryCore()
+    patches = [(0x8000 + i * 4, p32(i)) for i in range(MemoryFirmware.PATCHRAM_NUMBER_OF_SLOTS + 1)]
+    nose.tools.assert_false(core.applyPatches(patches))
+    nose.tools.assert_equal(enabled_slots(core), {})
+
+
+def test_patchram_slot_allocator():
+    core = MemoryCore()
+    nose.tools.assert_true(core.patchRom(0x8000, b'\x00\x00\x00\x00'))  # slot 0
+
+    slot = core.allocatePatchramSlot()
+    nose.tools.assert_equal(slot, 1)
+    nose.tools.assert_equal(core.allocatePatchramSlot(), 2)
+    nose.tools.assert_equal(core.allocatePatchramSlot(0x8000), 0)
+
+    # Reserved slots are skipped when a free slot is chosen
+    nose.tools.assert_true(core.patchRom(0x9000, b'\x00\x00\x00\x00'))
+    nose.tools.assert_true(core.applyPatches([(0xa000, b'\x00\x00\x00\x00')]))
+    table_addresses, _, _ = core.getPatchramState()
+    nose.tools.assert_equal(table_addresses[:5], [0x8000, None, None, 0x9000, 0xa000])
+
+    # The owner of the slot installs its patch there
+    nose.tools.assert_true(core.patchRom(0xb000, b'\x00\x00\x00\x00', slot))
+    table_addresses, _, _ = core.getPatchramState()
+    nose.tools.assert_equal(table_addresses[1], 0xb000)
+
+    core.releasePatchramSlot(2)
+    nose.tools.assert_equal(core.allocatePatchramSlot(), 2)
@@ -0,0 +1,24 @@
+from __future__ import print_function
+import argparse
+import tempfile
+
+from internalblue.cli import InternalBlueCLI
+
+from memory_core import MemoryCore
+
+import nose
+
+
+def _cli():
+    # The history file is written when the interpreter exits, so the directory is kept
+    main_args = argparse.Namespace(data_directory=tempfile.mkdtemp(), verbose=False, trace=None, save=None,
+                                   device=None, replay=None)
+    return InternalBlueCLI(main_args, core=MemoryCore())
+
+
+def test_cli_startup():
+    # cmd2 refuses command names which start with a shortcut
+    cli = _cli()
+    nose.tools.assert_is_instance(cli.internalblue, MemoryCore)
+    for command in ("memorypool", "monitorheap", "lescan", "inquiry", "tracepoint", "countpoint"):
+        nose.tools.assert_in(command, cli.get_all_commands())
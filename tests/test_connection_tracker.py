@@ -0,0 +1,106 @@
+from __future__ import print_function
+import struct
+
+from internalblue.hci import HCI_Event
+from internalblue.utils.packing import pack_u32_array
+
+from memory_core import MemoryCore
+from test_connections import ArrayFirmware, _connection
+
+import nose
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+def _event(code, data):
+    return [HCI_Event(code, len(data), data)]
+
+
+def _connection_complete(handle, address, link_type=1):
+    return _event(0x03, struct.pack("<BH", 0, handle) + address[::-1] + bytes([link_type, 0]))
+
+
+def test_events():
+    core = MemoryCore()
+    tracker = core.connection_tracker
+    seen = []
+    tracker.subscribe(lambda event, connection: seen.append((event, connection.handle)))
+
+    address = b"\x11\x22\x33\x44\x55\x66"
+    core.connectionStatusCallback(_connection_complete(0x0B, address))  # only logs
+    tracker.hciCallback(_event(0x04, address[::-1] + b"\x00\x00\x00\x01"))
+    tracker.hciCallback(_connection_complete(0x0B, address))
+    tracker.hciCallback(_connection_complete(0x0C, b"\x01" * 6))
+    tracker.hciCallback(_event(0x3E, struct.pack("<BBHBB", 0x01, 0, 0x40, 1, 0) + b"\x02" * 6 + bytes(7)))
+
+    nose.tools.assert_equal([(c.handle, c.link_type, c.role) for c in tracker.connections()],
+                            [(0x0B, "ACL", "slave"), (0x0C, "ACL", "master"), (0x40, "LE", "slave")])
+    nose.tools.assert_equal(tracker.by_address(address)[0].handle, 0x0B)
+
+    tracker.hciCallback(_event(0x12, b"\x00" + address[::-1] + b"\x00"))  # Role Change to master
+    tracker.hciCallback(_event(0x08, struct.pack("<BHB", 0, 0x0B, 1)))  # Encryption on
+    nose.tools.assert_equal(tracker.get(0x0B).role, "master")
+    nose.tools.assert_true(tracker.get(0x0B).encrypted)
+
+    tracker.hciCallback(_event(0x05, struct.pack("<BHB", 0, 0x0C, 0x13)))
+    nose.tools.assert_equal([c.handle for c in tracker.connections("ACL")], [0x0B])
+    nose.tools.assert_equal(seen, [("connected", 0x0B), ("connected", 0x0C), ("connected", 0x40),
+                                   ("changed", 0x0B), ("changed", 0x0B), ("disconnected", 0x0C)])
+    # Nothing was read from the chip
+    nose.tools.assert_equal(core.reads, [])
+
+
+def test_other_links():
+    core = MemoryCore()
+    tracker = core.connection_tracker
+    address = b"\x11\x22\x33\x44\x55\x66"
+    tracker.hciCallback(_event(0x2C, struct.pack("<BH", 0, 0x0D) + address[::-1] + b"\x02"))
+    tracker.hciCallback(_event(0x3E, struct.pack("<BBHBB", 0x0A, 0, 0x41, 0, 0) + b"\x03" * 6 + bytes(19)))
+    tracker.hciCallback(_event(0x03, struct.pack("<BH", 0x04, 0x0E) + address[::-1] + b"\x01\x00"))  # failed
+    tracker.hciCallback(_event(0x05, b"\x00\x0d"))  # truncated
+    nose.tools.assert_equal([(c.handle, c.link_type, c.role) for c in tracker.connections()],
+                            [(0x0D, "eSCO", None), (0x41, "LE", "master")])
+
+
+def test_sync_and_details():
+    core = MemoryCore(fw=ArrayFirmware)
+    _connection(core, 0x4000, 1, 0x0B, b"\x11" * 6)
+    tracker = core.connection_tracker
+    tracker.hciCallback(_connection_complete(0x0B, b"\x11" * 6))
+
+    nose.tools.assert_equal(tracker.details(0x0B).connection_number, 1)
+    reads = len(core.reads)
+    tracker.details(0x0B)
+    nose.tools.assert_equal(len(core.reads), reads)
+
+    # Connections from before the start are found with a single sync
+    core = MemoryCore(fw=ArrayFirmware)
+    _connection(core, 0x4000 + 0x14C, 2, 0x0C, b"\x22" * 6)
+    nose.tools.assert_equal([c.handle for c in core.connection_tracker.current()], [0x0C])
+    nose.tools.assert_true(core.connection_tracker.synced)
+
+
+def test_current_merges_table():
+    core = MemoryCore(fw=ArrayFirmware)
+    _connection(core, 0x4000, 1, 0x0B, b"\x11" * 6)
+    _connection(core, 0x4000 + 0x14C, 2, 0x0C, b"\x22" * 6)
+    tracker = core.connection_tracker
+
+    # A tracked connection does not hide the one from before the start
+    tracker.hciCallback(_connection_complete(0x0C, b"\x22" * 6))
+    nose.tools.assert_equal([c.handle for c in tracker.current("ACL")], [0x0B, 0x0C])
+    nose.tools.assert_is_not_none(tracker.get(0x0C).information)
+    reads = len(core.reads)
+    nose.tools.assert_equal([c.handle for c in tracker.current("ACL", 0x0C)], [0x0C])
+    nose.tools.assert_equal(len(core.reads), reads)
+
+    # A connection whose event was missed is found when it is requested
+    _connection(core, 0x4000 + 2 * 0x14C, 3, 0x0D, b"\x33" * 6)
+    nose.tools.assert_equal([c.handle for c in tracker.current("ACL", 0x0D)], [0x0D])
+    nose.tools.assert_greater(len(core.reads), reads)
+    reads = len(core.reads)
+    nose.tools.assert_equal(tracker.current("ACL", 0x0E), [])
+    nose.tools.assert_greater(len(core.reads), reads)
@@ -0,0 +1,143 @@
+from __future__ import print_function
+import os
+import struct
+
+from internalblue.fw.fw_0x6109 import BCM4335C0
+from internalblue.hci import HCI_COMND
+from internalblue.objects.connection_information import ConnectionInformation
+from internalblue.utils.packing import pack_u32_array
+from internalblue.utils.struct_layout import Field
+
+from memory_core import MemoryCore, MemoryFirmware
+from trace_memory import cli_output, read_ram_records, trace_memory_core, tracedir
+
+import nose
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+class ArrayFirmware(MemoryFirmware):
+    CONNECTION_ARRAY_ADDRESS = 0x4000
+    CONNECTION_MAX = 4
+    CONNECTION_STRUCT_LENGTH = 0x14C
+
+
+class ListFirmware(MemoryFirmware):
+    CONNECTION_LIST_ADDRESS = 0x4000
+    CONNECTION_MAX = 4
+    CONNECTION_STRUCT_LENGTH = 0x168
+
+
+def _connection(core, address, number, handle, remote_address):
+    core.memory[address:address + 4] = struct.pack("<I", number)
+    core.memory[address + 0x28:address + 0x2E] = remote_address[::-1]
+    core.memory[address + 0x64:address + 0x66] = struct.pack("<H", handle)
+
+
+def test_array_in_one_read():
+    core = MemoryCore(fw=ArrayFirmware)
+    _connection(core, 0x4000 + 0x14C, 2, 0x0C, b"\x11\x22\x33\x44\x55\x66")
+    connections = core.readAllConnections()
+    nose.tools.assert_equal(len(connections), 4)
+    nose.tools.assert_equal([c is not None for c in connections], [False, True, False, False])
+    nose.tools.assert_equal(connections[1].connection_handle, 0x0C)
+    nose.tools.assert_equal(connections[1].remote_address, b"\x11\x22\x33\x44\x55\x66")
+    # One readMem, split into Read_RAM commands by readMem itself
+    nose.tools.assert_equal(sum(length for _, length in core.reads), 4 * 0x14C)
+    nose.tools.assert_equal(vars(connections[1]), vars(core.readConnectionInformation(2)))
+
+
+def test_list():
+    core = MemoryCore(fw=ListFirmware)
+    core.memory[0x4000:0x4010] = pack_u32_array([0x5000, 0, 0x5168, 0x8000])
+    _connection(core, 0x5000, 1, 0x0B, b"\x01" * 6)
+    _connection(core, 0x5168, 3, 0x0C, b"\x02" * 6)
+    connections = core.readAllConnections()
+    nose.tools.assert_equal([c.connection_handle if c else None for c in connections], [0x0B, None, 0x0C, None])
+    # Pointers, then the two adjacent structs together and the empty one
+    nose.tools.assert_equal(sum(length for _, length in core.reads), 16 + 3 * 0x168)
+    nose.tools.assert_equal(core.reads[1][0], 0x5000)
+
+
+def test_connection_view():
+    buffer = bytearray(0x14C)
+    buffer[0:4] = struct.pack("<I", 7)
+    buffer[0x1C:0x20] = struct.pack("<I", 1 << 15)
+    buffer[0x68:0x6C] = b"\xaa\xbb\xcc\xdd"
+    buffer[0x9C] = 127 - 20
+    buffer[0xA7] = 4
+    connection = ConnectionInformation.from_connection_buffer(buffer)
+    nose.tools.assert_equal(connection.connection_number, 7)
+    nose.tools.assert_false(connection.master_of_connection)
+    nose.tools.assert_equal(connection.link_key, b"\xaa\xbb\xcc\xdd")
+    nose.tools.assert_equal(connection.tx_pwr_lvl_dBm, -20)
+    # Decoded on access, from the buffer without a copy
+    buffer[0:4] = struct.pack("<I", 8)
+    nose.tools.assert_equal(connection["connection_number"], 8)
+    nose.tools.assert_equal(list(vars(connection)), list(ConnectionInformation.FIELDS))
+    nose.tools.assert_raises(AttributeError, setattr, connection, "unknown", 1)
+
+    layout = ConnectionInformation.LAYOUT.replace(connection_number=Field(0x04, "u16"))
+    buffer[4:6] = b"\x05\x00"
+    nose.tools.assert_equal(ConnectionInformation.from_connection_buffer(buffer, layout).connection_number, 5)
+
+
+def test_connection_values():
+    connection = ConnectionInformation(1, b"\x01" * 6, 0, True, 0x0C, b"", 0, b"", -1, b"", b"", b"\x00")
+    nose.tools.assert_equal(vars(connection)["connection_handle"], 0x0C)
+    connection.connection_handle = 0x0B
+    nose.tools.assert_equal(connection.connection_handle, 0x0B)
+
+
+# Recorded with one readMem per connection struct, the table read no longer replays as is
+CONNECTION_TRACES = ["info_connections.trace.broken", "info_connections_2.trace.broken", "readafh.trace.broken"]
+
+
+def test_recorded_connection_traces():
+    for tracefile in CONNECTION_TRACES:
+        tracepath = os.path.join(tracedir, "adbcore", tracefile)
+        core = trace_memory_core(tracepath, BCM4335C0)
+        connections = core.readAllConnections()
+        nose.tools.assert_equal(len(connections), BCM4335C0.CONNECTION_MAX)
+
+        # The single connection reads are the ones in the trace and give the same result
+        del core.reads[:]
+        for number in range(1, BCM4335C0.CONNECTION_MAX + 1):
+            connection = core.readConnectionInformation(number)
+            nose.tools.assert_equal(vars(connection) if connection else None,
+                                    vars(connections[number - 1]) if connections[number - 1] else None)
+        nose.tools.assert_equal(core.reads, [(address, len(data)) for address, data in read_ram_records(tracepath)])
+
+        messages = cli_output(core, "info connections")
+        for i, connection in enumerate(connections):
+            if connection is not None:
+                nose.tools.assert_in("### | Connection ---%02d--- ###" % i, messages)
+                nose.tools.assert_in("    - Conn. Handle:      0x%X" % connection.connection_handle, messages)
+
+
+def test_recorded_connection_layout():
+    nose.tools.assert_is(BCM4335C0.CONNECTION_STRUCT_LAYOUT, ConnectionInformation.LAYOUT)
+    core = trace_memory_core(os.path.join(tracedir, "adbcore", "info_connections_2.trace.broken"), BCM4335C0)
+    connection = core.readConnectionInformation(7)
+    nose.tools.assert_equal((connection.connection_number, connection.connection_handle), (7, 0x0C))
+    nose.tools.assert_equal(connection.remote_address, bytes.fromhex("0023023a1a2e"))
+    nose.tools.assert_true(connection.master_of_connection)
+    nose.tools.assert_equal(len(connection.link_key), connection.effective_key_len)
+
+
+def test_recorded_readafh_trace():
+    core = trace_memory_core(os.path.join(tracedir, "adbcore", "readafh.trace.broken"), BCM4335C0)
+    sent = []
+    read_ram = core.sendHciCommand
+
+    def sendHciCommand(hci_opcode, data, timeout=3):
+        sent.append((hci_opcode, bytes(data)))
+        return read_ram(hci_opcode, data, timeout)
+
+    core.sendHciCommand = sendHciCommand
+    cli_output(core, "readafh")
+    # The same Read_AFH_Channel_Map command as in the trace
+    nose.tools.assert_equal([data for opcode, data in sent if opcode == HCI_COMND.Read_AFH_Channel_Map], [b"\x0c\x00"])
@@ -0,0 +1,59 @@
+from __future__ import print_function
+from internalblue.objects.countpoint import Countpoint, CountpointSample
+from internalblue.utils.packing import pack_u32_array
+from internalblue.utils.thumb import relocatable, split_instructions, uses_pc
+
+from memory_core import MemoryCore
+
+import nose
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+def _code(*halfwords):
+    return b"".join(hw.to_bytes(2, "little") for hw in halfwords)
+
+
+def test_split_instructions():
+    # push {r4, lr}; mov.w r4, #0
+    nose.tools.assert_equal(split_instructions(_code(0xB510, 0xF04F, 0x0400)),
+                            [_code(0xB510), _code(0xF04F, 0x0400)])
+    # the second halfword starts a 32-bit instruction
+    nose.tools.assert_raises(ValueError, split_instructions, _code(0xB510, 0xF04F))
+
+
+def test_relocatable():
+    nose.tools.assert_true(relocatable(_code(0xB510, 0x4604)))  # push {r4, lr}; mov r4, r0
+    nose.tools.assert_true(relocatable(_code(0xF8D0, 0x1004)))  # ldr.w r1, [r0, #4]
+    nose.tools.assert_true(relocatable(_code(0x4770, 0xBF00)))  # bx lr; nop
+    nose.tools.assert_false(relocatable(_code(0x4801, 0xB510)))  # ldr r0, [pc, #4]
+    nose.tools.assert_false(relocatable(_code(0xB510, 0xE7FE)))  # b .
+    nose.tools.assert_false(relocatable(_code(0xF000, 0xF800)))  # bl
+    nose.tools.assert_false(relocatable(_code(0xF000, 0x8000)))  # beq.w
+    nose.tools.assert_false(relocatable(_code(0xF8DF, 0x0008)))  # ldr.w r0, [pc, #8]
+    nose.tools.assert_false(relocatable(_code(0xB108, 0xBF00)))  # cbz r0; nop
+    nose.tools.assert_false(relocatable(_code(0xBF08, 0x2001)))  # it eq; moveq r0, #1
+    nose.tools.assert_false(relocatable(_code(0x46F7, 0xBF00)))  # mov pc, lr
+    nose.tools.assert_false(relocatable(_code(0x4478, 0xBF00)))  # add r0, pc
+    nose.tools.assert_false(relocatable(_code(0xB510, 0xF04F)))  # cut off
+    nose.tools.assert_false(uses_pc(_code(0xF3EF, 0x8000)))  # mrs r0, apsr
+
+
+def test_read_countpoints_at_once():
+    core = MemoryCore()
+    core.countpoint_table_address = 0x8000
+    core.countpoints = [Countpoint(0x1000, 0x9000, 1, 0, b"\x00" * 4),
+                        Countpoint(0x2000, 0x9040, 2, 3, b"\x00" * 4)]
+    core.memory[0x8000:0x8010] = pack_u32_array([5, 0, 0, 7])
+    nose.tools.assert_equal(core.readCountpoints(), {0x1000: 5, 0x2000: 7})
+    nose.tools.assert_equal(core.reads, [(0x8000, 16)])
+
+
+def test_rates():
+    first = CountpointSample(10.0, {0x1000: 5, 0x2000: 0xFFFFFFF0})
+    second = CountpointSample(12.0, {0x1000: 25, 0x2000: 0x10, 0x3000: 1})
+    # counters wrap around, new countpoints have no rate yet
+    nose.tools.assert_equal(second.rates(first), {0x1000: 10.0, 0x2000: 16.0})
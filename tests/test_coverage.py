@@ -0,0 +1,129 @@
+from __future__ import print_function
+import os
+import tempfile
+
+from internalblue.coverage import CoverageCollector, read_drcov
+from internalblue.utils.packing import u32
+from internalblue.utils.thumb import encode_branch
+
+from memory_core import MemoryCore, MemoryFirmware
+
+import nose
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+class CoverageFirmware(MemoryFirmware):
+    TRACEPOINT_HOOKS_LOCATION = 0x8000
+    TRACEPOINT_HOOK_SIZE = 40
+    TRACEPOINT_HOOK_POOL_ADDRESS = 0x8000
+    TRACEPOINT_HOOK_POOL_SIZE = 0x800
+
+
+class OfflineCollector(CoverageCollector):
+    # The common hook code needs an assembler, it is never executed here
+    def _install_common_code(self, address):
+        return b"\x00\xbf" * 8
+
+
+def _collector(blocks, max_slots=None):
+    core = MemoryCore(fw=CoverageFirmware)
+    collector = OfflineCollector(core, blocks, max_slots=max_slots)
+    nose.tools.assert_true(collector.start())
+    return core, collector
+
+
+def _enabled(core, slot):
+    bitmap = core.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS + (slot // 32) * 4
+    return bool(u32(core.memory[bitmap:bitmap + 4]) & (1 << (slot % 32)))
+
+
+def _table(core, table, slot):
+    return bytes(core.memory[table + slot * 4:table + slot * 4 + 4])
+
+
+def test_encode_branch():
+    nose.tools.assert_equal(encode_branch(0x0, 0x1000), bytes.fromhex("00f0febf"))
+    nose.tools.assert_equal(encode_branch(0x1000, 0x1004), bytes.fromhex("00f000b8"))
+    nose.tools.assert_equal(encode_branch(0x1004, 0x1000), bytes.fromhex("fff7fcbf"))
+    nose.tools.assert_raises(ValueError, encode_branch, 0x0, 0x1001)
+    nose.tools.assert_raises(ValueError, encode_branch, 0x0, 0x2000000)
+
+
+def test_stub_layout():
+    core, collector = _collector([0x400], max_slots=2)
+    stub = bytes(core.memory[collector.stubs_address:collector.stubs_address + collector.STUB_SIZE])
+    nose.tools.assert_equal(len(stub), collector.STUB_SIZE)
+    nose.tools.assert_equal(stub[4:8], b"\x4f\xf0" + bytes([collector.slots[0], 0]))  # mov.w r0, <slot>
+    nose.tools.assert_equal(stub[10:14], encode_branch(collector.stubs_address + 10, collector.common_address))
+    nose.tools.assert_equal(u32(stub[16:20]), 0x401)
+
+
+def test_rotation():
+    core, collector = _collector([0x400, 0x404, 0x408, 0x402], max_slots=2)
+    # 0x402 is armed later since it needs two slots
+    nose.tools.assert_equal(sorted(collector.armed.values()), [0x400, 0x404])
+    for slot in collector.slots:
+        nose.tools.assert_true(_enabled(core, slot))
+    first = collector.slots[0]
+    nose.tools.assert_equal(_table(core, core.fw.PATCHRAM_TARGET_TABLE_ADDRESS, first), (0x400 >> 2).to_bytes(4, "little"))
+    nose.tools.assert_equal(_table(core, core.fw.PATCHRAM_VALUE_TABLE_ADDRESS, first),
+                            encode_branch(0x400, collector.stubs_address))
+
+    # A hit of 0x404 only
+    hit_slot = [slot for slot, block in collector.armed.items() if block == 0x404][0]
+    core.memory[collector.hitmap_address() + hit_slot] = 1
+    del core.reads[:]
+    nose.tools.assert_equal(collector.rotate(), [0x404])
+    nose.tools.assert_equal(collector.covered, {0x404})
+    nose.tools.assert_in((collector.hitmap_address(), hit_slot + 1), core.reads)
+
+    # The unaligned block waited longest, it takes both slots, the partner patches the second dword
+    nose.tools.assert_equal(list(collector.armed.values()), [0x402])
+    primary, partner = list(collector.armed_partners.items())[0]
+    nose.tools.assert_equal(core.memory[collector.partners_address() + primary], partner)
+    nose.tools.assert_equal(_table(core, core.fw.PATCHRAM_TARGET_TABLE_ADDRESS, partner), (0x404 >> 2).to_bytes(4, "little"))
+    branch = encode_branch(0x402, collector.stubs_address)
+    nose.tools.assert_equal(_table(core, core.fw.PATCHRAM_VALUE_TABLE_ADDRESS, primary)[2:], branch[:2])
+    nose.tools.assert_equal(_table(core, core.fw.PATCHRAM_VALUE_TABLE_ADDRESS, partner)[:2], branch[2:])
+
+    # The hit map was cleared by rotate(), blocks which were not hit are armed again
+    core.memory[collector.hitmap_address() + primary] = 1
+    nose.tools.assert_equal(collector.rotate(), [0x402])
+    nose.tools.assert_equal(sorted(collector.armed.values()), [0x400, 0x408])
+    nose.tools.assert_equal(collector.armed_partners, {})
+
+    core.memory[collector.hitmap_address() + collector.slots[0]] = 1
+    nose.tools.assert_equal(len(collector.stop()), 1)
+    nose.tools.assert_equal(collector.pending(), 1)
+    nose.tools.assert_false(collector.running)
+    for slot in range(core.fw.PATCHRAM_NUMBER_OF_SLOTS):
+        nose.tools.assert_false(_enabled(core, slot))
+    nose.tools.assert_equal(core.tracepoint_hook_pool.used, 0)
+
+
+def test_skips_patched_dwords():
+    core = MemoryCore(fw=CoverageFirmware)
+    core.patchRom(0x500, b"\x00\xbf\x00\xbf")
+    collector = OfflineCollector(core, [0x500, 0x502, 0x600])
+    nose.tools.assert_true(collector.start())
+    nose.tools.assert_equal(list(collector.armed.values()), [0x600])
+    nose.tools.assert_equal(collector.queue, [0x500, 0x502])
+
+
+def test_drcov_roundtrip():
+    core = MemoryCore(fw=CoverageFirmware)
+    collector = OfflineCollector(core, [(0x400, 12), (0x500, 6), 0x600])
+    collector.covered = {0x500, 0x400}
+    fd, filename = tempfile.mkstemp(suffix=".drcov")
+    os.close(fd)
+    try:
+        collector.write_drcov(filename)
+        with open(filename, "rb") as f:
+            nose.tools.assert_true(f.read().startswith(b"DRCOV VERSION: 2\n"))
+        nose.tools.assert_equal(read_drcov(filename), [(0x400, 12), (0x500, 6)])
+    finally:
+        os.remove(filename)
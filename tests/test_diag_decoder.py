@@ -0,0 +1,102 @@
+from __future__ import print_function
+import os
+import struct
+import tempfile
+import time
+
+from internalblue.diag_decoder import DiagDecoder, DiagFilter, decode_diag
+from internalblue.hci import HCI_Diag
+from internalblue.utils.packing import p8
+
+import nose
+
+
+def lmp_frame(direction, pdu, clock=0x12345678):
+    """ Payload of a LMP diagnostic frame (after the type byte), 62 bytes. """
+    offset = 9 if direction == 0x00 else 12
+    data = struct.pack(">I", clock) + b"\xaa" * (offset - 4) + pdu
+    return data.ljust(62, b"\x00")
+
+
+def ll_frame(direction, pdu, clock=0x100):
+    return (struct.pack(">I", clock) + b"\xbb" * 7 + pdu).ljust(62, b"\x00")
+
+
+def test_decode_lmp():
+    pdu = decode_diag(0x00, lmp_frame(0x00, p8(37 << 1 | 1) + b"\x09\x0f\x00"))
+    nose.tools.assert_equal((pdu.protocol, pdu.direction, pdu.clock), ("LMP", "sent", 0x12345678))
+    nose.tools.assert_equal((pdu.opcode, pdu.extended_opcode, pdu.tid), (37, None, 1))
+    nose.tools.assert_equal(pdu.name, "LMP_version_req")
+    nose.tools.assert_equal(pdu.parameters[0:3], b"\x09\x0f\x00")
+
+    extended = decode_diag(0x01, lmp_frame(0x01, p8(127 << 1) + b"\x03\x01"))
+    nose.tools.assert_equal((extended.direction, extended.opcode, extended.extended_opcode, extended.tid),
+                            ("received", 127, 3, 0))
+    nose.tools.assert_equal(extended.name, "LMP_features_req_ext")
+    nose.tools.assert_equal(extended.parameters[0:1], b"\x01")
+
+
+def test_decode_ll_and_others():
+    pdu = decode_diag(0x81, ll_frame(0x81, b"\x0c\x09\x0f\x00"))
+    nose.tools.assert_equal((pdu.protocol, pdu.direction, pdu.opcode, pdu.tid), ("LL", "received", 0x0C, None))
+    nose.tools.assert_equal(pdu.name, "LL_VERSION_IND")
+    nose.tools.assert_is_none(decode_diag(0xc1, b"\x00" * 62))
+    nose.tools.assert_is_none(decode_diag(0x00, b"\x00" * 5))
+
+
+def test_filters():
+    version = decode_diag(0x00, lmp_frame(0x00, p8(37 << 1)))
+    accepted = decode_diag(0x01, lmp_frame(0x01, p8(3 << 1)))
+    ll = decode_diag(0x80, ll_frame(0x80, b"\x03"))
+
+    received = DiagFilter.parse("lmp received")
+    nose.tools.assert_equal([received.matches(p) for p in (version, accepted, ll)], [False, True, False])
+    opcodes = DiagFilter.parse("opcode=0x25,3")
+    nose.tools.assert_equal([opcodes.matches(p) for p in (version, accepted, ll)], [True, True, True])
+    names = DiagFilter.parse("name=LL_ENC_REQ")
+    nose.tools.assert_equal([names.matches(p) for p in (version, accepted, ll)], [False, False, True])
+    nose.tools.assert_raises(ValueError, DiagFilter.parse, "foo")
+
+
+def test_decoder_counts_and_filters():
+    decoder = DiagDecoder(filters=[DiagFilter.parse("received")], history=2)
+    seen = []
+    decoder.subscribers.append(seen.append)
+    for _ in range(3):
+        decoder.hciCallback((HCI_Diag(0x00, lmp_frame(0x00, p8(3 << 1))), 0, 0, 0, 0, None))
+        decoder.hciCallback((HCI_Diag(0x01, lmp_frame(0x01, p8(3 << 1))), 0, 0, 0, 0, None))
+    decoder.hciCallback((HCI_Diag(0xc1, b"\x00" * 62), 0, 0, 0, 0, None))
+
+    nose.tools.assert_equal(decoder.frames, 7)
+    nose.tools.assert_equal(decoder.counters, {("LMP", "sent", 3, None): 3, ("LMP", "received", 3, None): 3})
+    nose.tools.assert_equal(decoder.counter("LMP_accepted"), 6)
+    nose.tools.assert_equal(len(seen), 3)
+    nose.tools.assert_equal(len(decoder.records), 2)
+    nose.tools.assert_true(all(pdu.direction == "received" for pdu in decoder.records))
+
+
+def test_read_btsnoop():
+    fd, filename = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"btsnoop\x00" + struct.pack(">II", 1, 1002))
+            for packet in (b"\x07\x00" + lmp_frame(0x00, p8(37 << 1)), b"\x04\x0e\x01\x00",
+                           b"\x07\x81" + ll_frame(0x81, b"\x02\x13")):
+                f.write(struct.pack(">IIIIq", len(packet), len(packet), 0, 0, 0x00E03AB44A676000) + packet)
+        decoder = DiagDecoder()
+        nose.tools.assert_equal(decoder.read_btsnoop(filename), 2)
+        nose.tools.assert_equal([pdu.name for pdu in decoder.records], ["LMP_version_req", "LL_TERMINATE_IND"])
+        nose.tools.assert_equal(decoder.records[0].timestamp.year, 2000)
+    finally:
+        os.remove(filename)
+
+
+def test_decoder_throughput():
+    # Should keep up with diagnostic traffic, i.e. many thousand PDUs per second
+    decoder = DiagDecoder(filters=[DiagFilter.parse("lmp opcode=3")])
+    frame = lmp_frame(0x01, p8(3 << 1))
+    start = time.time()
+    for _ in range(20000):
+        decoder.feed(0x01, frame)
+    nose.tools.assert_true(time.time() - start < 2.0)
+    nose.tools.assert_equal(decoder.counter("LMP_accepted"), 20000)
@@ -0,0 +1,91 @@
+from __future__ import print_function
+
+from internalblue import hci
+from internalblue.hci_events import (CommandComplete, CommandStatus, ConnectionComplete, ConnectionRequest,
+                                     EncryptionChange, ExtendedInquiryResult, InquiryResult, LeAdvertisingReport,
+                                     LeConnectionComplete, LeEnhancedConnectionComplete, NumberOfCompletedPackets,
+                                     RoleChange, SynchronousConnectionComplete, decode_event, decode_packet)
+
+import nose
+
+
+def test_command_complete():
+    # Read_RAM response with 4 bytes of memory
+    event = decode_event(0x0E, bytes.fromhex("014dfc0011223344"))
+    nose.tools.assert_is_instance(event, CommandComplete)
+    nose.tools.assert_equal((event.num_packets, event.opcode, event.status), (1, 0xFC4D, 0))
+    nose.tools.assert_equal(event.result, bytes.fromhex("11223344"))
+    nose.tools.assert_equal(CommandComplete(bytes.fromhex("014dfc0c")).status_str, "Command Disallowed")
+
+    status = decode_packet(hci.parse_hci_packet(bytes.fromhex("040f0400010504")))
+    nose.tools.assert_is_instance(status, CommandStatus)
+    nose.tools.assert_equal((status.status, status.num_packets, status.opcode), (0, 1, 0x0405))
+
+    nose.tools.assert_is_none(decode_event(0x10, b"\x00"))  # Hardware Error
+    nose.tools.assert_is_none(decode_packet(hci.parse_hci_packet(bytes.fromhex("020b2004000102030405"))))
+
+
+def test_connection_events():
+    event = decode_event(0x03, bytes.fromhex("000b00665544332211010000"))
+    nose.tools.assert_is_instance(event, ConnectionComplete)
+    nose.tools.assert_equal((event.handle, event.address, event.link_type), (0x0B, bytes.fromhex("112233445566"), 1))
+
+    completed = decode_event(0x13, bytes.fromhex("020b0003000c000100"))
+    nose.tools.assert_is_instance(completed, NumberOfCompletedPackets)
+    nose.tools.assert_equal(completed.completed, [(0x0B, 3), (0x0C, 1)])
+
+    le = decode_event(0x3E, bytes.fromhex("0100400001016655443322112800000048000000"))
+    nose.tools.assert_is_instance(le, LeConnectionComplete)
+    nose.tools.assert_equal((le.status, le.handle, le.role, le.address), (0, 0x40, "slave", bytes.fromhex("112233445566")))
+
+    enhanced = decode_event(0x3E, bytes.fromhex("0a0041000000665544332211" + "00" * 12 + "2800000048000000"))
+    nose.tools.assert_is_instance(enhanced, LeEnhancedConnectionComplete)
+    nose.tools.assert_equal((enhanced.handle, enhanced.role), (0x41, "master"))
+
+    request = decode_event(0x04, bytes.fromhex("6655443322110c025a01"))
+    nose.tools.assert_is_instance(request, ConnectionRequest)
+    nose.tools.assert_equal((request.status, request.address, request.device_class, request.link_type),
+                            (None, bytes.fromhex("112233445566"), 0x5A020C, 1))
+
+    sco = decode_event(0x2C, bytes.fromhex("000d0066554433221102"))
+    nose.tools.assert_is_instance(sco, SynchronousConnectionComplete)
+    nose.tools.assert_equal((sco.handle, sco.address, sco.link_type), (0x0D, bytes.fromhex("112233445566"), 2))
+
+    role = decode_event(0x12, bytes.fromhex("0066554433221101"))
+    nose.tools.assert_is_instance(role, RoleChange)
+    nose.tools.assert_equal((role.status, role.address, role.role), (0, bytes.fromhex("112233445566"), "slave"))
+
+    encryption = decode_event(0x08, bytes.fromhex("000b0001"))
+    nose.tools.assert_is_instance(encryption, EncryptionChange)
+    nose.tools.assert_equal((encryption.handle, encryption.encryption_enabled), (0x0B, True))
+
+
+def test_advertising_report():
+    data = bytes.fromhex("0202" + "00" + "01" + "665544332211" + "03" + "020106" + "c4"
+                         + "04" + "00" + "aabbccddeeff" + "00" + "7f")
+    event = decode_event(0x3E, data)
+    nose.tools.assert_is_instance(event, LeAdvertisingReport)
+    nose.tools.assert_equal(len(event.reports), 2)
+    first, second = event.reports
+    nose.tools.assert_equal((first.event_type, first.address_type, first.address, first.data, first.rssi),
+                            (0, 1, bytes.fromhex("112233445566"), bytes.fromhex("020106"), -60))
+    nose.tools.assert_equal((second.event_type, second.address, second.data, second.rssi),
+                            (4, bytes.fromhex("ffeeddccbbaa"), b"", 127))
+
+    # Truncated reports are dropped
+    nose.tools.assert_equal(len(decode_event(0x3E, data[0:14]).reports), 0)
+
+
+def test_inquiry_results():
+    result = decode_event(0x02, bytes.fromhex("01" + "665544332211" + "01" + "0000" + "0c025a" + "3412"))
+    nose.tools.assert_is_instance(result, InquiryResult)
+    response = result.responses[0]
+    nose.tools.assert_equal((response.address, response.device_class, response.clock_offset, response.rssi),
+                            (bytes.fromhex("112233445566"), 0x5A020C, 0x1234, None))
+
+    extended = decode_event(0x2F, bytes.fromhex("01" + "665544332211" + "01" + "00" + "0c025a" + "3412" + "c4"
+                                                + "0509546573740000"))
+    nose.tools.assert_is_instance(extended, ExtendedInquiryResult)
+    response = extended.responses[0]
+    nose.tools.assert_equal((response.device_class, response.clock_offset, response.rssi), (0x5A020C, 0x1234, -60))
+    nose.tools.assert_equal(response.eir, bytes.fromhex("0509546573740000"))
@@ -0,0 +1,78 @@
+from __future__ import print_function
+
+from internalblue import hci
+
+import nose
+
+
+PACKETS = [
+    "01011000",  # Read_Local_Version_Information
+    "014dfc059430200004",  # Read_RAM
+    "020b2004000102030405",  # ACL
+    "03423103aabbcc",  # SCO
+    "040e0c010110000900000931010842",  # Command Complete
+    "0700" + "11" * 62,  # Diagnostic LMP sent
+]
+
+
+def test_round_trip():
+    for packet in PACKETS:
+        raw = bytes.fromhex(packet)
+        parsed = hci.parse_hci_packet(raw)
+        nose.tools.assert_equal(parsed.getRaw(), raw)
+        nose.tools.assert_equal(hci.parse_hci_packet(bytearray(raw)).getRaw(), raw)
+
+
+def test_payload_views():
+    event = hci.parse_hci_packet(bytes.fromhex("040e0c010110000900000931010842"))
+    nose.tools.assert_equal((event.event_code, event.length), (0x0E, 0x0C))
+    nose.tools.assert_is_instance(event.payload, memoryview)
+    nose.tools.assert_equal(event.payload[3], 0x00)
+    nose.tools.assert_is_instance(event.data, bytes)
+    nose.tools.assert_equal(event.data, bytes.fromhex("010110000900000931010842"))
+
+    # No per-instance dict
+    nose.tools.assert_raises(AttributeError, setattr, event, "foo", 1)
+
+    # Packets created from fields work as before
+    diag = hci.HCI_Diag(0x01, b"\x00" * 62)
+    nose.tools.assert_equal(diag.getRaw(), b"\x07\x01" + b"\x00" * 62)
+    nose.tools.assert_equal(bytes(diag.payload), diag.data)
+    diag.data = b"\x01"
+    nose.tools.assert_equal(diag.getRaw(), b"\x07\x01\x01")
+
+
+def test_command_header():
+    cmd = hci.parse_hci_packet(bytes.fromhex("014dfc059430200004"))
+    nose.tools.assert_is_none(cmd._raw)  # commands are decoded right away, like events
+    nose.tools.assert_equal((cmd.uart_type, cmd.event_code), (hci.HCI.HCI_CMD, None))
+    nose.tools.assert_equal((cmd.opcode, cmd.length, cmd.data), (0xFC4D, 5, bytes.fromhex("9430200004")))
+
+
+def test_lazy_decoding():
+    acl = hci.parse_hci_packet(bytearray.fromhex("020b2004000102030405"))
+    nose.tools.assert_is_instance(acl, hci.HCI_Acl)
+    nose.tools.assert_equal(acl.uart_type, hci.HCI.ACL_DATA)
+    nose.tools.assert_is_not_none(acl._raw)  # not decoded for routing
+
+    nose.tools.assert_equal((acl.handle, acl.bp, acl.bc, acl.length), (0x00B, 2, 0, 4))
+    nose.tools.assert_is_none(acl._raw)
+    nose.tools.assert_equal(acl.data, bytearray.fromhex("0102030405"))
+    nose.tools.assert_raises(AttributeError, getattr, acl, "foo")
+
+    # other threads must see either the fields or _raw while the packet is decoded
+    class CheckedAcl(hci.HCI_Acl):
+        __slots__ = ()
+
+        def _decode(self, raw):
+            nose.tools.assert_is(self._raw, raw)
+            hci.HCI_Acl._decode(self, raw)
+            nose.tools.assert_is(self._raw, raw)
+
+    acl = CheckedAcl._parse(bytearray.fromhex("020b2004000102030405"))
+    nose.tools.assert_equal(acl.handle, 0x00B)
+    nose.tools.assert_is_none(acl._raw)
+
+    diag = hci.parse_hci_packet(bytes.fromhex("0781" + "00" * 62))
+    nose.tools.assert_is_none(diag.event_code)
+    nose.tools.assert_equal((diag.opcode, diag.length), (0x81, 63))
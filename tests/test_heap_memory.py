@@ -0,0 +1,136 @@
+from __future__ import print_function
+import os
+import struct
+
+from internalblue.fw.fw_0x420e import CYW20739B1
+from internalblue.fw.fw_0x6109 import BCM4335C0
+from internalblue.heap_monitor import HeapMonitor, HeapSnapshot, PoolSnapshot
+from internalblue.utils.packing import p32
+
+from memory_core import MemoryCore, MemoryFirmware
+from trace_memory import cli_output, read_ram_records, trace_memory_core, tracedir
+
+import nose
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+class HeapFirmware(MemoryFirmware):
+    BLOC_HEAD = 0x4000
+    BLOC_NG = True
+
+
+def _heap_core():
+    core = MemoryCore(fw=HeapFirmware)
+    core.memory[0x4000:0x4004] = p32(0x4100)
+    # Two pools with 3 buffers of 8 bytes and 2 buffers of 16 bytes
+    core.memory[0x4100:0x4112] = struct.pack("IHBBIIBB", 0x4200, 8, 3, 0, 0x5000, 0x500C, 1, 0)
+    core.memory[0x4200:0x4212] = struct.pack("IHBBIIBB", 0x4100, 16, 2, 0, 0x6000, 0, 0, 0)
+    core.memory[0x5000:0x5004] = p32(0x4100)  # used
+    core.memory[0x5004:0x500C] = b"ABCDEFGH"
+    core.memory[0x500C:0x5010] = p32(0)  # free, list head
+    core.memory[0x5018:0x501C] = p32(0x4100)  # used
+    core.memory[0x6000:0x6004] = p32(0x4200)
+    core.memory[0x6014:0x6018] = p32(0x4200)
+    return core
+
+
+def test_header_reads():
+    core = _heap_core()
+    heap = core.readHeapInformation()
+    nose.tools.assert_equal(len(heap), 2)
+    nose.tools.assert_equal(heap[0]["buffer_headers"], {0x5000: 0x4100, 0x500C: 0, 0x5018: 0x4100})
+    nose.tools.assert_equal(heap[1]["buffer_headers"], {0x6000: 0x4200, 0x6014: 0x4200})
+    nose.tools.assert_not_in("memory_dump", heap[0])
+    # Head pointer, two BLOC structs and the headers of both pools up to the last one
+    nose.tools.assert_equal(core.reads, [(0x4000, 4), (0x4100, 0x30), (0x5000, 28), (0x4200, 0x30), (0x6000, 24)])
+
+
+def test_large_buffer_headers():
+    core = _heap_core()
+    core.memory[0x4200:0x4212] = struct.pack("IHBBIIBB", 0x4100, 0x100, 2, 0, 0x6000, 0, 0, 0)
+    core.memory[0x6104:0x6108] = p32(0x4200)
+    heap = core.readHeapInformation()
+    nose.tools.assert_equal(heap[1]["buffer_headers"], {0x6000: 0x4200, 0x6104: 0x4200})
+    # One read per header, the buffer contents in between are skipped
+    nose.tools.assert_equal(core.reads[-2:], [(0x6000, 4), (0x6104, 4)])
+
+
+def test_include_memory():
+    core = _heap_core()
+    heap = core.readHeapInformation(include_memory=True)
+    nose.tools.assert_equal(heap[0]["memory_dump"][4:12], b"ABCDEFGH")
+    nose.tools.assert_equal(len(heap[1]["memory_dump"]), 40)
+    nose.tools.assert_equal(core.reads[2], (0x5000, 36))
+
+
+# Traces recorded with one Read_RAM command per buffer header, they no longer replay as is
+HEAP_TRACES = [
+    ("adbcore", "info_heap.trace.broken", BCM4335C0),
+    ("adbcore", "info_heap_verbose.trace.broken", BCM4335C0),
+    ("hcicore", "info_heap_cyw20719.trace.broken", CYW20739B1),
+    ("hcicore", "info_heap_cyw20719_verbose.trace.broken", CYW20739B1),
+]
+
+
+def test_recorded_heap_traces():
+    for core_name, tracefile, fw in HEAP_TRACES:
+        tracepath = os.path.join(tracedir, core_name, tracefile)
+        records = read_ram_records(tracepath)
+        blocs = [address for address, data in records if len(data) == 0x30]
+        headers = {address: struct.unpack("<I", data)[0] for address, data in records
+                   if len(data) == 4 and address != fw.BLOC_HEAD}
+
+        core = trace_memory_core(tracepath, fw)
+        heap = core.readHeapInformation()
+        nose.tools.assert_equal([bloc["address"] for bloc in heap], blocs)
+        read_headers = {}
+        for bloc in heap:
+            read_headers.update(bloc["buffer_headers"])
+        nose.tools.assert_equal(read_headers, headers)
+
+        # The CLI prints the same buffer table as during the recording
+        messages = cli_output(core, "info heap verbose")
+        for address, hdr in headers.items():
+            nose.tools.assert_true(any(m.startswith("            0x%06x : 0x%06x" % (address, hdr))
+                                       for m in messages))
+
+
+def test_heap_monitor():
+    core = _heap_core()
+    monitor = HeapMonitor(core, history=3)
+    first = monitor.snapshot()
+    # Only the BLOC structs and the buffer headers are read
+    nose.tools.assert_equal(core.reads, [(0x4000, 4), (0x4100, 0x30), (0x5000, 28), (0x4200, 0x30), (0x6000, 24)])
+    pool = first.pools[0x4100]
+    nose.tools.assert_equal(pool.states, bytes([PoolSnapshot.USED, PoolSnapshot.FREE, PoolSnapshot.USED]))
+    nose.tools.assert_equal(pool.used, 2)
+
+    # Allocate the last free buffer of the first pool
+    core.memory[0x500C:0x5010] = p32(0x4100)
+    core.memory[0x4110] = 0
+    monitor.snapshot()
+    nose.tools.assert_equal(monitor.deltas(), {0x4100: 1, 0x4200: 0})
+    nose.tools.assert_equal(monitor.persistent_buffers(2), [(0x4100, 0x5000), (0x4100, 0x5018),
+                                                            (0x4200, 0x6000), (0x4200, 0x6014)])
+    nose.tools.assert_equal(monitor.persistent_buffers(3), [])
+
+    monitor.snapshot()
+    nose.tools.assert_equal(len(monitor.snapshots), 3)
+    monitor.snapshot()
+    nose.tools.assert_equal(len(monitor.snapshots), 3)
+
+
+def test_heap_monitor_trends():
+    monitor = HeapMonitor(None)
+    for timestamp, free in [(0.0, 10), (10.0, 8), (20.0, 6)]:
+        pool = PoolSnapshot(0x4100, 16, free, 0x5000, 12, bytes(16))
+        monitor.snapshots.append(HeapSnapshot(timestamp, {0x4100: pool}))
+    slope, exhaustion = monitor.trends()[0x4100]
+    nose.tools.assert_almost_equal(slope, 0.2)
+    nose.tools.assert_almost_equal(exhaustion, 30.0)
+    nose.tools.assert_equal(list(monitor.exhausting(60.0)), [0x4100])
+    nose.tools.assert_equal(monitor.exhausting(10.0), {})
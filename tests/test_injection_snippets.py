@@ -0,0 +1,135 @@
+from __future__ import print_function
+import re
+
+import internalblue.core
+from internalblue.utils.packing import p32
+
+from memory_core import MemoryCore, MemoryFirmware
+
+import nose
+
+
+class LmpFirmware(MemoryFirmware):
+    CONNECTION_MAX = 11
+    SENDLMP_CODE_BASE_ADDRESS = 0x8000
+    SENDLMP_ASM_CODE = "ldr r0, =mailbox\n.ltorg\nmailbox:\n"
+    SENDLCP_CODE_BASE_ADDRESS = 0x9000
+    SENDLCP_ASM_CODE = "ldr r1, =mailbox\n.ltorg\nmailbox:\n"
+
+
+def fake_asm(code, vma=0, arch="thumb"):
+    """
+    Stands in for pwnlib's asm(): the 'ldr' becomes two bytes, the literal
+    pool holds the mailbox address and the .fill directive is honored.
+    Without .ltorg the literal pool follows the mailbox.
+    """
+    fake_asm.calls += 1
+    count, value = re.search(r"\.fill (\d+), 1, (0x[0-9a-f]+)", code).groups()
+    fill = bytes([int(value, 16)]) * int(count)
+    if ".ltorg" in code:
+        return b"\x01\x48" + p32(vma + 6) + fill
+    return b"\x01\x48" + fill + p32(vma + 2)
+
+
+def _with_fake_asm(func, *args):
+    original = internalblue.core.asm, internalblue.core._has_pwnlib
+    internalblue.core.asm, internalblue.core._has_pwnlib = fake_asm, True
+    try:
+        return func(*args)
+    finally:
+        internalblue.core.asm, internalblue.core._has_pwnlib = original
+
+
+def send(core, conn_nr, payload):
+    return _with_fake_asm(core.sendLmpPacketLegacy, conn_nr, 0x01, payload)
+
+
+def test_snippet_is_assembled_once():
+    fake_asm.calls = 0
+    core = MemoryCore(fw=LmpFirmware)
+
+    nose.tools.assert_true(send(core, 1, b"\x11\x22"))
+    nose.tools.assert_equal(core.writes, [(0x8000, 30)])
+    # Code, literal pool, then the mailbox with the connection number and the LMP packet
+    nose.tools.assert_equal(bytes(core.memory[0x8000:0x801E]),
+                            b"\x01\x48\x06\x80\x00\x00" + p32(1) + b"\x02\x11\x22" + b"\x00" * 17)
+    nose.tools.assert_equal(core.launches, [0x8000])
+    nose.tools.assert_equal(fake_asm.calls, 2)
+
+    # Same connection: only the changed payload bytes are written
+    nose.tools.assert_true(send(core, 1, b"\x33\x22"))
+    nose.tools.assert_equal(core.writes[1:], [(0x800B, 1)])
+    nose.tools.assert_equal(core.memory[0x800B], 0x33)
+
+    # Identical packet: nothing to write
+    nose.tools.assert_true(send(core, 1, b"\x33\x22"))
+    nose.tools.assert_equal(len(core.writes), 2)
+    nose.tools.assert_equal(core.launches, [0x8000] * 3)
+
+    # Another connection only changes the mailbox, the snippet is not assembled again
+    nose.tools.assert_true(send(core, 2, b"\x33\x22"))
+    nose.tools.assert_equal(core.writes[2:], [(0x8006, 1)])
+    nose.tools.assert_equal(core.memory[0x8006], 2)
+    nose.tools.assert_equal(fake_asm.calls, 2)
+
+
+def test_lcp_lengths():
+    fake_asm.calls = 0
+    core = MemoryCore(fw=LmpFirmware)
+    nose.tools.assert_true(_with_fake_asm(core.sendLcpPacket, 0, b"\x01\x02\x03"))
+    nose.tools.assert_equal(core.writes, [(0x9000, 17)])
+    nose.tools.assert_equal(bytes(core.memory[0x9006:0x9011]), p32(0) + p32(3) + b"\x01\x02\x03")
+
+    # Shorter packet: only the length changes, the end of the old packet stays behind it
+    nose.tools.assert_true(_with_fake_asm(core.sendLcpPacket, 0, b"\x01"))
+    nose.tools.assert_equal(core.writes[1:], [(0x900A, 1)])
+
+    # Longer packet: written from the first difference to its end
+    nose.tools.assert_true(_with_fake_asm(core.sendLcpPacket, 0, b"\x01\x02\x04\x05"))
+    nose.tools.assert_equal(core.writes[2:], [(0x900A, 8)])
+    nose.tools.assert_equal(bytes(core.memory[0x900E:0x9012]), b"\x01\x02\x04\x05")
+    nose.tools.assert_equal(fake_asm.calls, 2)
+
+
+def test_literal_pool_behind_mailbox():
+    class PoolFirmware(LmpFirmware):
+        SENDLMP_ASM_CODE = "ldr r0, =mailbox\nmailbox:\n"
+
+    core = MemoryCore(fw=PoolFirmware)
+    nose.tools.assert_false(send(core, 1, b"\x11"))
+    nose.tools.assert_equal(core.writes, [])
+
+
+def test_failed_write_rewrites_snippet():
+    core = MemoryCore(fw=LmpFirmware)
+    nose.tools.assert_true(send(core, 1, b"\x11"))
+
+    core.failing_writes = [(0x8000, 0x8100)]
+    nose.tools.assert_false(send(core, 1, b"\x22"))
+    core.failing_writes = []
+
+    nose.tools.assert_true(send(core, 1, b"\x22"))
+    nose.tools.assert_equal(core.writes[-1], (0x8000, 30))
+    nose.tools.assert_equal(core.launches, [0x8000, 0x8000])
+
+
+def test_connection_number_bounds():
+    core = MemoryCore(fw=LmpFirmware)
+    nose.tools.assert_false(send(core, 12, b"\x11"))
+    nose.tools.assert_equal(core.writes, [])
+
+
+def test_overlapping_write_invalidates_snippet():
+    core = MemoryCore(fw=LmpFirmware)
+    nose.tools.assert_true(send(core, 1, b"\x11"))
+
+    # Something else (e.g. the fuzzLmp() hook) is written over the snippet
+    nose.tools.assert_true(core.writeMem(0x8010, b"\xaa\xbb"))
+    nose.tools.assert_true(send(core, 1, b"\x11"))
+    nose.tools.assert_equal(core.writes[-1], (0x8000, 30))
+    nose.tools.assert_equal(bytes(core.memory[0x8010:0x8012]), b"\x00\x00")
+
+    # Writes next to the snippet keep it
+    nose.tools.assert_true(core.writeMem(0x801E, b"\xcc"))
+    nose.tools.assert_true(send(core, 1, b"\x22"))
+    nose.tools.assert_equal(core.writes[-1], (0x800B, 1))
@@ -0,0 +1,94 @@
+from __future__ import print_function
+import json
+import os
+import tempfile
+
+from internalblue.hci import HCI_COMND, HCI_Event
+from internalblue.inquiry import InquirySweep, InquiryTable, major_device_class, parse_eir
+from internalblue.utils.packing import p8, p16
+
+from memory_core import MemoryCore
+
+import nose
+
+
+ADDRESS = bytes.fromhex("112233445566")
+PHONE_CLASS = 0x5A020C
+EIR = b"\x05\x09Test\x03\x03\x0d\x18" + b"\x00" * 10
+
+
+def rssi_result(address, device_class, rssi):
+    return (b"\x01" + address[::-1] + b"\x01\x00" + p8(device_class & 0xFF) + p8((device_class >> 8) & 0xFF)
+            + p8(device_class >> 16) + p16(0x1234) + p8(rssi & 0xFF))
+
+
+class InquiryCore(MemoryCore):
+    """ Answers each Inquiry with one Extended Inquiry Result and Inquiry Complete. """
+
+    def __init__(self, **kwargs):
+        super(InquiryCore, self).__init__(**kwargs)
+        self.inquiries = 0
+        self.inquiry_modes = []
+
+    def _event(self, code, data):
+        for callback in list(self.registeredHciCallbacks):
+            callback((HCI_Event(code, len(data), data), 0, 0, 0, 0, None))
+
+    def sendHciCommand(self, hci_opcode, data, timeout=3):
+        if hci_opcode == HCI_COMND.Write_Inquiry_Mode:
+            self.inquiry_modes.append(data[0])
+            return p8(1) + p16(hci_opcode.value) + p8(0)
+        if hci_opcode == HCI_COMND.Inquiry:
+            self.inquiries += 1
+            self._event(0x2F, rssi_result(ADDRESS, PHONE_CLASS, -50 - self.inquiries) + EIR)
+            self._event(0x01, b"\x00")
+            return p8(0) + p8(1) + p16(hci_opcode.value)
+        return None
+
+
+def test_parse_eir():
+    nose.tools.assert_equal(parse_eir(EIR), {0x09: b"Test", 0x03: b"\x0d\x18"})
+    nose.tools.assert_equal(parse_eir(b"\x05\x09Te"), {})  # truncated
+    nose.tools.assert_equal(major_device_class(PHONE_CLASS), "Phone")
+
+
+def test_table_and_export():
+    table = InquiryTable(history=2)
+    nose.tools.assert_true(table.update(ADDRESS, 1, PHONE_CLASS, 0x1234, -60, EIR, 10.0))
+    nose.tools.assert_false(table.update(ADDRESS, 1, 0x240404, 0x1234, -55, None, 11.0))
+    table.update(ADDRESS, 1, 0x240404, 0x1234, -50, None, 12.0)
+    table.update(bytes.fromhex("aabbccddeeff"), 1, PHONE_CLASS, 0, None, None, 13.0)
+
+    device = table.get(ADDRESS)
+    nose.tools.assert_equal((device["responses"], device["rssi"], device["name"]), (3, [-55, -50], "Test"))
+    nose.tools.assert_equal((device["first_seen"], device["last_seen"]), (10.0, 12.0))
+    nose.tools.assert_equal([d["address"] for d in table.snapshot(major_class=0x04)], ["11:22:33:44:55:66"])
+    nose.tools.assert_equal([d["address"] for d in table.snapshot(major_class=0x02)], ["aa:bb:cc:dd:ee:ff"])
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        table.write_json(filename)
+        with open(filename) as f:
+            nose.tools.assert_equal(len(json.load(f)["devices"]), 2)
+        table.write_csv(filename)
+        with open(filename) as f:
+            nose.tools.assert_equal(len(f.readlines()), 3)
+    finally:
+        os.remove(filename)
+
+
+def test_sweep():
+    core = InquiryCore()
+    sweep = InquirySweep(core, interval=0)
+    new_devices = []
+    sweep.subscribers.append(new_devices.append)
+    nose.tools.assert_true(sweep.start(sweeps=3))
+    nose.tools.assert_true(sweep.wait(timeout=5))
+
+    nose.tools.assert_equal((core.inquiry_modes, core.inquiries), ([2], 3))
+    nose.tools.assert_equal((sweep.sweeps, sweep.responses, sweep.dropped), (3, 3, 0))
+    nose.tools.assert_not_in(sweep.hciCallback, core.registeredHciCallbacks)
+    nose.tools.assert_equal(len(new_devices), 1)
+    device = sweep.table.get(ADDRESS)
+    nose.tools.assert_equal((device["rssi"], device["name"], device["device_class"]), ([-51, -52, -53], "Test", PHONE_CLASS))
@@ -0,0 +1,119 @@
+from __future__ import print_function
+import threading
+import time
+
+from internalblue.hci import HCI_Event
+from internalblue.le_scanner import DeviceTable, LeScanner
+from internalblue.utils.packing import p8
+
+from memory_core import MemoryCore
+
+import nose
+
+
+def report(address, data, rssi, event_type=0x00):
+    """ One report of an LE Advertising Report event, address big endian. """
+    return p8(event_type) + b"\x00" + address[::-1] + p8(len(data)) + data + p8(rssi & 0xFF)
+
+
+def adv_event(*reports):
+    return b"\x02" + p8(len(reports)) + b"".join(reports)
+
+
+ADDRESS_A = bytes.fromhex("112233445566")
+ADDRESS_B = bytes.fromhex("aabbccddeeff")
+
+
+def test_aggregation_and_dedup():
+    scanner = LeScanner()
+    seen = []
+    scanner.subscribers.append(lambda address, event_type, data, rssi: seen.append((address, rssi)))
+
+    # Enhanced event types: channel 38 and 39
+    nose.tools.assert_equal(scanner.feed(adv_event(report(ADDRESS_A, b"\x02\x01\x06", -60, 0x10),
+                                                   report(ADDRESS_B, b"", -80)), 100.0), 2)
+    scanner.feed(adv_event(report(ADDRESS_A, b"\x02\x01\x06", -50, 0x20)), 101.0)
+    scanner.feed(adv_event(report(ADDRESS_A, b"\x03\x09AB", -70, 0x04)), 102.0)  # SCAN_RSP
+
+    nose.tools.assert_equal((scanner.events, scanner.reports, scanner.duplicates), (3, 4, 1))
+    nose.tools.assert_equal(seen, [(ADDRESS_A, -60), (ADDRESS_B, -80), (ADDRESS_A, -70)])
+
+    device = scanner.table.device(ADDRESS_A)
+    nose.tools.assert_equal((device["reports"], device["duplicates"]), (3, 1))
+    nose.tools.assert_equal((device["rssi_min"], device["rssi_max"], device["rssi_last"]), (-70, -50, -70))
+    nose.tools.assert_almost_equal(device["rssi_mean"], -60.0)
+    nose.tools.assert_equal((device["channel_37"], device["channel_38"], device["channel_39"]), (1, 1, 1))
+    nose.tools.assert_equal((device["first_seen"], device["last_seen"]), (100.0, 102.0))
+    nose.tools.assert_equal(device["data"], {0: b"\x02\x01\x06", 4: b"\x03\x09AB"})
+    nose.tools.assert_equal([d["address"] for d in scanner.table.devices()], [ADDRESS_A, ADDRESS_B])
+    nose.tools.assert_is_none(scanner.table.device(b"\x00" * 6))
+
+
+def test_callback_queues_and_worker_processes():
+    core = MemoryCore()
+    scanner = LeScanner(core, backlog=2)
+    nose.tools.assert_true(scanner.start(enable_scan=False))
+    nose.tools.assert_in(scanner.hciCallback, core.registeredHciCallbacks)
+    event = adv_event(report(ADDRESS_A, b"", -40))
+    scanner.hciCallback((HCI_Event(0x3E, len(event), event), 0, 0, 0, 0, None))
+    scanner.hciCallback((HCI_Event(0x0E, 4, b"\x01\x00\x00\x00"), 0, 0, 0, 0, None))
+    scanner.stop(disable_scan=False)
+    nose.tools.assert_not_in(scanner.hciCallback, core.registeredHciCallbacks)
+    nose.tools.assert_equal((scanner.events, len(scanner.table)), (1, 1))
+
+    # The queue is bounded
+    for _ in range(3):
+        scanner.hciCallback((HCI_Event(0x3E, len(event), event), 0, 0, 0, 0, None))
+    nose.tools.assert_equal((len(scanner.pending), scanner.dropped), (2, 1))
+    nose.tools.assert_equal(scanner.process(), 2)
+
+
+def test_throughput():
+    # Dense environments: thousands of reports per second
+    scanner = LeScanner(table=DeviceTable())
+    events = [adv_event(*[report(bytes([i, j, 0, 0, 0, 1]), b"\x02\x01\x06\x03\xff\x4c\x00", -50 - j)
+                          for j in range(4)]) for i in range(250)]
+    start = time.time()
+    for _ in range(10):
+        for event in events:
+            scanner.feed(event)
+    nose.tools.assert_true(time.time() - start < 2.0)
+    nose.tools.assert_equal((scanner.reports, len(scanner.table)), (10000, 1000))
+    nose.tools.assert_true(scanner.rate() > 0)
+
+
+def test_clear_while_scanning():
+    # The worker updates the table while the CLI reads and clears it
+    table = DeviceTable()
+    events = [adv_event(*[report(bytes([i, j, 0, 0, 0, 1]), b"", -50) for j in range(4)]) for i in range(250)]
+    scanner = LeScanner(table=table)
+
+    def worker():
+        for _ in range(5):
+            for event in events:
+                scanner.feed(event)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    while thread.is_alive():
+        for device in table.devices():
+            nose.tools.assert_equal(device["rssi_last"], -50)
+        table.clear()
+    thread.join()
+    nose.tools.assert_equal(len(table.devices()), len(table))
+
+
+def test_to_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise nose.SkipTest("numpy is not installed")
+    table = DeviceTable()
+    table.update(ADDRESS_A, 0, 0x10, b"", -60, 100.0)
+    columns = table.to_numpy()
+    nose.tools.assert_equal(list(columns["rssi_last"]), [-60])
+    nose.tools.assert_equal(list(columns["address"]), [ADDRESS_A.hex()])
+    # the table keeps growing after an export
+    table.update(ADDRESS_B, 0, 0x00, b"", -80, 101.0)
+    nose.tools.assert_equal(len(table), 2)
+    nose.tools.assert_equal(list(columns["rssi_last"]), [-60])
@@ -0,0 +1,117 @@
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+
+from internalblue import hci
+from internalblue.hci import HCI_COMND, HCI_Event
+from internalblue.lmp_fuzzer import LmpCorpus, LmpCrash, LmpFuzzer, LmpMutator, LmpTestCase
+from internalblue.utils.packing import p8, p16
+
+from memory_core import MemoryCore
+
+import nose
+
+
+class LmpCore(MemoryCore):
+    """
+    Answers each VSC_SendLmpPdu command sent with sendH4 with a Command
+    Complete event (status 0 for opcodes below 0x40). The chip crashes after
+    <crash_after> packets: with a stack dump if <crash_pc> is set, otherwise
+    it stops responding.
+    """
+
+    def __init__(self, crash_after=None, crash_pc=None, **kwargs):
+        super(LmpCore, self).__init__(**kwargs)
+        self.stackDumpReceiver = hci.StackDumpReceiver()
+        self.crash_after = crash_after
+        self.crash_pc = crash_pc
+        self.commands = []
+
+    def sendH4(self, h4type, data, timeout=2):
+        self.commands.append(data)
+        if self.crash_after is not None and len(self.commands) > self.crash_after:
+            if self.crash_pc is not None:
+                self.stackDumpReceiver.registers = {"pc": self.crash_pc, "lr": 0, "sp": 0}
+            return True
+        first = data[6]
+        opcode = data[7] if first >> 1 == 0x7F else first >> 1
+        status = 0 if opcode < 0x40 else 0x12
+        event = HCI_Event(0x0E, 4, p8(1) + p16(HCI_COMND.VSC_SendLmpPdu.value) + p8(status))
+        for callback in list(self.registeredHciCallbacks):
+            callback((event, 0, 0, 0, 0, None))
+        return True
+
+
+def test_test_case_pdu():
+    case = LmpTestCase(0x33, False, b"\x01\x02")
+    nose.tools.assert_equal(case.pdu(), b"\x66\x01\x02")
+    nose.tools.assert_equal(LmpTestCase.from_pdu(case.pdu()), case)
+    extended = LmpTestCase(0x0B, True, b"\xff")
+    nose.tools.assert_equal(extended.pdu(), b"\xfe\x0b\xff")
+    nose.tools.assert_equal(LmpTestCase.from_pdu(extended.pdu()), extended)
+
+
+def test_mutator_respects_limits():
+    mutator = LmpMutator(seed=1, max_length=10)
+    corpus = [LmpTestCase(0x01, False, b"\x00" * 9), LmpTestCase(0x05, True, b"\x11" * 8)]
+    for _ in range(500):
+        case = mutator.generate(corpus)
+        nose.tools.assert_true(len(case.pdu()) <= 10)
+        if case.extended_op:
+            nose.tools.assert_true(0 <= case.opcode <= 0xFF)
+        else:
+            nose.tools.assert_true(1 <= case.opcode <= 0x7E)
+
+    # Same seed, same cases
+    first = [LmpMutator(seed=7).generate(corpus) for _ in range(20)]
+    nose.tools.assert_equal(first, [LmpMutator(seed=7).generate(corpus) for _ in range(20)])
+
+
+def test_fuzzer_pipelines_and_grows_corpus():
+    core = LmpCore()
+    fuzzer = LmpFuzzer(core, conn_handle=0x0B, mutator=LmpMutator(seed=3), window=4, timeout=0.5)
+    nose.tools.assert_is_none(fuzzer.run(count=200))
+
+    nose.tools.assert_equal(fuzzer.sent, 200)
+    nose.tools.assert_equal(fuzzer.accepted + fuzzer.rejected, 200)
+    nose.tools.assert_equal(len(core.commands), 200)
+    nose.tools.assert_equal(core.commands[0][0:3], p16(HCI_COMND.VSC_SendLmpPdu.value) + p8(20))
+    nose.tools.assert_equal(core.commands[0][3:5], p16(0x0B))
+    nose.tools.assert_true(fuzzer.corpus.cases)
+    nose.tools.assert_true(all(case.opcode < 0x40 for case in fuzzer.corpus.cases))
+    nose.tools.assert_not_in(fuzzer.hciCallback, core.registeredHciCallbacks)
+    nose.tools.assert_true(fuzzer.rate() > 0)
+
+
+def test_fuzzer_detects_stack_dump():
+    directory = tempfile.mkdtemp()
+    try:
+        core = LmpCore(crash_after=10, crash_pc=0x41234)
+        fuzzer = LmpFuzzer(core, corpus=LmpCorpus(directory), window=2, timeout=0.5)
+        crash = fuzzer.run(count=100)
+        nose.tools.assert_equal((crash.kind, crash.pc, crash.new), ("stackdump", 0x41234, True))
+        nose.tools.assert_equal(crash.cases[-1], LmpTestCase.from_pdu(core.commands[10][6:6 + core.commands[10][5]]))
+        crash_directory = os.path.join(directory, "crashes", "pc_00041234")
+        nose.tools.assert_true(os.path.exists(os.path.join(crash_directory, "registers.txt")))
+
+        # A second crash at the same pc is not stored again
+        nose.tools.assert_false(fuzzer.corpus.add_crash(LmpCrash("stackdump", [], {"pc": 0x41234})))
+
+        # Corpus and crashes are loaded again
+        corpus = LmpCorpus(directory)
+        nose.tools.assert_equal(sorted(c.digest() for c in corpus.cases),
+                                sorted(c.digest() for c in fuzzer.corpus.cases))
+        nose.tools.assert_in("pc_00041234", corpus.crashes)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_fuzzer_detects_timeout():
+    core = LmpCore(crash_after=5)
+    fuzzer = LmpFuzzer(core, window=3, timeout=0.05)
+    crash = fuzzer.run(count=100)
+    nose.tools.assert_equal((crash.kind, crash.pc), ("timeout", None))
+    # The window was full: three commands without response
+    nose.tools.assert_equal(fuzzer.sent, 8)
+    nose.tools.assert_equal(len(crash.cases), 8)
@@ -0,0 +1,52 @@
+from __future__ import print_function
+import struct
+
+from internalblue.hci import HCI_Event
+from internalblue.utils.memory_pool_statistics import MemoryPoolStatistics, PoolSeries
+
+from memory_core import MemoryCore
+
+import nose
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+def _statistics_event(time, pools):
+    data = b"\x1b\x08" + bytes([len(pools)]) + struct.pack("<HIIII", 1, 0x200000, 0x210000, time, 0)
+    for name, allocated, free, low in pools:
+        data += struct.pack("<III6H", 0x220000, 0x220010, struct.unpack("<I", name)[0], 0x40,
+                            allocated + free, low, allocated, free, 0)
+    return HCI_Event(0xFF, len(data), data)
+
+
+def test_callback_records_time_series():
+    core = MemoryCore()
+    core.memory_pool_statistics.add_alert("RFCM", "free", "lt", 2)
+    for second, free in enumerate([4, 1, 0, 3, 1]):
+        core.readMemoryPoolStatisticsCallback([_statistics_event(second, [(b"RFCM", 8 - free, free, 0),
+                                                                          (b"ACLB", 1, 7, 5)])])
+    statistics = core.memory_pool_statistics
+    nose.tools.assert_equal(sorted(statistics.pools), ["ACLB", "RFCM"])
+    nose.tools.assert_equal([free for _, free in statistics.query("RFCM", "free")], [4, 1, 0, 3, 1])
+    nose.tools.assert_equal(statistics.pools["RFCM"].column("chip_time"), [0, 1, 2, 3, 4])
+    # Fires when free drops below 2, again after it recovered
+    nose.tools.assert_equal([sample["free"] for _, _, _, sample in statistics.fired], [1, 1])
+
+
+def test_ring_buffer():
+    series = PoolSeries("RFCM", 3)
+    for i in range(5):
+        series.append(float(i), i, i, 10 - i, 0)
+    nose.tools.assert_equal(len(series), 3)
+    nose.tools.assert_equal(series.column("allocated"), [2, 3, 4])
+    nose.tools.assert_equal(series.latest()["free"], 6)
+    nose.tools.assert_equal([s["timestamp"] for s in series.samples(since=3.0)], [3.0, 4.0])
+
+
+def test_invalid_alert():
+    statistics = MemoryPoolStatistics()
+    nose.tools.assert_raises(ValueError, statistics.add_alert, None, "size", "<", 1)
+    nose.tools.assert_raises(ValueError, statistics.add_alert, None, "free", "~", 1)
@@ -0,0 +1,63 @@
+from __future__ import print_function
+from internalblue.utils.packing import (p8, u8, p16, u16, p32, u32, bits, unbits, bits_str,
+                                        unpack_u32_array, pack_u32_array, unpack_u16_array)
+from internalblue import hci
+
+import nose
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+def test_pack_unpack():
+    nose.tools.assert_equal(p8(0xab), b'\xab')
+    nose.tools.assert_equal(p16(0x1234, 'big'), b'\x12\x34')
+    nose.tools.assert_equal(p16(0x1234, 'little'), b'\x34\x12')
+    nose.tools.assert_equal(p32(0x12345678, 'BIG'), b'\x12\x34\x56\x78')
+    nose.tools.assert_equal(u8(b'\xab'), 0xab)
+    nose.tools.assert_equal(u16(b'\x12\x34', 'big'), 0x1234)
+    nose.tools.assert_equal(u32(b'\x78\x56\x34\x12', 'little'), 0x12345678)
+
+
+def test_bits():
+    nose.tools.assert_equal(bits(b'\x01\x80'), [0, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0])
+    nose.tools.assert_equal(bits(b'\x01\x80', 'little'), [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1])
+    nose.tools.assert_equal(bits_str(b'\x01\xff'), '0000000111111111')
+    nose.tools.assert_equal(bits_str(b'bits_str', endian='little'),
+                            '0100011010010110001011101100111011111010110011100010111001001110')
+    nose.tools.assert_equal(bits(b''), [])
+    nose.tools.assert_equal(bits_str(b''), '')
+    nose.tools.assert_raises(ValueError, bits, 511)
+    nose.tools.assert_raises_regex(ValueError, r"^bits_str\(\)", bits_str, 511)
+    nose.tools.assert_raises_regex(ValueError, r"^bits_str\(\)", bits_str, b'', 'middle')
+
+
+def test_unbits():
+    nose.tools.assert_equal(unbits([0, 0, 0, 0, 0, 0, 0, 1, True, False]), b'\x01\x80')
+    nose.tools.assert_equal(unbits('1', 'little'), b'\x01')
+    nose.tools.assert_equal(unbits('0000000111111111'), b'\x01\xff')
+    nose.tools.assert_equal(unbits(bits_str(b'bits_str', 'little'), 'little'), b'bits_str')
+    nose.tools.assert_equal(unbits([]), b'')
+    nose.tools.assert_raises(ValueError, unbits, [0, 2])
+    nose.tools.assert_raises(ValueError, unbits, '012')
+
+
+def test_u32_arrays():
+    data = bytes(range(16))
+    nose.tools.assert_equal(unpack_u32_array(data), [0x03020100, 0x07060504, 0x0b0a0908, 0x0f0e0d0c])
+    nose.tools.assert_equal(unpack_u32_array(data, offset=4, count=2), [0x07060504, 0x0b0a0908])
+    nose.tools.assert_equal(unpack_u32_array(data, stride=8), [0x03020100, 0x0b0a0908])
+    nose.tools.assert_equal(pack_u32_array([0x03020100, 0x07060504]), data[:8])
+    nose.tools.assert_equal(unpack_u16_array(data[:4]), [0x0100, 0x0302])
+
+
+def test_acl_sco_header():
+    acl = hci.HCI.from_data(bytes.fromhex('020b2004000102030405'))
+    nose.tools.assert_equal((acl.handle, acl.bp, acl.bc, acl.length), (0x00b, 2, 0, 4))
+    nose.tools.assert_equal(acl.getRaw(), bytes.fromhex('020b2004000102030405'))
+
+    sco = hci.HCI.from_data(bytes.fromhex('03423103aabbcc'))
+    nose.tools.assert_equal((sco.handle, sco.ps, sco.length), (0x142, 3, 3))
+    nose.tools.assert_equal(sco.getRaw(), bytes.fromhex('03423103aabbcc'))
@@ -0,0 +1,101 @@
+from __future__ import print_function
+from internalblue.objects.patch_manifest import PatchManifest, RamBlobs
+
+import os
+import tempfile
+import nose
+
+from memory_core import MemoryCore, MemoryFirmware
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+def test_coalesced_ram_blobs():
+    manifest = PatchManifest()
+    manifest.add_ram(0x100, b'\x00' * 8)
+    manifest.add_ram(0x200, b'\x22' * 4)
+    manifest.add_ram(0x104, b'\x11' * 8)  # overlaps the first blob
+    manifest.add_ram(0x10c, b'\x33' * 2)  # adjacent to the merged blob
+
+    nose.tools.assert_equal(manifest.coalesced_ram_blobs(), [
+        (0x100, b'\x00' * 4 + b'\x11' * 8 + b'\x33' * 2),
+        (0x200, b'\x22' * 4),
+    ])
+
+
+def test_ram_blobs_merge_on_add():
+    blobs = RamBlobs()
+    for i in range(1000):
+        blobs.add(0x1000 + i * 4, i.to_bytes(4, "little"))
+    nose.tools.assert_equal(len(blobs), 1)
+    nose.tools.assert_equal(list(blobs)[0][1][-4:], (999).to_bytes(4, "little"))
+
+    blobs.add(0x3000, b'\xaa' * 4)
+    blobs.add(0x0ff0, b'\xbb' * 4)
+    nose.tools.assert_equal([address for address, _ in blobs], [0x0ff0, 0x1000, 0x3000])
+    # bridges all three blobs, the new bytes win
+    blobs.add(0x0ff2, b'\xcc' * (0x3002 - 0x0ff2))
+    nose.tools.assert_equal(list(blobs), [(0x0ff0, b'\xbb' * 2 + b'\xcc' * (0x3002 - 0x0ff2) + b'\xaa' * 2)])
+
+
+def test_manifest_save_load():
+    manifest = PatchManifest("MemoryCore", 0x6109, [(0x4000, b'\x70\x47')], [(0x8000, b'\xaa\xbb\xcc\xdd')])
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        manifest.save(filename)
+        loaded = PatchManifest.load(filename)
+    finally:
+        os.remove(filename)
+
+    nose.tools.assert_equal(loaded.fw_name, "MemoryCore")
+    nose.tools.assert_equal(loaded.lmp_subversion, 0x6109)
+    nose.tools.assert_equal(loaded.ram_blobs, [(0x4000, b'\x70\x47')])
+    nose.tools.assert_equal(loaded.patches, [(0x8000, b'\xaa\xbb\xcc\xdd')])
+    nose.tools.assert_equal(loaded.digest(), manifest.digest())
+
+
+def test_manifest_reapply():
+    core = MemoryCore()
+    core.lmp_subversion = 0x6109
+    nose.tools.assert_true(core.writeMem(0x4000, b'\x01\x02\x03\x04', persistent=True))
+    nose.tools.assert_true(core.writeMem(0x4004, b'\x05\x06', persistent=True))
+    nose.tools.assert_true(core.writeMem(0x5000, b'\xff' * 16))  # scratch buffer, not recorded
+    nose.tools.assert_true(core.patchRom(0x8000, b'\xaa\xbb\xcc\xdd'))
+    nose.tools.assert_true(core.applyPatches([(0x8010, b'\x11\x22\x33\x44')]))
+
+    manifest = core.createPatchManifest()
+    nose.tools.assert_equal(manifest.coalesced_ram_blobs(), [(0x4000, b'\x01\x02\x03\x04\x05\x06')])
+    nose.tools.assert_equal(manifest.patches, [(0x8000, b'\xaa\xbb\xcc\xdd'), (0x8010, b'\x11\x22\x33\x44')])
+    nose.tools.assert_true(core.isPatchManifestApplied(manifest))
+
+    # Already applied: nothing is written
+    core.writes = []
+    nose.tools.assert_true(core.applyPatchManifest(manifest))
+    nose.tools.assert_equal(core.writes, [])
+
+    # Controller reset: RAM and patchram are gone
+    fresh = MemoryCore()
+    fresh.lmp_subversion = 0x6109
+    nose.tools.assert_false(fresh.isPatchManifestApplied(manifest))
+    nose.tools.assert_true(fresh.applyPatchManifest(manifest))
+    nose.tools.assert_true(fresh.isPatchManifestApplied(manifest))
+    nose.tools.assert_equal(bytes(fresh.memory[0x4000:0x4006]), b'\x01\x02\x03\x04\x05\x06')
+
+    # Wrong firmware
+    other = MemoryCore()
+    other.lmp_subversion = 0x4208
+    nose.tools.assert_false(other.applyPatchManifest(manifest))
+
+
+def test_hook_branches_are_not_recorded():
+    # The hook code behind the branch is scratch RAM, which a manifest does not restore
+    core = MemoryCore()
+    nose.tools.assert_true(core.patchRom(0x8000, b'\xaa\xbb\xcc\xdd'))
+    nose.tools.assert_true(core.patchRom(0x8010, b'\x11\x22\x33\x44', record=False))
+    nose.tools.assert_true(core.patchRom(0x8022, b'\x55\x66\x77\x88', record=False))  # two slots
+    nose.tools.assert_equal(core.createPatchManifest().patches, [(0x8000, b'\xaa\xbb\xcc\xdd')])
@@ -58,6 +58,6 @@ def test_info_queue():
     information = reference.readQueueInformation()
     print(information)
 
-    nose.tools.assert_equal([vars(element) for element in information], [vars(element) for element in dummy])
+    nose.tools.assert_equal([element.to_dict() for element in information], [element.to_dict() for element in dummy])
 
     reference.shutdown()
\ No newline at end of file
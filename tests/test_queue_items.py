@@ -0,0 +1,98 @@
+from __future__ import print_function
+import os
+import struct
+
+from internalblue.fw.fw import MemorySection
+from internalblue.fw.fw_0x6109 import BCM4335C0
+from internalblue.objects.queue_element import QueueElement
+from internalblue.utils.packing import p32
+
+from memory_core import MemoryCore, MemoryFirmware
+from trace_memory import cli_output, read_ram_records, trace_memory_core, tracedir
+
+import nose
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+class QueueFirmware(MemoryFirmware):
+    SECTIONS = [MemorySection(0x0, 0x10000, False, True)]
+    QUEUE_HEAD = 0x4000
+    QUEUE_NAMES = ["first", "second", "third"]
+
+
+def _queue(core, address, item_size, capacity, available, buf_start, next_item, next, prev):
+    buf_end = buf_start + item_size * capacity
+    next_free = buf_start + (next_item - buf_start + available * item_size) % (buf_end - buf_start)
+    core.memory[address:address + 0x38] = struct.pack(
+        "14I", struct.unpack("<I", b"UEUQ")[0], 0, item_size // 4, capacity, available, capacity - available,
+        buf_start, buf_end, next_item, next_free, 0, 0, next, prev)
+
+
+def _queue_core():
+    core = MemoryCore(fw=QueueFirmware)
+    core.memory[0x4000:0x4004] = p32(0x4100)
+    # Struct followed by its buffer, then the next struct
+    _queue(core, 0x4100, 4, 4, 0, 0x4138, 0x4138, 0x4148, 0x8000)
+    # A ring buffer which wraps around
+    _queue(core, 0x4148, 8, 4, 3, 0x4180, 0x4190, 0x8000, 0x4100)
+    core.memory[0x4180:0x41A0] = b"".join(bytes([i]) * 8 for i in range(4))
+    # Far away from the others
+    _queue(core, 0x8000, 4, 2, 1, 0x9000, 0x9004, 0x4100, 0x4148)
+    core.memory[0x9004:0x9008] = b"WXYZ"
+    return core
+
+
+def test_queue_items():
+    core = _queue_core()
+    queues = core.readQueueInformation(include_items=True)
+    nose.tools.assert_equal([queue.name for queue in queues], ["first", "second", "third"])
+    nose.tools.assert_equal(queues[0].items, [])
+    nose.tools.assert_equal(queues[1].items, [b"\x02" * 8, b"\x03" * 8, b"\x00" * 8])
+    nose.tools.assert_equal(queues[2].items, [b"WXYZ"])
+    # The first read covers both adjacent structs and the wrapped buffer
+    nose.tools.assert_equal(core.reads, [(0x4000, 4), (0x4100, 248), (0x8000, 248), (0x9000, 8)])
+
+
+def test_queue_corrupt_next_item():
+    core = _queue_core()
+    # next_item in front of the buffer
+    core.memory[0x8020:0x8024] = p32(0x8FF0)
+    queues = core.readQueueInformation(include_items=True)
+    nose.tools.assert_equal(queues[2].items, [])
+    nose.tools.assert_equal(queues[1].items, [b"\x02" * 8, b"\x03" * 8, b"\x00" * 8])
+
+
+def test_queue_to_dict():
+    core = _queue_core()
+    queues = core.readQueueInformation()
+    nose.tools.assert_equal(list(queues[2].to_dict()), list(QueueElement.__slots__))
+    nose.tools.assert_equal(queues[2].to_dict()["queue_buf_start"], 0x9000)
+    nose.tools.assert_equal(queues[2]["available_items"], 1)
+    nose.tools.assert_is_none(queues[2].items)
+    nose.tools.assert_raises(AttributeError, setattr, queues[2], "unknown", 1)
+
+
+def test_recorded_queue_trace():
+    # Recorded with one Read_RAM command per QUEUE struct, the read ahead no longer replays as is
+    tracepath = os.path.join(tracedir, "adbcore", "info_queue.trace.broken")
+    structs = [(address,) + struct.unpack("14I", data)
+               for address, data in read_ram_records(tracepath) if len(data) == 0x38]
+
+    core = trace_memory_core(tracepath, BCM4335C0)
+    queues = core.readQueueInformation()
+    nose.tools.assert_equal(len(queues), len(structs))
+    for queue, fields in zip(queues, structs):
+        nose.tools.assert_equal((queue.address, queue.capacity, queue.available_items, queue.free_slots,
+                                 queue.queue_buf_start), (fields[0],) + fields[4:8])
+
+    # The CLI prints the same queue table as during the recording
+    messages = cli_output(core, "info queue")
+    for queue in queues:
+        nose.tools.assert_in(
+            "QUEU[%2d] @ 0x%06X:  %-21s %2d / %2d / %2d      %2d Bytes    0x%06X" % (
+                queue.index, queue.address, queue.name, queue.available_items, queue.free_slots, queue.capacity,
+                queue.item_size, queue.queue_buf_start), messages)
@@ -0,0 +1,52 @@
+from __future__ import print_function
+from internalblue.utils.ram_allocator import RamAllocator
+
+import nose
+
+
+def test_allocate_until_full():
+    pool = RamAllocator(0xD7B00, 28 * 5)
+    hooks = [pool.allocate(28) for _ in range(5)]
+    nose.tools.assert_equal(hooks, [0xD7B00 + 28 * i for i in range(5)])
+    nose.tools.assert_is_none(pool.allocate(28))
+    nose.tools.assert_equal(pool.available, 0)
+
+
+def test_alignment():
+    pool = RamAllocator(0x1002, 0x100)
+    nose.tools.assert_equal(pool.allocate(6), 0x1004)
+    nose.tools.assert_equal(pool.allocate(1), 0x100C)
+    nose.tools.assert_equal(pool.used, 12)
+
+
+def test_free_merges_blocks():
+    pool = RamAllocator(0x1000, 0x30)
+    a = pool.allocate(0x10)
+    b = pool.allocate(0x10)
+    c = pool.allocate(0x10)
+    nose.tools.assert_true(pool.free(a))
+    nose.tools.assert_true(pool.free(c))
+    nose.tools.assert_false(pool.free(c))
+    nose.tools.assert_is_none(pool.allocate(0x20))
+    nose.tools.assert_true(pool.free(b))
+    nose.tools.assert_equal(pool.free_blocks, [(0x1000, 0x30)])
+    nose.tools.assert_equal(pool.allocate(0x30), 0x1000)
+    nose.tools.assert_in(0x1000, pool)
+
+
+def test_tracepoint_hook_pool_size():
+    # The pools of the firmwares with tracepoints fit far more hooks than the old fixed 5
+    from internalblue.fw.fw_0x4208 import CYW20735B1
+    from internalblue.fw.fw_0x420e import CYW20739B1
+    from internalblue.fw.fw_0x6109 import BCM4335C0
+    for fw in [BCM4335C0, CYW20735B1, CYW20739B1]:
+        pool = RamAllocator(fw.TRACEPOINT_HOOK_POOL_ADDRESS, fw.TRACEPOINT_HOOK_POOL_SIZE)
+        count = 0
+        while pool.allocate(fw.TRACEPOINT_HOOK_SIZE) is not None:
+            count += 1
+        nose.tools.assert_equal(count, fw.TRACEPOINT_HOOK_POOL_SIZE // fw.TRACEPOINT_HOOK_SIZE)
+        nose.tools.assert_greater(count, 5)
+        # Behind the tracepoint body, inside of a RAM section
+        nose.tools.assert_greater_equal(pool.start, fw.TRACEPOINT_BODY_ASM_LOCATION + fw.TRACEPOINT_BODY_ASM_SIZE)
+        nose.tools.assert_true(any(section.is_ram and section.start_addr <= pool.start
+                                   and pool.start + pool.size <= section.end_addr for section in fw.SECTIONS))
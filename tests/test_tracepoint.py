@@ -0,0 +1,200 @@
+from __future__ import print_function
+from internalblue.objects.tracepoint import (CaptureRange, Tracepoint, TracepointCaptures, TracepointCondition,
+                                             capture_table, condition_asm)
+from internalblue.utils.packing import p16, p32, pack_u32_array
+from internalblue.utils.ram_allocator import RamAllocator
+from internalblue import hci
+
+from memory_core import MemoryCore
+
+import nose
+import tempfile
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+def test_capture_range_parse():
+    absolute = CaptureRange.parse("0x200000:0x40")
+    nose.tools.assert_equal((absolute.address, absolute.length, absolute.stack_relative), (0x200000, 0x40, False))
+    stack = CaptureRange.parse("sp-8:32")
+    nose.tools.assert_equal((stack.address, stack.length, stack.stack_relative), (-8, 32, True))
+    nose.tools.assert_equal(stack.resolve(0x20F000), 0x20EFF8)
+    nose.tools.assert_raises(ValueError, CaptureRange.parse, "0x200000")
+    nose.tools.assert_raises(ValueError, CaptureRange.parse, "0x200000:0")
+
+
+def test_capture_table():
+    table = capture_table([CaptureRange(0x200000, 0x40), CaptureRange(-8, 0x10, stack_relative=True)])
+    nose.tools.assert_equal(
+        table,
+        p32(2, "little") + p32(0x200000, "little") + p16(0x40, "little") + p16(0, "little")
+        + p32(0xFFFFFFF8, "little") + p16(0x10, "little") + p16(1, "little"),
+    )
+
+
+def test_captures_store_deltas():
+    captures = TracepointCaptures()
+    nose.tools.assert_equal(captures.add_hit([(0x100, b"\x00" * 8), (0x200, b"ab")]), 10)
+    nose.tools.assert_equal(captures.add_hit([(0x100, b"\x00\x01\x00\x00\x00\x00\x02\x03"), (0x200, b"ab")]), 3)
+    # A new range is stored completely
+    nose.tools.assert_equal(captures.add_hit([(0x100, b"\x00\x01\x00\x00\x00\x00\x02\x03"), (0x300, b"xyz")]), 3)
+
+    nose.tools.assert_equal(captures.hits[1], [(0x100, 8, [(1, b"\x01"), (6, b"\x02\x03")]), (0x200, 2, [])])
+    nose.tools.assert_equal(captures.hit(0), [(0x100, b"\x00" * 8), (0x200, b"ab")])
+    nose.tools.assert_equal(captures.hit(1), [(0x100, b"\x00\x01\x00\x00\x00\x00\x02\x03"), (0x200, b"ab")])
+    nose.tools.assert_equal(captures.hit(-1), [(0x100, b"\x00\x01\x00\x00\x00\x00\x02\x03"), (0x300, b"xyz")])
+
+
+def test_condition_parse():
+    nose.tools.assert_equal(repr(TracepointCondition.parse("r0==0x5")), "r0==0x5")
+    nose.tools.assert_equal(repr(TracepointCondition.parse("LR != 0x1234")), "lr!=0x1234")
+    nose.tools.assert_equal(repr(TracepointCondition.parse("hits==10")), "hits==10")
+    nose.tools.assert_equal(repr(TracepointCondition.parse("[0x200000]>=2")), "u32[0x200000]>=0x2")
+    nose.tools.assert_equal(repr(TracepointCondition.parse("u8[r1+4]!=0")), "u8[r1+4]!=0x0")
+    nose.tools.assert_equal(repr(TracepointCondition.parse("u16[sp-0x10]<3")), "u16[sp-16]<0x3")
+    nose.tools.assert_equal(TracepointCondition.parse("r3==-1").value, 0xFFFFFFFF)
+    for spec in ["r0", "pc==1", "r0=1", "hits>3", "hits==0", "[]==1", "u64[0x1000]==1"]:
+        nose.tools.assert_raises(ValueError, TracepointCondition.parse, spec)
+
+
+def test_condition_asm():
+    nose.tools.assert_equal(condition_asm([], 0x1234), ("", ""))
+
+    condition, skip = condition_asm(
+        [TracepointCondition.hit_count(3), TracepointCondition.parse("r2>0x10"), TracepointCondition.parse("u8[sp+4]==1")],
+        0x1234, b"\x01\x30\x02\x31", counter_address=0xD7E00,
+    )
+    lines = [line.strip() for line in condition.splitlines()]
+    # flags are saved and restored around the comparisons
+    nose.tools.assert_equal(lines[0], "mrs  r4, cpsr")
+    nose.tools.assert_equal(lines[-1], "msr  cpsr_f, r4")
+    # saved r2 is the third register on the stack, sp of the tracepoint is above the 14 saved registers
+    nose.tools.assert_in("ldr  r0, [sp, 8]", lines)
+    nose.tools.assert_in("add  r0, sp, 56", lines)
+    nose.tools.assert_in("ldrb  r0, [r0]", lines)
+    nose.tools.assert_equal([line for line in lines if line.endswith("tracepoint_skip")],
+                            ["bls  tracepoint_skip", "bne  tracepoint_skip", "bne  tracepoint_skip"])
+    # the counter is evaluated last, so it only counts hits that passed the other conditions
+    nose.tools.assert_greater(lines.index("ldr  r0, =0xd7e00"), lines.index("ldrb  r0, [r0]"))
+    # a skipped hit runs the original instructions and continues after them,
+    # branching back to 0x1234 would hit the hook again
+    nose.tools.assert_equal([line.strip() for line in skip.splitlines()],
+                            ["tracepoint_skip:", "msr  cpsr_f, r4", "pop  {r0-r12, lr}",
+                             ".hword 0x3001", ".hword 0x3102", "b 0x1238"])
+    nose.tools.assert_raises(ValueError, condition_asm, [TracepointCondition.parse("r0==1")], 0x1234)
+
+
+def test_hook_templates_format():
+    from internalblue.fw.fw_0x6109 import BCM4335C0
+    from internalblue.fw.fw_0x4208 import CYW20735B1
+    for fw in [BCM4335C0, CYW20735B1]:
+        condition, skip = condition_asm([TracepointCondition.parse("r0==1")], 0x1234, b"\x01\x30\x02\x31")
+        hook = fw.TRACEPOINT_HOOK_ASM % {"address": 0x1234, "slot": 3, "body": fw.TRACEPOINT_BODY_ASM_LOCATION,
+                                         "capture": 0, "condition": condition, "condition_skip": skip}
+        nose.tools.assert_in("tracepoint_skip:", hook)
+        nose.tools.assert_less(hook.index("cmp  r0, r1"), hook.index("ldr  r6, =0x1234"))
+
+
+def _event(data):
+    event = hci.HCI_Event(0xFF, len(data), data)
+    return (event, 0, 0, 0, False, None)
+
+
+def _trace_event(pc, sp):
+    # pc, sp, cpsr, r0-r12, lr
+    return _event(b"TRACE_" + pack_u32_array([pc, sp, 0x60000000] + list(range(13)) + [0x1235]))
+
+
+def _capture_event(address, data):
+    return _event(b"CAPT__" + p32(address, "little") + p16(len(data), "little") + data)
+
+
+def _core_with_tracepoint(capture):
+    core = MemoryCore()
+    core.data_directory = tempfile.mkdtemp()
+    core.tracepoint_hook_pool = RamAllocator(0x8000, 0x100)
+    hook_address = core.tracepoint_hook_pool.allocate(40)
+    capture_address = core.tracepoint_hook_pool.allocate(len(capture_table(capture)))
+    core.tracepoints.append(Tracepoint(0x1234, hook_address, core.allocatePatchramSlot(0x1234),
+                                       capture, capture_address))
+    return core
+
+
+def test_tracepoint_capture_chunks():
+    core = _core_with_tracepoint([CaptureRange(-8, 300, stack_relative=True), CaptureRange(0x200000, 4)])
+    stack = bytes(range(256)) + bytes(44)
+
+    core._tracepointHciCallbackFunction(_trace_event(0x1234, 0x20F008))
+    nose.tools.assert_equal(core.tracepoints, [])
+    nose.tools.assert_equal(core.reserved_patchram_slots, set())
+    # the body still reads the capture table while it sends the ranges
+    used = core.tracepoint_hook_pool.used
+    nose.tools.assert_not_equal(used, 0)
+
+    core._tracepointHciCallbackFunction(_capture_event(0x20F000, stack[:236]))
+    core._tracepointHciCallbackFunction(_capture_event(0x20F000 + 236, stack[236:]))
+    nose.tools.assert_not_in(0x1234, core.tracepoint_captures)
+    nose.tools.assert_equal(core.tracepoint_hook_pool.used, used)
+    core._tracepointHciCallbackFunction(_capture_event(0x200000, b"\xde\xad\xbe\xef"))
+    nose.tools.assert_equal(core.tracepoint_hook_pool.used, 0)
+
+    captures = core.tracepoint_captures[0x1234]
+    nose.tools.assert_equal(captures.hit(0), [(0x20F000, stack), (0x200000, b"\xde\xad\xbe\xef")])
+    nose.tools.assert_is_none(core.tracepoint_capture_pending)
+
+    # The hit is logged with its captures once they are complete
+    log = core.getTracepointLog()
+    nose.tools.assert_equal(len(log), 1)
+    nose.tools.assert_equal(log[0].captures, captures.hit(0))
+    nose.tools.assert_equal(log[0].register("lr"), 0x1235)
+
+
+def test_tracepoint_capture_lost_packet():
+    core = _core_with_tracepoint([CaptureRange(0x200000, 300)])
+    core._tracepointHciCallbackFunction(_trace_event(0x1234, 0x20F008))
+    core._tracepointHciCallbackFunction(_capture_event(0x200000 + 236, bytes(64)))
+    nose.tools.assert_is_none(core.tracepoint_capture_pending)
+    nose.tools.assert_not_in(0x1234, core.tracepoint_captures)
+    nose.tools.assert_equal(core.getTracepointLog()[0].captures, [])
+    nose.tools.assert_equal(core.tracepoint_hook_pool.used, 0)
+
+
+def test_tracepoint_capture_never_completes():
+    core = _core_with_tracepoint([CaptureRange(0x200000, 300)])
+    core._tracepointHciCallbackFunction(_trace_event(0x1234, 0x20F008))
+    nose.tools.assert_not_equal(core.tracepoint_hook_pool.used, 0)
+    # the next hit gives up the pending capture and frees its RAM
+    core._tracepointHciCallbackFunction(_trace_event(0x5678, 0x20F008))
+    nose.tools.assert_is_none(core.tracepoint_capture_pending)
+    nose.tools.assert_equal(core.tracepoint_hook_pool.used, 0)
+
+
+def test_delete_tracepoint_after_slot_is_disabled():
+    core = _core_with_tracepoint([])
+    tp = core.tracepoints[0]
+    nose.tools.assert_true(core.patchRom(0x1234, b"\x00\xbf\x00\xbf", tp.patchram_slot))
+    used = core.tracepoint_hook_pool.used
+
+    # the slot stays enabled, so the chip can still branch to the hook
+    core.failing_writes = [(core.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS, core.fw.PATCHRAM_ENABLED_BITMAP_ADDRESS + 0x10)]
+    nose.tools.assert_false(core.deleteTracepoint(0x1234))
+    nose.tools.assert_equal(core.tracepoints, [tp])
+    nose.tools.assert_equal(core.tracepoint_hook_pool.used, used)
+
+    core.failing_writes = []
+    nose.tools.assert_true(core.deleteTracepoint(0x1234))
+    nose.tools.assert_equal(core.tracepoints, [])
+    nose.tools.assert_equal(core.tracepoint_hook_pool.used, 0)
+
+
+def test_tracepoint_registers_only():
+    core = _core_with_tracepoint([])
+    core.session_patches[0x1234] = b"\x00\xbf\x00\xbf"
+    core._tracepointHciCallbackFunction(_trace_event(0x1234, 0x20F008))
+    nose.tools.assert_equal(len(core.tracepoint_captures[0x1234]), 1)
+    # the hook disabled its slot
+    nose.tools.assert_not_in(0x1234, core.session_patches)
+    nose.tools.assert_equal(core.tracepoint_registers[0], 0x1234)
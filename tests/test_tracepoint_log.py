@@ -0,0 +1,115 @@
+from __future__ import print_function
+from internalblue.utils.tracepoint_log import TracepointHit, TracepointLog
+
+import nose
+import os
+import tempfile
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+def _registers(pc, r0):
+    # pc, sp, cpsr, r0-r12, lr
+    return [pc, 0x20F000, 0x60000000, r0] + list(range(1, 13)) + [0x1235]
+
+
+def _log():
+    return TracepointLog(os.path.join(tempfile.mkdtemp(), "hits"))
+
+
+def test_append_and_read():
+    log = _log()
+    log.append(TracepointHit(1.5, _registers(0x1000, 1)))
+    log.append(TracepointHit(2.5, _registers(0x2000, 2), [(0x200000, b"abcd"), (0x20F000, b"")]))
+    nose.tools.assert_equal(len(log), 2)
+
+    hit = log[1]
+    nose.tools.assert_equal(hit.timestamp, 2.5)
+    nose.tools.assert_equal(hit.pc, 0x2000)
+    nose.tools.assert_equal(hit.register("r0"), 2)
+    nose.tools.assert_equal(hit.register("lr"), 0x1235)
+    nose.tools.assert_equal(hit.captures, [(0x200000, b"abcd"), (0x20F000, b"")])
+    nose.tools.assert_equal([hit.timestamp for hit in log.hits(pc=0x1000)], [1.5])
+
+
+def test_queries():
+    log = _log()
+    for i in range(10):
+        log.append(TracepointHit(float(i), _registers(0x1000 if i % 3 else 0x2000, i % 2)))
+    nose.tools.assert_equal(log.hit_counts(), {0x1000: 6, 0x2000: 4})
+    nose.tools.assert_equal(log.register_histogram("r0"), {0: 5, 1: 5})
+    nose.tools.assert_equal(log.register_histogram("r0", pc=0x2000), {0: 2, 1: 2})
+    nose.tools.assert_raises(ValueError, log.register_histogram, "r42")
+
+
+def test_reopen_and_recover_index():
+    path = os.path.join(tempfile.mkdtemp(), "hits")
+    log = TracepointLog(path)
+    log.append(TracepointHit(1.0, _registers(0x1000, 1)))
+    log.append(TracepointHit(2.0, _registers(0x2000, 2), [(0x200000, b"abcd")]))
+    log.close()
+
+    # Appending continues after the existing hits
+    log = TracepointLog(path)
+    log.append(TracepointHit(3.0, _registers(0x3000, 3)))
+    log.close()
+
+    # Lose the index and cut the last record in half
+    os.remove(path + ".idx")
+    with open(path + ".hits", "rb+") as f:
+        f.truncate(os.path.getsize(path + ".hits") - 10)
+    log = TracepointLog(path)
+    nose.tools.assert_equal([hit.pc for hit in log.hits()], [0x1000, 0x2000])
+    nose.tools.assert_equal(log[1].captures, [(0x200000, b"abcd")])
+
+    # The partial record was cut off, new records can be recovered again
+    log.append(TracepointHit(4.0, _registers(0x4000, 4)))
+    log.close()
+    os.remove(path + ".idx")
+    log = TracepointLog(path)
+    nose.tools.assert_equal([hit.pc for hit in log.hits()], [0x1000, 0x2000, 0x4000])
+    log.close()
+
+
+def test_reopen_with_stale_index():
+    path = os.path.join(tempfile.mkdtemp(), "hits")
+    log = TracepointLog(path)
+    log.append(TracepointHit(1.0, _registers(0x1000, 1)))
+    log.append(TracepointHit(2.0, _registers(0x2000, 2)))
+    log.close()
+
+    # The index (with half an entry) still lists the record that was cut in half
+    with open(path + ".idx", "ab") as f:
+        f.write(b"\x01\x02")
+    with open(path + ".hits", "rb+") as f:
+        f.truncate(os.path.getsize(path + ".hits") - 10)
+    log = TracepointLog(path)
+    nose.tools.assert_equal([hit.pc for hit in log.hits()], [0x1000])
+    log.append(TracepointHit(3.0, _registers(0x3000, 3)))
+    log.close()
+    log = TracepointLog(path)
+    nose.tools.assert_equal([hit.pc for hit in log.hits()], [0x1000, 0x3000])
+
+
+def test_not_a_log():
+    path = os.path.join(tempfile.mkdtemp(), "hits")
+    with open(path + ".hits", "wb") as f:
+        f.write(b"something else")
+    nose.tools.assert_raises(ValueError, TracepointLog, path)
+
+
+def test_to_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise nose.SkipTest("numpy is not installed")
+    log = _log()
+    log.append(TracepointHit(1.0, _registers(0x1000, 7)))
+    log.append(TracepointHit(2.0, _registers(0x2000, 8), [(0x200000, b"abcd")]))
+    arrays = log.to_numpy()
+    nose.tools.assert_equal(list(arrays["timestamp"]), [1.0, 2.0])
+    nose.tools.assert_equal(arrays["registers"].shape, (2, 17))
+    nose.tools.assert_equal(list(arrays["registers"][:, 3]), [7, 8])
@@ -0,0 +1,81 @@
+from __future__ import print_function
+import argparse
+import logging
+import os
+import re
+import tempfile
+
+from internalblue.cli import InternalBlueCLI
+
+from memory_core import MemoryCore
+
+try:
+    from typing import List, Optional, Any, TYPE_CHECKING, Tuple
+except ImportError:
+    pass
+
+
+READ_RAM_COMMAND = re.compile(b"\x4d\xfc\x05(.{5})", re.DOTALL)
+READ_RAM_COMPLETE = re.compile(b"\x04\x0e(.)\x01\x4d\xfc\x00", re.DOTALL)
+
+
+tracedir = os.path.join(os.path.dirname(__file__), "traces")
+
+
+def read_ram_records(tracepath):
+    # type: (str) -> List[Tuple[int, bytes]]
+    """
+    Returns the address and the returned data of every Read_RAM command in
+    a replay trace, in the order they were sent. The RX lines of the adbcore
+    traces are chunks of a btsnoop stream, so all RX data is joined before
+    the Command Complete events are searched.
+    """
+    requests = []
+    rx = bytearray()
+    with open(tracepath) as f:
+        for line in f:
+            if line.startswith("TX "):
+                for match in READ_RAM_COMMAND.finditer(bytes.fromhex(line[3:].strip())):
+                    requests.append(int.from_bytes(match.group(1)[:4], "little"))
+            elif line.startswith("RX "):
+                rx += bytes.fromhex(line[3:].strip())
+
+    responses = []
+    for match in READ_RAM_COMPLETE.finditer(bytes(rx)):
+        length = match.group(1)[0] - 4
+        responses.append(bytes(rx[match.end():match.end() + length]))
+
+    assert len(requests) == len(responses), "%d Read_RAM commands but %d responses" % (
+        len(requests), len(responses))
+    return list(zip(requests, responses))
+
+
+def trace_memory_core(tracepath, fw, size=0x320000):
+    # type: (str, Any, int) -> MemoryCore
+    """
+    Creates a MemoryCore for the firmware fw which holds the memory that was
+    read from the chip while the trace was recorded. Commands whose Read_RAM
+    pattern changed since then can still be checked against the recorded memory.
+    """
+    core = MemoryCore(size=size, fw=fw)
+    for address, data in read_ram_records(tracepath):
+        core.memory[address:address + len(data)] = data
+    return core
+
+
+def cli_output(core, command):
+    # type: (MemoryCore, str) -> List[str]
+    """ Runs a CLI command on the core and returns the messages it logged. """
+    # The history file is written when the interpreter exits, so the directory is kept
+    main_args = argparse.Namespace(data_directory=tempfile.mkdtemp(), verbose=False, trace=None, save=None,
+                                   device=None, replay=None)
+    cli = InternalBlueCLI(main_args, core=core)
+    messages = []  # type: List[str]
+    handler = logging.Handler()
+    handler.emit = lambda record: messages.append(record.getMessage())
+    core.logger.addHandler(handler)
+    try:
+        cli.onecmd_plus_hooks(command)
+    finally:
+        core.logger.removeHandler(handler)
+    return messages